@@ -1,26 +1,26 @@
 # Python API for crypto-drive-manager.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: January 18, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-crypto-drive-manager
 
-"""Python API for `crypto-drive-manager`."""
+"""
+Python API for `crypto-drive-manager`.
+
+This module is imported by every entry point of `crypto-drive-manager`,
+including the ``systemd-cryptsetup-generator`` wrapper that runs during
+early boot, so dependencies other than the ones needed to define the
+module are imported by the functions that use them.
+"""
 
 # Standard library modules.
 import enum
 import os
+import time
 
 # External dependencies.
-from executor import execute
-from humanfriendly import Timer, compact, concatenate, pluralize
-from linux_utils.crypttab import parse_crypttab
-from linux_utils.fstab import find_mounted_filesystems
-from linux_utils.luks import cryptdisks_start
 from verboselogs import VerboseLogger
 
-# Modules included in our package.
-from crypto_drive_manager.systemd import have_systemd_dependencies
-
 __version__ = '3.0'
 """Semi-standard module versioning."""
 
@@ -28,7 +28,10 @@ __version__ = '3.0'
 logger = VerboseLogger(__name__)
 
 
-def initialize_keys_device(image_file, mapper_name, mount_point, volumes=(), cleanup=None):
+def initialize_keys_device(image_file, mapper_name, mount_point, volumes=(), cleanup=None,
+                           concurrency=1, pipeline=False, fast_keyslots=False, key_cache=None,
+                           wait_for_devices=None, events=None, store_format=None, coordinator=None,
+                           metrics=None, state=None):
     """
     Initialize and activate the virtual keys device and use it to activate encrypted volumes.
 
@@ -48,144 +51,592 @@ def initialize_keys_device(image_file, mapper_name, mount_point, volumes=(), cle
                     :data:`None` to automatically figure out what the best
                     choice is (this is the default). See also
                     :func:`.have_systemd_dependencies()`.
+    :param concurrency: The maximum number of encrypted drives to activate
+                        in parallel (an integer, defaults to 1). When this is
+                        one the drives are activated one by one in the current
+                        thread, otherwise a pool of worker threads is used
+                        (most of the time is spent waiting for ``cryptsetup``
+                        and ``mount`` so threads are good enough).
+    :param pipeline: :data:`True` to read the keys of the selected drives
+                     into memory and lock the virtual keys device before the
+                     drives are unlocked, :data:`False` to keep the virtual
+                     keys device unlocked until all drives have been
+                     activated (this is the default).
+    :param fast_keyslots: :data:`True` to install new key files in key slots
+                          that use minimal PBKDF parameters (see
+                          :mod:`crypto_drive_manager.keyslots`),
+                          :data:`False` to use the defaults of
+                          ``cryptsetup`` (this is the default).
+    :param key_cache: A :class:`.KeyCache` object (e.g. a :class:`.KernelKeyring`)
+                      or :data:`None` (the default) to disable caching of keys.
+    :param wait_for_devices: The number of seconds to wait for selected drives
+                             that aren't available yet (a number) or
+                             :data:`None` (the default) to skip those drives.
+    :param events: The event source used to wait for devices (see
+                   :func:`.PlanExecutor.wait_for_drives()`, the default
+                   uses :class:`.InotifyEventSource`).
+    :param store_format: ``ext4`` to store the key files in an ext4 filesystem
+                         on the virtual keys device, ``raw`` to use a key
+                         store without a filesystem (see
+                         :mod:`crypto_drive_manager.keystore`) or
+                         :data:`None` (the default) to use the format of the
+                         existing virtual keys device (``ext4`` on the first
+                         run). When ``raw`` is given and the virtual keys
+                         device contains an ext4 filesystem the key files are
+                         migrated to a key store (see :func:`KeysDevice.migrate()`).
+    :param coordinator: A :class:`.RunCoordinator` object whose :keyword:`with`
+                        statement has started (before `state` was used) or
+                        :data:`None` (the default) to skip coordination
+                        with concurrent runs.
+    :param metrics: A :class:`.RunMetrics` object that's updated with the
+                    results of the run (before :exc:`ActivationFailed` is
+                    raised) or :data:`None` (the default).
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
+                  External commands are run using the execution context of
+                  this object (see :attr:`.SystemState.context`).
+    :raises: :exc:`ActivationFailed` when one or more of the selected
+             encrypted drives couldn't be activated.
+
+    The required actions are decided up front (see :func:`.create_plan()`)
+    and carried out one group of similar actions at a time (see
+    :class:`.PlanExecutor`). When all selected drives are already unlocked
+    the virtual keys device isn't unlocked at all.
+
+    In pipeline mode the time during which the virtual keys device is
+    accessible no longer depends on how long it takes to unlock and mount
+    the drives: The keys are read in one pass (see :func:`.PlanExecutor.load_keys()`),
+    the virtual keys device is unmounted and locked in a background thread
+    and meanwhile the drives are unlocked by feeding their keys to
+    ``cryptsetup open`` (see :func:`unlock_with_key()`).
+
+    When a key cache is given the drives whose keys are cached are unlocked
+    first (see :func:`.PlanExecutor.unlock_cached_drives()`). The virtual
+    keys device is only unlocked when some drives are left (cache misses),
+    in which case the keys of those drives are loaded and added to the cache
+    for the next run.
+
+    When `wait_for_devices` is given the drives that aren't available are
+    activated as soon as they appear (one overall deadline applies to all of
+    them, it starts once the virtual keys device has been unlocked so that
+    the time spent entering the passphrase doesn't count). In this case the
+    virtual keys device stays unlocked until all drives have appeared or the
+    deadline expires, even in pipeline mode.
+
+    When the virtual keys device contains a key store the keys are always
+    loaded into memory and the drives are unlocked using :func:`unlock_with_key()`,
+    because ``cryptdisks_start`` expects to find the key files.
+
+    When a coordinator is given the results of a concurrent run that we had to
+    wait for are reused (see :func:`.RunCoordinator.reuse_results()`) and the
+    virtual keys device is left unlocked when other runs are waiting for us
+    (see :func:`.RunCoordinator.keep_keys_device()`).
     """
-    first_run = not os.path.isfile(image_file)
-    initialized = not first_run
-    mapper_device = '/dev/mapper/%s' % mapper_name
-    if cleanup is None:
-        # Figure out whether it's safe to unmount and lock
-        # the virtual keys device after we're done.
-        if have_systemd_dependencies(mount_point):
-            logger.notice(compact("""
-                The virtual keys device will remain unlocked because
-                you're running systemd and you appear to be affected
-                by https://github.com/systemd/systemd/issues/3816.
-            """))
-            cleanup = False
-        else:
-            logger.verbose(compact("""
-                Locking virtual keys device after use (this should be
-                safe to do because it appears that you're not affected
-                by https://github.com/systemd/systemd/issues/3816).
-            """))
-            cleanup = True
+    from concurrent.futures import ThreadPoolExecutor
+    from crypto_drive_manager.plan import Action, PlanExecutor, create_plan
+    keys = {}
+    state = coerce_state(state)
+    if volumes:
+        from humanfriendly import concatenate
+        logger.verbose("Unlocking encrypted devices matching filter: %s", concatenate(map(repr, volumes)))
+    else:
+        logger.verbose("Unlocking all configured and available encrypted devices ..")
+    plan = create_plan(mount_point, volumes, first_run=not os.path.isfile(image_file), state=state)
+    executor = PlanExecutor(plan, fast_keyslots=fast_keyslots, concurrency=concurrency, state=state)
+    waiting = plan.find(Action.SKIP_UNAVAILABLE) if wait_for_devices else []
+    used_keys_device = False
+    if coordinator is not None:
+        coordinator.reuse_results(plan, executor.results)
     try:
-        # Create the virtual keys device (on the first run).
-        if first_run:
-            logger.info("Creating virtual keys device %s ..", image_file)
-            execute('dd', 'if=/dev/zero', 'of=%s' % image_file, 'bs=%i' % (1024 * 1024), 'count=10')
-            execute('cryptsetup', 'luksFormat', image_file)
-        # Unlock the keys device.
-        if not os.path.exists(mapper_device):
-            logger.info("Unlocking virtual keys device %s ..", image_file)
-            execute('cryptsetup', 'luksOpen', image_file, mapper_name)
-        unlocked_timer = Timer()
-        with finalizer('cryptsetup', 'luksClose', mapper_name, enabled=cleanup):
-            # Create a file system on the virtual keys device (on the first run).
-            if first_run:
-                logger.info("Creating file system on virtual keys device ..")
-                execute('mkfs.ext4', mapper_device)
-                initialized = True
-            # Mount the virtual keys device.
-            if not os.path.isdir(mount_point):
-                os.makedirs(mount_point)
-            if os.path.ismount(mount_point):
-                logger.info("The virtual keys device is already mounted ..")
-            else:
-                logger.info("Mounting the virtual keys device ..")
-                execute('mount', mapper_device, mount_point)
-            with finalizer('umount', mount_point, enabled=cleanup):
-                os.chmod(mount_point, 0o700)
-                if volumes:
-                    logger.verbose("Unlocking encrypted devices matching filter: %s", concatenate(map(repr, volumes)))
+        if key_cache is not None and not plan.first_run:
+            with state.phase('unlock-cached'):
+                executor.unlock_cached_drives(key_cache)
+        if not (plan.needs_keys or waiting):
+            logger.verbose("All selected drives are unlocked, no need to unlock virtual keys device.")
+            with state.phase('activate-drives'):
+                executor.mount_drives()
+        else:
+            used_keys_device = True
+            keys_device = KeysDevice(image_file, mapper_name, mount_point, cleanup, store_format, coordinator, state)
+            with keys_device:
+                deadline = time.time() + (wait_for_devices or 0)
+                # Now that the key files are accessible we can check which are missing.
+                executor.key_store = keys_device.key_store
+                plan.check_key_files(keys_device.key_store)
+                with state.phase('install-keys'):
+                    executor.install_keys()
+                if pipeline or key_cache is not None or not keys_device.key_store.has_files:
+                    with state.phase('load-keys'):
+                        keys = executor.load_keys()
+                    if key_cache is not None:
+                        executor.cache_keys(key_cache, keys)
+                if pipeline and not waiting:
+                    # Lock the virtual keys device while the drives are unlocked.
+                    with ThreadPoolExecutor(max_workers=1) as pool:
+                        teardown = pool.submit(keys_device.lock)
+                        with state.phase('activate-drives'):
+                            executor.unlock_drives(keys)
+                            executor.mount_drives()
+                        # Propagate failures to lock the virtual keys device.
+                        teardown.result()
                 else:
-                    logger.verbose("Unlocking all configured and available encrypted devices ..")
-                # Create, install and use the keys to unlock the drives.
-                num_configured = 0
-                num_available = 0
-                num_unlocked = 0
-                for device in find_managed_drives(mount_point):
-                    if volumes and device.target not in volumes:
-                        logger.verbose("Ignoring %s because it doesn't match the filter.", device.target)
-                    elif device.is_available:
-                        status = activate_encrypted_drive(
-                            mapper_name=device.target,
+                    with state.phase('activate-drives'):
+                        executor.unlock_drives(keys if pipeline or not keys_device.key_store.has_files else None)
+                        executor.mount_drives()
+                    if waiting:
+                        with state.phase('wait-for-devices'):
+                            executor.wait_for_drives(waiting, deadline, events, key_cache)
+    finally:
+        for key in keys.values():
+            key.wipe()
+    if coordinator is not None:
+        if coordinator.inherited_keys_device and not used_keys_device and not coordinator.keep_keys_device():
+            # We're the last of the concurrent runs, so it's up to us.
+            from crypto_drive_manager.teardown import lock_keys_device
+            lock_keys_device(mapper_name, mount_point, state)
+        coordinator.record_results(executor.results)
+    if metrics is not None:
+        metrics.update(plan, executor.results)
+    report_results(executor.results, plan.num_configured, len(plan.available_drives))
+
+
+def migrate_key_slots(image_file, mapper_name, mount_point, volumes=(), cleanup=None, concurrency=1,
+                      coordinator=None, state=None):
+    """
+    Move the key files of managed drives to key slots with minimal PBKDF parameters.
+
+    :param image_file: See :func:`initialize_keys_device()`.
+    :param mapper_name: See :func:`initialize_keys_device()`.
+    :param mount_point: See :func:`initialize_keys_device()`.
+    :param volumes: See :func:`initialize_keys_device()`.
+    :param cleanup: See :func:`initialize_keys_device()`.
+    :param concurrency: The maximum number of drives to migrate in parallel
+                        (an integer, defaults to 1).
+    :param coordinator: See :func:`initialize_keys_device()`.
+    :param state: A :class:`.SystemState` object (optional).
+    :returns: An :class:`ActivationResults` object whose values are
+              :class:`.KeySlotMigration` objects.
+
+    Drives don't need to be unlocked to migrate their key slots, refer to
+    :func:`.migrate_key_slot()` for details about how the migration works.
+    Failures are logged and collected in :attr:`ActivationResults.failures`.
+    """
+    from crypto_drive_manager.keyslots import migrate_key_slot
+    results = ActivationResults()
+    state = coerce_state(state)
+    with KeysDevice(image_file, mapper_name, mount_point, cleanup, coordinator=coordinator, state=state) as keys_device:
+        num_configured, selected_drives = select_managed_drives(mount_point, volumes, state)
+
+        def migrate(device):
+            try:
+                with state.phase('migrate-key-slot', drive=device.target):
+                    with keys_device.key_store.key_file(device.target) as key_file:
+                        results[device.target] = migrate_key_slot(
                             physical_device=device.source_device,
-                            keys_directory=mount_point,
-                            reset=first_run,
+                            key_file=key_file,
+                            key_slot=find_key_slot_option(device.options),
+                            context=state.context,
                         )
-                        if status & DriveStatus.UNLOCKED:
-                            num_unlocked += 1
-                        num_available += 1
-                    num_configured += 1
-                if num_unlocked > 0:
-                    logger.success("Unlocked %s.", pluralize(num_unlocked, "encrypted device"))
-                elif num_available > 0:
-                    logger.info("Nothing to do! (%s already unlocked)", pluralize(num_available, "encrypted device"))
-                elif num_configured > 0:
-                    logger.info("Nothing to do! (no encrypted devices available)")
-                else:
-                    logger.info("Nothing to do! (no encrypted drives configured)")
-        if cleanup:
-            logger.verbose("Virtual keys device was accessible for %s.", unlocked_timer)
-    finally:
-        if not initialized:
-            logger.warning("Initialization procedure was interrupted, deleting %s ..", image_file)
-            if os.path.isfile(image_file):
-                os.unlink(image_file)
+            except Exception as e:
+                logger.error("Failed to migrate key slot of encrypted drive %s! (%s)", device.target, e)
+                results.failures[device.target] = e
+
+        map_drives(migrate, selected_drives, concurrency, "Migrating key slots of %s")
+    return results
+
+
+def rotate_keys(image_file, mapper_name, mount_point, volumes=(), cleanup=None, concurrency=1,
+                fast_keyslots=False, coordinator=None, state=None):
+    """
+    Replace the keys of managed drives (resuming interrupted rotations).
 
+    :param image_file: See :func:`initialize_keys_device()`.
+    :param mapper_name: See :func:`initialize_keys_device()`.
+    :param mount_point: See :func:`initialize_keys_device()`.
+    :param volumes: See :func:`initialize_keys_device()`.
+    :param cleanup: See :func:`initialize_keys_device()`.
+    :param concurrency: The maximum number of drives whose keys are rotated
+                        in parallel (an integer, defaults to 1).
+    :param fast_keyslots: See :func:`initialize_keys_device()`.
+    :param coordinator: See :func:`initialize_keys_device()`.
+    :param state: A :class:`.SystemState` object (optional).
+    :returns: An :class:`ActivationResults` object whose values are
+              :class:`.KeyRotation` objects.
+    :raises: :exc:`~exceptions.ValueError` when the virtual keys device
+             doesn't exist yet.
 
-def activate_encrypted_drive(mapper_name, physical_device, keys_directory, reset=False):
+    Drives don't need to be unlocked to rotate their keys, refer to
+    :mod:`crypto_drive_manager.rotation` for details about how the rotation
+    works. Rotations that were interrupted are resumed first. Failures are
+    logged and collected in :attr:`ActivationResults.failures`.
+    """
+    import threading
+    from humanfriendly import Timer, format_timespan, pluralize
+    from crypto_drive_manager.rotation import RotationJournal, rotate_key
+    if not os.path.isfile(image_file):
+        raise ValueError("The virtual keys device %s doesn't exist yet!" % image_file)
+    results = ActivationResults()
+    state = coerce_state(state)
+    with KeysDevice(image_file, mapper_name, mount_point, cleanup, coordinator=coordinator, state=state) as keys_device:
+        key_store = keys_device.key_store
+        journal = RotationJournal(key_store)
+        num_configured, selected_drives = select_managed_drives(mount_point, volumes, state)
+        interrupted = set(journal.names())
+        selected_names = set(d.target for d in selected_drives)
+        for name in sorted(interrupted - selected_names):
+            logger.warning("Rotation of key %s was interrupted but the drive isn't selected or available!", name)
+        drives = []
+        for device in selected_drives:
+            if device.target in interrupted or key_store.exists(device.target):
+                drives.append(device)
+            else:
+                logger.warning("Not rotating key of %s because it hasn't been initialized yet.", device.target)
+        # Resume interrupted rotations first.
+        drives.sort(key=lambda d: d.target not in interrupted)
+        if interrupted & selected_names:
+            logger.info("Resuming interrupted rotation of %s ..",
+                        pluralize(len(interrupted & selected_names), "key"))
+        progress = dict(lock=threading.Lock(), done=0)
+        timer = Timer()
+
+        def rotate(device):
+            try:
+                with state.phase('rotate-key', drive=device.target):
+                    results[device.target] = rotate_key(
+                        physical_device=device.source_device,
+                        name=device.target,
+                        key_store=key_store,
+                        journal=journal,
+                        fast=fast_keyslots,
+                        key_slot=find_key_slot_option(device.options),
+                        context=state.context,
+                    )
+            except Exception as e:
+                logger.error("Failed to rotate key of encrypted drive %s! (%s)", device.target, e)
+                results.failures[device.target] = e
+            with progress['lock']:
+                progress['done'] += 1
+                if device.target in results:
+                    logger.info("Rotated key of %s in %s (%i/%i drives done, %s elapsed).",
+                                device.target, format_timespan(results[device.target].duration),
+                                progress['done'], len(drives), timer)
+
+        map_drives(rotate, drives, concurrency, "Rotating keys of %s")
+    return results
+
+
+def verify_keys(image_file, mapper_name, mount_point, volumes=(), cleanup=None, concurrency=None,
+                memory_budget=None, cache_file=None, coordinator=None, state=None):
+    """
+    Check that the keys of managed drives unlock the drives (without activating them).
+
+    :param image_file: See :func:`initialize_keys_device()`.
+    :param mapper_name: See :func:`initialize_keys_device()`.
+    :param mount_point: See :func:`initialize_keys_device()`.
+    :param volumes: See :func:`initialize_keys_device()`.
+    :param cleanup: See :func:`initialize_keys_device()`.
+    :param concurrency: The maximum number of drives to check in parallel (an
+                        integer, defaults to the number of CPUs).
+    :param memory_budget: The amount of memory in bytes that concurrent
+                          checks may use for key derivation (an integer,
+                          defaults to :func:`.default_memory_budget()`).
+    :param cache_file: The pathname of the cache file (a string, defaults
+                       to :data:`.DEFAULT_CACHE_FILE`).
+    :param coordinator: See :func:`initialize_keys_device()`.
+    :param state: A :class:`.SystemState` object (optional).
+    :returns: An :class:`ActivationResults` object whose values are
+              :class:`.VerificationResult` objects.
+    :raises: :exc:`~exceptions.ValueError` when the virtual keys device
+             doesn't exist yet.
+
+    Refer to :func:`.verify_key()` for details about how the keys are
+    checked. The key slot given by the ``key-slot`` option in
+    ``/etc/crypttab`` (if any) is the only key slot that's tested, because
+    that's the key slot that will be used at boot. Unexpected errors are
+    logged and collected in :attr:`ActivationResults.failures`.
+    """
+    from crypto_drive_manager.state import is_local_context
+    from crypto_drive_manager.verification import (
+        DEFAULT_CACHE_FILE,
+        ResourceBudget,
+        VerificationCache,
+        VerificationResult,
+        default_memory_budget,
+        verify_key,
+    )
+    if not os.path.isfile(image_file):
+        raise ValueError("The virtual keys device %s doesn't exist yet!" % image_file)
+    results = ActivationResults()
+    state = coerce_state(state)
+    cpu_count = state.context.cpu_count
+    if memory_budget is None and is_local_context(state.context):
+        memory_budget = default_memory_budget()
+    budget = ResourceBudget(cpu_count, memory_budget)
+    cache = VerificationCache(cache_file or DEFAULT_CACHE_FILE)
+    with KeysDevice(image_file, mapper_name, mount_point, cleanup, coordinator=coordinator, state=state) as keys_device:
+        key_store = keys_device.key_store
+        num_configured, selected_drives = select_managed_drives(mount_point, volumes, state)
+
+        def verify(device):
+            try:
+                if not key_store.exists(device.target):
+                    logger.error("Key of encrypted drive %s is missing!", device.target)
+                    results[device.target] = VerificationResult('missing', None, 0, False, "Key is missing!")
+                    return
+                with state.phase('verify-key', drive=device.target):
+                    results[device.target] = verify_key(
+                        physical_device=device.source_device,
+                        name=device.target,
+                        key_store=key_store,
+                        key_slot=find_key_slot_option(device.options),
+                        cache=cache,
+                        budget=budget,
+                        context=state.context,
+                    )
+                if results[device.target].status != 'passed':
+                    logger.error("Key of encrypted drive %s failed verification! (%s)",
+                                 device.target, results[device.target].error)
+            except Exception as e:
+                logger.error("Failed to verify key of encrypted drive %s! (%s)", device.target, e)
+                results.failures[device.target] = e
+
+        map_drives(verify, selected_drives, concurrency or cpu_count, "Verifying keys of %s")
+    cache.save()
+    return results
+
+
+def find_key_slot_option(options):
+    """
+    Find the ``key-slot`` option of an entry in ``/etc/crypttab``.
+
+    :param options: The options of the entry (a list of strings).
+    :returns: The key slot (an integer) or :data:`None`.
+    """
+    for option in options:
+        name, _, value = option.partition('=')
+        if name in ('key-slot', 'keyslot') and value.isdigit():
+            return int(value)
+    return None
+
+
+def coerce_state(state):
+    """
+    Take a snapshot of the system state unless the caller provided one.
+
+    :param state: A :class:`.SystemState` object or :data:`None`.
+    :returns: A :class:`.SystemState` object.
+    """
+    from crypto_drive_manager.state import SystemState
+    return state if state is not None else SystemState()
+
+
+def decide_cleanup(mount_point, state=None):
+    """
+    Figure out whether it's safe to unmount and lock the virtual keys device after use.
+
+    :param mount_point: The mount point for the virtual keys device (a string).
+    :param state: A :class:`.SystemState` object (optional).
+    :returns: :data:`True` if the virtual keys device can be locked after
+              use, :data:`False` otherwise.
+    """
+    from humanfriendly import compact
+    from crypto_drive_manager.systemd import have_systemd_dependencies
+    if have_systemd_dependencies(mount_point, state=state):
+        logger.notice(compact("""
+            The virtual keys device will remain unlocked because
+            you're running systemd and you appear to be affected
+            by https://github.com/systemd/systemd/issues/3816.
+        """))
+        return False
+    else:
+        logger.verbose(compact("""
+            Locking virtual keys device after use (this should be
+            safe to do because it appears that you're not affected
+            by https://github.com/systemd/systemd/issues/3816).
+        """))
+        return True
+
+
+def select_managed_drives(mount_point, volumes=(), state=None):
+    """
+    Select the managed drives that should be activated.
+
+    :param mount_point: The mount point for the virtual keys device (a string).
+    :param volumes: See :func:`initialize_keys_device()`.
+    :param state: A :class:`.SystemState` object (optional).
+    :returns: A tuple of two values:
+
+              1. The number of configured (managed) drives (an integer).
+              2. A list of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry`
+                 objects for the drives that match `volumes` and are available.
+    """
+    from humanfriendly import concatenate
+    if volumes:
+        logger.verbose("Unlocking encrypted devices matching filter: %s", concatenate(map(repr, volumes)))
+    else:
+        logger.verbose("Unlocking all configured and available encrypted devices ..")
+    num_configured = 0
+    selected_drives = []
+    for device in find_managed_drives(mount_point, state=state):
+        if volumes and device.target not in volumes:
+            logger.verbose("Ignoring %s because it doesn't match the filter.", device.target)
+        elif device.is_available:
+            selected_drives.append(device)
+        num_configured += 1
+    return num_configured, selected_drives
+
+
+def report_results(results, num_configured, num_available):
+    """
+    Report the results of activating the selected drives.
+
+    :param results: An :class:`ActivationResults` object.
+    :param num_configured: The number of configured drives (an integer).
+    :param num_available: The number of available (selected) drives (an integer).
+    :raises: :exc:`ActivationFailed` when one or more drives couldn't be activated.
+    """
+    from humanfriendly import pluralize
+    num_unlocked = sum(1 for status in results.values() if status & DriveStatus.UNLOCKED)
+    num_activated = sum(1 for status in results.values() if status & DriveStatus.ACTIVATED)
+    if num_activated > 0:
+        logger.info("Activated LVM volume groups on %s.", pluralize(num_activated, "encrypted device"))
+    if num_unlocked > 0:
+        logger.success("Unlocked %s.", pluralize(num_unlocked, "encrypted device"))
+    elif results.failures:
+        logger.warning("Nothing unlocked! (%s failed)", pluralize(len(results.failures), "encrypted device"))
+    elif any(results.values()):
+        # Volume groups were activated or filesystems mounted on drives that were already unlocked.
+        logger.info("No drives needed to be unlocked. (%s already unlocked)",
+                    pluralize(num_available, "encrypted device"))
+    elif num_available > 0:
+        logger.info("Nothing to do! (%s already unlocked)", pluralize(num_available, "encrypted device"))
+    elif num_configured > 0:
+        logger.info("Nothing to do! (no encrypted devices available)")
+    else:
+        logger.info("Nothing to do! (no encrypted drives configured)")
+    if results.failures:
+        raise ActivationFailed(results.failures)
+
+
+def map_drives(function, drives, concurrency, message):
+    """
+    Call a function for every drive (optionally in parallel).
+
+    :param function: The callable to call with each drive.
+    :param drives: A list of drives.
+    :param concurrency: See :func:`initialize_keys_device()`.
+    :param message: A log message with a placeholder for the number of drives.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from humanfriendly import pluralize
+    if concurrency > 1 and len(drives) > 1:
+        logger.verbose(message + " using %s ..",
+                       pluralize(len(drives), "encrypted drive"),
+                       pluralize(min(concurrency, len(drives)), "worker thread"))
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            # We use list() to consume the iterator (and wait for all of the
+            # workers to finish) while the pool is still available.
+            list(pool.map(function, drives))
+    else:
+        for device in drives:
+            function(device)
+
+
+def activate_encrypted_drive(mapper_name, physical_device, keys_directory, reset=False,
+                             fast_keyslots=False, state=None):
     """
     Initialize and activate an encrypted volume.
 
-    :param mapper_name: The device mapper name for the virtual keys device (a
-                        string).
+    :param mapper_name: The device mapper name for the encrypted volume (a
+                        string, this needs to match a managed drive in
+                        ``/etc/crypttab``).
     :param physical_device: The pathname of the physical drive that contains
-                            the encrypted LUKS volume (a string).
+                            the encrypted LUKS volume (a string). This is only
+                            used in error messages, the source device
+                            configured in ``/etc/crypttab`` is used to unlock
+                            the drive.
     :param keys_directory: The mount point for the virtual keys device (a
                            string).
     :param reset: If ``True`` the key file for the encrypted volume will be
                   regenerated (overwriting any previous key).
+    :param fast_keyslots: :data:`True` to install new key files in key slots
+                          that use minimal PBKDF parameters, :data:`False`
+                          otherwise (see :func:`.add_key_file()`).
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
     :return: An integer created by combining members of the
              :class:`DriveStatus` enumeration using bitwise or.
-    :raises: :exc:`~executor.ExternalCommandFailed` when a program
-             like ``cryptsetup`` or ``mount`` reports an error.
-    """
-    status = DriveStatus.DEFAULT
-    mapper_device = '/dev/mapper/%s' % mapper_name
-    device_exists = os.path.exists(mapper_device)
-    if reset or not device_exists:
-        key_file = os.path.join(keys_directory, '%s.key' % mapper_name)
-        if reset or not os.path.isfile(key_file):
-            logger.info("Creating %s to unlock %s (%s)", key_file, mapper_name, physical_device)
-            execute('dd', 'if=/dev/urandom', 'of=%s' % key_file, 'bs=4', 'count=1024')
-            logger.info("Installing %s on %s ..", key_file, physical_device)
-            execute('cryptsetup', 'luksAddKey', physical_device, key_file)
-            status |= DriveStatus.INITIALIZED
-        os.chmod(key_file, 0o400)
-        if not device_exists:
-            logger.info("Unlocking encrypted drive %s ..", mapper_name)
-            cryptdisks_start(mapper_name)
-            status |= DriveStatus.UNLOCKED
-    if drive_needs_mounting(mapper_device):
-        logger.info("Mounting %s ..", mapper_device)
-        execute('mount', mapper_device)
-        status |= DriveStatus.MOUNTED
-    return status
-
-
-def find_managed_drives(keys_directory):
+    :raises: :exc:`~exceptions.ValueError` when the drive isn't a managed
+             drive or it isn't available, :exc:`.aio.CommandFailed`
+             when a program like ``cryptsetup`` or ``mount`` reports an error.
+
+    This is a thin wrapper for :func:`crypto_drive_manager.aio.activate_encrypted_drive()`
+    that runs the coroutine in a new event loop (see :func:`.run_sync()`), so
+    it requires Python 3.5 or newer and can't be called from a coroutine.
+    The virtual keys device needs to be mounted on `keys_directory`.
+    """
+    from crypto_drive_manager import aio
+    return aio.run_sync(aio.activate_encrypted_drive(
+        mapper_name, physical_device, keys_directory, reset=reset,
+        fast_keyslots=fast_keyslots, state=coerce_state(state),
+    ))
+
+
+def unlock_with_key(mapper_name, physical_device, key, state=None):
+    """
+    Unlock an encrypted volume by feeding its key to ``cryptsetup`` on standard input.
+
+    :param mapper_name: The device mapper name for the encrypted volume (a string).
+    :param physical_device: The pathname of the physical drive that contains
+                            the encrypted LUKS volume (a string).
+    :param key: A :class:`.KeyBuffer` object.
+    :param state: A :class:`.SystemState` object (optional).
+
+    This bypasses ``cryptdisks_start`` (which expects to find the key file)
+    so of the options in ``/etc/crypttab`` only ``discard`` and ``readonly``
+    are honored.
+    """
+    state = coerce_state(state)
+    state.context.execute(*unlock_command(mapper_name, physical_device, state), input=key.data)
+
+
+def unlock_command(mapper_name, physical_device, state, key_file='-'):
+    """
+    Generate the ``cryptsetup open`` command used by :func:`unlock_with_key()`.
+
+    :param mapper_name: See :func:`unlock_with_key()`.
+    :param physical_device: See :func:`unlock_with_key()`.
+    :param state: A :class:`.SystemState` object.
+    :param key_file: The pathname of the key file (a string, defaults to
+                     ``-`` which means the key is read from standard input).
+    :returns: A list of strings.
+    """
+    entry = state.crypttab_by_target.get(mapper_name)
+    options = entry.options if entry else []
+    command = ['cryptsetup', 'open', '--type=luks', '--key-file=%s' % key_file]
+    if 'discard' in options:
+        command.append('--allow-discards')
+    if 'readonly' in options or 'read-only' in options:
+        command.append('--readonly')
+    command.extend([physical_device, mapper_name])
+    return command
+
+
+def find_managed_drives(keys_directory, state=None):
     """
     Find the encrypted drives managed by `crypto-drive-manager`.
 
     :param keys_directory: The mount point for the virtual keys device (a string).
-    :returns: A generator of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry` objects.
+    :param state: A :class:`.SystemState` object (if this isn't given
+                  ``/etc/crypttab`` is loaded using :func:`.load_crypttab()`).
+    :returns: A list of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry` objects.
+
+    Drives are considered managed when they use LUKS and their key file is
+    located in `keys_directory` (see also :func:`match_prefix()`).
     """
-    for entry in parse_crypttab():
-        if ('luks' in entry.options and entry.key_file and
-                match_prefix(entry.key_file, keys_directory)):
-            yield entry
+    from crypto_drive_manager.crypttab import load_crypttab
+    crypttab = state.crypttab if state else load_crypttab()
+    return crypttab.find_managed_drives(keys_directory)
 
 
 def match_prefix(pathname, prefix):
@@ -209,25 +660,292 @@ def match_prefix(pathname, prefix):
     return pathname.startswith(prefix)
 
 
-def drive_needs_mounting(mapper_device):
+def drive_needs_mounting(mapper_device, state=None):
     """
     Check if an encrypted drive can be mounted directly.
 
     :param mapper_device: The pathname of the device mapper device (a string).
+    :param state: A :class:`.SystemState` object (if this isn't given
+                  ``/proc/mounts`` is parsed on the fly).
     :returns: ``True`` if the drive should be mounted, ``False`` otherwise.
     """
-    if any(fs.device_file == mapper_device for fs in find_mounted_filesystems()):
+    from crypto_drive_manager.probe import probe_filesystem
+    state = coerce_state(state)
+    if state.is_mounted(mapper_device):
         logger.verbose("Drive %s is already mounted.", mapper_device)
         return False
-    for line in execute('blkid', '-o', 'export', mapper_device, capture=True).splitlines():
-        name, _, value = line.partition('=')
-        if name.lower() == 'type' and value.lower() == 'lvm2_member':
-            logger.verbose("Drive %s is part of an LVM volume group so we won't try to mount it.", mapper_device)
-            return False
+    if probe_filesystem(mapper_device, context=state.context) == 'LVM2_member':
+        logger.verbose("Drive %s is part of an LVM volume group so we won't mount it directly.", mapper_device)
+        return False
     logger.verbose("Drive %s not yet mounted.", mapper_device)
     return True
 
 
+class KeysDevice(object):
+
+    """
+    Context manager that makes the virtual keys device accessible.
+
+    When the :keyword:`with` statement starts the virtual keys device is
+    created (on the first run), unlocked and mounted. When the :keyword:`with`
+    statement ends the virtual keys device is unmounted and locked again
+    (if :attr:`cleanup` is :data:`True`). Use :func:`lock()` to do so before
+    the :keyword:`with` statement ends.
+
+    When the virtual keys device contains a key store instead of an ext4
+    filesystem (see :mod:`crypto_drive_manager.keystore`) it isn't mounted
+    at all.
+    """
+
+    def __init__(self, image_file, mapper_name, mount_point, cleanup=None,
+                 store_format=None, coordinator=None, state=None):
+        """
+        Initialize a :class:`KeysDevice` object.
+
+        :param image_file: See :func:`initialize_keys_device()`.
+        :param mapper_name: See :func:`initialize_keys_device()`.
+        :param mount_point: See :func:`initialize_keys_device()`.
+        :param cleanup: See :func:`initialize_keys_device()`.
+        :param store_format: See :func:`initialize_keys_device()`.
+        :param coordinator: See :func:`initialize_keys_device()`.
+        :param state: A :class:`.SystemState` object (if this isn't given a
+                      snapshot of the system state is taken automatically).
+        """
+        self.image_file = image_file
+        self.mapper_name = mapper_name
+        self.mount_point = mount_point
+        self.cleanup = cleanup
+        self.store_format = store_format
+        self.coordinator = coordinator
+        self.state = coerce_state(state)
+        self.first_run = not os.path.isfile(image_file)
+        self.initialized = not self.first_run
+        self.finalizers = []
+        self.timer = None
+        self.key_store = None
+        """The keys on the virtual keys device (a :class:`.KeyDirectory` or :class:`.KeyStore` object)."""
+
+    @property
+    def mapper_device(self):
+        """The pathname of the device mapper device for the virtual keys device (a string)."""
+        return '/dev/mapper/%s' % self.mapper_name
+
+    def __enter__(self):
+        """Create (on the first run), unlock and mount the virtual keys device."""
+        from humanfriendly import Timer
+        from crypto_drive_manager.keys import create_image_file
+        from crypto_drive_manager.keystore import KeyDirectory, KeyStore
+        state = self.state
+        if self.cleanup is None:
+            with state.phase('check-systemd'):
+                self.cleanup = decide_cleanup(self.mount_point, state)
+        try:
+            # Create the virtual keys device (on the first run).
+            if self.first_run:
+                with state.phase('create-keys-device'):
+                    logger.info("Creating virtual keys device %s ..", self.image_file)
+                    create_image_file(self.image_file)
+                    state.context.execute('cryptsetup', 'luksFormat', self.image_file)
+            # Unlock the keys device.
+            if not state.is_mapped(self.mapper_name):
+                with state.phase('open-keys-device'):
+                    logger.info("Unlocking virtual keys device %s ..", self.image_file)
+                    state.context.execute('cryptsetup', 'luksOpen', self.image_file, self.mapper_name)
+                    state.add_mapper(self.mapper_name)
+            self.timer = Timer()
+            self.finalizers.append(finalizer(
+                'cryptsetup', 'luksClose', self.mapper_name, enabled=self.cleanup,
+                context=state.context, phase=state.phase('close-keys-device'),
+            ))
+            if self.recover():
+                return self
+            store_format = self.detect_store_format()
+            if store_format == 'raw':
+                # Use the key store without mounting anything.
+                if self.first_run:
+                    with state.phase('format-keys-device'):
+                        logger.info("Creating key store on virtual keys device ..")
+                        self.key_store = KeyStore.create(self.mapper_device)
+                        self.initialized = True
+                else:
+                    self.key_store = KeyStore(self.mapper_device)
+                return self
+            # Create a file system on the virtual keys device (on the first run).
+            if self.first_run:
+                with state.phase('format-keys-device'):
+                    logger.info("Creating file system on virtual keys device ..")
+                    state.context.execute('mkfs.ext4', self.mapper_device)
+                    self.initialized = True
+            # Mount the virtual keys device.
+            with state.phase('mount-keys-device'):
+                if not os.path.isdir(self.mount_point):
+                    os.makedirs(self.mount_point)
+                if state.is_mounted(self.mapper_device) or os.path.ismount(self.mount_point):
+                    logger.info("The virtual keys device is already mounted ..")
+                else:
+                    logger.info("Mounting the virtual keys device ..")
+                    state.context.execute('mount', self.mapper_device, self.mount_point)
+                    state.add_mount(self.mapper_device, self.mount_point)
+            self.key_store = KeyDirectory(self.mount_point)
+            if self.store_format == 'raw':
+                self.migrate()
+                return self
+            self.finalizers.append(finalizer(
+                'umount', self.mount_point, enabled=self.cleanup,
+                context=state.context, phase=state.phase('unmount-keys-device'),
+            ))
+            os.chmod(self.mount_point, 0o700)
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def detect_store_format(self):
+        """
+        Decide between an ext4 filesystem and a key store (after the virtual keys device was unlocked).
+
+        :returns: ``ext4`` or ``raw``.
+        :raises: :exc:`~exceptions.ValueError` when a key store is requested
+                 for a remote system or when migrating a key store back to
+                 an ext4 filesystem is requested.
+
+        On the first run :attr:`store_format` decides (defaulting to
+        ``ext4``), otherwise the format of the device decides (a device that
+        is mounted contains an ext4 filesystem, otherwise the start of the
+        device is inspected using :func:`.detect_store_format()`).
+        """
+        from crypto_drive_manager.keystore import detect_store_format
+        from crypto_drive_manager.state import is_local_context
+        local = is_local_context(self.state.context)
+        if self.store_format == 'raw' and not local:
+            raise ValueError("Key stores are only supported on the local system!")
+        if self.first_run:
+            return self.store_format or 'ext4'
+        if not local or self.state.is_mounted(self.mapper_device):
+            detected = 'ext4'
+        else:
+            detected = detect_store_format(self.mapper_device)
+        if detected == 'raw' and self.store_format == 'ext4':
+            raise ValueError("Migrating a key store to an ext4 filesystem isn't supported!")
+        return detected
+
+    @property
+    def recovery_directory(self):
+        """The directory with a copy of the keys while they're migrated to a key store (a string)."""
+        from crypto_drive_manager.keystore import RECOVERY_DIRECTORY
+        return os.path.join(RECOVERY_DIRECTORY, self.mapper_name)
+
+    def migrate(self):
+        """
+        Replace the ext4 filesystem on the virtual keys device by a key store.
+
+        The keys are read into memory and copied to :attr:`recovery_directory`
+        (see :func:`.save_recovery_copy()`) before the ext4 filesystem is
+        unmounted and the key store is formatted in its place (see
+        :func:`finish_migration()`). When the migration is interrupted after
+        the copy was completed the next run resumes the migration from the
+        copy (see :func:`recover()`). The copy is kept in memory-backed
+        storage, so this doesn't survive a reboot or power loss halfway
+        through the migration.
+        """
+        from humanfriendly import pluralize
+        from crypto_drive_manager.keystore import save_recovery_copy
+        state = self.state
+        with state.phase('migrate-keys-device'):
+            names = self.key_store.names()
+            logger.info("Migrating %s on virtual keys device to key store ..", pluralize(len(names), "key file"))
+            keys = {}
+            try:
+                for name in names:
+                    keys[name] = self.key_store.read(name)
+                save_recovery_copy(keys, self.recovery_directory)
+                self.finish_migration(keys)
+            finally:
+                for key in keys.values():
+                    key.wipe()
+
+    def recover(self):
+        """
+        Resume an interrupted migration to a key store (see :func:`migrate()`).
+
+        :returns: :data:`True` if a migration was resumed (in which case
+                  :attr:`key_store` is set), :data:`False` otherwise.
+
+        An incomplete copy in :attr:`recovery_directory` means the migration
+        was interrupted before the ext4 filesystem was touched, so the copy is
+        removed and the ext4 filesystem is used as usual.
+        """
+        from crypto_drive_manager.keystore import KeyDirectory, is_complete_copy, wipe_directory
+        if not os.path.isdir(self.recovery_directory):
+            return False
+        if not is_complete_copy(self.recovery_directory):
+            logger.warning("Removing incomplete copy of keys in %s ..", self.recovery_directory)
+            wipe_directory(self.recovery_directory)
+            return False
+        logger.warning("Resuming interrupted migration to key store using copy of keys in %s ..",
+                       self.recovery_directory)
+        source = KeyDirectory(self.recovery_directory)
+        keys = {}
+        try:
+            with self.state.phase('migrate-keys-device'):
+                for name in source.names():
+                    keys[name] = source.read(name)
+                self.finish_migration(keys)
+        finally:
+            for key in keys.values():
+                key.wipe()
+        return True
+
+    def finish_migration(self, keys):
+        """
+        Format a key store on the virtual keys device and copy the keys to it.
+
+        :param keys: A dictionary with device mapper names as keys and
+                     :class:`.KeyBuffer` objects as values.
+
+        The copy in :attr:`recovery_directory` is only removed after every
+        key in the key store has been verified (see :func:`.copy_keys()`).
+        """
+        from crypto_drive_manager.keystore import KeyStore, copy_keys, wipe_directory
+        state = self.state
+        if state.is_mounted(self.mapper_device) or os.path.ismount(self.mount_point):
+            state.context.execute('umount', self.mount_point)
+            state.remove_mount(self.mapper_device)
+        self.key_store = KeyStore.create(self.mapper_device)
+        copy_keys(keys, self.key_store)
+        wipe_directory(self.recovery_directory)
+
+    def lock(self):
+        """
+        Unmount and lock the virtual keys device (only once and only if :attr:`cleanup` is :data:`True`).
+
+        When :attr:`coordinator` is set and other runs are waiting for this
+        run the virtual keys device is left unlocked for them.
+        """
+        enabled = any(f.enabled for f in self.finalizers)
+        if enabled and self.coordinator is not None and self.coordinator.keep_keys_device():
+            for f in self.finalizers:
+                f.enabled = False
+            enabled = False
+        # Unmount before locking (the reverse of the order of setup).
+        while self.finalizers:
+            self.finalizers.pop().run()
+        if enabled:
+            logger.verbose("Virtual keys device was accessible for %s.", self.timer)
+            if self.state.timings is not None:
+                self.state.timings.record('phase', 'keys-device-exposure', None, self.timer.elapsed_time, 'ok')
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Unmount and lock the virtual keys device (and clean up after an interrupted first run)."""
+        try:
+            self.lock()
+        finally:
+            if not self.initialized:
+                logger.warning("Initialization procedure was interrupted, deleting %s ..", self.image_file)
+                if os.path.isfile(self.image_file):
+                    os.unlink(self.image_file)
+
+
 class finalizer(object):
 
     """Context manager to run a command when the :keyword:`with` statement ends."""
@@ -237,19 +955,86 @@ class finalizer(object):
         Initialize the context manager.
 
         :param args: The positional argument(s) for py:func:`execute()`.
-        :param kw: Any keyword arguments for py:func:`execute()`.
+        :param kw: Any keyword arguments for py:func:`execute()`. The keyword
+                   argument `context` can be used to specify the execution
+                   context (see :func:`~linux_utils.coerce_context()`) and
+                   `phase` can be a context manager that times the command
+                   (see :func:`.SystemState.phase()`).
         """
+        from linux_utils import coerce_context
+        from crypto_drive_manager.timings import NullPhase
         self.args = args
+        self.context = coerce_context(kw.pop('context', None))
+        self.phase = kw.pop('phase', None) or NullPhase()
         self.enabled = kw.pop('enabled', True)
         self.kw = kw
 
     def __enter__(self):
         """Enable use as a context manager."""
+        return self
 
     def __exit__(self, *args):
         """Unconditionally run the previously specified external command."""
+        self.run()
+
+    def run(self):
+        """Run the external command (only once) unless the context manager is disabled."""
         if self.enabled:
-            execute(*self.args, **self.kw)
+            self.enabled = False
+            with self.phase:
+                self.context.execute(*self.args, **self.kw)
+
+
+class ActivationResults(dict):
+
+    """
+    Dictionary with the results of an unlock run (see :class:`.PlanExecutor`).
+
+    The keys of the dictionary are mapper names and the values are
+    :class:`DriveStatus` values (combined using bitwise or) for the
+    encrypted drives that were activated successfully.
+    """
+
+    def __init__(self, *args, **kw):
+        """Initialize an :class:`ActivationResults` object."""
+        super(ActivationResults, self).__init__(*args, **kw)
+        self.failures = {}
+        """A dictionary with mapper names as keys and exceptions as values."""
+
+    def merge(self, other):
+        """
+        Merge the results of another :class:`ActivationResults` object into this one.
+
+        :param other: An :class:`ActivationResults` object.
+
+        Statuses of drives present in both objects are combined using bitwise
+        or. Drives that failed in `other` are removed from this object.
+        """
+        for mapper_name, status in other.items():
+            self[mapper_name] = self.get(mapper_name, DriveStatus.DEFAULT) | status
+        for mapper_name in other.failures:
+            self.pop(mapper_name, None)
+        self.failures.update(other.failures)
+
+
+class ActivationFailed(Exception):
+
+    """Raised by :func:`initialize_keys_device()` when drives couldn't be activated."""
+
+    def __init__(self, failures):
+        """
+        Initialize an :class:`ActivationFailed` exception.
+
+        :param failures: A dictionary with mapper names (strings) as keys and
+                         the exceptions raised during activation as values.
+        """
+        from humanfriendly import concatenate, pluralize
+        self.failures = failures
+        super(ActivationFailed, self).__init__(
+            "Failed to activate %s! (%s)" % (
+                pluralize(len(failures), "encrypted drive"),
+                concatenate(sorted(failures)),
+            ))
 
 
 class DriveStatus(enum.IntEnum):
@@ -279,3 +1064,6 @@ class DriveStatus(enum.IntEnum):
 
     MOUNTED = 4
     """The encrypted drive was mounted as configured in ``/etc/fstab``."""
+
+    ACTIVATED = 8
+    """The LVM volume group on the encrypted drive was activated (see :func:`.activate_lvm_drives()`)."""
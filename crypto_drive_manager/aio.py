@@ -0,0 +1,879 @@
+# Asynchronous API for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Asynchronous (:mod:`asyncio`) API for `crypto-drive-manager`.
+
+This module provides coroutine counterparts of :func:`.initialize_keys_device()`
+and :func:`.activate_encrypted_drive()` that run external commands using
+:func:`asyncio.create_subprocess_exec()`, so that they can be embedded in
+:mod:`asyncio` based programs without tying up a thread for the duration of
+the unlock sequence.
+
+The actions are decided by :func:`.create_plan()` and carried out by
+:class:`AsyncPlanExecutor`, which extends :class:`.PlanExecutor` so that both
+APIs share the same plans, key stores, key cache, LVM activation and
+dependency ordered mounting. The differences are:
+
+- External commands can be given a timeout (see :func:`run_command()`),
+  except for the commands that prompt the operator for a pass phrase.
+
+- Independent drives are activated concurrently by tasks on the event loop
+  (limited by a semaphore) instead of by a pool of worker threads.
+
+- When a coroutine is cancelled the external command that is running is
+  killed and the virtual keys device is still unmounted and locked (see
+  :class:`finalizer`) before the cancellation propagates.
+
+Taking a snapshot of the system state, creating the plan and probing
+filesystem signatures read files and are done in the default thread pool
+of the event loop, everything else runs on the event loop.
+
+The synchronous :func:`crypto_drive_manager.activate_encrypted_drive()` is a
+thin wrapper for :func:`activate_encrypted_drive()` (see :func:`run_sync()`).
+
+.. note:: Because `crypto-drive-manager` remains compatible with Python 2
+          this module isn't imported by the top level package and it
+          requires Python 3.5 or newer.
+"""
+
+# Standard library modules.
+import asyncio
+import contextlib
+import functools
+import os
+import shutil
+import subprocess
+import time
+
+# External dependencies.
+from executor import quote
+from humanfriendly import Timer, concatenate, pluralize
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import DriveStatus, KeysDevice, decide_cleanup, report_results, unlock_command
+from crypto_drive_manager.keys import create_image_file
+from crypto_drive_manager.keyslots import add_key_command
+from crypto_drive_manager.lvm import (
+    find_lvm_mounts,
+    find_owners,
+    parse_inactive_volume_groups,
+    parse_logical_volumes,
+    parse_volume_groups,
+    report_command,
+)
+from crypto_drive_manager.mounts import MountScheduler, MountStatus, find_drive_mounts, record_mounts
+from crypto_drive_manager.plan import Action, PlanExecutor, create_plan, secure_key_file
+from crypto_drive_manager.state import SystemState, is_local_context
+from crypto_drive_manager.timings import InstrumentedContext
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+async def initialize_keys_device(image_file, mapper_name, mount_point, volumes=(), cleanup=None, concurrency=1,
+                                 fast_keyslots=False, key_cache=None, timeout=None, state=None):
+    """
+    Initialize and activate the virtual keys device and use it to activate encrypted volumes.
+
+    :param timeout: The number of seconds that external commands are allowed
+                    to run (a number or :data:`None`, see :func:`run_command()`).
+                    Commands that prompt the operator for a pass phrase
+                    aren't subject to the timeout.
+    :returns: An :class:`.ActivationResults` object.
+    :raises: :exc:`.ActivationFailed` when one or more of the selected
+             encrypted drives couldn't be activated.
+
+    Refer to :func:`crypto_drive_manager.initialize_keys_device()` for
+    details about the other parameters and the behavior of this coroutine.
+    Pipeline mode, waiting for devices, migrating to a key store and
+    coordination with concurrent runs are only available in the synchronous
+    API. The drives are mounted after the virtual keys device has been
+    locked again, because mounting doesn't need the keys.
+    """
+    if state is None:
+        state = await run_in_executor(SystemState)
+    first_run = not os.path.isfile(image_file)
+    plan = await run_in_executor(create_plan, mount_point, volumes, first_run=first_run, state=state)
+    executor = AsyncPlanExecutor(plan, fast_keyslots=fast_keyslots, concurrency=concurrency,
+                                 state=state, timeout=timeout)
+    if key_cache is not None and not plan.first_run:
+        await executor.unlock_cached_drives(key_cache)
+    if plan.needs_keys:
+        async with AsyncKeysDevice(image_file, mapper_name, mount_point, cleanup, state, timeout) as keys_device:
+            executor.key_store = keys_device.key_store
+            plan.check_key_files(keys_device.key_store)
+            await executor.install_keys()
+            keys = {}
+            try:
+                if key_cache is not None or not keys_device.key_store.has_files:
+                    keys = await executor.load_keys()
+                    if key_cache is not None:
+                        executor.cache_keys(key_cache, keys)
+                await executor.unlock_drives(keys if not keys_device.key_store.has_files else None)
+            finally:
+                for key in keys.values():
+                    key.wipe()
+    else:
+        logger.verbose("All selected drives are unlocked, no need to unlock virtual keys device.")
+    await executor.mount_drives()
+    report_results(executor.results, plan.num_configured, len(plan.available_drives))
+    return executor.results
+
+
+async def activate_encrypted_drive(mapper_name, physical_device, keys_directory, reset=False,
+                                   fast_keyslots=False, timeout=None, state=None):
+    """
+    Initialize and activate an encrypted volume.
+
+    :param timeout: See :func:`initialize_keys_device()`.
+    :returns: An integer created by combining members of the
+              :class:`.DriveStatus` enumeration using bitwise or.
+    :raises: :exc:`~exceptions.ValueError` when the drive isn't a managed
+             drive or it isn't available, :exc:`CommandFailed` when a program
+             like ``cryptsetup`` or ``mount`` reports an error.
+
+    Refer to :func:`crypto_drive_manager.activate_encrypted_drive()` for
+    details about the other parameters (the virtual keys device needs to be
+    mounted on `keys_directory`).
+    """
+    if state is None:
+        state = await run_in_executor(SystemState)
+    plan = await run_in_executor(create_plan, keys_directory, [mapper_name],
+                                 first_run=reset, keys_accessible=True, state=state)
+    if not plan.drives:
+        raise ValueError("Encrypted drive %s isn't managed by crypto-drive-manager!" % mapper_name)
+    if not plan.available_drives:
+        raise ValueError("Encrypted drive %s isn't available! (%s)" % (mapper_name, physical_device))
+    executor = AsyncPlanExecutor(plan, fast_keyslots=fast_keyslots, state=state, timeout=timeout)
+    with timed_phase(state, 'activate', mapper_name):
+        await executor.install_keys()
+        await executor.unlock_drives()
+        await executor.mount_drives()
+    if mapper_name in executor.results.failures:
+        raise executor.results.failures[mapper_name]
+    return executor.results[mapper_name]
+
+
+class AsyncPlanExecutor(PlanExecutor):
+
+    """
+    Carry out an :class:`.ActivationPlan` using :mod:`asyncio`.
+
+    The actions of each group are executed concurrently, limited by a
+    semaphore whose size is given by :attr:`.PlanExecutor.concurrency`.
+    The methods that change the system are coroutines (waiting for devices
+    isn't supported).
+    """
+
+    def __init__(self, plan, fast_keyslots=False, concurrency=1, key_store=None, state=None, timeout=None):
+        """
+        Initialize an :class:`AsyncPlanExecutor` object.
+
+        :param timeout: See :func:`initialize_keys_device()`.
+
+        Refer to :class:`.PlanExecutor` for details about the other parameters.
+        """
+        super(AsyncPlanExecutor, self).__init__(plan, fast_keyslots, concurrency, key_store, state)
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max(1, concurrency or 1))
+
+    async def run(self, *command, **options):
+        """
+        Run an external command using :func:`run_command()`.
+
+        :param command: The program name and its arguments (strings).
+        :param options: Any keyword arguments for :func:`run_command()`
+                        (the timeout defaults to :attr:`timeout`).
+        :returns: The return value of :func:`run_command()`.
+        """
+        options.setdefault('timeout', self.timeout)
+        return await run_command(*command, context=self.state.context, **options)
+
+    async def execute_group(self, action, function, message, name=None):
+        """
+        Execute the actions of one type for all drives (concurrently).
+
+        :param action: An :class:`.Action` value.
+        :param function: A coroutine function that takes a :class:`.DrivePlan`
+                         object and returns a :class:`.DriveStatus` value.
+        :param message: The log message (see :func:`.map_drives()`).
+        :param name: See :func:`.PlanExecutor.execute_group()`.
+
+        Failures are logged and recorded in :attr:`.ActivationResults.failures`,
+        cancellation propagates to the caller.
+        """
+        name = name or action.value
+        drives = self.pending(action)
+
+        async def wrapper(drive):
+            async with self.semaphore:
+                try:
+                    with timed_phase(self.state, name, drive.mapper_name):
+                        status = await function(drive)
+                    self.results[drive.mapper_name] |= status
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Action %s failed for encrypted drive %s! (%s)", name, drive.mapper_name, e)
+                    self.results.pop(drive.mapper_name, None)
+                    self.results.failures[drive.mapper_name] = e
+
+        if self.concurrency > 1 and len(drives) > 1:
+            logger.verbose(message + " using %s ..",
+                           pluralize(len(drives), "encrypted drive"),
+                           pluralize(min(self.concurrency, len(drives)), "concurrent task"))
+        await asyncio.gather(*(wrapper(d) for d in drives))
+
+    async def install_keys(self):
+        """Create the missing key files and install them on the encrypted drives."""
+        async def create(drive):
+            logger.info("Creating %s to unlock %s (%s)", self.key_store.location(drive.mapper_name),
+                        drive.mapper_name, drive.source_device)
+            self.key_store.generate(drive.mapper_name)
+            return DriveStatus.DEFAULT
+
+        async def install(drive):
+            logger.info("Installing %s on %s ..", self.key_store.location(drive.mapper_name), drive.source_device)
+            with self.key_store.key_file(drive.mapper_name) as key_file:
+                # cryptsetup prompts for an existing pass phrase, so the timeout doesn't apply.
+                command = add_key_command(drive.source_device, key_file, fast=self.fast_keyslots)
+                await self.run(*command, drive=drive.mapper_name, timeout=None)
+            return DriveStatus.INITIALIZED
+
+        await self.execute_group(Action.CREATE_KEY, create, "Creating key files of %s")
+        await self.execute_group(Action.ADD_KEY, install, "Installing key files of %s")
+
+    async def load_keys(self):
+        """
+        Read the keys of the drives that will be unlocked into memory.
+
+        :returns: See :func:`.PlanExecutor.load_keys()`.
+        """
+        keys = {}
+
+        async def load(drive):
+            keys[drive.mapper_name] = self.key_store.read(drive.mapper_name)
+            return DriveStatus.DEFAULT
+
+        await self.execute_group(Action.OPEN, load, "Loading keys of %s", name='load-key')
+        return keys
+
+    async def unlock_cached_drives(self, key_cache):
+        """
+        Unlock the encrypted drives whose keys are cached.
+
+        :param key_cache: A :class:`.KeyCache` object.
+
+        Refer to :func:`.PlanExecutor.unlock_cached_drives()` for details.
+        """
+        candidates = [d for d in self.pending(Action.OPEN) if Action.CREATE_KEY not in d.actions]
+        if not candidates:
+            return
+        try:
+            keys = key_cache.lookup(d.mapper_name for d in candidates)
+        except Exception as e:
+            logger.warning("Failed to get cached keys, falling back to key files! (%s)", e)
+            return
+        try:
+            async def unlock(drive):
+                async with self.semaphore:
+                    try:
+                        with timed_phase(self.state, 'unlock-cached', drive.mapper_name):
+                            logger.info("Unlocking encrypted drive %s using cached key ..", drive.mapper_name)
+                            command = unlock_command(drive.mapper_name, drive.source_device, self.state)
+                            await self.run(*command, input=keys[drive.mapper_name].data, drive=drive.mapper_name)
+                            self.state.add_mapper(drive.mapper_name)
+                        drive.actions.remove(Action.OPEN)
+                        self.results[drive.mapper_name] |= DriveStatus.UNLOCKED
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.warning("Failed to unlock %s using cached key, falling back to key file! (%s)",
+                                       drive.mapper_name, e)
+                        key_cache.evict([drive.mapper_name])
+
+            await asyncio.gather(*(unlock(d) for d in candidates if d.mapper_name in keys))
+        finally:
+            for key in keys.values():
+                key.wipe()
+
+    async def unlock_drives(self, keys=None):
+        """
+        Unlock the encrypted drives.
+
+        :param keys: See :func:`.PlanExecutor.unlock_drives()`.
+
+        Without `keys` the drives are unlocked using ``cryptdisks_start``
+        when it's installed, otherwise ``cryptsetup open`` is given the key
+        file of the drive.
+        """
+        use_cryptdisks_start = keys is None and await self.find_program('cryptdisks_start')
+
+        async def unlock(drive):
+            logger.info("Unlocking encrypted drive %s ..", drive.mapper_name)
+            if keys is not None:
+                command = unlock_command(drive.mapper_name, drive.source_device, self.state)
+                await self.run(*command, input=keys[drive.mapper_name].data, drive=drive.mapper_name)
+            else:
+                secure_key_file(drive)
+                if use_cryptdisks_start:
+                    command = ['cryptdisks_start', drive.mapper_name]
+                else:
+                    command = unlock_command(drive.mapper_name, drive.source_device, self.state, drive.key_file)
+                await self.run(*command, drive=drive.mapper_name)
+            self.state.add_mapper(drive.mapper_name)
+            return DriveStatus.UNLOCKED
+
+        await self.execute_group(Action.OPEN, unlock, "Unlocking %s")
+
+    async def mount_drives(self):
+        """
+        Mount the filesystems on the encrypted drives.
+
+        Refer to :func:`.PlanExecutor.mount_drives()` for details.
+        """
+        from crypto_drive_manager.probe import probe_filesystems
+        unprobed = [d for d in self.pending(Action.MOUNT) if d.filesystem is None]
+        if unprobed:
+            with timed_phase(self.state, 'probe'):
+                signatures = await run_in_executor(probe_filesystems, [d.mapper_device for d in unprobed],
+                                                   context=self.state.context)
+            for drive in unprobed:
+                drive.filesystem = signatures.get(drive.mapper_device)
+                if drive.filesystem == 'LVM2_member':
+                    logger.verbose("Drive %s is part of an LVM volume group so we won't mount it directly.",
+                                   drive.mapper_device)
+                    drive.actions[drive.actions.index(Action.MOUNT)] = Action.ACTIVATE_LVM
+        mounts = find_drive_mounts([d.mapper_name for d in self.pending(Action.MOUNT)], self.state)
+        lvm_drives = [d.mapper_name for d in self.pending(Action.ACTIVATE_LVM)]
+        if lvm_drives:
+            mounts.extend(await self.activate_lvm_drives(lvm_drives))
+        await AsyncMountScheduler(mounts, self).run()
+        record_mounts(mounts, self.results)
+
+    async def activate_lvm_drives(self, mapper_names):
+        """
+        Activate the LVM volume groups on unlocked drives (in one batch).
+
+        :param mapper_names: A list of device mapper names (strings).
+        :returns: A list of :class:`.Mount` objects for the logical volumes
+                  that need to be mounted.
+
+        Refer to :func:`.activate_lvm_drives()` for details.
+        """
+        devices = dict(('/dev/mapper/%s' % name, name) for name in mapper_names)
+        try:
+            with timed_phase(self.state, 'activate-volume-groups'):
+                await self.run('pvscan', '--cache', *sorted(devices))
+                output = await self.run(*report_command('pvs', 'pv_name,vg_name', sorted(devices)),
+                                        capture=True, check=False)
+                volume_groups = parse_volume_groups(output)
+                names = sorted(set(volume_groups.values()))
+                inactive = set()
+                if names:
+                    output = await self.run(*report_command('lvs', 'vg_name,lv_active', names),
+                                            capture=True, check=False)
+                    inactive = parse_inactive_volume_groups(output, names)
+                if inactive:
+                    logger.info("Activating LVM volume groups %s ..", concatenate(sorted(inactive)))
+                    await self.run('vgchange', '--activate', 'y', *sorted(inactive))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Failed to activate LVM volume groups on %s! (%s)", concatenate(sorted(mapper_names)), e)
+            for name in mapper_names:
+                self.results.pop(name, None)
+                self.results.failures[name] = e
+            return []
+        owners = find_owners(devices, volume_groups, inactive, self.results)
+        logical_volumes = []
+        if owners:
+            output = await self.run(*report_command('lvs', 'vg_name,lv_path,lv_dm_path', sorted(owners)),
+                                    capture=True, check=False)
+            logical_volumes = parse_logical_volumes(output, sorted(owners))
+        return find_lvm_mounts(owners, logical_volumes, self.state)
+
+    async def find_program(self, program_name):
+        """
+        Check whether a program is installed.
+
+        :param program_name: The name of the program (a string).
+        :returns: :data:`True` if the program is installed, :data:`False` otherwise.
+        """
+        if is_local_context(self.state.context):
+            return shutil.which(program_name) is not None
+        return await self.run('which', program_name, capture=True, check=False) != ''
+
+
+class AsyncMountScheduler(MountScheduler):
+
+    """Mount filesystems concurrently while respecting the nesting of their mount points."""
+
+    def __init__(self, mounts, executor):
+        """
+        Initialize an :class:`AsyncMountScheduler` object.
+
+        :param mounts: A list of :class:`.Mount` objects.
+        :param executor: The :class:`AsyncPlanExecutor` whose semaphore and
+                         timeout are used.
+        """
+        super(AsyncMountScheduler, self).__init__(mounts, executor.concurrency, executor.state)
+        self.executor = executor
+
+    async def run(self):
+        """
+        Mount the filesystems.
+
+        :returns: The list of :class:`.Mount` objects (whose status has been set).
+
+        Refer to :func:`.MountScheduler.run()` for details.
+        """
+        if not self.mounts:
+            return self.mounts
+        timer = Timer()
+        children = {}
+        for mount in self.mounts:
+            children.setdefault(mount.parent, []).append(mount)
+
+        async def mount_tree(mount):
+            async with self.executor.semaphore:
+                await self.mount(mount)
+            if mount.status == MountStatus.MOUNTED:
+                await asyncio.gather(*(mount_tree(c) for c in children.get(mount, [])))
+            else:
+                for child in children.get(mount, []):
+                    self.skip(child, mount, children)
+
+        await asyncio.gather(*(mount_tree(m) for m in children.get(None, [])))
+        self.report(timer)
+        return self.mounts
+
+    async def mount(self, mount):
+        """
+        Mount a single filesystem.
+
+        :param mount: A :class:`.Mount` object.
+        """
+        timer = Timer()
+        try:
+            with timed_phase(self.state, 'mount', mount.drive):
+                logger.verbose("Mounting %s ..", mount)
+                await self.executor.run('mount', mount.target, drive=mount.drive)
+                self.state.add_mount(mount.device_file, mount.mount_point)
+            mount.status = MountStatus.MOUNTED
+            logger.info("Mounted %s (%s) in %s.", mount, mount.device_file, timer)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            mount.status = MountStatus.FAILED
+            mount.exception = e
+        mount.elapsed_time = timer.elapsed_time
+
+
+class AsyncKeysDevice(KeysDevice):
+
+    """
+    Asynchronous context manager that makes the virtual keys device accessible.
+
+    Refer to :class:`.KeysDevice` for details. Migrating to a key store and
+    coordination with concurrent runs are only supported by the synchronous
+    :class:`.KeysDevice` (an interrupted migration is resumed though).
+    """
+
+    def __init__(self, image_file, mapper_name, mount_point, cleanup=None, state=None, timeout=None):
+        """
+        Initialize an :class:`AsyncKeysDevice` object.
+
+        :param timeout: See :func:`initialize_keys_device()`.
+
+        Refer to :class:`.KeysDevice` for details about the other parameters.
+        """
+        super(AsyncKeysDevice, self).__init__(image_file, mapper_name, mount_point, cleanup, state=state)
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        """Create (on the first run), unlock and mount the virtual keys device."""
+        from crypto_drive_manager.keystore import KeyDirectory, KeyStore
+        state = self.state
+        if self.cleanup is None:
+            with timed_phase(state, 'check-systemd'):
+                self.cleanup = await run_in_executor(decide_cleanup, self.mount_point, state)
+        try:
+            # Create the virtual keys device (on the first run). The
+            # commands that prompt for the pass phrase have no timeout.
+            if self.first_run:
+                with timed_phase(state, 'create-keys-device'):
+                    logger.info("Creating virtual keys device %s ..", self.image_file)
+                    create_image_file(self.image_file)
+                    await run_command('cryptsetup', 'luksFormat', self.image_file, context=state.context)
+            # Unlock the keys device.
+            if not state.is_mapped(self.mapper_name):
+                with timed_phase(state, 'open-keys-device'):
+                    logger.info("Unlocking virtual keys device %s ..", self.image_file)
+                    await run_command('cryptsetup', 'luksOpen', self.image_file, self.mapper_name,
+                                      context=state.context)
+                    state.add_mapper(self.mapper_name)
+            self.timer = Timer()
+            self.finalizers.append(finalizer(
+                'cryptsetup', 'luksClose', self.mapper_name, enabled=self.cleanup,
+                state=state, phase='close-keys-device', timeout=self.timeout,
+            ))
+            if await run_in_executor(self.recover):
+                return self
+            if self.detect_store_format() == 'raw':
+                # Use the key store without mounting anything.
+                if self.first_run:
+                    with timed_phase(state, 'format-keys-device'):
+                        logger.info("Creating key store on virtual keys device ..")
+                        self.key_store = KeyStore.create(self.mapper_device)
+                        self.initialized = True
+                else:
+                    self.key_store = KeyStore(self.mapper_device)
+                return self
+            # Create a file system on the virtual keys device (on the first run).
+            if self.first_run:
+                with timed_phase(state, 'format-keys-device'):
+                    logger.info("Creating file system on virtual keys device ..")
+                    await run_command('mkfs.ext4', self.mapper_device, context=state.context, timeout=self.timeout)
+                    self.initialized = True
+            # Mount the virtual keys device.
+            with timed_phase(state, 'mount-keys-device'):
+                if not os.path.isdir(self.mount_point):
+                    os.makedirs(self.mount_point)
+                if state.is_mounted(self.mapper_device) or os.path.ismount(self.mount_point):
+                    logger.info("The virtual keys device is already mounted ..")
+                else:
+                    logger.info("Mounting the virtual keys device ..")
+                    await run_command('mount', self.mapper_device, self.mount_point,
+                                      context=state.context, timeout=self.timeout)
+                    state.add_mount(self.mapper_device, self.mount_point)
+            self.key_store = KeyDirectory(self.mount_point)
+            self.finalizers.append(finalizer(
+                'umount', self.mount_point, enabled=self.cleanup,
+                state=state, phase='unmount-keys-device', timeout=self.timeout,
+            ))
+            os.chmod(self.mount_point, 0o700)
+        except BaseException:
+            await self.__aexit__()
+            raise
+        return self
+
+    async def lock(self):
+        """
+        Unmount and lock the virtual keys device (only once and only if :attr:`cleanup` is :data:`True`).
+
+        Every finalizer runs, even when an earlier one fails or the calling
+        task is cancelled halfway through (see :func:`finalizer.run()`).
+        """
+        enabled = any(f.enabled for f in self.finalizers)
+        try:
+            # Unmount before locking (the reverse of the order of setup).
+            while self.finalizers:
+                await self.finalizers.pop().run()
+        finally:
+            while self.finalizers:
+                await self.finalizers.pop().run()
+        if enabled:
+            logger.verbose("Virtual keys device was accessible for %s.", self.timer)
+            if self.state.timings is not None:
+                self.state.timings.record('phase', 'keys-device-exposure', None, self.timer.elapsed_time, 'ok')
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Unmount and lock the virtual keys device (and clean up after an interrupted first run)."""
+        try:
+            await self.lock()
+        finally:
+            if not self.initialized:
+                logger.warning("Initialization procedure was interrupted, deleting %s ..", self.image_file)
+                if os.path.isfile(self.image_file):
+                    os.unlink(self.image_file)
+
+
+class finalizer(object):
+
+    """Cleanup command that runs to completion even when the calling task is cancelled."""
+
+    def __init__(self, *command, **options):
+        """
+        Initialize a :class:`finalizer` object.
+
+        :param command: The program name and its arguments (strings).
+        :param options: The keyword argument `enabled` can be :data:`False` to
+                        disable the finalizer, `state` gives the
+                        :class:`.SystemState` whose execution context is used,
+                        `phase` is the name used to time the command and
+                        `timeout` is passed to :func:`run_command()`.
+        """
+        self.command = command
+        self.enabled = options.get('enabled', True)
+        self.state = options['state']
+        self.phase = options.get('phase')
+        self.timeout = options.get('timeout')
+
+    async def run(self):
+        """
+        Run the external command (only once) unless the finalizer is disabled.
+
+        The command runs in a separate task that is shielded from cancellation
+        (see :func:`shielded()`), so when the calling task is cancelled we wait
+        for the command to finish before the cancellation propagates.
+        """
+        if self.enabled:
+            self.enabled = False
+            with timed_phase(self.state, self.phase):
+                await shielded(run_command(*self.command, context=self.state.context, timeout=self.timeout))
+
+
+async def shielded(coroutine):
+    """
+    Run a coroutine to completion, even when the calling task is cancelled.
+
+    :param coroutine: The coroutine to run.
+    :returns: The return value of the coroutine.
+    :raises: Any exceptions raised by the coroutine, otherwise
+             :exc:`asyncio.CancelledError` when the calling task was
+             cancelled while the coroutine was running.
+    """
+    task = asyncio.ensure_future(coroutine)
+    cancelled = False
+    while True:
+        try:
+            result = await asyncio.shield(task)
+            break
+        except asyncio.CancelledError:
+            if task.done():
+                raise
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
+    return result
+
+
+async def run_command(*command, **options):
+    """
+    Run an external command without blocking the event loop.
+
+    :param command: The program name and its arguments (strings).
+    :param context: The execution context of a :class:`.SystemState` (see
+                    :func:`~linux_utils.coerce_context()`). Commands are run
+                    on the local system using :func:`asyncio.create_subprocess_exec()`
+                    or they're emulated when this is a :class:`.SimulatedContext`.
+                    Other (e.g. remote) execution contexts aren't supported.
+    :param capture: :data:`True` to capture and return the standard output
+                    stream, :data:`False` to inherit it (the default).
+    :param check: :data:`True` to raise :exc:`CommandFailed` when the command
+                  exits with a nonzero status (the default), :data:`False`
+                  otherwise.
+    :param input: The data to feed to the standard input stream of the
+                  command (a byte string, :class:`bytearray` or :data:`None`).
+    :param timeout: The number of seconds that the command is allowed to run
+                    (a number or :data:`None` to wait indefinitely).
+    :param drive: The mapper name of the drive that the command is run for
+                  (a string or :data:`None`, only used for timings).
+    :returns: The captured output (a string) when `capture` is :data:`True`,
+              otherwise :data:`True` if the command succeeded and
+              :data:`False` if it failed.
+    :raises: :exc:`CommandFailed`, :exc:`CommandTimedOut` or
+             :exc:`~exceptions.ValueError` when the execution context
+             isn't supported.
+
+    When the command times out or the calling task is cancelled the command
+    is killed before the exception propagates. When the execution context
+    records timings (see :class:`.InstrumentedContext`) the command is
+    timed as well.
+    """
+    from crypto_drive_manager.simulation import SimulatedContext
+    context = options.get('context')
+    capture = options.get('capture', False)
+    timeout = options.get('timeout')
+    timings = None
+    while isinstance(context, InstrumentedContext):
+        timings, context = context.timings, context.context
+    context = coerce_context(context)
+    command_line = ' '.join(quote(a) for a in command)
+    logger.debug("Executing external command: %s", command_line)
+    start_time = time.time()
+    returncode = None
+    try:
+        if isinstance(context, SimulatedContext):
+            returncode, stdout = await emulate_command(context.system, command, options.get('input'), timeout)
+        elif is_local_context(context):
+            returncode, stdout = await spawn_command(command, capture, options.get('input'), timeout)
+        else:
+            raise ValueError("The asyncio API doesn't support this execution context! (%s)" % context)
+    finally:
+        if timings is not None:
+            timings.record('command', command_line, options.get('drive'), time.time() - start_time, returncode)
+    if options.get('check', True) and returncode != 0:
+        raise CommandFailed(command, returncode)
+    return stdout if capture else returncode == 0
+
+
+async def spawn_command(command, capture, input, timeout):
+    """
+    Run an external command on the local system (see :func:`run_command()`).
+
+    :returns: A tuple with the exit status (an integer) and the standard
+              output (a string, empty unless `capture` is :data:`True`).
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=(subprocess.PIPE if input is not None else None),
+        stdout=(subprocess.PIPE if capture else None)
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(bytes(input) if input is not None else None), timeout)
+    except asyncio.TimeoutError:
+        await shielded(kill_process(process))
+        raise CommandTimedOut(command, timeout)
+    except asyncio.CancelledError:
+        await shielded(kill_process(process))
+        raise
+    return process.returncode, (stdout.decode('UTF-8') if capture else '')
+
+
+async def emulate_command(system, command, input, timeout):
+    """
+    Emulate an external command using a :class:`.SimulatedSystem` (see :func:`run_command()`).
+
+    :returns: A tuple with the exit status (an integer) and the standard
+              output (a string).
+
+    The latency of the command is awaited first, so that timeouts and
+    cancellation behave like they do for real commands.
+    """
+    try:
+        await asyncio.wait_for(asyncio.sleep(system.latency(command)), timeout)
+    except asyncio.TimeoutError:
+        raise CommandTimedOut(command, timeout)
+    result = system.run(command, input=input, delay=False)
+    return result.returncode, result.stdout.decode('UTF-8')
+
+
+async def kill_process(process):
+    """Kill an external command (if it's still running) and wait for it to exit."""
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+@contextlib.contextmanager
+def timed_phase(state, name, drive=None):
+    """
+    Time a phase of an unlock run (if timings are being recorded).
+
+    :param state: A :class:`.SystemState` object.
+    :param name: The name of the phase (a string or :data:`None`).
+    :param drive: The mapper name of a drive (a string or :data:`None`).
+    :returns: A context manager.
+
+    Unlike :func:`.SystemState.phase()` this doesn't maintain a stack of
+    phases per thread, because concurrent tasks share a single thread.
+    """
+    start_time = time.time()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        if state.timings is not None and name:
+            state.timings.record('phase', name, drive, time.time() - start_time, status)
+
+
+async def run_in_executor(function, *args, **kw):
+    """
+    Call a synchronous function in the default thread pool of the running event loop.
+
+    :param function: The function to call.
+    :param args: The positional arguments for `function`.
+    :param kw: The keyword arguments for `function`.
+    :returns: The return value of `function`.
+    """
+    return await get_running_loop().run_in_executor(None, functools.partial(function, *args, **kw))
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine in a new event loop and wait for it to finish.
+
+    :param coroutine: The coroutine to run.
+    :returns: The return value of the coroutine.
+
+    Uses :func:`asyncio.run()` when it's available (Python 3.7 and newer)
+    and falls back to :meth:`~asyncio.AbstractEventLoop.run_until_complete()`
+    otherwise.
+    """
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(coroutine)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def get_running_loop():
+    """
+    Get the event loop that is running the current coroutine.
+
+    :returns: An :class:`asyncio.AbstractEventLoop` object.
+
+    Uses :func:`asyncio.get_running_loop()` when it's available (Python 3.7
+    and newer) and falls back to :func:`asyncio.get_event_loop()` otherwise.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+
+class CommandFailed(Exception):
+
+    """Raised by :func:`run_command()` when an external command fails."""
+
+    def __init__(self, command, returncode):
+        """
+        Initialize a :class:`CommandFailed` exception.
+
+        :param command: The program name and its arguments (a tuple of strings).
+        :param returncode: The exit status of the command (an integer).
+        """
+        self.command = command
+        self.returncode = returncode
+        super(CommandFailed, self).__init__(self.format_message())
+
+    def format_message(self):
+        """Generate the error message for the exception."""
+        return "External command failed with exit code %s! (%s)" % (
+            self.returncode, ' '.join(quote(a) for a in self.command),
+        )
+
+
+class CommandTimedOut(CommandFailed):
+
+    """Raised by :func:`run_command()` when an external command doesn't finish in time."""
+
+    def __init__(self, command, timeout):
+        """
+        Initialize a :class:`CommandTimedOut` exception.
+
+        :param command: The program name and its arguments (a tuple of strings).
+        :param timeout: The timeout that expired (a number of seconds).
+        """
+        self.timeout = timeout
+        super(CommandTimedOut, self).__init__(command, None)
+
+    def format_message(self):
+        """Generate the error message for the exception."""
+        return "External command timed out after %s seconds! (%s)" % (
+            self.timeout, ' '.join(quote(a) for a in self.command),
+        )
@@ -1,11 +1,11 @@
 # Command line interface for crypto-drive-manager.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: January 18, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-crypto-drive-manager
 
 """
-Usage: crypto-drive-manager [OPTIONS] [NAME, ..]
+Usage: crypto-drive-manager [OPTIONS] [status|lock|evict|rotate|verify] [NAME, ..]
 
 Safely, quickly and conveniently unlock an unlimited number of LUKS encrypted
 devices using a single pass phrase.
@@ -15,6 +15,56 @@ the mount point of the encrypted disk with key files are unlocked (as needed).
 To unlock a subset of the configured devices you can pass one or more NAME
 arguments that match mapper name(s) configured in /etc/crypttab.
 
+Devices that contain an LVM physical volume aren't mounted directly. Instead
+the LVM volume groups on the unlocked devices are activated (using a single
+'vgchange' command for all devices) and the logical volumes that are
+configured in /etc/fstab are mounted.
+
+The 'status' command shows a table with the state of the managed devices
+(available, unlocked, mounted) and the actions that an unlock run would
+perform, without unlocking the encrypted disk with key files.
+
+The 'lock' command unmounts and locks the managed devices (or the devices
+given as NAME arguments). Filesystems are unmounted deepest mount point first,
+LVM volume groups on the devices are deactivated and finally the devices are
+locked. Within each of these steps all devices are handled in parallel (use
+--jobs to limit this). A table is printed that shows which devices couldn't
+be locked because they're busy. When all managed devices were locked the
+encrypted disk with key files is locked as well. The cached keys of the
+devices that were locked are evicted (see --cache-keys).
+
+The 'evict' command removes the cached keys of the managed devices (or the
+devices given as NAME arguments) from the kernel keyring.
+
+The 'rotate' command replaces the keys of the managed devices (or the devices
+given as NAME arguments) with new keys: For each device a new key is added to
+a free key slot, tested and then the key slot of the old key is removed.
+Devices are handled in parallel when --jobs is given and a table with the old
+and new key slots and the time spent per device is printed at the end. The
+progress is recorded on the encrypted disk with key files, so when the
+'rotate' command is interrupted it can simply be started again to resume
+where it left off (no device is ever left without a working key). The cached
+keys of the devices are evicted (see --cache-keys).
+
+The 'verify' command checks that the key files of the managed devices (or
+the devices given as NAME arguments) unlock the devices, using 'cryptsetup
+open --test-passphrase' (the devices aren't unlocked). When the 'key-slot'
+option is set in /etc/crypttab only that key slot is tested. Devices are
+checked in parallel (one per CPU unless --jobs is given) within the limits
+of --memory-budget. Devices whose LUKS header and key file didn't change
+since they last passed are skipped (the results are cached in
+/var/cache/crypto-drive-manager). A table with the results is printed (use
+--json to get JSON instead) and the exit code is 1 when any device failed.
+
+Unlock runs, the 'rotate' and 'verify' commands and the 'lock' command wait
+for each other (using lock files in /run/crypto-drive-manager), so they can
+safely be started concurrently from udev rules, systemd units, cron jobs,
+etc. An unlock run that waited for another unlock run reuses its results:
+Devices that the other run failed to unlock are reported as failed without
+trying again and only the devices that the other run didn't handle are
+unlocked. The encrypted disk with key files is left unlocked for runs that
+are waiting and locked by the last run.
+
 Supported options:
 
   -i, --image-file=PATH
@@ -33,6 +83,135 @@ Supported options:
     Set the pathname of the mount point for the encrypted disk with key files
     (defaults to '/mnt/keys').
 
+  -j, --jobs=N
+
+    Unlock up to N encrypted devices in parallel (defaults to 1, except for
+    the 'lock' command which handles all devices in parallel). Most of the
+    time needed to unlock a device is spent in cryptsetup (key derivation)
+    and mount, so on systems with many encrypted devices this can greatly
+    reduce the time it takes to unlock all devices. Filesystems are mounted
+    in parallel as well, except that a filesystem whose mount point is inside
+    another managed filesystem waits until that filesystem has been mounted.
+
+  -p, --pipeline
+
+    Read the keys of all encrypted devices into (locked) memory, then unmount
+    and lock the encrypted disk with key files before the encrypted devices
+    are unlocked. This keeps the time during which the key files are
+    accessible short, regardless of how many encrypted devices are unlocked
+    and how long that takes. Because the encrypted devices are unlocked
+    using 'cryptsetup open' instead of 'cryptdisks_start' only the 'discard'
+    and 'readonly' options in /etc/crypttab are supported in this mode.
+
+  --fast-keyslots
+
+    Install newly generated key files in LUKS key slots that use the minimal
+    key derivation (PBKDF) parameters. The key files consist of random data
+    that can't be brute forced anyway, so the (expensive) default parameters
+    meant for human passphrases only slow down every unlock.
+
+  --migrate-keyslots
+
+    Move the key files of the managed encrypted devices (or the devices
+    given as positional arguments) to LUKS key slots that use the minimal
+    PBKDF parameters and remove the old key slots. The old key slot is only
+    removed after the new key slot was verified. A table is printed that
+    shows how much unlock time per device was saved.
+
+  --cache-keys=SECONDS
+
+    Cache the keys of the encrypted devices in the kernel keyring for the
+    given number of seconds (0 means until they're evicted). Later runs that
+    also use this option unlock devices whose keys are cached without
+    unlocking the encrypted disk with key files, which is only unlocked to
+    load the keys that aren't cached. Devices unlocked using a cached key are
+    unlocked using 'cryptsetup open', so the same limitations as for
+    --pipeline apply.
+
+  --keyring=NAME
+
+    The kernel keyring used by --cache-keys and the 'evict' command, either
+    'user' (the default, shared by all processes running as root) or
+    'session' (only shared by processes in the same session).
+
+  --key-store=FORMAT
+
+    Choose how the key files are stored on the encrypted disk with key files:
+    'ext4' stores them in an ext4 filesystem (the default for new disks) and
+    'raw' stores them in a compact key store without a filesystem, which
+    avoids formatting, mounting and unmounting the encrypted disk with key
+    files. When 'raw' is given for an existing ext4 filesystem the key files
+    are migrated the next time the encrypted disk with key files is unlocked.
+    Devices are unlocked using 'cryptsetup open' when a key store is used, so
+    the same limitations as for --pipeline apply.
+
+  --wait-for-devices[=SECONDS]
+
+    Wait for selected encrypted devices that aren't available yet (e.g.
+    drives behind slow HBAs or in USB enclosures) instead of skipping them.
+    Each device is unlocked and mounted as soon as it appears. No more than
+    the given number of seconds (defaults to 90) is spent waiting for all
+    devices together. The encrypted disk with key files stays unlocked while
+    waiting, even when --pipeline is used.
+
+  --daemon
+
+    Keep running after the available encrypted devices have been unlocked
+    and watch /dev/disk/by-uuid for managed encrypted devices that appear
+    later on (e.g. drives that spin up late or are hot swapped). Only the
+    devices that appeared are unlocked and mounted. Devices that appear
+    within a second of each other are handled together and each batch waits
+    for concurrent runs of crypto-drive-manager to finish. Cached keys are
+    used (and added) when --cache-keys is given.
+
+  --linger=SECONDS
+
+    In daemon mode keep the encrypted disk with key files unlocked for the
+    given number of seconds after unlocking a batch of encrypted devices, so
+    that devices that appear shortly afterwards can be unlocked without
+    unlocking the encrypted disk with key files again (defaults to 0).
+
+  --memory-budget=SIZE
+
+    The amount of memory that the 'verify' command may use for key derivation
+    of concurrently tested devices (e.g. '4G', defaults to half of the
+    available memory). Argon2 key slots can use up to 1 GiB of memory each.
+
+  --timeout=SECONDS
+
+    The number of seconds after which the commands run by the 'lock' command
+    (umount, vgchange and cryptsetup) are terminated (defaults to 60, zero
+    disables the timeout).
+
+  --dry-run
+
+    Show the actions that an unlock run would perform (grouped by type, in
+    the order in which they're performed) without changing anything and
+    without unlocking the encrypted disk with key files. Because the key
+    files can't be inspected while the encrypted disk with key files is
+    locked, missing key files are only reported when it's already mounted.
+
+  --json
+
+    Print the output of --dry-run and the 'status' and 'verify' commands as
+    JSON.
+
+  --timings[=json]
+
+    Measure the time spent in each phase of the run and in every external
+    command, and print a per-phase and per-drive breakdown when the run ends.
+    When the value 'json' is given, all measurements are printed as JSON
+    instead.
+
+  --metrics=FILE
+
+    Write Prometheus metrics about unlock runs (the run duration, how long the
+    encrypted disk with key files was unlocked, the unlock and mount latency
+    and status of each encrypted device, the number of configured, available
+    and unlocked devices and failure counters) to the given file after each
+    run, for the textfile collector of the Prometheus node exporter. The file
+    is replaced atomically.
+
   --install-systemd-workaround
 
     Replace the systemd-cryptsetup-generator program with a wrapper that
@@ -60,37 +239,69 @@ import logging
 import os
 import sys
 
-# External dependencies.
-import coloredlogs
-from humanfriendly.terminal import usage, warning
-
 # Modules included in our package.
-from crypto_drive_manager import initialize_keys_device
-from crypto_drive_manager.systemd import (
-    install_systemd_workaround,
-    systemd_workaround_requested,
-    update_systemd_services,
-)
+from crypto_drive_manager.systemd import systemd_workaround_requested, update_systemd_services
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
 
 
 def main():
-    """Command line interface for the ``crypto-drive-manager`` program."""
-    # Initialize logging to the terminal and system log.
-    coloredlogs.install(syslog=True)
+    """
+    Command line interface for the ``crypto-drive-manager`` program.
+
+    To keep startup fast (especially when running as a systemd generator
+    during early boot) modules are only imported once it's clear which
+    mode of operation was requested.
+    """
+    # Decide if the systemd workaround is being executed based on sys.argv[0].
+    if systemd_workaround_requested():
+        update_systemd_services(sys.argv[1:])
+        # In this case none of the other code should run.
+        return
     # Define command line option defaults.
     image_file = '/root/encryption-keys.img'
     mapper_name = 'encryption-keys'
     mount_point = '/mnt/keys'
     install_workaround = False
+    concurrency = None
+    pipeline = False
+    fast_keyslots = False
+    migrate_keyslots = False
+    cache_timeout = None
+    keyring = 'user'
+    daemon = False
+    linger = 0
+    timeout = None
+    dry_run = False
+    output_json = False
+    timings_format = None
+    wait_for_devices = None
+    store_format = None
+    metrics_file = None
+    memory_budget = None
+    verbosity = 0
     # Parse the command line arguments.
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'i:n:m:vqh', [
-            'image-file=', 'mapper-name=', 'mount-point=',
-            'install-systemd-workaround',
-            'verbose', 'quiet', 'help',
+        # The getopt module doesn't support options with an optional argument,
+        # so we extract --timings=FORMAT and --wait-for-devices=SECONDS here.
+        command_line = []
+        for value in sys.argv[1:]:
+            if value.startswith('--timings='):
+                value, _, timings_format = value.partition('=')
+                if timings_format not in ('json', 'text'):
+                    raise ValueError("Unsupported timings format! (%s)" % timings_format)
+            elif value.startswith('--wait-for-devices='):
+                value, _, wait_for_devices = value.partition('=')
+                wait_for_devices = float(wait_for_devices)
+                if wait_for_devices < 0:
+                    raise ValueError("The time to wait for devices can't be negative!")
+            command_line.append(value)
+        options, arguments = getopt.getopt(command_line, 'i:n:m:j:pvqh', [
+            'image-file=', 'mapper-name=', 'mount-point=', 'jobs=', 'pipeline', 'timings',
+            'fast-keyslots', 'migrate-keyslots', 'cache-keys=', 'keyring=', 'daemon', 'linger=',
+            'timeout=', 'dry-run', 'json', 'key-store=', 'wait-for-devices', 'metrics=',
+            'memory-budget=', 'install-systemd-workaround', 'verbose', 'quiet', 'help',
         ])
         for option, value in options:
             if option in ('-i', '--image-file'):
@@ -99,47 +310,277 @@ def main():
                 mapper_name = value
             elif option in ('-m', '--mount-point'):
                 mount_point = value
+            elif option in ('-j', '--jobs'):
+                concurrency = int(value)
+                if concurrency < 1:
+                    raise ValueError("The number of jobs should be a positive integer!")
+            elif option in ('-p', '--pipeline'):
+                pipeline = True
+            elif option == '--fast-keyslots':
+                fast_keyslots = True
+            elif option == '--migrate-keyslots':
+                migrate_keyslots = True
+            elif option == '--cache-keys':
+                cache_timeout = float(value)
+                if cache_timeout < 0:
+                    raise ValueError("The cache timeout can't be negative!")
+            elif option == '--keyring':
+                if value not in ('user', 'session'):
+                    raise ValueError("Unsupported keyring! (%s)" % value)
+                keyring = value
+            elif option == '--daemon':
+                daemon = True
+            elif option == '--linger':
+                linger = float(value)
+                if linger < 0:
+                    raise ValueError("The linger time can't be negative!")
+            elif option == '--timeout':
+                timeout = float(value)
+                if timeout < 0:
+                    raise ValueError("The timeout can't be negative!")
+            elif option == '--dry-run':
+                dry_run = True
+            elif option == '--json':
+                output_json = True
+            elif option == '--timings':
+                timings_format = timings_format or 'text'
+            elif option == '--key-store':
+                from crypto_drive_manager.keystore import STORE_FORMATS
+                if value not in STORE_FORMATS:
+                    raise ValueError("Unsupported key store format! (%s)" % value)
+                store_format = value
+            elif option == '--wait-for-devices':
+                if wait_for_devices is None:
+                    from crypto_drive_manager.plan import DEFAULT_DEVICE_TIMEOUT
+                    wait_for_devices = DEFAULT_DEVICE_TIMEOUT
+            elif option == '--metrics':
+                metrics_file = value
+            elif option == '--memory-budget':
+                from humanfriendly import parse_size
+                memory_budget = parse_size(value, binary=True)
             elif option == '--install-systemd-workaround':
                 install_workaround = True
             elif option in ('-v', '--verbose'):
-                coloredlogs.increase_verbosity()
+                verbosity += 1
             elif option in ('-q', '--quiet'):
-                coloredlogs.decrease_verbosity()
+                verbosity -= 1
             elif option in ('-h', '--help'):
+                from humanfriendly.terminal import usage
                 usage(__doc__)
                 return
             else:
                 assert False, "Unhandled option!"
     except Exception as e:
+        from humanfriendly.terminal import warning
         warning("Error: Failed to parse command line arguments! (%s)", e)
         sys.exit(1)
+    # Check for the 'status', 'lock', 'evict', 'rotate' and 'verify' commands.
+    command = arguments[0] if arguments and arguments[0] in ('status', 'lock', 'evict', 'rotate', 'verify') else None
+    if command:
+        arguments = arguments[1:]
     # Make sure we're running as root (after parsing the command
     # line so that root isn't required to list the usage message).
     if os.getuid() != 0:
+        from humanfriendly.terminal import warning
         warning("Error: Please run this command as root!")
         sys.exit(1)
-    # Decide if the systemd workaround is being executed based on sys.argv[0].
-    if systemd_workaround_requested():
-        update_systemd_services()
-        # In this case none of the other code should run.
-        return
+    # Initialize logging to the terminal and system log.
+    import coloredlogs
+    coloredlogs.install(syslog=True)
+    for i in range(abs(verbosity)):
+        if verbosity > 0:
+            coloredlogs.increase_verbosity()
+        else:
+            coloredlogs.decrease_verbosity()
     # Check if the operator wants to install the systemd workaround.
     if install_workaround:
+        from crypto_drive_manager.systemd import install_systemd_workaround
         install_systemd_workaround()
     # Initialize the keys device and use it to unlock the managed drives?
     # Only if we didn't just install the systemd workaround OR the operator
     # requested to unlock specific drives.
     if (not install_workaround) or arguments:
+        from crypto_drive_manager import ActivationFailed
+        from crypto_drive_manager.state import SystemState
+        from crypto_drive_manager.timings import Timings
+        timings = Timings() if timings_format or metrics_file else None
+        metrics = None
+        if metrics_file and not (command or dry_run or daemon or migrate_keyslots):
+            from crypto_drive_manager.metrics import RunMetrics
+            metrics = RunMetrics(timings)
         try:
-            initialize_keys_device(
-                image_file=image_file,
-                mapper_name=mapper_name,
-                mount_point=mount_point,
-                volumes=arguments,
-            )
+            if command == 'evict':
+                from humanfriendly import pluralize
+                from crypto_drive_manager.keyring import KernelKeyring
+                cache = KernelKeyring(keyring)
+                evicted = cache.evict(arguments or None)
+                logger.info("Evicted %s from %s.", pluralize(len(evicted), "cached key"), cache)
+            elif command == 'status' or (dry_run and not command):
+                from crypto_drive_manager.plan import create_plan
+                plan = create_plan(
+                    keys_directory=mount_point,
+                    volumes=arguments,
+                    first_run=not os.path.isfile(image_file),
+                    state=SystemState(timings=timings),
+                )
+                if output_json:
+                    print(plan.render_json())
+                elif command == 'status':
+                    print(plan.render_table())
+                else:
+                    print(plan.render_actions())
+            elif daemon and not (command or migrate_keyslots):
+                # The daemon coordinates with concurrent runs for each batch of events.
+                from crypto_drive_manager.coordination import DEFAULT_DIRECTORY
+                from crypto_drive_manager.daemon import HotplugDaemon
+                HotplugDaemon(
+                    image_file=image_file,
+                    mapper_name=mapper_name,
+                    mount_point=mount_point,
+                    volumes=arguments,
+                    linger=linger,
+                    concurrency=concurrency or 1,
+                    fast_keyslots=fast_keyslots,
+                    key_cache=create_key_cache(keyring, cache_timeout),
+                    coordination_directory=DEFAULT_DIRECTORY,
+                    state=SystemState(timings=timings),
+                ).run()
+            else:
+                # Wait for concurrent runs that could interfere with this one.
+                from crypto_drive_manager.coordination import RunCoordinator
+                with RunCoordinator(volumes=arguments) as coordinator:
+                    if command == 'lock':
+                        from crypto_drive_manager.teardown import (
+                            DEFAULT_TIMEOUT, TeardownStatus,
+                            lock_encrypted_drives, lock_keys_device, render_lock_report,
+                        )
+                        state = SystemState(timings=timings)
+                        drives = lock_encrypted_drives(
+                            keys_directory=mount_point,
+                            volumes=arguments,
+                            concurrency=concurrency,
+                            timeout=DEFAULT_TIMEOUT if timeout is None else timeout,
+                            state=state,
+                        )
+                        if drives:
+                            print(render_lock_report(drives))
+                        from crypto_drive_manager.keyring import forget_keys
+                        forget_keys([d.mapper_name for d in drives if d.status == TeardownStatus.LOCKED], keyring)
+                        if any(d.status != TeardownStatus.LOCKED for d in drives):
+                            sys.exit(1)
+                        if not arguments:
+                            lock_keys_device(mapper_name, mount_point, state)
+                    elif command == 'rotate':
+                        from humanfriendly import pluralize
+                        from crypto_drive_manager import rotate_keys
+                        from crypto_drive_manager.keyring import forget_keys
+                        from crypto_drive_manager.rotation import render_rotation_report
+                        results = rotate_keys(
+                            image_file=image_file,
+                            mapper_name=mapper_name,
+                            mount_point=mount_point,
+                            volumes=arguments,
+                            concurrency=concurrency or 1,
+                            fast_keyslots=fast_keyslots,
+                            coordinator=coordinator,
+                            state=SystemState(timings=timings),
+                        )
+                        print(render_rotation_report(results))
+                        forget_keys(sorted(results), keyring)
+                        if results.failures:
+                            logger.error("Failed to rotate %s!", pluralize(len(results.failures), "key"))
+                            sys.exit(1)
+                    elif command == 'verify':
+                        from crypto_drive_manager import verify_keys
+                        from crypto_drive_manager.verification import (
+                            render_verification_json,
+                            render_verification_report,
+                        )
+                        results = verify_keys(
+                            image_file=image_file,
+                            mapper_name=mapper_name,
+                            mount_point=mount_point,
+                            volumes=arguments,
+                            concurrency=concurrency,
+                            memory_budget=memory_budget,
+                            coordinator=coordinator,
+                            state=SystemState(timings=timings),
+                        )
+                        if output_json:
+                            print(render_verification_json(results))
+                        else:
+                            print(render_verification_report(results))
+                        if results.failures or any(r.status != 'passed' for r in results.values()):
+                            sys.exit(1)
+                    elif migrate_keyslots:
+                        from humanfriendly import pluralize
+                        from crypto_drive_manager import migrate_key_slots
+                        from crypto_drive_manager.keyslots import render_migration_report
+                        results = migrate_key_slots(
+                            image_file=image_file,
+                            mapper_name=mapper_name,
+                            mount_point=mount_point,
+                            volumes=arguments,
+                            concurrency=concurrency or 1,
+                            coordinator=coordinator,
+                            state=SystemState(timings=timings),
+                        )
+                        print(render_migration_report(results))
+                        if results.failures:
+                            logger.error("Failed to migrate %s!", pluralize(len(results.failures), "key slot"))
+                            sys.exit(1)
+                    else:
+                        from crypto_drive_manager import initialize_keys_device
+                        initialize_keys_device(
+                            image_file=image_file,
+                            mapper_name=mapper_name,
+                            mount_point=mount_point,
+                            volumes=arguments,
+                            concurrency=concurrency or 1,
+                            pipeline=pipeline,
+                            fast_keyslots=fast_keyslots,
+                            key_cache=create_key_cache(keyring, cache_timeout),
+                            wait_for_devices=wait_for_devices,
+                            store_format=store_format,
+                            coordinator=coordinator,
+                            metrics=metrics,
+                            state=SystemState(timings=timings),
+                        )
         except KeyboardInterrupt:
             logger.error("Interrupted by Control-C, terminating ..")
             sys.exit(1)
+        except ActivationFailed as e:
+            # The individual failures have already been logged.
+            logger.error("%s", e)
+            sys.exit(1)
         except Exception:
             logger.exception("Terminating due to unexpected exception!")
             sys.exit(1)
+        finally:
+            if metrics is not None:
+                try:
+                    metrics.write(metrics_file)
+                except Exception as e:
+                    logger.warning("Failed to write metrics to %s! (%s)", metrics_file, e)
+            if timings_format == 'json':
+                print(timings.render_json())
+            elif timings_format:
+                print(timings.render_report())
+
+
+def create_key_cache(keyring, timeout):
+    """
+    Create the key cache requested by ``--cache-keys``.
+
+    :param keyring: The value of the ``--keyring`` option (a string).
+    :param timeout: The value of the ``--cache-keys`` option (a number) or
+                    :data:`None` when keys shouldn't be cached.
+    :returns: A :class:`.KernelKeyring` object or :data:`None` (also when
+              the kernel keyring isn't available, which is logged).
+    """
+    if timeout is not None:
+        from crypto_drive_manager.keyring import KernelKeyring, KeyringError
+        try:
+            return KernelKeyring(keyring, timeout=timeout)
+        except KeyringError as e:
+            logger.warning("Not caching keys: %s", e)
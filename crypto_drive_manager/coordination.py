@@ -0,0 +1,272 @@
+# Coordination of concurrent invocations.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Coordination of concurrent invocations of `crypto-drive-manager`.
+
+Several triggers (udev rules, systemd units, cron jobs and operators) can
+start `crypto-drive-manager` at the same time. Without coordination these
+runs race on ``cryptsetup luksOpen`` of the virtual keys device, on mounting
+its mount point and on locking the virtual keys device while another run
+still needs it. :class:`RunCoordinator` serializes runs using :man:`flock`
+on a lock file and adds single-flight semantics on top of that:
+
+- A run that has to wait for another run reuses the results of that run: The
+  drives that it activated are already unlocked (so there's nothing left to
+  do for them) and the drives for which it failed are reported as failures
+  without trying again. Only the drives that weren't covered by the other
+  run are activated.
+
+- Runs that are waiting register themselves by holding a shared lock on a
+  second file. A run that's about to lock the virtual keys device checks for
+  waiting runs and when there are any it leaves the virtual keys device
+  unlocked for them. The last run locks it, which means the lifetime of the
+  virtual keys device is reference counted between the runs.
+"""
+
+# Standard library modules.
+import errno
+import fcntl
+import json
+import os
+import time
+
+# External dependencies.
+from humanfriendly import Timer, concatenate, pluralize
+from verboselogs import VerboseLogger
+
+DEFAULT_DIRECTORY = '/run/crypto-drive-manager'
+"""The directory that contains the files used by :class:`RunCoordinator` (a string)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class RunCoordinator(object):
+
+    """
+    Context manager that serializes runs with single-flight semantics.
+
+    The directory given to the constructor contains three files:
+
+    ``lock``
+     Exclusively locked while a run is active.
+
+    ``waiters``
+     Locked in shared mode by runs that are waiting for the active run.
+
+    ``run.json``
+     Describes the active run (or the last run when no run is active),
+     including its results once it has finished.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, volumes=()):
+        """
+        Initialize a :class:`RunCoordinator` object.
+
+        :param directory: The pathname of the directory that contains the
+                          coordination files (a string, created when it
+                          doesn't exist yet).
+        :param volumes: See :func:`.initialize_keys_device()`.
+        """
+        self.directory = directory
+        self.volumes = list(volumes)
+        self.lock_fd = None
+        self.run = None
+        self.previous_run = None
+        """A dictionary with the results of the run that we waited for (or :data:`None`)."""
+        self.inherited_keys_device = False
+        """:data:`True` if the run that we waited for left the virtual keys device unlocked for us."""
+        self.keys_device_kept = False
+        """:data:`True` when the virtual keys device was left unlocked for a waiting run."""
+
+    @property
+    def lock_file(self):
+        """The pathname of the lock file (a string)."""
+        return os.path.join(self.directory, 'lock')
+
+    @property
+    def waiters_file(self):
+        """The pathname of the file that's locked by waiting runs (a string)."""
+        return os.path.join(self.directory, 'waiters')
+
+    @property
+    def run_file(self):
+        """The pathname of the file that describes the active or last run (a string)."""
+        return os.path.join(self.directory, 'run.json')
+
+    def __enter__(self):
+        """Wait for the active run (if any) to finish and register this run."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not try_lock(self.lock_fd, fcntl.LOCK_EX):
+                self.wait()
+        except BaseException:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+            raise
+        self.write_run(started=time.time())
+        return self
+
+    def wait(self):
+        """
+        Wait for the active run to finish (while registered as a waiting run).
+
+        When the active run finished after we started waiting its results
+        are available in :attr:`previous_run`.
+        """
+        timer = Timer()
+        started = time.time()
+        active = self.read_run()
+        waiters_fd = os.open(self.waiters_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(waiters_fd, fcntl.LOCK_SH)
+            logger.info("Waiting for concurrent run (%s) to finish ..", describe_run(active))
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        finally:
+            os.close(waiters_fd)
+        finished = self.read_run()
+        self.inherited_keys_device = bool(finished.get('keys_device_kept'))
+        if (finished.get('finished') or 0) >= started:
+            self.previous_run = finished
+        logger.verbose("Waited %s for concurrent run.", timer)
+
+    def has_waiters(self):
+        """
+        Check if other runs are waiting for this run to finish.
+
+        :returns: :data:`True` if other runs are waiting, :data:`False` otherwise.
+        """
+        fd = os.open(self.waiters_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if try_lock(fd, fcntl.LOCK_EX):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return False
+            return True
+        finally:
+            os.close(fd)
+
+    def keep_keys_device(self):
+        """
+        Decide whether to leave the virtual keys device unlocked for waiting runs.
+
+        :returns: :data:`True` when other runs are waiting (in which case the
+                  caller shouldn't lock the virtual keys device), :data:`False`
+                  otherwise.
+        """
+        if self.has_waiters():
+            logger.info("Leaving virtual keys device unlocked for concurrent run(s) ..")
+            self.keys_device_kept = True
+        return self.keys_device_kept
+
+    def reuse_results(self, plan, results):
+        """
+        Reuse the results of the run that we waited for.
+
+        :param plan: An :class:`.ActivationPlan` object.
+        :param results: The :class:`.ActivationResults` of this run.
+
+        Drives that the other run failed to activate are recorded as failures
+        and their actions are removed from the plan. Drives that the other run
+        activated don't need to be handled because the plan was created after
+        the other run finished.
+        """
+        if not self.previous_run:
+            return
+        failures = self.previous_run.get('failures', {})
+        reused = [d for d in plan.drives if d.mapper_name in failures]
+        for drive in reused:
+            drive.actions = []
+            results.pop(drive.mapper_name, None)
+            results.failures[drive.mapper_name] = Exception("Failed in concurrent run (%s): %s" % (
+                describe_run(self.previous_run), failures[drive.mapper_name],
+            ))
+        logger.info("Reusing results of concurrent run (%s): %s activated, %s failed.",
+                    describe_run(self.previous_run),
+                    pluralize(len(self.previous_run.get('activated', [])), "drive"),
+                    pluralize(len(reused), "selected drive"))
+
+    def record_results(self, results):
+        """
+        Record the results of this run for runs that are waiting for it.
+
+        :param results: An :class:`.ActivationResults` object.
+        """
+        self.write_run(
+            finished=time.time(),
+            activated=sorted(results),
+            failures=dict((name, str(e)) for name, e in results.failures.items()),
+        )
+
+    def read_run(self):
+        """
+        Read the description of the active (or last) run.
+
+        :returns: A dictionary (empty when the file doesn't exist or can't be parsed).
+        """
+        try:
+            with open(self.run_file) as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_run(self, **fields):
+        """
+        Update the description of this run.
+
+        :param fields: The fields to update.
+        """
+        if self.run is None:
+            self.run = dict(pid=os.getpid(), volumes=self.volumes)
+        self.run.update(fields, keys_device_kept=self.keys_device_kept)
+        temporary_file = '%s.%i.tmp' % (self.run_file, os.getpid())
+        with open(temporary_file, 'w') as handle:
+            json.dump(self.run, handle)
+        os.rename(temporary_file, self.run_file)
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Release the lock (so that a waiting run can start)."""
+        if self.lock_fd is not None:
+            try:
+                # Make sure the next run knows about the virtual keys device,
+                # even when this run didn't finish normally.
+                if self.keys_device_kept != self.run.get('keys_device_kept'):
+                    self.write_run()
+            finally:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+
+def try_lock(fd, operation):
+    """
+    Try to acquire a lock without blocking.
+
+    :param fd: An open file descriptor (an integer).
+    :param operation: :data:`fcntl.LOCK_EX` or :data:`fcntl.LOCK_SH`.
+    :returns: :data:`True` if the lock was acquired, :data:`False` otherwise.
+    """
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return False
+        raise
+
+
+def describe_run(run):
+    """
+    Render a human friendly description of a run.
+
+    :param run: A dictionary as returned by :func:`RunCoordinator.read_run()`.
+    :returns: A string.
+    """
+    if not run:
+        return "unknown process"
+    volumes = run.get('volumes')
+    return "process %s, %s" % (run.get('pid', '?'), "drives %s" % concatenate(volumes) if volumes else "all drives")
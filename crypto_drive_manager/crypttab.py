@@ -0,0 +1,114 @@
+# Indexed and cached parsing of /etc/crypttab.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Indexed and cached parsing of ``/etc/crypttab``.
+
+The :class:`CrypttabIndex` class parses ``/etc/crypttab`` once and indexes
+the entries by mapper name, by source device and by the directories that
+contain their key files, so that these lookups don't require scanning all
+entries (which matters with crypttab files of thousands of entries).
+
+:func:`load_crypttab()` caches the index of each crypttab file for as long as
+the file isn't changed (based on its inode, size and modification time) so
+that long running callers like the :mod:`~crypto_drive_manager.daemon` can
+refresh their view of the system without parsing ``/etc/crypttab`` again.
+"""
+
+# Standard library modules.
+import os
+import threading
+
+# External dependencies.
+from linux_utils import coerce_context
+from linux_utils.crypttab import parse_crypttab
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The cached indexes (see load_crypttab()).
+cache = {}
+cache_lock = threading.Lock()
+
+
+def load_crypttab(filename='/etc/crypttab', context=None):
+    """
+    Get a (cached) :class:`CrypttabIndex` for a crypttab file.
+
+    :param filename: The pathname of the crypttab file (a string, defaults
+                     to ``/etc/crypttab``).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: A :class:`CrypttabIndex` object.
+
+    The index is reused as long as the inode, size and modification time of
+    the file don't change. Because :func:`os.stat()` only works for local
+    contexts (see :func:`.is_local_context()`) crypttab files are parsed on
+    every call when other contexts are used.
+    """
+    from crypto_drive_manager.state import is_local_context
+    context = coerce_context(context)
+    if not is_local_context(context):
+        return CrypttabIndex(parse_crypttab(filename=filename, context=context))
+    try:
+        stat = os.stat(filename)
+        signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+    except OSError:
+        signature = None
+    with cache_lock:
+        cached = cache.get(filename)
+        if cached and signature and cached.signature == signature:
+            logger.debug("Reusing cached index of %s ..", filename)
+            return cached
+    index = CrypttabIndex(parse_crypttab(filename=filename, context=context), signature=signature)
+    if signature:
+        with cache_lock:
+            cache[filename] = index
+    return index
+
+
+class CrypttabIndex(object):
+
+    """Entries parsed from ``/etc/crypttab`` indexed for fast lookups."""
+
+    def __init__(self, entries, signature=None):
+        """
+        Initialize a :class:`CrypttabIndex` object.
+
+        :param entries: An iterable of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry` objects.
+        :param signature: A tuple that identifies the version of the parsed
+                          file (used by :func:`load_crypttab()`).
+        """
+        self.entries = list(entries)
+        self.signature = signature
+        self.by_target = {}
+        self.by_source = {}
+        self.by_keys_directory = {}
+        for entry in self.entries:
+            self.by_target[entry.target] = entry
+            if entry.source_device:
+                self.by_source[entry.source_device] = entry
+            if 'luks' in entry.options and entry.key_file:
+                # Index the entry under every directory that contains the key
+                # file, because the keys directory can be any of these (this
+                # matches the semantics of match_prefix()).
+                directory = os.path.dirname(os.path.normpath(entry.key_file))
+                while True:
+                    self.by_keys_directory.setdefault(directory, []).append(entry)
+                    parent = os.path.dirname(directory)
+                    if parent == directory:
+                        break
+                    directory = parent
+
+    def find_managed_drives(self, keys_directory):
+        """
+        Find the entries whose key files are located in the given directory.
+
+        :param keys_directory: The mount point of the virtual keys device (a string).
+        :returns: A list of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry`
+                  objects (in the order in which they appear in the crypttab file).
+        """
+        return list(self.by_keys_directory.get(os.path.normpath(keys_directory), []))
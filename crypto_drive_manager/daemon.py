@@ -0,0 +1,460 @@
+# Hotplug daemon for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Resident daemon that unlocks managed drives as they appear.
+
+A normal run of `crypto-drive-manager` skips drives that aren't available at
+that moment, so drives that spin up late or are hot swapped require another
+run. The :class:`HotplugDaemon` class keeps an index of the managed drives in
+memory, waits for block devices to appear (see :class:`InotifyEventSource`)
+and unlocks and mounts only the drives that just arrived. Events that arrive
+in quick succession are handled as a single batch and the virtual keys device
+can be kept unlocked for a while after a batch, so that a drive bay full of
+disks that appear one after another doesn't unlock the virtual keys device
+for every disk.
+"""
+
+# Standard library modules.
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import struct
+import time
+
+# External dependencies.
+from humanfriendly import Timer, format_timespan, pluralize
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import (
+    ActivationFailed,
+    KeysDevice,
+    decide_cleanup,
+    find_managed_drives,
+    report_results,
+    select_managed_drives,
+)
+from crypto_drive_manager.state import SystemState
+
+DEFAULT_DEBOUNCE = 1.0
+"""The number of seconds to wait for more events before handling a batch (a number)."""
+
+DEFAULT_LINGER = 0
+"""The number of seconds that the virtual keys device stays unlocked after a batch (a number)."""
+
+DEFAULT_WATCH_DIRECTORIES = ('/dev/disk/by-uuid',)
+"""The directories watched by :class:`InotifyEventSource` (a tuple of strings)."""
+
+IN_CREATE = 0x00000100
+"""The inotify event mask for files created in a watched directory."""
+
+IN_MOVED_TO = 0x00000080
+"""The inotify event mask for files moved into a watched directory."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class HotplugDaemon(object):
+
+    """Unlock and mount managed drives as they appear."""
+
+    def __init__(self, image_file, mapper_name, mount_point, volumes=(), events=None,
+                 debounce=DEFAULT_DEBOUNCE, linger=DEFAULT_LINGER, cleanup=None,
+                 concurrency=1, fast_keyslots=False, key_cache=None, coordination_directory=None, state=None):
+        """
+        Initialize a :class:`HotplugDaemon` object.
+
+        :param image_file: See :func:`.initialize_keys_device()`.
+        :param mapper_name: See :func:`.initialize_keys_device()`.
+        :param mount_point: See :func:`.initialize_keys_device()`.
+        :param volumes: See :func:`.initialize_keys_device()`.
+        :param events: The event source (an object with the methods
+                       ``wait()`` and ``close()`` like
+                       :class:`InotifyEventSource`, which is the default).
+        :param debounce: The number of seconds to wait for more events
+                         before a batch is handled (a number).
+        :param linger: The number of seconds that the virtual keys device
+                       stays unlocked after a batch was handled (a number).
+                       When another batch arrives in the meantime the
+                       virtual keys device is reused.
+        :param cleanup: See :func:`.initialize_keys_device()`.
+        :param concurrency: See :func:`.initialize_keys_device()`.
+        :param fast_keyslots: See :func:`.initialize_keys_device()`.
+        :param key_cache: See :func:`.initialize_keys_device()`.
+        :param coordination_directory: The directory used by :class:`.RunCoordinator`
+                                       to serialize the handling of each batch
+                                       with concurrent runs (a string or
+                                       :data:`None` to skip coordination).
+        :param state: A :class:`.SystemState` object (optional).
+        """
+        self.image_file = image_file
+        self.mapper_name = mapper_name
+        self.mount_point = mount_point
+        self.volumes = volumes
+        self.events = events or InotifyEventSource()
+        self.debounce = debounce
+        self.linger = linger
+        self.cleanup = cleanup
+        self.concurrency = concurrency
+        self.fast_keyslots = fast_keyslots
+        self.key_cache = key_cache
+        self.coordination_directory = coordination_directory
+        self.state = state or SystemState()
+        self.keys_device = None
+        self.lock_deadline = None
+        self.index = {}
+        self.indexed_crypttab = None
+        self.closed = False
+
+    def build_index(self):
+        """
+        Index the managed drives by the pathname of their source device.
+
+        The index maps the pathnames of the source devices (and the resolved
+        pathnames, so that events for symbolic links like the ones in
+        ``/dev/disk/by-uuid`` match) to crypttab entries. The index is only
+        rebuilt by :func:`handle()` when ``/etc/crypttab`` was changed (see
+        :func:`.load_crypttab()`).
+        """
+        self.index = {}
+        self.indexed_crypttab = self.state.crypttab
+        for entry in find_managed_drives(self.mount_point, state=self.state):
+            if not self.volumes or entry.target in self.volumes:
+                self.index[entry.source_device] = entry
+                self.index[os.path.realpath(entry.source_device)] = entry
+        logger.verbose("Watching for %s.", pluralize(len(set(e.target for e in self.index.values())), "managed drive"))
+
+    def run(self):
+        """
+        Unlock the available drives and then handle events until the event source is closed.
+
+        Drives that are available when the daemon starts are unlocked right
+        away. Afterwards each batch of events is passed to :func:`handle()`.
+        Failures to handle a batch are logged but don't stop the daemon.
+
+        When the daemon runs in the main thread :data:`~signal.SIGTERM` is
+        handled (see :func:`terminate()`) so that ``systemctl stop`` locks
+        the virtual keys device before the daemon exits.
+        """
+        if self.cleanup is None:
+            self.cleanup = decide_cleanup(self.mount_point, self.state)
+        self.build_index()
+        try:
+            previous_handler = signal.signal(signal.SIGTERM, self.terminate)
+        except ValueError:
+            # Signal handlers can only be installed by the main thread.
+            previous_handler = None
+        try:
+            try:
+                num_configured, selected_drives = select_managed_drives(self.mount_point, self.volumes, self.state)
+                if selected_drives:
+                    self.activate(selected_drives)
+            except Exception:
+                logger.exception("Failed to activate the available drives!")
+            while True:
+                batch = self.wait_for_batch()
+                if batch is None:
+                    break
+                elif batch:
+                    try:
+                        self.handle(batch)
+                    except Exception:
+                        logger.exception("Failed to handle events for %s!", ', '.join(sorted(batch)))
+        finally:
+            self.closed = True
+            self.lock_keys_device()
+            self.events.close()
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+
+    def terminate(self, signal_number, frame):
+        """
+        Handle :data:`~signal.SIGTERM` by stopping the daemon.
+
+        :raises: :exc:`~exceptions.SystemExit` so that :func:`run()` locks the
+                 virtual keys device and closes the event source on the way
+                 out (signals that arrive during this cleanup are ignored).
+        """
+        if not self.closed:
+            logger.info("Received SIGTERM, stopping the hotplug daemon ..")
+            self.closed = True
+            raise SystemExit(0)
+
+    def wait_for_batch(self):
+        """
+        Wait for events and collect events that arrive in quick succession.
+
+        :returns: A set of pathnames (empty when the virtual keys device was
+                  locked because its linger time expired) or :data:`None`
+                  when the event source was closed.
+
+        While the virtual keys device is unlocked the wait is limited to the
+        remaining linger time, otherwise the wait is unbounded.
+        """
+        timeout = None
+        if self.closed:
+            return None
+        if self.lock_deadline is not None:
+            timeout = max(0, self.lock_deadline - time.time())
+        pathnames = self.events.wait(timeout)
+        if pathnames is None:
+            return None
+        if not pathnames:
+            self.lock_keys_device()
+            return set()
+        batch = set(pathnames)
+        # Keep collecting events until no more events arrive for `debounce' seconds.
+        while True:
+            more = self.events.wait(self.debounce)
+            if more is None:
+                # Handle the batch before stopping.
+                self.closed = True
+            if not more:
+                break
+            batch.update(more)
+        return batch
+
+    def handle(self, pathnames):
+        """
+        Unlock and mount the managed drives that correspond to a batch of events.
+
+        :param pathnames: An iterable of pathnames of block devices that appeared.
+        """
+        self.state.refresh()
+        if self.state.crypttab is not self.indexed_crypttab:
+            self.build_index()
+        drives = {}
+        for pathname in pathnames:
+            entry = self.index.get(pathname) or self.index.get(os.path.realpath(pathname))
+            if entry and not self.state.is_mapped(entry.target):
+                drives[entry.target] = entry
+        if drives:
+            logger.info("Detected %s: %s", pluralize(len(drives), "managed drive"), ', '.join(sorted(drives)))
+            self.activate(list(drives.values()))
+        else:
+            logger.debug("Ignoring events for unmanaged or unlocked devices: %s", ', '.join(sorted(pathnames)))
+
+    def activate(self, drives):
+        """
+        Unlock and mount the given drives (unlocking the virtual keys device as needed).
+
+        :param drives: A list of :class:`~linux_utils.crypttab.EncryptedFileSystemEntry` objects.
+        :raises: Any exceptions raised while unlocking the virtual keys device
+                 (:func:`run()` logs them). Drives that fail to activate are
+                 logged and don't raise an exception.
+
+        The actions are decided by :func:`.create_plan()` and carried out by
+        :class:`.PlanExecutor`, so drives that contain an LVM physical volume
+        and nested mount points are handled like in a normal run. When a key
+        cache is given the drives whose keys are cached are unlocked without
+        unlocking the virtual keys device. When the virtual keys device
+        contains a key store the keys are loaded into memory and fed to
+        ``cryptsetup open`` (see :func:`.unlock_with_key()`).
+        """
+        from crypto_drive_manager.plan import PlanExecutor, create_plan
+        timer = Timer()
+        with self.coordinate() as coordinator:
+            first_run = self.keys_device is None and not os.path.isfile(self.image_file)
+            plan = create_plan(self.mount_point, [d.target for d in drives], first_run=first_run,
+                               keys_accessible=False, state=self.state)
+            executor = PlanExecutor(plan, fast_keyslots=self.fast_keyslots, concurrency=self.concurrency,
+                                    state=self.state)
+            if coordinator is not None:
+                coordinator.reuse_results(plan, executor.results)
+            keys = {}
+            try:
+                if self.key_cache is not None and not plan.first_run:
+                    executor.unlock_cached_drives(self.key_cache)
+                if plan.needs_keys:
+                    if self.keys_device is None:
+                        # KeysDevice.__enter__() cleans up after itself when it fails.
+                        keys_device = KeysDevice(self.image_file, self.mapper_name, self.mount_point,
+                                                 self.cleanup, coordinator=coordinator, state=self.state)
+                        self.keys_device = keys_device.__enter__()
+                    key_store = self.keys_device.key_store
+                    executor.key_store = key_store
+                    plan.check_key_files(key_store)
+                    executor.install_keys()
+                    if self.key_cache is not None or not key_store.has_files:
+                        keys = executor.load_keys()
+                        if self.key_cache is not None:
+                            executor.cache_keys(self.key_cache, keys)
+                    executor.unlock_drives(keys if not key_store.has_files else None)
+                executor.mount_drives()
+                if coordinator is not None:
+                    coordinator.record_results(executor.results)
+                report_results(executor.results, len(drives), len(plan.available_drives))
+            except ActivationFailed as e:
+                logger.error("%s", e)
+            finally:
+                for key in keys.values():
+                    key.wipe()
+                if self.linger > 0 and self.keys_device is not None:
+                    self.lock_deadline = time.time() + self.linger
+                    logger.verbose("Keeping virtual keys device unlocked for %s.", format_timespan(self.linger))
+                else:
+                    self.close_keys_device()
+        logger.verbose("Handled %s in %s.", pluralize(len(drives), "drive"), timer)
+
+    @contextlib.contextmanager
+    def coordinate(self):
+        """
+        Serialize the handling of a batch with concurrent runs.
+
+        :returns: A context manager that gives a :class:`.RunCoordinator`
+                  object (or :data:`None` when :attr:`coordination_directory`
+                  isn't set).
+
+        The lock is only held while a batch is handled (or while the virtual
+        keys device is being locked), so that other runs aren't blocked while
+        the daemon is idle. Because a concurrent run may have locked the
+        virtual keys device while it was lingering, the state of the system
+        is refreshed once the lock has been acquired.
+        """
+        if self.coordination_directory is None:
+            yield None
+            return
+        from crypto_drive_manager.coordination import RunCoordinator
+        with RunCoordinator(self.coordination_directory, self.volumes) as coordinator:
+            self.state.refresh()
+            if self.keys_device is not None and not self.state.is_mapped(self.mapper_name):
+                logger.verbose("Virtual keys device was locked by a concurrent run.")
+                self.keys_device = None
+                self.lock_deadline = None
+            if self.keys_device is not None:
+                self.keys_device.coordinator = coordinator
+            try:
+                yield coordinator
+            finally:
+                if self.keys_device is not None:
+                    self.keys_device.coordinator = None
+
+    def lock_keys_device(self):
+        """Lock the virtual keys device (if it's currently unlocked) while coordinating with concurrent runs."""
+        if self.keys_device is not None:
+            with self.coordinate():
+                self.close_keys_device()
+
+    def close_keys_device(self):
+        """Lock the virtual keys device (if it's currently unlocked)."""
+        keys_device, self.keys_device = self.keys_device, None
+        self.lock_deadline = None
+        if keys_device is not None:
+            keys_device.__exit__()
+
+
+class InotifyEventSource(object):
+
+    """
+    Event source that uses :man:`inotify` to watch for block devices that appear.
+
+    Watching ``/dev/disk/by-uuid`` has the advantage over listening to udev
+    events that the symbolic links only appear after udev has probed the
+    device, so that the device is ready to be unlocked.
+
+    Directories that don't exist yet (for example ``/dev/disk/by-partuuid``
+    before the first partition appears) are watched by watching their closest
+    existing parent directory until they're created.
+    """
+
+    def __init__(self, directories=DEFAULT_WATCH_DIRECTORIES):
+        """
+        Initialize an :class:`InotifyEventSource` object.
+
+        :param directories: The directories to watch (an iterable of strings).
+        :raises: :exc:`~exceptions.OSError` when inotify isn't available.
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise_errno("Failed to initialize inotify!")
+        self.watches = {}
+        self.pending = set()
+        for directory in directories:
+            self.add_watch(directory)
+
+    def add_watch(self, directory):
+        """
+        Start watching a directory.
+
+        :param directory: The pathname of the directory (a string).
+        :returns: :data:`True` if the directory is being watched, :data:`False`
+                  if it doesn't exist yet (in which case its closest existing
+                  parent directory is watched until it's created).
+        """
+        existing = directory
+        while not os.path.isdir(existing):
+            existing = os.path.dirname(existing)
+        wd = self.libc.inotify_add_watch(self.fd, existing.encode('UTF-8'), IN_CREATE | IN_MOVED_TO)
+        if wd < 0:
+            raise_errno("Failed to watch %s!" % existing)
+        self.watches[wd] = existing
+        if existing != directory:
+            self.pending.add(directory)
+            return False
+        self.pending.discard(directory)
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for block devices to appear.
+
+        :param timeout: The number of seconds to wait (a number or
+                        :data:`None` to wait indefinitely).
+        :returns: A list of pathnames (empty when the timeout expired) or
+                  :data:`None` when the event source was closed.
+        """
+        if self.fd is None:
+            return None
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        pathnames = list(self.parse_events(os.read(self.fd, 65536)))
+        for directory in sorted(self.pending):
+            if self.add_watch(directory):
+                # Report the entries that were created before the watch was added.
+                pathnames.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory)))
+        return pathnames
+
+    def parse_events(self, data):
+        """
+        Parse a buffer with ``inotify_event`` structures.
+
+        :param data: The data read from the inotify file descriptor (a byte string).
+        :returns: A generator of pathnames (strings).
+        """
+        offset = 0
+        header = struct.Struct('iIII')
+        while offset + header.size <= len(data):
+            wd, mask, cookie, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('UTF-8')
+            offset += length
+            if wd in self.watches and name:
+                yield os.path.join(self.watches[wd], name)
+
+    def close(self):
+        """Stop watching for events."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def raise_errno(message):
+    """Raise :exc:`~exceptions.OSError` based on the value of :data:`errno` in the C library."""
+    number = ctypes.get_errno()
+    raise OSError(number, "%s (%s)" % (message, os.strerror(number)))
@@ -0,0 +1,358 @@
+# Caching of drive keys in the Linux kernel keyring.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Caching of drive keys in the Linux kernel keyring.
+
+Unlocking the virtual keys device is the most expensive step of an unlock
+run (it involves key derivation for the pass phrase, a filesystem mount and
+afterwards an unmount and ``cryptsetup close``). When `crypto-drive-manager`
+runs repeatedly (for example from a timer or whenever drives are hot
+swapped) the keys of the drives can be cached in the kernel keyring with a
+timeout, so that later runs can unlock drives straight from the cache and
+only fall back to the virtual keys device on a cache miss.
+
+The kernel keyring is used via :man:`keyutils` (the C library behind the
+``keyctl`` program) so that keys are moved between the kernel and a
+:class:`.KeyBuffer` without ever being passed through a pipe or written to
+disk. :class:`KeyCache` defines the interface used by
+:func:`.initialize_keys_device()`, :class:`KernelKeyring` implements it on
+top of the kernel keyring and :class:`.SimulatedKeyring` is an in-memory
+implementation for testing.
+"""
+
+# Standard library modules.
+import ctypes
+import ctypes.util
+import errno
+import math
+import os
+import struct
+
+# External dependencies.
+from humanfriendly import format_timespan, pluralize
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.keys import KeyBuffer
+
+DEFAULT_KEY_TIMEOUT = 60 * 15
+"""The default number of seconds after which cached keys expire (an integer, defaults to 15 minutes)."""
+
+DEFAULT_KEYRING = 'user'
+"""The name of the default keyring (a string, see :data:`KEYRINGS`)."""
+
+DESCRIPTION_PREFIX = 'crypto-drive-manager:'
+"""The prefix of the descriptions of cached keys (a string, followed by the mapper name)."""
+
+KEY_TYPE = 'user'
+"""The kernel key type used for cached keys (a string)."""
+
+KEYRINGS = dict(session=-3, user=-4)
+"""
+A dictionary with the names of the supported keyrings (strings) as keys and
+their special key serial numbers (integers) as values:
+
+``user``
+ The keyring of the current user, which survives the process (and the login
+ session) that created it. This is what allows later runs to find the cached
+ keys, so it's the default.
+
+``session``
+ The session keyring of the current process. Only processes that share the
+ session keyring (e.g. started from the same login shell) can use the cache.
+"""
+
+KEY_PERMISSIONS = 0x3f000000 | 0x002f0000
+"""
+The permissions of cached keys (an integer).
+
+The possessor gets all permissions and processes running as the same user get
+view, read, write, search and setattr permission. This is required because
+processes that don't possess the user keyring (like systemd services, which
+get a private session keyring) otherwise can't read, update or evict the
+cached keys.
+"""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class KeyringError(Exception):
+
+    """Raised when the kernel keyring can't be used."""
+
+
+class KeyCache(object):
+
+    """
+    Abstract base class for caches of drive keys.
+
+    Subclasses implement the methods :func:`find_key()`, :func:`read_key()`,
+    :func:`add_key()`, :func:`remove_key()` and :func:`list_keys()`. The cache
+    is used through :func:`lookup()`, :func:`store()` and :func:`evict()`.
+    """
+
+    def __init__(self, timeout=DEFAULT_KEY_TIMEOUT):
+        """
+        Initialize a :class:`KeyCache` object.
+
+        :param timeout: The number of seconds after which cached keys expire
+                        (a number, or :data:`None` to cache keys until they're
+                        evicted).
+        """
+        self.timeout = timeout
+
+    def lookup(self, names):
+        """
+        Get the cached keys of one or more drives.
+
+        :param names: An iterable of mapper names (strings).
+        :returns: A dictionary with mapper names as keys and :class:`.KeyBuffer`
+                  objects as values (drives whose key isn't cached are omitted).
+                  The caller is responsible for wiping the keys.
+        """
+        keys = {}
+        for name in names:
+            handle = self.find_key(DESCRIPTION_PREFIX + name)
+            if handle is not None:
+                key = self.read_key(handle)
+                if key is not None:
+                    keys[name] = key
+        logger.verbose("Found %s in %s.", pluralize(len(keys), "cached key"), self)
+        return keys
+
+    def store(self, keys):
+        """
+        Add keys to the cache (replacing any previously cached keys).
+
+        :param keys: A dictionary with mapper names as keys and :class:`.KeyBuffer`
+                     objects as values.
+        """
+        for name, key in sorted(keys.items()):
+            self.add_key(DESCRIPTION_PREFIX + name, key)
+        if keys:
+            logger.verbose("Cached %s in %s (%s).", pluralize(len(keys), "key"), self,
+                           "expires in %s" % format_timespan(self.timeout) if self.timeout else "no timeout")
+
+    def evict(self, names=None):
+        """
+        Remove cached keys.
+
+        :param names: An iterable of mapper names (strings) or :data:`None` to
+                      remove the cached keys of all drives.
+        :returns: The mapper names of the keys that were removed (a list of strings).
+        """
+        if names is None:
+            descriptions = [d for d in self.list_keys() if d.startswith(DESCRIPTION_PREFIX)]
+        else:
+            descriptions = [DESCRIPTION_PREFIX + n for n in names]
+        evicted = []
+        for description in sorted(descriptions):
+            handle = self.find_key(description)
+            if handle is not None:
+                self.remove_key(handle)
+                evicted.append(description[len(DESCRIPTION_PREFIX):])
+        return evicted
+
+    def find_key(self, description):
+        """
+        Find a cached key.
+
+        :param description: The description of the key (a string).
+        :returns: An opaque key handle or :data:`None` when the key isn't cached.
+        """
+        raise NotImplementedError()
+
+    def read_key(self, handle):
+        """
+        Read a cached key.
+
+        :param handle: A key handle returned by :func:`find_key()`.
+        :returns: A :class:`.KeyBuffer` object or :data:`None` when the key
+                  expired or was removed in the mean time.
+        """
+        raise NotImplementedError()
+
+    def add_key(self, description, key):
+        """
+        Add a key to the cache (respecting :attr:`timeout`).
+
+        :param description: The description of the key (a string).
+        :param key: A :class:`.KeyBuffer` object.
+        """
+        raise NotImplementedError()
+
+    def remove_key(self, handle):
+        """
+        Remove a key from the cache.
+
+        :param handle: A key handle returned by :func:`find_key()`.
+        """
+        raise NotImplementedError()
+
+    def list_keys(self):
+        """
+        List the cached keys.
+
+        :returns: A list of key descriptions (strings).
+        """
+        raise NotImplementedError()
+
+
+class KernelKeyring(KeyCache):
+
+    """Cache of drive keys in the Linux kernel keyring (using ``libkeyutils``)."""
+
+    def __init__(self, keyring=DEFAULT_KEYRING, timeout=DEFAULT_KEY_TIMEOUT):
+        """
+        Initialize a :class:`KernelKeyring` object.
+
+        :param keyring: The name of the keyring (one of the keys of :data:`KEYRINGS`).
+        :param timeout: See :class:`KeyCache`.
+        :raises: :exc:`KeyringError` when `keyring` isn't supported or
+                 ``libkeyutils`` isn't available.
+        """
+        super(KernelKeyring, self).__init__(timeout)
+        if keyring not in KEYRINGS:
+            raise KeyringError("Unsupported keyring! (%s)" % keyring)
+        self.keyring = keyring
+        self.library = load_keyutils()
+
+    @property
+    def keyring_id(self):
+        """The special key serial number of the keyring (an integer)."""
+        return KEYRINGS[self.keyring]
+
+    def find_key(self, description):
+        """Find a key using ``keyctl_search()``."""
+        serial = self.library.keyctl_search(self.keyring_id, KEY_TYPE.encode(), description.encode(), 0)
+        if serial < 0:
+            self.check_errno("search keyring", errno.ENOKEY, errno.EKEYEXPIRED, errno.EKEYREVOKED, errno.EACCES)
+            return None
+        return serial
+
+    def read_key(self, handle):
+        """Read a key using ``keyctl_read()``."""
+        size = self.library.keyctl_read(handle, None, 0)
+        if size < 0:
+            self.check_errno("read key", errno.ENOKEY, errno.EKEYEXPIRED, errno.EKEYREVOKED)
+            return None
+        key = KeyBuffer(size)
+        try:
+            if size and self.library.keyctl_read(handle, ctypes.addressof(key.view), size) != size:
+                # The key was removed or updated in the mean time.
+                key.wipe()
+                return None
+        except Exception:
+            key.wipe()
+            raise
+        return key
+
+    def add_key(self, description, key):
+        """Add a key to the keyring (using the ``add_key``, ``keyctl_setperm`` and ``keyctl_set_timeout`` calls)."""
+        pointer = ctypes.addressof(key.view) if key.view is not None else None
+        serial = self.library.add_key(KEY_TYPE.encode(), description.encode(), pointer, len(key.data), self.keyring_id)
+        if serial < 0:
+            self.check_errno("add key")
+        if self.library.keyctl_setperm(serial, KEY_PERMISSIONS) < 0:
+            self.check_errno("set key permissions")
+        # Round up so that sub-second timeouts don't mean "never expires" (zero).
+        if self.library.keyctl_set_timeout(serial, int(math.ceil(self.timeout or 0))) < 0:
+            self.check_errno("set key timeout")
+
+    def remove_key(self, handle):
+        """Remove a key using ``keyctl_invalidate()``."""
+        if self.library.keyctl_invalidate(handle) < 0:
+            self.check_errno("invalidate key", errno.ENOKEY, errno.EKEYEXPIRED, errno.EKEYREVOKED)
+
+    def list_keys(self):
+        """List the keys in the keyring using ``keyctl_read()`` and ``keyctl_describe()``."""
+        size = self.library.keyctl_read(self.keyring_id, None, 0)
+        if size < 0:
+            self.check_errno("list keyring", errno.ENOKEY)
+            return []
+        buffer = ctypes.create_string_buffer(size)
+        size = max(0, min(size, self.library.keyctl_read(self.keyring_id, buffer, size)))
+        serials = struct.unpack('%ii' % (size // 4), buffer.raw[:size - size % 4])
+        descriptions = []
+        for serial in serials:
+            text = ctypes.create_string_buffer(4096)
+            if self.library.keyctl_describe(serial, text, len(text)) >= 0:
+                # The format is `type;uid;gid;perm;description'.
+                fields = text.value.decode('utf-8', 'replace').split(';', 4)
+                if len(fields) == 5 and fields[0] == KEY_TYPE:
+                    descriptions.append(fields[4])
+        return descriptions
+
+    def check_errno(self, action, *expected):
+        """
+        Raise an exception for a failed ``libkeyutils`` call (unless the error is expected).
+
+        :param action: A description of what failed (a string).
+        :param expected: Zero or more :mod:`errno` values that are ignored.
+        :raises: :exc:`KeyringError` when the error isn't expected.
+        """
+        number = ctypes.get_errno()
+        if number not in expected:
+            raise KeyringError("Failed to %s in %s! (%s)" % (action, self, os.strerror(number)))
+
+    def __str__(self):
+        """Render a human friendly string representation of the keyring."""
+        return "%s keyring" % self.keyring
+
+
+def load_keyutils():
+    """
+    Load the ``libkeyutils`` shared library.
+
+    :returns: A :class:`ctypes.CDLL` object with the argument and result
+              types of the functions used by :class:`KernelKeyring`.
+    :raises: :exc:`KeyringError` when the library isn't available.
+    """
+    filename = ctypes.util.find_library('keyutils')
+    if not filename:
+        raise KeyringError("The kernel keyring can't be used because libkeyutils isn't installed!")
+    library = ctypes.CDLL(filename, use_errno=True)
+    serial, long_, size_t = ctypes.c_int32, ctypes.c_long, ctypes.c_size_t
+    signatures = dict(
+        add_key=(serial, [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, size_t, serial]),
+        keyctl_describe=(long_, [serial, ctypes.c_char_p, size_t]),
+        keyctl_invalidate=(long_, [serial]),
+        keyctl_read=(long_, [serial, ctypes.c_void_p, size_t]),
+        keyctl_search=(long_, [serial, ctypes.c_char_p, ctypes.c_char_p, serial]),
+        keyctl_set_timeout=(long_, [serial, ctypes.c_uint]),
+        keyctl_setperm=(long_, [serial, ctypes.c_uint32]),
+    )
+    for name, (restype, argtypes) in signatures.items():
+        function = getattr(library, name)
+        function.restype = restype
+        function.argtypes = argtypes
+    return library
+
+
+def forget_keys(names=None, keyring=DEFAULT_KEYRING):
+    """
+    Remove cached keys from the kernel keyring (if the kernel keyring can be used).
+
+    :param names: See :func:`KeyCache.evict()`.
+    :param keyring: See :class:`KernelKeyring`.
+    :returns: See :func:`KeyCache.evict()`.
+
+    This is used by the ``lock`` command to make sure that drives that were
+    locked can't be unlocked again without the pass phrase of the virtual keys
+    device. When ``libkeyutils`` isn't available nothing can have been cached,
+    so that isn't considered an error.
+    """
+    try:
+        cache = KernelKeyring(keyring)
+    except KeyringError as e:
+        logger.debug("Not evicting cached keys: %s", e)
+        return []
+    evicted = cache.evict(names)
+    if evicted:
+        logger.info("Evicted %s from %s.", pluralize(len(evicted), "cached key"), cache)
+    return evicted
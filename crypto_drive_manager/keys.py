@@ -0,0 +1,230 @@
+# Generation of key files and image files.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Generation of key files and the image file for the virtual keys device.
+
+Originally `crypto-drive-manager` used ``dd`` to generate key files and the
+image file. This module does the same thing in-process which avoids a fork
+and exec per key file, makes sure key files are never readable by anyone but
+root (not even briefly) and avoids writing every byte of the image file.
+"""
+
+# Standard library modules.
+import ctypes
+import ctypes.util
+import errno
+import os
+
+# External dependencies.
+from humanfriendly import format_size
+from verboselogs import VerboseLogger
+
+DEFAULT_KEY_SIZE = 4096
+"""The size of generated key files in bytes (an integer, defaults to 4 KiB)."""
+
+DEFAULT_IMAGE_SIZE = 1024 * 1024 * 10
+"""The size of the image file for the virtual keys device in bytes (an integer, defaults to 10 MiB)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def generate_key_file(filename, size=DEFAULT_KEY_SIZE):
+    """
+    Atomically create or replace a key file with random bytes.
+
+    :param filename: The pathname of the key file (a string).
+    :param size: The size of the key file in bytes (an integer).
+    :raises: :exc:`~exceptions.IOError` on a short read from ``/dev/urandom``.
+
+    The random bytes are read from ``/dev/urandom`` straight into a
+    :class:`KeyBuffer` (instead of using :func:`os.urandom()`, which returns
+    an immutable byte string that can't be wiped) and the buffer is wiped
+    once the key file has been written. Refer to :func:`write_key_file()`
+    for details about how the key file is written.
+    """
+    logger.debug("Generating %s key file %s ..", format_size(size, binary=True), filename)
+    with KeyBuffer(size) as key:
+        with open('/dev/urandom', 'rb', 0) as handle:
+            if handle.readinto(key.data) != size:
+                raise IOError("Short read from /dev/urandom!")
+        write_key_file(filename, key.data)
+
+
+def write_key_file(filename, data):
+    """
+    Atomically create or replace a key file.
+
+    :param filename: The pathname of the key file (a string).
+    :param data: The contents of the key file (a byte string or :class:`bytearray`).
+
+    The data is written to a temporary file that is created with ``O_EXCL``
+    and mode 0400, the data is flushed to disk and finally the temporary file
+    is renamed to `filename`. This means the key file is never readable by
+    other users and readers of `filename` will always see either the old key
+    or the new key, even when the system crashes halfway through.
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    temporary_file = os.path.join(directory, '.%s.%i.tmp' % (basename, os.getpid()))
+    fd = os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o400)
+    try:
+        try:
+            # Slicing a memoryview doesn't copy the key (slicing `data` would).
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            # Drop the view (even when a traceback keeps this frame alive)
+            # so that a bytearray can still be wiped by the caller.
+            view = None
+            os.close(fd)
+        os.rename(temporary_file, filename)
+    except Exception:
+        os.unlink(temporary_file)
+        raise
+    sync_directory(directory)
+
+
+def create_image_file(filename, size=DEFAULT_IMAGE_SIZE):
+    """
+    Create the image file for the virtual keys device.
+
+    :param filename: The pathname of the image file (a string).
+    :param size: The size of the image file in bytes (an integer).
+    :raises: :exc:`~exceptions.OSError` when `filename` already exists.
+
+    When the filesystem supports it the space for the image file is reserved
+    using :func:`os.posix_fallocate()`, otherwise a sparse file is created.
+    Either way none of the data needs to be written.
+    """
+    logger.debug("Creating %s image file %s ..", format_size(size, binary=True), filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        try:
+            allocate_file(fd, size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except Exception:
+        os.unlink(filename)
+        raise
+
+
+def allocate_file(fd, size):
+    """
+    Allocate space for a file (falling back to a sparse file).
+
+    :param fd: An open file descriptor (an integer).
+    :param size: The size of the file in bytes (an integer).
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            logger.debug("Filesystem doesn't support fallocate(), creating sparse file ..")
+    os.ftruncate(fd, size)
+
+
+class KeyBuffer(object):
+
+    """
+    In-memory copy of a key file that is locked in RAM and zeroed on release.
+
+    The key is stored in a :class:`bytearray` (which, unlike a byte string,
+    can be overwritten in place). The memory is locked using :man:`mlock` so
+    that it can't be swapped to disk (when this fails, for example because
+    ``RLIMIT_MEMLOCK`` is too low, a debug message is logged and the buffer
+    is used anyway). Use the buffer as a context manager or call
+    :func:`wipe()` to zero and release the memory.
+    """
+
+    def __init__(self, size):
+        """
+        Initialize a :class:`KeyBuffer` object.
+
+        :param size: The size of the buffer in bytes (an integer).
+        """
+        self.data = bytearray(size)
+        self.view = (ctypes.c_char * size).from_buffer(self.data) if size else None
+        self.locked = self.view is not None and call_libc('mlock', self.view, size)
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a key file into a new :class:`KeyBuffer`.
+
+        :param filename: The pathname of the key file (a string).
+        :returns: A :class:`KeyBuffer` object.
+        """
+        with open(filename, 'rb', 0) as handle:
+            buffer = cls(os.fstat(handle.fileno()).st_size)
+            try:
+                if handle.readinto(buffer.data) != len(buffer.data):
+                    raise IOError("Short read from key file %s!" % filename)
+            except Exception:
+                buffer.wipe()
+                raise
+        return buffer
+
+    def wipe(self):
+        """Overwrite the key with zero bytes and unlock the memory."""
+        if self.view is not None:
+            ctypes.memset(self.view, 0, len(self.data))
+            if self.locked:
+                call_libc('munlock', self.view, len(self.data))
+                self.locked = False
+            # Release the buffer export so the bytearray can be resized.
+            self.view = None
+            del self.data[:]
+
+    def __enter__(self):
+        """Enable use as a context manager."""
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Wipe the key when the :keyword:`with` block ends."""
+        self.wipe()
+
+    def __del__(self):
+        """Wipe the key when the object is garbage collected."""
+        self.wipe()
+
+
+def call_libc(name, buffer, size):
+    """
+    Call a memory locking function from the C library (best effort).
+
+    :param name: The name of the function (``mlock`` or ``munlock``).
+    :param buffer: A :mod:`ctypes` array.
+    :param size: The size of the buffer in bytes (an integer).
+    :returns: :data:`True` if the call succeeded, :data:`False` otherwise.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if getattr(libc, name)(ctypes.byref(buffer), ctypes.c_size_t(size)) == 0:
+            return True
+        logger.debug("Failed to %s key buffer! (%s)", name, os.strerror(ctypes.get_errno()))
+    except Exception as e:
+        logger.debug("Failed to %s key buffer! (%s)", name, e)
+    return False
+
+
+def sync_directory(directory):
+    """
+    Flush a directory to disk (so that a rename is durable).
+
+    :param directory: The pathname of the directory (a string).
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
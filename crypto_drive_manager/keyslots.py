@@ -0,0 +1,344 @@
+# Management of LUKS key slots.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Management of the LUKS key slots used by `crypto-drive-manager`.
+
+By default ``cryptsetup luksAddKey`` protects a key slot using a key
+derivation function (PBKDF2 or Argon2) that is tuned to make brute forcing
+human passphrases expensive, which means every unlock spends hundreds of
+milliseconds to seconds of CPU time (and with Argon2 up to a gigabyte of
+memory) on key derivation. The key files generated by `crypto-drive-manager`
+consist of 4 KiB of random data which can't be brute forced anyway, so their
+key slots can safely use the minimal PBKDF parameters given by
+:data:`FAST_PBKDF_OPTIONS`.
+
+This module installs such "fast" key slots and migrates existing key slots
+(see :func:`migrate_key_slot()`).
+"""
+
+# Standard library modules.
+import collections
+import re
+
+# External dependencies.
+from executor import ExternalCommandFailed
+from humanfriendly import Timer, format_timespan
+from humanfriendly.tables import format_pretty_table
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+FAST_PBKDF_ITERATIONS = 1000
+"""The number of PBKDF2 iterations used for fast key slots (an integer, the minimum allowed by ``cryptsetup``)."""
+
+FAST_PBKDF_OPTIONS = ('--pbkdf=pbkdf2', '--pbkdf-force-iterations=%i' % FAST_PBKDF_ITERATIONS)
+"""The ``cryptsetup`` command line options used to install fast key slots (a tuple of strings)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def add_key_file(physical_device, key_file, fast=False, existing_key_file=None, key_slot=None, context=None):
+    """
+    Install a key file in a key slot of a LUKS volume.
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param key_file: The pathname of the key file to install (a string).
+    :param fast: :data:`True` to use the minimal PBKDF parameters given by
+                 :data:`FAST_PBKDF_OPTIONS`, :data:`False` to use the
+                 defaults of ``cryptsetup`` (this is the default).
+    :param existing_key_file: The pathname of a key file that unlocks an
+                              existing key slot (a string or :data:`None`,
+                              in which case ``cryptsetup`` prompts for an
+                              existing passphrase).
+    :param key_slot: The number of the key slot to use (an integer or
+                     :data:`None` to use the first free key slot).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    """
+    coerce_context(context).execute(*add_key_command(physical_device, key_file, fast, existing_key_file, key_slot))
+
+
+def add_key_command(physical_device, key_file, fast=False, existing_key_file=None, key_slot=None):
+    """
+    Generate the ``cryptsetup luksAddKey`` command used by :func:`add_key_file()`.
+
+    :param physical_device: See :func:`add_key_file()`.
+    :param key_file: See :func:`add_key_file()`.
+    :param fast: See :func:`add_key_file()`.
+    :param existing_key_file: See :func:`add_key_file()`.
+    :param key_slot: See :func:`add_key_file()`.
+    :returns: A list of strings.
+    """
+    command = ['cryptsetup', 'luksAddKey']
+    if existing_key_file:
+        command.append('--key-file=%s' % existing_key_file)
+    if key_slot is not None:
+        command.append('--key-slot=%i' % key_slot)
+    if fast:
+        command.extend(FAST_PBKDF_OPTIONS)
+    command.extend([physical_device, key_file])
+    return command
+
+
+def test_key_file(physical_device, key_file, key_slot=None, context=None):
+    """
+    Find the key slot that is unlocked by a key file (without activating the volume).
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param key_file: The pathname of the key file (a string).
+    :param key_slot: The number of the key slot to test (an integer or
+                     :data:`None` to test all key slots).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: A tuple of two values:
+
+              1. The number of the key slot that was unlocked (an integer).
+              2. The time it took to unlock the key slot (a float, in seconds).
+    :raises: :exc:`~executor.ExternalCommandFailed` when the key file
+             doesn't unlock a key slot, :exc:`KeySlotError` when the output
+             of ``cryptsetup`` can't be parsed.
+    """
+    command = ['cryptsetup', 'open', '--test-passphrase', '--verbose', '--key-file=%s' % key_file]
+    if key_slot is not None:
+        command.append('--key-slot=%i' % key_slot)
+    command.append(physical_device)
+    timer = Timer()
+    output = coerce_context(context).capture(*command)
+    match = re.search(r'Key slot (\d+) unlocked', output)
+    if not match:
+        raise KeySlotError("Failed to determine key slot unlocked by %s! (%s)" % (key_file, physical_device))
+    return int(match.group(1)), timer.elapsed_time
+
+
+def parse_key_slots(dump):
+    """
+    Parse the output of ``cryptsetup luksDump``.
+
+    :param dump: The output of ``cryptsetup luksDump`` (a string).
+    :returns: A tuple of two values:
+
+              1. The LUKS version (an integer).
+              2. A dictionary with the numbers of the enabled key slots
+                 (integers) as keys and dictionaries with the properties of
+                 the key slots (e.g. ``PBKDF`` and ``Iterations``) as values.
+
+    Both the LUKS1 and the LUKS2 header formats are supported.
+    """
+    version = None
+    section = None
+    current = None
+    key_slots = {}
+    for line in dump.splitlines():
+        luks1_slot = re.match(r'^Key Slot (\d+): (ENABLED|DISABLED)$', line)
+        luks2_slot = re.match(r'^\s+(\d+): \S+$', line)
+        if luks1_slot:
+            # LUKS1 always uses PBKDF2.
+            current = ({'PBKDF': 'pbkdf2'} if luks1_slot.group(2) == 'ENABLED' else None)
+            if current is not None:
+                key_slots[int(luks1_slot.group(1))] = current
+        elif line and not line[0].isspace():
+            section = line.partition(':')[0].strip()
+            current = None
+            if section == 'Version':
+                version = int(line.partition(':')[2])
+        elif section == 'Keyslots' and luks2_slot:
+            current = key_slots.setdefault(int(luks2_slot.group(1)), {})
+        elif current is not None and ':' in line:
+            name, _, value = line.partition(':')
+            current[name.strip()] = value.strip()
+    return version, key_slots
+
+
+def is_fast_key_slot(properties):
+    """
+    Check if a key slot uses the minimal PBKDF parameters.
+
+    :param properties: A dictionary with the properties of a key slot (as
+                       returned by :func:`parse_key_slots()`).
+    :returns: :data:`True` if the key slot uses PBKDF2 with at most
+              :data:`FAST_PBKDF_ITERATIONS` iterations, :data:`False`
+              otherwise.
+    """
+    try:
+        return (properties.get('PBKDF') == 'pbkdf2' and
+                int(properties.get('Iterations', '')) <= FAST_PBKDF_ITERATIONS)
+    except ValueError:
+        return False
+
+
+def migrate_key_slot(physical_device, key_file, key_slot=None, context=None):
+    """
+    Re-install a key file in a fast key slot and remove the old key slot.
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param key_file: The pathname of the key file (a string).
+    :param key_slot: The key slot that the key file must occupy (an integer,
+                     see :func:`.find_key_slot_option()`) or :data:`None`
+                     when any key slot will do.
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: A :class:`KeySlotMigration` object.
+    :raises: :exc:`KeySlotError` when no free key slot is available or the
+             pinned key slot contains another key,
+             :exc:`~executor.ExternalCommandFailed` when ``cryptsetup``
+             reports an error.
+
+    The migration is done so that the LUKS volume can be unlocked with the
+    key file at every point in time:
+
+    1. The key slot unlocked by the key file is located (and the time it
+       takes to unlock it is measured).
+    2. The key file is installed in a free key slot using the minimal PBKDF
+       parameters (authenticated using the key file itself).
+    3. The new key slot is tested (and the time it takes to unlock it is
+       measured). When this fails the new key slot is removed again.
+    4. Only then is the old key slot removed.
+    5. When the key file is pinned to a key slot it's installed in that key
+       slot again (now using the minimal PBKDF parameters) and tested, after
+       which the key slot from step 2 is removed.
+
+    When a migration is interrupted the fast key slots it added are still
+    unlocked by the key file. Instead of adding another key slot the next
+    migration reuses such a key slot and removes the others. Key slots that
+    already use the minimal PBKDF parameters (and the pinned key slot, if
+    any) are left alone.
+    """
+    context = coerce_context(context)
+    old_slot, old_time = test_key_file(physical_device, key_file, context=context)
+    version, key_slots = parse_key_slots(context.capture('cryptsetup', 'luksDump', physical_device))
+    if key_slot is not None and key_slot != old_slot and key_slot in key_slots:
+        # The key file unlocks a lower key slot left behind by an interrupted migration.
+        if find_key_slot(physical_device, key_file, key_slot, context) is None:
+            raise KeySlotError("Key slot %i of %s is pinned in /etc/crypttab but contains another key!" % (
+                key_slot, physical_device,
+            ))
+        old_slot, old_time = test_key_file(physical_device, key_file, key_slot=key_slot, context=context)
+    leftovers = [
+        n for n in sorted(key_slots) if n not in (old_slot, key_slot) and is_fast_key_slot(key_slots[n]) and
+        find_key_slot(physical_device, key_file, n, context) is not None
+    ]
+    if is_fast_key_slot(key_slots[old_slot]) and key_slot in (None, old_slot):
+        logger.verbose("Key slot %i of %s is already a fast key slot.", old_slot, physical_device)
+        new_slot, new_time = old_slot, old_time
+    else:
+        if is_fast_key_slot(key_slots[old_slot]):
+            # The pinned key slot was removed by an interrupted migration.
+            fast_slot, fast_time = old_slot, old_time
+        elif leftovers:
+            fast_slot = leftovers.pop(0)
+            logger.info("Reusing fast key slot %i left behind by an interrupted migration on %s ..",
+                        fast_slot, physical_device)
+            fast_slot, fast_time = test_key_file(physical_device, key_file, key_slot=fast_slot, context=context)
+        else:
+            # Prefer key slots after the old key slot, so that the old key
+            # slot is found first when this migration is interrupted.
+            free_slots = sorted((n for n in range(8 if version == 1 else 32) if n not in key_slots and n != key_slot),
+                                key=lambda n: n < old_slot)
+            if not free_slots:
+                raise KeySlotError("No free key slot available on %s!" % physical_device)
+            fast_slot = free_slots[0]
+            logger.info("Moving %s from key slot %i to fast key slot %i on %s ..",
+                        key_file, old_slot, fast_slot, physical_device)
+            add_key_file(physical_device, key_file, fast=True, existing_key_file=key_file,
+                         key_slot=fast_slot, context=context)
+            fast_slot, fast_time = verify_key_slot(physical_device, key_file, fast_slot, context)
+        if old_slot != fast_slot:
+            context.execute('cryptsetup', 'luksKillSlot', '--key-file=%s' % key_file, physical_device, str(old_slot))
+        new_slot, new_time = fast_slot, fast_time
+        if key_slot is not None:
+            # The fast key slot unlocks the volume while the pinned key slot is replaced.
+            logger.info("Moving %s back to pinned key slot %i on %s ..", key_file, key_slot, physical_device)
+            add_key_file(physical_device, key_file, fast=True, existing_key_file=key_file,
+                         key_slot=key_slot, context=context)
+            new_slot, new_time = verify_key_slot(physical_device, key_file, key_slot, context)
+            leftovers.append(fast_slot)
+    for n in leftovers:
+        logger.info("Removing fast key slot %i left behind by an interrupted migration on %s ..", n, physical_device)
+        context.execute('cryptsetup', 'luksKillSlot', '--key-file=%s' % key_file, physical_device, str(n))
+    return KeySlotMigration(old_slot, new_slot, old_time, new_time)
+
+
+def verify_key_slot(physical_device, key_file, key_slot, context):
+    """
+    Test a key slot that was just installed (removing it again when the test fails).
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param key_file: The pathname of the key file (a string).
+    :param key_slot: The number of the key slot (an integer).
+    :param context: An execution context.
+    :returns: The result of :func:`test_key_file()`.
+    :raises: :exc:`KeySlotError` or :exc:`~executor.ExternalCommandFailed`
+             when the key file doesn't unlock the key slot.
+    """
+    try:
+        unlocked_slot, elapsed_time = test_key_file(physical_device, key_file, key_slot=key_slot, context=context)
+        if unlocked_slot != key_slot:
+            raise KeySlotError("Key file %s unlocked key slot %i instead of %i!" % (key_file, unlocked_slot, key_slot))
+    except Exception:
+        logger.warning("Failed to verify new key slot %i, removing it again ..", key_slot)
+        context.execute('cryptsetup', 'luksKillSlot', '--key-file=%s' % key_file, physical_device, str(key_slot))
+        raise
+    return unlocked_slot, elapsed_time
+
+
+def find_key_slot(physical_device, key_file, key_slot=None, context=None):
+    """
+    Find the key slot unlocked by a key file (without raising an exception when there is none).
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param key_file: The pathname of the key file (a string).
+    :param key_slot: The number of the key slot to test (an integer or
+                     :data:`None` to test all key slots).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: The number of the key slot (an integer) or :data:`None`.
+    """
+    try:
+        slot, _ = test_key_file(physical_device, key_file, key_slot=key_slot, context=context)
+        return slot
+    except ExternalCommandFailed:
+        return None
+
+
+def render_migration_report(migrations):
+    """
+    Render a table with the results of :func:`migrate_key_slot()`.
+
+    :param migrations: A dictionary with mapper names (strings) as keys and
+                       :class:`KeySlotMigration` objects as values.
+    :returns: The rendered report (a string).
+    """
+    rows = []
+    for mapper_name, m in sorted(migrations.items()):
+        rows.append([
+            mapper_name, m.old_slot, m.new_slot,
+            format_timespan(m.old_time), format_timespan(m.new_time), format_timespan(m.time_saved),
+        ])
+    lines = [format_pretty_table(rows, ["Drive", "Old slot", "New slot", "Unlock before", "Unlock after", "Saved"])]
+    if migrations:
+        total = sum(m.time_saved for m in migrations.values())
+        lines.append("Saved %s per unlock in total (%s per drive on average)." % (
+            format_timespan(total), format_timespan(total / len(migrations)),
+        ))
+    return '\n'.join(lines)
+
+
+class KeySlotMigration(collections.namedtuple('KeySlotMigration', 'old_slot, new_slot, old_time, new_time')):
+
+    """
+    The result of :func:`migrate_key_slot()`.
+
+    The fields of the named tuple are the numbers of the old and new key slots
+    (integers) and the time it took to unlock the old and new key slots
+    (floats, in seconds).
+    """
+
+    @property
+    def time_saved(self):
+        """The time saved per unlock (a float, in seconds)."""
+        return max(0, self.old_time - self.new_time)
+
+
+class KeySlotError(Exception):
+
+    """Raised when a key slot can't be located or migrated."""
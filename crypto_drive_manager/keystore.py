@@ -0,0 +1,701 @@
+# Storage of key files on the virtual keys device.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Storage of key files on the virtual keys device.
+
+Originally the virtual keys device contains an ext4 filesystem with one key
+file per managed drive (see :class:`KeyDirectory`). Most of the time spent
+creating and unlocking the virtual keys device goes to ``mkfs.ext4``,
+``mount`` and ``umount`` while storing a handful of 4 KiB keys doesn't
+require a filesystem at all. :class:`KeyStore` implements a compact container
+format that is read and written directly on the unlocked device:
+
+- A header (one 4 KiB block) that identifies the format and describes the
+  layout of the rest of the device.
+
+- An index of fixed size entries that map device mapper names to records.
+  Entries are located by hashing the name (with linear probing) so a lookup
+  reads the header, one index block and one record instead of the whole
+  device.
+
+- Fixed size records that contain the keys. A key is replaced by writing the
+  new key to a free record before the index entry is updated, so the old key
+  or the new key is always intact (even when the system crashes halfway).
+
+Both classes have the same interface, which is what :class:`.PlanExecutor`,
+:func:`.migrate_key_slots()` and :func:`.rotate_keys()` use.
+:class:`.KeysDevice` detects the format when it unlocks the virtual keys
+device and migrates an ext4 filesystem to a key store on request (see
+:func:`.KeysDevice.migrate()`). Because ``cryptdisks_start`` expects the
+key file from ``/etc/crypttab`` drives are unlocked by feeding their keys
+to ``cryptsetup open`` when a key store is used (see :func:`.unlock_with_key()`).
+"""
+
+# Standard library modules.
+import contextlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+# External dependencies.
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.keys import (
+    DEFAULT_KEY_SIZE,
+    KeyBuffer,
+    generate_key_file,
+    sync_directory,
+    write_key_file,
+)
+
+STORE_FORMATS = ('ext4', 'raw')
+"""The supported formats of the virtual keys device (a tuple of strings)."""
+
+MAGIC = b'CDMKEYS\0'
+"""The byte string at the start of a :class:`KeyStore` (8 bytes)."""
+
+VERSION = 1
+"""The version of the :class:`KeyStore` format (an integer)."""
+
+BLOCK_SIZE = 4096
+"""The size of the header and the alignment of the index and records in bytes (an integer)."""
+
+HEADER = struct.Struct('>8sIIIII')
+"""The header: magic, version, record size, number of records, offset of the index, offset of the records."""
+
+ENTRY = struct.Struct('>96sIII20x')
+"""An index entry (128 bytes): name, record number plus one, key size and CRC32 checksum of the key."""
+
+DELETED = 0xFFFFFFFF
+"""The record number of deleted index entries (which don't end a probe sequence)."""
+
+RUNTIME_DIRECTORY = '/run'
+"""The directory where :func:`KeyStore.key_file()` creates temporary key files (a string)."""
+
+RECOVERY_DIRECTORY = os.path.join(RUNTIME_DIRECTORY, 'crypto-drive-manager', 'migration')
+"""The directory that contains copies of keys while they're migrated to a key store (a string)."""
+
+RECOVERY_MARKER = 'complete'
+"""The name of the file that marks a copy made by :func:`save_recovery_copy()` as complete (a string)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class KeyStoreError(Exception):
+
+    """Raised when a key store is corrupt, full or doesn't contain the requested key."""
+
+
+class KeyDirectory(object):
+
+    """Key files in a directory (the ext4 filesystem on the virtual keys device)."""
+
+    has_files = True
+    """:data:`True` because the keys are available as files (a boolean)."""
+
+    def __init__(self, directory):
+        """
+        Initialize a :class:`KeyDirectory` object.
+
+        :param directory: The pathname of the directory (a string).
+        """
+        self.directory = directory
+
+    def location(self, name):
+        """
+        Get the pathname of the key file of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: The pathname of the key file (a string).
+        """
+        return os.path.join(self.directory, '%s.key' % name)
+
+    def names(self):
+        """
+        Find the names of the keys in the directory.
+
+        :returns: A sorted list of device mapper names (strings).
+        """
+        return sorted(fn[:-len('.key')] for fn in os.listdir(self.directory)
+                      if fn.endswith('.key') and os.path.isfile(os.path.join(self.directory, fn)))
+
+    def exists(self, name):
+        """
+        Check if the key of a drive exists.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: :data:`True` if the key file exists, :data:`False` otherwise.
+        """
+        return os.path.isfile(self.location(name))
+
+    def generate(self, name, size=DEFAULT_KEY_SIZE):
+        """
+        Create or replace the key of a drive (see :func:`.generate_key_file()`).
+
+        :param name: The device mapper name of the drive (a string).
+        :param size: The size of the key in bytes (an integer).
+        """
+        generate_key_file(self.location(name), size)
+
+    def read(self, name):
+        """
+        Read the key of a drive into memory.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A :class:`.KeyBuffer` object.
+
+        Key files generated by older versions weren't created with restrictive
+        permissions, so we make sure they are now.
+        """
+        filename = self.location(name)
+        os.chmod(filename, 0o400)
+        return KeyBuffer.from_file(filename)
+
+    def write(self, name, data):
+        """
+        Atomically create or replace the key of a drive (see :func:`.write_key_file()`).
+
+        :param name: The device mapper name of the drive (a string).
+        :param data: The key (a byte string or :class:`bytearray`).
+        """
+        write_key_file(self.location(name), data)
+
+    def remove(self, name):
+        """
+        Remove the key of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: :data:`True` if the key was removed, :data:`False` if it didn't exist.
+        """
+        if not self.exists(name):
+            return False
+        os.unlink(self.location(name))
+        sync_directory(self.directory)
+        return True
+
+    def rename(self, name, new_name):
+        """
+        Atomically rename a key (replacing the key of `new_name`).
+
+        :param name: The current name of the key (a string).
+        :param new_name: The new name of the key (a string).
+        """
+        os.rename(self.location(name), self.location(new_name))
+        sync_directory(self.directory)
+
+    @contextlib.contextmanager
+    def key_file(self, name):
+        """
+        Get the pathname of a file that contains the key of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A context manager that produces the pathname of the key file.
+        """
+        yield self.location(name)
+
+    def __str__(self):
+        """Render a human friendly representation of the key directory."""
+        return self.directory
+
+
+class KeyStore(object):
+
+    """Keys stored directly on a block device (or in a regular file) without a filesystem."""
+
+    has_files = False
+    """:data:`False` because the keys aren't available as files (a boolean)."""
+
+    def __init__(self, device_file):
+        """
+        Initialize a :class:`KeyStore` object.
+
+        :param device_file: The pathname of the device that contains the key
+                            store (a string). Use :func:`create()` to format
+                            a new key store.
+        :raises: :exc:`KeyStoreError` when the device doesn't contain a key store.
+        """
+        self.device_file = device_file
+        self.lock = threading.RLock()
+        header = read_block(device_file, 0, HEADER.size)
+        magic, version, self.record_size, self.num_records, self.index_offset, self.records_offset = \
+            HEADER.unpack(header)
+        if magic != MAGIC:
+            raise KeyStoreError("%s doesn't contain a key store!" % device_file)
+        if version != VERSION:
+            raise KeyStoreError("Unsupported key store version %i! (%s)" % (version, device_file))
+
+    @classmethod
+    def create(cls, device_file, record_size=DEFAULT_KEY_SIZE):
+        """
+        Format a new (empty) key store.
+
+        :param device_file: The pathname of the device (a string).
+        :param record_size: The maximum size of a key in bytes (an integer).
+        :returns: A :class:`KeyStore` object.
+        :raises: :exc:`KeyStoreError` when the device is too small.
+
+        The size of the index is chosen so that every record has an entry.
+        Only the header and the index are written (the index is zeroed), the
+        contents of the records don't matter until they're used.
+        """
+        with open_device(device_file) as fd:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            num_records = (size - BLOCK_SIZE) // (record_size + ENTRY.size)
+            index_size = round_up(num_records * ENTRY.size, BLOCK_SIZE)
+            # Use the space lost to rounding (if any) without outgrowing the index.
+            num_records = min(index_size // ENTRY.size, (size - BLOCK_SIZE - index_size) // record_size)
+            if num_records < 1:
+                raise KeyStoreError("Device %s is too small for a key store!" % device_file)
+            header = HEADER.pack(MAGIC, VERSION, record_size, num_records, BLOCK_SIZE, BLOCK_SIZE + index_size)
+            # Zero the index before writing the header.
+            write_at(fd, BLOCK_SIZE, b'\0' * index_size)
+            os.fsync(fd)
+            write_at(fd, 0, header + b'\0' * (BLOCK_SIZE - len(header)))
+            os.fsync(fd)
+        logger.verbose("Created key store on %s with room for %i keys.", device_file, num_records)
+        return cls(device_file)
+
+    def location(self, name):
+        """
+        Describe where the key of a drive is stored (for log messages).
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A string.
+        """
+        return "key %s in %s" % (name, self.device_file)
+
+    def names(self):
+        """
+        Find the names of the keys in the key store.
+
+        :returns: A sorted list of device mapper names (strings).
+        """
+        return sorted(e.name for e in self.read_index() if e.name)
+
+    def exists(self, name):
+        """
+        Check if the key of a drive exists.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: :data:`True` if the key exists, :data:`False` otherwise.
+        """
+        return self.lookup(name) is not None
+
+    def generate(self, name, size=DEFAULT_KEY_SIZE):
+        """
+        Create or replace the key of a drive with random bytes.
+
+        :param name: The device mapper name of the drive (a string).
+        :param size: The size of the key in bytes (an integer).
+        """
+        with KeyBuffer(size) as key:
+            key.data[:] = os.urandom(size)
+            self.write(name, key.data)
+
+    def read(self, name):
+        """
+        Read the key of a drive into memory.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A :class:`.KeyBuffer` object.
+        :raises: :exc:`KeyStoreError` when the key doesn't exist or its
+                 checksum doesn't match.
+
+        Only the header, the index block(s) on the probe sequence of `name`
+        and the record with the key are read.
+        """
+        entry = self.lookup(name)
+        if entry is None:
+            raise KeyStoreError("Key store %s doesn't contain a key for %s!" % (self.device_file, name))
+        key = KeyBuffer(entry.size)
+        try:
+            with open_device(self.device_file, os.O_RDONLY) as fd:
+                read_into(fd, self.record_offset(entry.record), key.data)
+            if zlib.crc32(key.data) & 0xFFFFFFFF != entry.checksum:
+                raise KeyStoreError("Checksum of key %s in %s doesn't match!" % (name, self.device_file))
+        except Exception:
+            key.wipe()
+            raise
+        return key
+
+    def write(self, name, data):
+        """
+        Add or replace the key of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :param data: The key (a byte string or :class:`bytearray`).
+        :raises: :exc:`KeyStoreError` when the key is too big or the key store is full.
+
+        The key is written to a free record and flushed to disk before the
+        index entry is updated (and flushed to disk). The record of the
+        previous key (if any) is then overwritten with zeros.
+        """
+        if len(data) > self.record_size:
+            raise KeyStoreError("Key for %s is too big! (%i bytes)" % (name, len(data)))
+        # The lock makes sure that concurrent writers don't pick the same free record.
+        with self.lock:
+            entries = self.read_index()
+            used = set(e.record for e in entries if e.name)
+            free = [r for r in range(self.num_records) if r not in used]
+            if not free:
+                raise KeyStoreError("Key store %s is full!" % self.device_file)
+            position, existing = self.probe(name, lambda i: entries[i])
+            if existing is None and position is None:
+                raise KeyStoreError("Key store %s is full!" % self.device_file)
+            if existing is not None:
+                position = existing.position
+            with open_device(self.device_file) as fd:
+                # The key and the padding are written separately to avoid copying the key.
+                write_at(fd, self.record_offset(free[0]), data)
+                write_at(fd, self.record_offset(free[0]) + len(data), b'\0' * (self.record_size - len(data)))
+                os.fsync(fd)
+                entry = IndexEntry(position, name, free[0], len(data), zlib.crc32(data) & 0xFFFFFFFF)
+                write_at(fd, self.entry_offset(position), entry.pack())
+                os.fsync(fd)
+                if existing is not None:
+                    write_at(fd, self.record_offset(existing.record), b'\0' * self.record_size)
+                    os.fsync(fd)
+
+    def remove(self, name):
+        """
+        Remove the key of a drive (overwriting the key with zeros).
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: :data:`True` if the key was removed, :data:`False` if it didn't exist.
+        """
+        with self.lock:
+            entry = self.lookup(name)
+            if entry is None:
+                return False
+            with open_device(self.device_file) as fd:
+                write_at(fd, self.entry_offset(entry.position), ENTRY.pack(b'', DELETED, 0, 0))
+                os.fsync(fd)
+                write_at(fd, self.record_offset(entry.record), b'\0' * self.record_size)
+                os.fsync(fd)
+        return True
+
+    def rename(self, name, new_name):
+        """
+        Rename a key (replacing the key of `new_name`).
+
+        :param name: The current name of the key (a string).
+        :param new_name: The new name of the key (a string).
+
+        The key is written under its new name before the old name is
+        removed, so when the system crashes halfway through the key exists
+        under both names (it's never lost).
+        """
+        with self.lock:
+            with self.read(name) as key:
+                self.write(new_name, key.data)
+            self.remove(name)
+
+    @contextlib.contextmanager
+    def key_file(self, name):
+        """
+        Temporarily make the key of a drive available as a file.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A context manager that produces the pathname of a key file.
+
+        Some ``cryptsetup`` commands (like ``luksAddKey``) need the key in a
+        file. The file is created in a private directory in
+        :data:`RUNTIME_DIRECTORY` (a tmpfs on systems with systemd, so the key
+        never reaches a disk) and overwritten with zeros before it's removed.
+        """
+        directory = tempfile.mkdtemp(prefix='crypto-drive-manager-',
+                                     dir=RUNTIME_DIRECTORY if os.path.isdir(RUNTIME_DIRECTORY) else None)
+        filename = os.path.join(directory, '%s.key' % name)
+        try:
+            with self.read(name) as key:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o400)
+                try:
+                    write_at(fd, 0, key.data)
+                finally:
+                    os.close(fd)
+                try:
+                    yield filename
+                finally:
+                    fd = os.open(filename, os.O_WRONLY)
+                    try:
+                        write_at(fd, 0, b'\0' * len(key.data))
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+        finally:
+            shutil.rmtree(directory)
+
+    def lookup(self, name):
+        """
+        Find the index entry of a key.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: An :class:`IndexEntry` object or :data:`None`.
+        """
+        blocks = {}
+
+        with open_device(self.device_file, os.O_RDONLY) as fd:
+            def get_entry(position):
+                offset = self.entry_offset(position)
+                block = offset - offset % BLOCK_SIZE
+                if block not in blocks:
+                    blocks[block] = read_at(fd, block, BLOCK_SIZE)
+                return IndexEntry.unpack(position, blocks[block], offset - block)
+
+            return self.probe(name, get_entry)[1]
+
+    def probe(self, name, get_entry):
+        """
+        Walk the probe sequence of a name.
+
+        :param name: The device mapper name of the drive (a string).
+        :param get_entry: A callable that takes a position in the index and
+                          returns the :class:`IndexEntry` at that position.
+        :returns: A tuple with two values: The position of the first unused
+                  or deleted entry on the probe sequence (an integer or
+                  :data:`None`) and the :class:`IndexEntry` of `name` (or
+                  :data:`None` when it doesn't exist).
+        """
+        available = None
+        start = zlib.crc32(encode_name(name)) % self.num_records
+        for i in range(self.num_records):
+            entry = get_entry((start + i) % self.num_records)
+            if entry.name == name:
+                return available, entry
+            if not entry.name:
+                if available is None:
+                    available = entry.position
+                if entry.record != DELETED:
+                    # Never used entries end the probe sequence.
+                    break
+        return available, None
+
+    def read_index(self):
+        """
+        Read the complete index (only needed when a key is added or replaced).
+
+        :returns: A list of :class:`IndexEntry` objects.
+        """
+        with open_device(self.device_file, os.O_RDONLY) as fd:
+            data = read_at(fd, self.index_offset, self.num_records * ENTRY.size)
+        return [IndexEntry.unpack(i, data, i * ENTRY.size) for i in range(self.num_records)]
+
+    def entry_offset(self, position):
+        """Get the offset of an index entry in the key store (an integer)."""
+        return self.index_offset + position * ENTRY.size
+
+    def record_offset(self, record):
+        """Get the offset of a record in the key store (an integer)."""
+        return self.records_offset + record * self.record_size
+
+    def __str__(self):
+        """Render a human friendly representation of the key store."""
+        return self.device_file
+
+
+class IndexEntry(object):
+
+    """An entry in the index of a :class:`KeyStore`."""
+
+    def __init__(self, position, name, record, size, checksum):
+        """
+        Initialize an :class:`IndexEntry` object.
+
+        :param position: The position of the entry in the index (an integer).
+        :param name: The device mapper name (a string, empty for unused entries).
+        :param record: The number of the record that contains the key (an integer).
+        :param size: The size of the key in bytes (an integer).
+        :param checksum: The CRC32 checksum of the key (an integer).
+        """
+        self.position = position
+        self.name = name
+        self.record = record
+        self.size = size
+        self.checksum = checksum
+
+    @classmethod
+    def unpack(cls, position, data, offset):
+        """
+        Parse an index entry.
+
+        :param position: The position of the entry in the index (an integer).
+        :param data: The buffer that contains the entry (a byte string).
+        :param offset: The offset of the entry in `data` (an integer).
+        :returns: An :class:`IndexEntry` object.
+        """
+        name, record, size, checksum = ENTRY.unpack_from(data, offset)
+        name = name.rstrip(b'\0').decode('UTF-8')
+        # The record number is stored plus one so that zeroed entries are unused.
+        return cls(position, name, record - 1 if name else record, size, checksum)
+
+    def pack(self):
+        """Serialize the index entry (a byte string)."""
+        return ENTRY.pack(encode_name(self.name), self.record + 1, self.size, self.checksum)
+
+
+def detect_store_format(device_file):
+    """
+    Detect the format of the (unlocked) virtual keys device.
+
+    :param device_file: The pathname of the device (a string).
+    :returns: ``raw`` when the device contains a :class:`KeyStore`, ``ext4`` otherwise.
+    """
+    return 'raw' if read_block(device_file, 0, len(MAGIC)) == MAGIC else 'ext4'
+
+
+def copy_keys(keys, target):
+    """
+    Copy keys to a :class:`KeyStore` or :class:`KeyDirectory`.
+
+    :param keys: A dictionary with device mapper names as keys and
+                 :class:`.KeyBuffer` objects as values.
+    :param target: A :class:`KeyStore` or :class:`KeyDirectory` object.
+    :raises: :exc:`KeyStoreError` when a key can't be read back.
+
+    Every key is read back and compared after it has been written.
+    """
+    for name in sorted(keys):
+        target.write(name, keys[name].data)
+        with target.read(name) as copy:
+            if copy.data != keys[name].data:
+                raise KeyStoreError("Failed to verify key %s in %s!" % (name, target))
+        logger.verbose("Copied key %s to %s.", name, target)
+
+
+def save_recovery_copy(keys, directory):
+    """
+    Copy keys to a private directory (before the virtual keys device is reformatted).
+
+    :param keys: A dictionary with device mapper names as keys and
+                 :class:`.KeyBuffer` objects as values.
+    :param directory: The pathname of the directory (a string, normally
+                      below :data:`RECOVERY_DIRECTORY` which is a tmpfs on
+                      systems with systemd, so the keys never reach a disk).
+
+    The copy is only marked as complete (see :func:`is_complete_copy()`)
+    after every key has been written and verified.
+    """
+    if os.path.isdir(directory):
+        wipe_directory(directory)
+    os.makedirs(directory, 0o700)
+    copy_keys(keys, KeyDirectory(directory))
+    fd = os.open(os.path.join(directory, RECOVERY_MARKER), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o400)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    sync_directory(directory)
+
+
+def is_complete_copy(directory):
+    """
+    Check if a directory contains a complete copy made by :func:`save_recovery_copy()`.
+
+    :param directory: The pathname of the directory (a string).
+    :returns: :data:`True` if the copy is complete, :data:`False` otherwise.
+    """
+    return os.path.isfile(os.path.join(directory, RECOVERY_MARKER))
+
+
+def wipe_directory(directory):
+    """
+    Overwrite the files in a directory with zeros and remove the directory.
+
+    :param directory: The pathname of the directory (a string).
+    """
+    for filename in os.listdir(directory):
+        pathname = os.path.join(directory, filename)
+        fd = os.open(pathname, os.O_WRONLY)
+        try:
+            write_at(fd, 0, b'\0' * os.fstat(fd).st_size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.unlink(pathname)
+    os.rmdir(directory)
+
+
+def encode_name(name):
+    """
+    Encode the name of a key for the index.
+
+    :param name: The device mapper name (a string).
+    :returns: A byte string.
+    :raises: :exc:`KeyStoreError` when the name is too long.
+    """
+    encoded = name.encode('UTF-8')
+    if len(encoded) > ENTRY.size - 32:
+        raise KeyStoreError("Name of key is too long! (%s)" % name)
+    return encoded
+
+
+def round_up(value, alignment):
+    """Round an integer up to a multiple of `alignment`."""
+    return (value + alignment - 1) // alignment * alignment
+
+
+@contextlib.contextmanager
+def open_device(device_file, flags=os.O_RDWR):
+    """
+    Open a device (or regular file) for unbuffered I/O.
+
+    :param device_file: The pathname of the device (a string).
+    :param flags: The flags for :func:`os.open()` (an integer).
+    :returns: A context manager that produces a file descriptor (an integer).
+    """
+    fd = os.open(device_file, flags)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def read_block(device_file, offset, size):
+    """Read `size` bytes at `offset` from a device (a byte string)."""
+    with open_device(device_file, os.O_RDONLY) as fd:
+        return read_at(fd, offset, size)
+
+
+def read_at(fd, offset, size):
+    """Read `size` bytes at `offset` from a file descriptor (a byte string, shorter at the end of the device)."""
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_into(fd, offset, buffer):
+    """
+    Read a key from a file descriptor into a :class:`bytearray` (without intermediate copies that outlive the call).
+
+    :param fd: The file descriptor (an integer).
+    :param offset: The offset of the key (an integer).
+    :param buffer: The :class:`bytearray` to fill.
+    :raises: :exc:`KeyStoreError` on a short read.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    with os.fdopen(os.dup(fd), 'rb', 0) as handle:
+        if handle.readinto(buffer) != len(buffer):
+            raise KeyStoreError("Short read from key store!")
+
+
+def write_at(fd, offset, data):
+    """Write a byte string at `offset` to a file descriptor (without copying `data`)."""
+    os.lseek(fd, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
@@ -0,0 +1,329 @@
+# Interaction with the Linux Logical Volume Manager (LVM).
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Interaction with the Linux Logical Volume Manager (LVM).
+
+Encrypted drives managed by `crypto-drive-manager` can contain an LVM
+physical volume instead of a filesystem. This module finds the volume groups
+and logical volumes on top of such drives using the LVM reporting commands
+(``pvs`` and ``lvs``), which are run once for all drives.
+
+After drives have been unlocked :func:`activate_lvm_drives()` activates the
+volume groups on top of them (again in one batch instead of once per drive)
+and finds the logical volumes that are configured in ``/etc/fstab``, which
+are then mounted by :func:`.mount_encrypted_drives()`.
+"""
+
+# Standard library modules.
+import collections
+import os
+
+# External dependencies.
+from humanfriendly import concatenate
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import ActivationResults, DriveStatus, coerce_state
+
+LogicalVolume = collections.namedtuple('LogicalVolume', 'volume_group, path, dm_path')
+"""
+A logical volume reported by :func:`list_logical_volumes()`.
+
+The fields are the name of the volume group, the pathname of the logical
+volume (e.g. ``/dev/vg/lv``) and its device mapper pathname (e.g.
+``/dev/mapper/vg-lv``).
+"""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def activate_lvm_drives(mapper_names, state=None):
+    """
+    Activate the LVM volume groups on unlocked drives.
+
+    :param mapper_names: An iterable of device mapper names of drives that
+                         contain an LVM physical volume (strings).
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
+    :returns: A tuple of two values:
+
+              1. An :class:`.ActivationResults` object in which the drives
+                 whose volume group was activated have the status
+                 :data:`~.DriveStatus.ACTIVATED` (volume groups that were
+                 already active don't count).
+              2. A list of :class:`.Mount` objects for the logical volumes
+                 that are configured in ``/etc/fstab`` and aren't mounted
+                 yet (these are mounted by their mount point, so that the
+                 options in ``/etc/fstab`` apply).
+
+    The volume groups of all drives are activated in one batch (see
+    :func:`activate_volume_groups()`).
+    """
+    state = coerce_state(state)
+    results = ActivationResults()
+    mounts = []
+    devices = dict(('/dev/mapper/%s' % name, name) for name in mapper_names)
+    if not devices:
+        return results, mounts
+    try:
+        with state.phase('activate-volume-groups'):
+            volume_groups, activated = activate_volume_groups(sorted(devices), context=state.context)
+    except Exception as e:
+        logger.error("Failed to activate LVM volume groups on %s! (%s)", concatenate(sorted(devices.values())), e)
+        for name in devices.values():
+            results.failures[name] = e
+        return results, mounts
+    owners = find_owners(devices, volume_groups, activated, results)
+    return results, find_lvm_mounts(owners, list_logical_volumes(owners, context=state.context), state)
+
+
+def find_owners(devices, volume_groups, activated, results):
+    """
+    Decide which drive the logical volumes of each volume group are mounted on behalf of.
+
+    :param devices: A dictionary with the pathnames of device mapper devices
+                    (strings) as keys and mapper names (strings) as values.
+    :param volume_groups: The result of :func:`find_volume_groups()`.
+    :param activated: A set with the names of the volume groups that were activated.
+    :param results: An :class:`.ActivationResults` object (updated in place,
+                    drives of activated volume groups get the status
+                    :data:`~.DriveStatus.ACTIVATED`).
+    :returns: A dictionary with volume group names (strings) as keys and
+              mapper names (strings) as values.
+
+    The logical volumes of volume groups that span multiple drives are
+    mounted on behalf of the first of those drives.
+    """
+    owners = {}
+    for device_file, vg_name in sorted(volume_groups.items()):
+        if vg_name in activated:
+            results[devices[device_file]] = DriveStatus.ACTIVATED
+        owners.setdefault(vg_name, devices[device_file])
+    return owners
+
+
+def find_lvm_mounts(owners, logical_volumes, state):
+    """
+    Find the logical volumes that are configured in ``/etc/fstab`` and aren't mounted yet.
+
+    :param owners: The result of :func:`find_owners()`.
+    :param logical_volumes: The result of :func:`list_logical_volumes()`.
+    :param state: A :class:`.SystemState` object.
+    :returns: A list of :class:`.Mount` objects (the logical volumes are
+              mounted by their mount point, so that the options in
+              ``/etc/fstab`` apply).
+    """
+    from crypto_drive_manager.mounts import Mount
+    mounts = []
+    for vg_name, entries in sorted(find_fstab_entries(logical_volumes, state).items()):
+        for lv, entry in entries:
+            if state.is_mounted(lv.dm_path):
+                logger.verbose("Logical volume %s is already mounted.", lv.path)
+            else:
+                mounts.append(Mount(lv.dm_path, entry.mount_point, owners[vg_name], target=entry.mount_point))
+    return mounts
+
+
+def activate_volume_groups(device_files, context=None):
+    """
+    Activate the volume groups that use the given devices as physical volumes.
+
+    :param device_files: An iterable of pathnames of block devices (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A tuple of two values:
+
+              1. The result of :func:`find_volume_groups()`.
+              2. A set with the names of the volume groups that were
+                 activated (strings).
+    :raises: :exc:`~executor.ExternalCommandFailed` when ``vgchange`` fails.
+
+    A single ``pvscan --cache`` makes LVM aware of all of the physical
+    volumes and a single ``vgchange --activate y`` activates the volume groups
+    on top of them. Volume groups that are already active (see
+    :func:`find_inactive_volume_groups()`) are left alone.
+    """
+    device_files = list(device_files)
+    if not device_files:
+        return {}, set()
+    context = coerce_context(context)
+    context.execute('pvscan', '--cache', *device_files, check=False, silent=True)
+    volume_groups = find_volume_groups(device_files, context=context)
+    inactive = find_inactive_volume_groups(volume_groups.values(), context=context)
+    if inactive:
+        names = sorted(inactive)
+        logger.info("Activating LVM volume groups %s ..", concatenate(names))
+        context.execute('vgchange', '--activate', 'y', *names, capture=True, capture_stderr=True, silent=True)
+    return volume_groups, inactive
+
+
+def find_inactive_volume_groups(volume_groups, context=None):
+    """
+    Find the volume groups that contain logical volumes that aren't active.
+
+    :param volume_groups: An iterable of volume group names (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A set with the names of the inactive volume groups (strings).
+    """
+    volume_groups = sorted(set(volume_groups))
+    if not volume_groups:
+        return set()
+    output = coerce_context(context).capture(*report_command('lvs', 'vg_name,lv_active', volume_groups),
+                                             check=False, silent=True)
+    return parse_inactive_volume_groups(output, volume_groups)
+
+
+def parse_inactive_volume_groups(output, volume_groups):
+    """
+    Parse the ``lvs`` report used by :func:`find_inactive_volume_groups()`.
+
+    :param output: The output of ``lvs`` (a string).
+    :param volume_groups: A list of volume group names (strings).
+    :returns: A set with the names of the inactive volume groups (strings).
+    """
+    inactive = set()
+    for fields in parse_report(output):
+        if len(fields) == 2 and fields[0] in volume_groups and fields[1] != 'active':
+            inactive.add(fields[0])
+    return inactive
+
+
+def find_volume_groups(device_files, context=None):
+    """
+    Find the volume groups that use the given devices as physical volumes.
+
+    :param device_files: An iterable of pathnames of block devices (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A dictionary with pathnames of devices (strings) as keys and
+              volume group names (strings) as values. Devices that aren't
+              (part of a volume group) are omitted.
+    """
+    device_files = list(device_files)
+    if not device_files:
+        return {}
+    output = coerce_context(context).capture(*report_command('pvs', 'pv_name,vg_name', device_files),
+                                             check=False, silent=True)
+    return parse_volume_groups(output)
+
+
+def parse_volume_groups(output):
+    """
+    Parse the ``pvs`` report used by :func:`find_volume_groups()`.
+
+    :param output: The output of ``pvs`` (a string).
+    :returns: See :func:`find_volume_groups()`.
+    """
+    volume_groups = {}
+    for pv_name, vg_name in parse_report(output):
+        if vg_name:
+            volume_groups[pv_name] = vg_name
+    return volume_groups
+
+
+def find_logical_volumes(volume_groups, context=None):
+    """
+    Find the logical volumes in the given volume groups.
+
+    :param volume_groups: An iterable of volume group names (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A dictionary with volume group names (strings) as keys and
+              lists of device mapper pathnames (strings like
+              ``/dev/mapper/vg-lv``) as values.
+    """
+    volume_groups = sorted(set(volume_groups))
+    logical_volumes = dict((vg, []) for vg in volume_groups)
+    for lv in list_logical_volumes(volume_groups, context=context):
+        logical_volumes[lv.volume_group].append(lv.dm_path)
+    return logical_volumes
+
+
+def list_logical_volumes(volume_groups, context=None):
+    """
+    List the logical volumes in the given volume groups.
+
+    :param volume_groups: An iterable of volume group names (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A list of :class:`LogicalVolume` objects.
+    """
+    volume_groups = sorted(set(volume_groups))
+    if not volume_groups:
+        return []
+    output = coerce_context(context).capture(*report_command('lvs', 'vg_name,lv_path,lv_dm_path', volume_groups),
+                                             check=False, silent=True)
+    return parse_logical_volumes(output, volume_groups)
+
+
+def parse_logical_volumes(output, volume_groups):
+    """
+    Parse the ``lvs`` report used by :func:`list_logical_volumes()`.
+
+    :param output: The output of ``lvs`` (a string).
+    :param volume_groups: A list of volume group names (strings).
+    :returns: A list of :class:`LogicalVolume` objects.
+    """
+    logical_volumes = []
+    for fields in parse_report(output):
+        if len(fields) == 3 and fields[0] in volume_groups and fields[2]:
+            logical_volumes.append(LogicalVolume(*fields))
+    return logical_volumes
+
+
+def find_fstab_entries(logical_volumes, state):
+    """
+    Find the entries in ``/etc/fstab`` that refer to the given logical volumes.
+
+    :param logical_volumes: A list of :class:`LogicalVolume` objects.
+    :param state: A :class:`.SystemState` object.
+    :returns: A dictionary with volume group names (strings) as keys and lists
+              of tuples with a :class:`LogicalVolume` object and a
+              :class:`~linux_utils.fstab.FileSystemEntry` object as values.
+
+    Entries can refer to a logical volume by its pathname or its device mapper
+    pathname. For local contexts (see :func:`.is_local_context()`) symbolic
+    links like ``/dev/disk/by-uuid/..`` are resolved as well.
+    """
+    from crypto_drive_manager.state import is_local_context
+    resolve = is_local_context(state.context)
+    aliases = {}
+    for lv in logical_volumes:
+        for pathname in (lv.path, lv.dm_path):
+            aliases[pathname] = lv
+        if resolve and os.path.exists(lv.dm_path):
+            aliases[os.path.realpath(lv.dm_path)] = lv
+    matches = {}
+    for entry in state.fstab:
+        device_file = entry.device_file
+        lv = aliases.get(device_file)
+        if lv is None and resolve and device_file and os.path.exists(device_file):
+            lv = aliases.get(os.path.realpath(device_file))
+        if lv is not None:
+            matches.setdefault(lv.volume_group, []).append((lv, entry))
+    return matches
+
+
+def report_command(program, fields, names):
+    """
+    Generate an LVM reporting command.
+
+    :param program: The name of the reporting command (``pvs`` or ``lvs``).
+    :param fields: The fields to report (a comma separated string).
+    :param names: The devices or volume groups to report on (an iterable of strings).
+    :returns: A list of strings.
+    """
+    return [program, '--noheadings', '--separator=:', '--options=%s' % fields] + list(names)
+
+
+def parse_report(output):
+    """
+    Parse the output of an LVM reporting command.
+
+    :param output: The output of ``pvs``, ``vgs`` or ``lvs`` with the options
+                   ``--noheadings`` and ``--separator=:`` (a string).
+    :returns: A list of tuples with the fields of each line (strings).
+    """
+    return [tuple(f.strip() for f in line.split(':')) for line in output.splitlines() if line.strip()]
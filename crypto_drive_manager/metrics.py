@@ -0,0 +1,261 @@
+# Prometheus metrics for unlock runs.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Export the results of unlock runs as Prometheus metrics.
+
+The node exporter of Prometheus can publish metrics from ``*.prom`` files in
+a directory (the textfile collector), which is a good fit for a program that
+runs once in a while instead of continuously. :class:`RunMetrics` collects
+the outcome of an unlock run (see :func:`.initialize_keys_device()`) and the
+measurements of a :class:`.Timings` object and renders them in the text
+exposition format. :func:`write_textfile()` replaces the file atomically so
+the node exporter never reads a partially written file.
+
+Because every run replaces the file, the counters (the metrics whose names
+end in ``_total``) are read from the previous file and incremented.
+"""
+
+# Standard library modules.
+import collections
+import os
+import re
+import time
+
+# External dependencies.
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import DriveStatus
+
+DEFAULT_TEXTFILE = '/var/lib/prometheus/node-exporter/crypto-drive-manager.prom'
+"""The default pathname of the metrics file (a string)."""
+
+PREFIX = 'crypto_drive_manager_'
+"""The prefix of the names of all metrics (a string)."""
+
+UNLOCK_PHASES = ('open', 'unlock-cached')
+"""The names of the phases (see :func:`.SystemState.phase()`) that unlock a drive (a tuple of strings)."""
+
+SAMPLE_PATTERN = re.compile(r'^(\w+)(\{.*\})?\s+(\S+)$')
+"""Regular expression that parses a sample in the text exposition format."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class RunMetrics(object):
+
+    """Metrics of a single unlock run."""
+
+    def __init__(self, timings=None):
+        """
+        Initialize a :class:`RunMetrics` object (this starts timing the run).
+
+        :param timings: The :class:`.Timings` object given to the
+                        :class:`.SystemState` of the run (needed for the
+                        latencies, optional otherwise).
+        """
+        self.timings = timings
+        self.timer = Timer()
+        self.num_configured = None
+        self.num_available = None
+        self.results = None
+
+    def update(self, plan, results):
+        """
+        Record the outcome of the run (called by :func:`.initialize_keys_device()`).
+
+        :param plan: An :class:`.ActivationPlan` object.
+        :param results: An :class:`.ActivationResults` object.
+        """
+        self.num_configured = plan.num_configured
+        self.num_available = len(plan.available_drives)
+        self.results = results
+
+    def render(self, previous=None):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        :param previous: The contents of the previous metrics file (a string
+                         or :data:`None`). The counters are incremented from
+                         the values in this file.
+        :returns: The metrics (a string).
+        """
+        counters = parse_counters(previous or '')
+        succeeded = self.results is not None and not self.results.failures
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, help))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for labels, value in samples:
+                lines.append('%s%s%s %s' % (PREFIX, name, format_labels(labels), format_value(value)))
+
+        def increment(name, labels, amount):
+            key = (PREFIX + name, format_labels(labels))
+            return counters.get(key, 0) + amount
+
+        add('run_duration_seconds', 'gauge', "Duration of the last unlock run.",
+            [({}, self.timer.elapsed_time)])
+        add('run_timestamp_seconds', 'gauge', "Time when the last unlock run finished.",
+            [({}, time.time())])
+        add('run_success', 'gauge', "Whether the last unlock run activated all selected drives (1) or not (0).",
+            [({}, int(succeeded))])
+        add('runs_total', 'counter', "Number of unlock runs.",
+            [({}, increment('runs_total', {}, 1))])
+        add('failed_runs_total', 'counter', "Number of unlock runs that didn't activate all selected drives.",
+            [({}, increment('failed_runs_total', {}, 0 if succeeded else 1))])
+        exposure = self.sum_phases('keys-device-exposure')
+        if exposure:
+            add('keys_device_exposure_seconds', 'gauge',
+                "Time during which the virtual keys device was unlocked in the last run.",
+                [({}, exposure[None])])
+        if self.results is not None:
+            num_unlocked = sum(1 for status in self.results.values() if status & DriveStatus.UNLOCKED)
+            add('configured_drives', 'gauge', "Number of managed drives in /etc/crypttab.",
+                [({}, self.num_configured)])
+            add('available_drives', 'gauge', "Number of selected drives that were available.",
+                [({}, self.num_available)])
+            add('unlocked_drives', 'gauge', "Number of drives unlocked by the last run.",
+                [({}, num_unlocked)])
+            add('failed_drives', 'gauge', "Number of drives that the last run failed to activate.",
+                [({}, len(self.results.failures))])
+            statuses = dict((name, int(status)) for name, status in self.results.items())
+            statuses.update((name, -1) for name in self.results.failures)
+            add('drive_status', 'gauge', "Status of each drive after the last run (a bitmask of %s, -1 means failed)."
+                % ', '.join('%s=%i' % (s.name, s.value) for s in DriveStatus if s.value),
+                [({'drive': name}, statuses[name]) for name in sorted(statuses)])
+        # Carry over the counters of drives that weren't part of this run.
+        drives = set(parse_drive(k[1]) for k in counters if k[0] == PREFIX + 'drive_failures_total')
+        failed = set()
+        if self.results is not None:
+            drives.update(self.results)
+            drives.update(self.results.failures)
+            failed.update(self.results.failures)
+        drives.discard(None)
+        if drives:
+            add('drive_failures_total', 'counter', "Number of runs that failed to activate each drive.",
+                [({'drive': name}, increment('drive_failures_total', {'drive': name}, int(name in failed)))
+                 for name in sorted(drives)])
+        unlock_latency = self.sum_phases(*UNLOCK_PHASES)
+        if unlock_latency:
+            add('drive_unlock_seconds', 'gauge', "Time spent unlocking each drive in the last run.",
+                [({'drive': d}, unlock_latency[d]) for d in sorted(unlock_latency) if d])
+        mount_latency = self.sum_phases('mount')
+        if mount_latency:
+            add('drive_mount_seconds', 'gauge', "Time spent mounting the filesystems of each drive in the last run.",
+                [({'drive': d}, mount_latency[d]) for d in sorted(mount_latency) if d])
+        if self.timings is not None:
+            phases = [(k, v[1]) for k, v in self.timings.summarize('phase').items()]
+            if phases:
+                add('phase_seconds', 'gauge', "Time spent in each phase of the last run (summed over drives).",
+                    [({'phase': name}, total) for name, total in phases])
+        return '\n'.join(lines) + '\n'
+
+    def sum_phases(self, *names):
+        """
+        Add up the durations of phases per drive.
+
+        :param names: The names of one or more phases (strings).
+        :returns: A dictionary with mapper names (or :data:`None` for phases
+                  that aren't specific to a drive) as keys and durations in
+                  seconds as values.
+        """
+        totals = collections.defaultdict(float)
+        if self.timings is not None:
+            with self.timings.lock:
+                records = list(self.timings.records)
+            for record in records:
+                if record.kind == 'phase' and record.name in names:
+                    totals[record.drive] += record.duration
+        return dict(totals)
+
+    def write(self, filename=DEFAULT_TEXTFILE):
+        """
+        Write the metrics to a file (see :func:`write_textfile()`).
+
+        :param filename: The pathname of the metrics file (a string).
+        """
+        try:
+            with open(filename) as handle:
+                previous = handle.read()
+        except (IOError, OSError):
+            previous = None
+        write_textfile(filename, self.render(previous))
+        logger.verbose("Wrote metrics to %s.", filename)
+
+
+def write_textfile(filename, contents):
+    """
+    Atomically replace a text file.
+
+    :param filename: The pathname of the file (a string).
+    :param contents: The new contents of the file (a string).
+
+    The contents are written to a temporary file in the same directory (which
+    the node exporter ignores because its name doesn't end in ``.prom``),
+    flushed to disk and then renamed to `filename`.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    temporary_file = os.path.join(directory, '.%s.%i.tmp' % (os.path.basename(filename), os.getpid()))
+    try:
+        with open(temporary_file, 'w') as handle:
+            handle.write(contents)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.chmod(temporary_file, 0o644)
+        os.rename(temporary_file, filename)
+    except Exception:
+        if os.path.exists(temporary_file):
+            os.unlink(temporary_file)
+        raise
+
+
+def parse_counters(text):
+    """
+    Parse the counters in a metrics file.
+
+    :param text: The contents of the metrics file (a string).
+    :returns: A dictionary with tuples of the metric name and the formatted
+              labels as keys and numbers as values.
+    """
+    counters = {}
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line.strip())
+        if match and match.group(1).endswith('_total'):
+            try:
+                counters[(match.group(1), match.group(2) or '')] = float(match.group(3))
+            except ValueError:
+                pass
+    return counters
+
+
+def parse_drive(labels):
+    """Get the value of the ``drive`` label from labels formatted by :func:`format_labels()` (a string)."""
+    match = re.search(r'drive="((?:[^"\\]|\\.)*)"', labels)
+    return match.group(1).replace('\\"', '"').replace('\\\\', '\\') if match else None
+
+
+def format_labels(labels):
+    """
+    Format the labels of a sample.
+
+    :param labels: A dictionary with label names and values (strings).
+    :returns: The formatted labels (a string, empty when there are no labels).
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in sorted(labels.items()))
+
+
+def format_value(value):
+    """Format the value of a sample (a string)."""
+    if isinstance(value, float) and not value.is_integer():
+        return '%.6f' % value
+    return '%i' % value
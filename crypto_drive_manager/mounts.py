@@ -0,0 +1,296 @@
+# Dependency aware mounting of filesystems.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Dependency aware mounting of the filesystems on managed drives.
+
+Mounting the filesystems on managed drives one at a time (in the order of
+``/etc/crypttab``) is slow when there are a lot of drives, but mounting them
+all in parallel is wrong when one managed filesystem is mounted inside
+another one (for example ``/srv`` and ``/srv/data``). :class:`MountScheduler`
+builds a dependency graph from the mount points in ``/etc/fstab`` so that
+independent filesystems are mounted in parallel while a filesystem that is
+mounted inside another one waits for (only) that filesystem.
+"""
+
+# Standard library modules.
+import enum
+import os
+
+# External dependencies.
+from humanfriendly import Timer, format_timespan, pluralize
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import DriveStatus, coerce_state
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def mount_encrypted_drives(drives, lvm_drives=(), concurrency=1, state=None):
+    """
+    Mount the filesystems on unlocked drives and on the logical volumes on top of them.
+
+    :param drives: An iterable of device mapper names of drives that contain
+                   a filesystem (strings).
+    :param lvm_drives: An iterable of device mapper names of drives that
+                       contain an LVM physical volume (strings). The volume
+                       groups on these drives are activated first (see
+                       :func:`.activate_lvm_drives()`).
+    :param concurrency: The maximum number of filesystems that are mounted in
+                        parallel (an integer).
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
+    :returns: An :class:`.ActivationResults` object (drives of which a
+              filesystem was mounted have the status :data:`~.DriveStatus.MOUNTED`).
+
+    Drives that are already mounted are skipped. All filesystems are mounted
+    by a single :class:`MountScheduler`, so filesystems on logical volumes
+    can depend on filesystems on drives and vice versa.
+    """
+    from crypto_drive_manager.lvm import activate_lvm_drives
+    state = coerce_state(state)
+    mounts = find_drive_mounts(drives, state)
+    results, lvm_mounts = activate_lvm_drives(lvm_drives, state=state)
+    mounts.extend(lvm_mounts)
+    MountScheduler(mounts, concurrency, state).run()
+    record_mounts(mounts, results)
+    return results
+
+
+def find_drive_mounts(drives, state):
+    """
+    Prepare to mount the filesystems on unlocked drives.
+
+    :param drives: An iterable of device mapper names of drives that contain
+                   a filesystem (strings).
+    :param state: A :class:`.SystemState` object.
+    :returns: A list of :class:`Mount` objects (drives that are already
+              mounted are skipped).
+    """
+    mounts = []
+    for mapper_name in drives:
+        device_file = '/dev/mapper/%s' % mapper_name
+        if state.is_mounted(device_file):
+            logger.verbose("Drive %s is already mounted.", device_file)
+        else:
+            mounts.append(Mount(device_file, find_mount_point(device_file, state), mapper_name))
+    return mounts
+
+
+def record_mounts(mounts, results):
+    """
+    Record the results of mounting filesystems.
+
+    :param mounts: A list of :class:`Mount` objects (whose status has been set).
+    :param results: An :class:`.ActivationResults` object (updated in place).
+    """
+    for mount in mounts:
+        if mount.status == MountStatus.MOUNTED:
+            results[mount.drive] = results.get(mount.drive, DriveStatus.DEFAULT) | DriveStatus.MOUNTED
+    for mount in mounts:
+        if mount.status != MountStatus.MOUNTED and mount.drive not in results.failures:
+            results.pop(mount.drive, None)
+            results.failures[mount.drive] = mount.exception
+
+
+def find_mount_point(device_file, state):
+    """
+    Find the mount point of a device in ``/etc/fstab``.
+
+    :param device_file: The pathname of a device (a string).
+    :param state: A :class:`.SystemState` object.
+    :returns: The mount point (a string) or :data:`None` when `device_file`
+              doesn't occur in ``/etc/fstab``.
+
+    For local contexts (see :func:`.is_local_context()`) symbolic links are
+    resolved on both sides, so that entries like ``UUID=..`` and ``LABEL=..``
+    (which refer to symbolic links in ``/dev/disk``) match as well.
+    """
+    from crypto_drive_manager.state import is_local_context
+    resolve = is_local_context(state.context) and os.path.exists(device_file)
+    real_path = os.path.realpath(device_file) if resolve else device_file
+    for entry in state.fstab:
+        if entry.device_file == device_file:
+            return entry.mount_point
+        if resolve and entry.device_file and os.path.exists(entry.device_file):
+            if os.path.realpath(entry.device_file) == real_path:
+                return entry.mount_point
+
+
+class MountStatus(enum.Enum):
+
+    """Enumeration of the results of mounting a filesystem."""
+
+    MOUNTED = 'mounted'
+    """The filesystem was mounted."""
+
+    FAILED = 'failed'
+    """The ``mount`` command failed."""
+
+    SKIPPED = 'skipped'
+    """The filesystem wasn't mounted because the filesystem it's mounted inside of wasn't mounted."""
+
+
+class Mount(object):
+
+    """A filesystem to be mounted by :class:`MountScheduler`."""
+
+    def __init__(self, device_file, mount_point, drive, target=None):
+        """
+        Initialize a :class:`Mount` object.
+
+        :param device_file: The pathname of the device that contains the
+                            filesystem (a string).
+        :param mount_point: The mount point of the filesystem in ``/etc/fstab``
+                            (a string or :data:`None` when it's unknown).
+        :param drive: The device mapper name of the managed drive that the
+                      filesystem belongs to (a string).
+        :param target: The argument to the ``mount`` command (a string,
+                       defaults to `device_file`).
+        """
+        self.device_file = device_file
+        self.mount_point = mount_point
+        self.drive = drive
+        self.target = target or device_file
+        self.parent = None
+        """The :class:`Mount` that this filesystem is mounted inside of (or :data:`None`)."""
+        self.status = None
+        self.exception = None
+        self.elapsed_time = None
+
+    @property
+    def error(self):
+        """The error message of a failed or skipped mount (a string or :data:`None`)."""
+        if self.exception is not None:
+            return str(self.exception).strip().splitlines()[-1]
+
+    def __str__(self):
+        """Render a human friendly string representation of the mount."""
+        return self.mount_point or self.device_file
+
+
+class MountScheduler(object):
+
+    """Mount filesystems in parallel while respecting the nesting of their mount points."""
+
+    def __init__(self, mounts, concurrency=1, state=None):
+        """
+        Initialize a :class:`MountScheduler` object.
+
+        :param mounts: A list of :class:`Mount` objects.
+        :param concurrency: The maximum number of filesystems that are
+                            mounted in parallel (an integer).
+        :param state: A :class:`.SystemState` object.
+        """
+        self.mounts = mounts
+        self.concurrency = max(1, concurrency or 1)
+        self.state = coerce_state(state)
+        self.link_parents()
+
+    def link_parents(self):
+        """
+        Find the parent of every mount (the closest mount whose mount point contains it).
+
+        Only the mounts given to the scheduler are considered, filesystems
+        that are already mounted (or that aren't managed) don't matter.
+        """
+        by_mount_point = dict((os.path.normpath(m.mount_point), m) for m in self.mounts if m.mount_point)
+        for mount in self.mounts:
+            if mount.mount_point:
+                directory = os.path.normpath(mount.mount_point)
+                while directory != os.path.dirname(directory):
+                    directory = os.path.dirname(directory)
+                    if directory in by_mount_point:
+                        mount.parent = by_mount_point[directory]
+                        break
+
+    def run(self):
+        """
+        Mount the filesystems.
+
+        :returns: The list of :class:`Mount` objects (whose status has been set).
+
+        The filesystems without a parent are mounted first (in parallel) and
+        as soon as a filesystem has been mounted the filesystems inside of
+        it are started. When a filesystem fails to mount the filesystems
+        inside of it are skipped. The failures are logged together at the end.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        if not self.mounts:
+            return self.mounts
+        timer = Timer()
+        children = {}
+        for mount in self.mounts:
+            children.setdefault(mount.parent, []).append(mount)
+        if self.concurrency > 1 and len(self.mounts) > 1:
+            logger.verbose("Mounting %s using %s ..",
+                           pluralize(len(self.mounts), "filesystem"),
+                           pluralize(min(self.concurrency, len(self.mounts)), "worker thread"))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = dict((pool.submit(self.mount, m), m) for m in children.get(None, []))
+            while futures:
+                done, not_done = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent = futures.pop(future)
+                    for child in children.get(parent, []):
+                        if parent.status == MountStatus.MOUNTED:
+                            futures[pool.submit(self.mount, child)] = child
+                        else:
+                            self.skip(child, parent, children)
+        self.report(timer)
+        return self.mounts
+
+    def mount(self, mount):
+        """
+        Mount a single filesystem.
+
+        :param mount: A :class:`Mount` object.
+        """
+        timer = Timer()
+        try:
+            with self.state.phase('mount', drive=mount.drive):
+                logger.verbose("Mounting %s ..", mount)
+                self.state.context.execute('mount', mount.target)
+                self.state.add_mount(mount.device_file, mount.mount_point)
+            mount.status = MountStatus.MOUNTED
+            logger.info("Mounted %s (%s) in %s.", mount, mount.device_file, timer)
+        except Exception as e:
+            mount.status = MountStatus.FAILED
+            mount.exception = e
+        mount.elapsed_time = timer.elapsed_time
+
+    def skip(self, mount, parent, children):
+        """
+        Skip a filesystem (and the filesystems inside of it) because its parent wasn't mounted.
+
+        :param mount: The :class:`Mount` to skip.
+        :param parent: The :class:`Mount` that wasn't mounted.
+        :param children: A dictionary with :class:`Mount` objects as keys and
+                         lists of their child mounts as values.
+        """
+        mount.status = MountStatus.SKIPPED
+        mount.exception = Exception("Not mounted because %s wasn't mounted." % parent)
+        for child in children.get(mount, []):
+            self.skip(child, mount, children)
+
+    def report(self, timer):
+        """
+        Log a summary of the mounts (including all failures).
+
+        :param timer: A :class:`~humanfriendly.Timer` that was started when the mounts started.
+        """
+        mounted = [m for m in self.mounts if m.status == MountStatus.MOUNTED]
+        failed = [m for m in self.mounts if m.status != MountStatus.MOUNTED]
+        if mounted:
+            slowest = max(mounted, key=lambda m: m.elapsed_time)
+            logger.verbose("Mounted %s in %s (slowest was %s in %s).", pluralize(len(mounted), "filesystem"),
+                           timer, slowest, format_timespan(slowest.elapsed_time))
+        if failed:
+            logger.error("Failed to mount %s:\n%s", pluralize(len(failed), "filesystem"), '\n'.join(
+                " - %s (%s): %s" % (m, m.drive, m.error) for m in failed
+            ))
@@ -0,0 +1,641 @@
+# Planning and execution of unlock runs.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Planning and execution of unlock runs.
+
+An unlock run is split in two steps:
+
+1. :func:`create_plan()` inspects a single snapshot of the system state (see
+   :class:`.SystemState`) and decides which actions (see :class:`Action`) are
+   required for every managed drive. This doesn't change anything, which
+   means a plan can be shown to the operator (see the ``--dry-run`` option
+   and the ``status`` command) without unlocking the virtual keys device.
+
+2. :class:`PlanExecutor` carries out a plan. Instead of walking through the
+   steps for one drive at a time the actions are grouped by type (all keys
+   are created, then all keys are installed, then all drives are unlocked,
+   then all drives are mounted) and the actions of each group are executed
+   in parallel (see :func:`.map_drives()`). Drives for which an action fails
+   are excluded from the remaining groups.
+"""
+
+# Standard library modules.
+import enum
+import json
+import os
+import time
+
+# External dependencies.
+from humanfriendly import format_timespan, pluralize
+from humanfriendly.tables import format_pretty_table
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import (
+    ActivationResults,
+    DriveStatus,
+    coerce_state,
+    find_managed_drives,
+    map_drives,
+    unlock_with_key,
+)
+
+DEFAULT_DEVICE_TIMEOUT = 90
+"""The default number of seconds to wait for devices to appear (a number, the same as systemd's default)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class Action(enum.Enum):
+
+    """Enumeration of the actions that a plan can contain for a managed drive."""
+
+    CREATE_KEY = 'create-key'
+    """Generate a new key file."""
+
+    ADD_KEY = 'add-key'
+    """Install the key file in a key slot of the encrypted drive."""
+
+    OPEN = 'open'
+    """Unlock the encrypted drive."""
+
+    MOUNT = 'mount'
+    """Mount the filesystem on the encrypted drive (as configured in ``/etc/fstab``)."""
+
+    ACTIVATE_LVM = 'activate-lvm'
+    """Activate the LVM volume group on the drive and mount its logical volumes (instead of mounting the drive)."""
+
+    SKIP_UNAVAILABLE = 'skip-unavailable'
+    """Skip the drive because the physical device isn't available."""
+
+
+def create_plan(keys_directory, volumes=(), first_run=False, keys_accessible=None, state=None):
+    """
+    Decide which actions are required to activate the managed drives.
+
+    :param keys_directory: The mount point of the virtual keys device (a string).
+    :param volumes: See :func:`.initialize_keys_device()`.
+    :param first_run: :data:`True` when the virtual keys device doesn't exist
+                      yet (which means the key files of all drives will be
+                      regenerated), :data:`False` otherwise.
+    :param keys_accessible: :data:`True` if the key files in `keys_directory`
+                            can be inspected, :data:`False` if they can't
+                            (because the virtual keys device is locked) or
+                            :data:`None` to check whether `keys_directory`
+                            is a mount point.
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
+    :returns: An :class:`ActivationPlan` object.
+
+    Drives that are unlocked but not mounted are probed (see
+    :func:`.probe_filesystems()`) to decide between :data:`Action.MOUNT` and
+    :data:`Action.ACTIVATE_LVM` (the latter only when the volume group isn't
+    active yet). Drives that are still locked can't be probed, so the plan
+    includes :data:`Action.MOUNT` and :class:`PlanExecutor` probes them after
+    they've been unlocked.
+    """
+    from crypto_drive_manager.lvm import find_inactive_volume_groups, find_volume_groups
+    from crypto_drive_manager.probe import probe_filesystems
+    state = coerce_state(state)
+    if keys_accessible is None:
+        keys_accessible = os.path.ismount(keys_directory)
+    with state.phase('plan'):
+        drives = []
+        num_configured = 0
+        for entry in find_managed_drives(keys_directory, state=state):
+            num_configured += 1
+            if volumes and entry.target not in volumes:
+                logger.verbose("Ignoring %s because it doesn't match the filter.", entry.target)
+                continue
+            drive = DrivePlan(entry, keys_directory)
+            drive.available = entry.is_available
+            drive.unlocked = state.is_mapped(entry.target)
+            drive.mounted = state.is_mounted(drive.mapper_device)
+            drives.append(drive)
+        for drive in drives:
+            if not drive.available:
+                drive.actions.append(Action.SKIP_UNAVAILABLE)
+                continue
+            drive.plan_activation(first_run)
+        plan = ActivationPlan(drives, keys_directory, num_configured, first_run)
+        if keys_accessible:
+            plan.check_key_files()
+        # Probe the drives that are unlocked but not mounted (in one pass).
+        candidates = [d for d in drives if d.available and d.unlocked and not d.mounted]
+        if candidates:
+            signatures = probe_filesystems([d.mapper_device for d in candidates], context=state.context)
+            physical_volumes = []
+            for drive in candidates:
+                drive.filesystem = signatures.get(drive.mapper_device)
+                if drive.filesystem == 'LVM2_member':
+                    physical_volumes.append(drive)
+                else:
+                    drive.actions.append(Action.MOUNT)
+            # Only activate volume groups that aren't active yet.
+            if physical_volumes:
+                volume_groups = find_volume_groups([d.mapper_device for d in physical_volumes], context=state.context)
+                inactive = find_inactive_volume_groups(volume_groups.values(), context=state.context)
+                for drive in physical_volumes:
+                    if volume_groups.get(drive.mapper_device) in inactive:
+                        drive.actions.append(Action.ACTIVATE_LVM)
+                    else:
+                        logger.verbose("Volume group on %s is already active.", drive.mapper_device)
+    return plan
+
+
+class ActivationPlan(object):
+
+    """The actions required to activate the managed drives (see :func:`create_plan()`)."""
+
+    def __init__(self, drives, keys_directory, num_configured, first_run=False):
+        """
+        Initialize an :class:`ActivationPlan` object.
+
+        :param drives: A list of :class:`DrivePlan` objects.
+        :param keys_directory: The mount point of the virtual keys device (a string).
+        :param num_configured: The number of managed drives, including the
+                               drives that don't match the filter (an integer).
+        :param first_run: See :func:`create_plan()`.
+        """
+        self.drives = drives
+        self.keys_directory = keys_directory
+        self.num_configured = num_configured
+        self.first_run = first_run
+
+    @property
+    def available_drives(self):
+        """The :class:`DrivePlan` objects of the drives that are available (a list)."""
+        return [d for d in self.drives if d.available]
+
+    @property
+    def needs_keys(self):
+        """:data:`True` if the virtual keys device needs to be unlocked to carry out the plan."""
+        return self.first_run or any(self.find(Action.CREATE_KEY, Action.ADD_KEY, Action.OPEN))
+
+    def check_key_files(self, key_store=None):
+        """
+        Check which of the key files exist and plan to create the missing key files.
+
+        :param key_store: A :class:`.KeyDirectory` or :class:`.KeyStore` object
+                          (defaults to the key files in :attr:`keys_directory`).
+
+        This is only possible while the virtual keys device is unlocked, so
+        :func:`.initialize_keys_device()` calls this once it has unlocked the
+        virtual keys device.
+        """
+        from crypto_drive_manager.keystore import KeyDirectory
+        key_store = key_store or KeyDirectory(self.keys_directory)
+        for drive in self.drives:
+            drive.key_file_exists = key_store.exists(drive.mapper_name)
+            if Action.OPEN in drive.actions and Action.CREATE_KEY not in drive.actions and not drive.key_file_exists:
+                drive.actions[0:0] = [Action.CREATE_KEY, Action.ADD_KEY]
+
+    def find(self, *actions):
+        """
+        Find the drives whose plan includes one of the given actions.
+
+        :param actions: One or more :class:`Action` values.
+        :returns: A list of :class:`DrivePlan` objects.
+        """
+        return [d for d in self.drives if any(a in d.actions for a in actions)]
+
+    def render_actions(self):
+        """
+        Render the actions grouped by type (in the order in which they're executed).
+
+        :returns: The rendered actions (a string).
+        """
+        lines = []
+        if self.first_run:
+            lines.append("Create virtual keys device.")
+        if self.needs_keys:
+            lines.append("Unlock virtual keys device.")
+        for action in Action:
+            drives = self.find(action)
+            if drives:
+                lines.append("%s %s: %s" % (
+                    action.value, pluralize(len(drives), "drive"),
+                    ', '.join(d.mapper_name for d in drives),
+                ))
+        return '\n'.join(lines) if lines else "Nothing to do."
+
+    def render_table(self):
+        """
+        Render the state and the planned actions of every drive as a table.
+
+        :returns: The rendered table (a string).
+        """
+        rows = []
+        for drive in self.drives:
+            rows.append([
+                drive.mapper_name,
+                drive.source_device,
+                format_flag(drive.available),
+                format_flag(drive.unlocked),
+                format_flag(drive.mounted),
+                format_flag(drive.key_file_exists),
+                ', '.join(a.value for a in drive.actions) or '-',
+            ])
+        return format_pretty_table(rows, ["Drive", "Device", "Available", "Unlocked", "Mounted", "Key file", "Actions"])
+
+    def render_json(self):
+        """
+        Render the plan as JSON.
+
+        :returns: A JSON document (a string).
+        """
+        return json.dumps(dict(
+            keys_directory=self.keys_directory,
+            first_run=self.first_run,
+            needs_keys=self.needs_keys,
+            drives=[d.to_dict() for d in self.drives],
+        ), indent=2)
+
+
+class DrivePlan(object):
+
+    """The state of a managed drive and the actions planned for it."""
+
+    def __init__(self, entry, keys_directory):
+        """
+        Initialize a :class:`DrivePlan` object.
+
+        :param entry: A :class:`~linux_utils.crypttab.EncryptedFileSystemEntry` object.
+        :param keys_directory: The mount point of the virtual keys device (a string).
+        """
+        self.entry = entry
+        self.key_file = os.path.join(keys_directory, '%s.key' % entry.target)
+        self.available = False
+        self.unlocked = False
+        self.mounted = False
+        self.filesystem = None
+        self.key_file_exists = None
+        """:data:`True` or :data:`False` when the key file was checked, :data:`None` otherwise."""
+        self.actions = []
+        """A list of :class:`Action` values."""
+
+    def plan_activation(self, first_run=False):
+        """
+        Plan the actions that unlock and mount an available drive.
+
+        :param first_run: See :func:`create_plan()`.
+        """
+        if first_run:
+            self.actions.extend([Action.CREATE_KEY, Action.ADD_KEY])
+        if not self.unlocked:
+            self.actions.extend([Action.OPEN, Action.MOUNT])
+
+    @property
+    def mapper_name(self):
+        """The device mapper name of the drive (a string)."""
+        return self.entry.target
+
+    @property
+    def mapper_device(self):
+        """The pathname of the device mapper device of the drive (a string)."""
+        return '/dev/mapper/%s' % self.mapper_name
+
+    @property
+    def source_device(self):
+        """The pathname of the physical device of the drive (a string)."""
+        return self.entry.source_device
+
+    def to_dict(self):
+        """
+        Convert the plan of the drive to a dictionary (for JSON serialization).
+
+        :returns: A dictionary.
+        """
+        return dict(
+            name=self.mapper_name,
+            source_device=self.source_device,
+            available=self.available,
+            unlocked=self.unlocked,
+            mounted=self.mounted,
+            filesystem=self.filesystem,
+            key_file=self.key_file,
+            key_file_exists=self.key_file_exists,
+            actions=[a.value for a in self.actions],
+        )
+
+
+class PlanExecutor(object):
+
+    """Carry out an :class:`ActivationPlan` (one group of similar actions at a time)."""
+
+    def __init__(self, plan, fast_keyslots=False, concurrency=1, key_store=None, state=None):
+        """
+        Initialize a :class:`PlanExecutor` object.
+
+        :param plan: An :class:`ActivationPlan` object.
+        :param fast_keyslots: See :func:`.initialize_keys_device()`.
+        :param concurrency: The maximum number of actions of the same type
+                            that are executed in parallel (an integer).
+        :param key_store: The keys on the virtual keys device (see
+                          :attr:`.KeysDevice.key_store`, defaults to the key
+                          files in :attr:`.ActivationPlan.keys_directory`).
+        :param state: A :class:`.SystemState` object (if this isn't given a
+                      snapshot of the system state is taken automatically).
+        """
+        from crypto_drive_manager.keystore import KeyDirectory
+        self.plan = plan
+        self.fast_keyslots = fast_keyslots
+        self.concurrency = concurrency
+        self.key_store = key_store or KeyDirectory(plan.keys_directory)
+        self.state = coerce_state(state)
+        self.results = ActivationResults((d.mapper_name, DriveStatus.DEFAULT) for d in plan.available_drives)
+
+    def pending(self, action):
+        """
+        Find the drives whose plan includes an action and that haven't failed.
+
+        :param action: An :class:`Action` value.
+        :returns: A list of :class:`DrivePlan` objects.
+        """
+        return [d for d in self.plan.find(action) if d.mapper_name not in self.results.failures]
+
+    def execute_group(self, action, function, message, name=None):
+        """
+        Execute the actions of one type for all drives.
+
+        :param action: An :class:`Action` value.
+        :param function: A callable that takes a :class:`DrivePlan` object
+                         and returns a :class:`.DriveStatus` value.
+        :param message: The log message for :func:`.map_drives()`.
+        :param name: The name used for timing and error reporting (a string,
+                     defaults to the value of `action`).
+
+        Failures are logged and recorded in :attr:`.ActivationResults.failures`.
+        """
+        name = name or action.value
+
+        def wrapper(drive):
+            try:
+                with self.state.phase(name, drive=drive.mapper_name):
+                    status = function(drive)
+                self.results[drive.mapper_name] |= status
+            except Exception as e:
+                logger.error("Action %s failed for encrypted drive %s! (%s)", name, drive.mapper_name, e)
+                self.results.pop(drive.mapper_name, None)
+                self.results.failures[drive.mapper_name] = e
+
+        map_drives(wrapper, self.pending(action), self.concurrency, message)
+
+    def install_keys(self):
+        """Create the missing key files and install them on the encrypted drives."""
+        from crypto_drive_manager.keyslots import add_key_file
+
+        def create(drive):
+            logger.info("Creating %s to unlock %s (%s)", self.key_store.location(drive.mapper_name),
+                        drive.mapper_name, drive.source_device)
+            self.key_store.generate(drive.mapper_name)
+            return DriveStatus.DEFAULT
+
+        def install(drive):
+            logger.info("Installing %s on %s ..", self.key_store.location(drive.mapper_name), drive.source_device)
+            with self.key_store.key_file(drive.mapper_name) as key_file:
+                add_key_file(drive.source_device, key_file, fast=self.fast_keyslots, context=self.state.context)
+            return DriveStatus.INITIALIZED
+
+        self.execute_group(Action.CREATE_KEY, create, "Creating key files of %s")
+        self.execute_group(Action.ADD_KEY, install, "Installing key files of %s")
+
+    def load_keys(self):
+        """
+        Read the keys of the drives that will be unlocked into memory.
+
+        :returns: A dictionary with mapper names as keys and :class:`.KeyBuffer`
+                  objects as values. The caller is responsible for wiping the
+                  keys (see :func:`.KeyBuffer.wipe()`).
+        """
+        keys = {}
+
+        def load(drive):
+            keys[drive.mapper_name] = self.key_store.read(drive.mapper_name)
+            return DriveStatus.DEFAULT
+
+        self.execute_group(Action.OPEN, load, "Loading keys of %s", name='load-key')
+        return keys
+
+    def unlock_cached_drives(self, key_cache):
+        """
+        Unlock the encrypted drives whose keys are cached.
+
+        :param key_cache: A :class:`.KeyCache` object.
+
+        Drives that were unlocked are removed from :data:`Action.OPEN`, so
+        that :attr:`ActivationPlan.needs_keys` reflects whether the virtual
+        keys device is still needed. When a drive can't be unlocked using its
+        cached key (for example because the key file was replaced) the cached
+        key is evicted and the drive is unlocked using its key file instead.
+        Failures of the cache itself are logged and treated as cache misses.
+        """
+        candidates = [d for d in self.pending(Action.OPEN) if Action.CREATE_KEY not in d.actions]
+        if not candidates:
+            return
+        try:
+            keys = key_cache.lookup(d.mapper_name for d in candidates)
+        except Exception as e:
+            logger.warning("Failed to get cached keys, falling back to key files! (%s)", e)
+            return
+        try:
+            def unlock(drive):
+                try:
+                    with self.state.phase('unlock-cached', drive=drive.mapper_name):
+                        logger.info("Unlocking encrypted drive %s using cached key ..", drive.mapper_name)
+                        unlock_with_key(drive.mapper_name, drive.source_device, keys[drive.mapper_name], self.state)
+                        self.state.add_mapper(drive.mapper_name)
+                    drive.actions.remove(Action.OPEN)
+                    self.results[drive.mapper_name] |= DriveStatus.UNLOCKED
+                except Exception as e:
+                    logger.warning("Failed to unlock %s using cached key, falling back to key file! (%s)",
+                                   drive.mapper_name, e)
+                    key_cache.evict([drive.mapper_name])
+
+            map_drives(unlock, [d for d in candidates if d.mapper_name in keys], self.concurrency,
+                       "Unlocking %s using cached keys")
+        finally:
+            for key in keys.values():
+                key.wipe()
+
+    def cache_keys(self, key_cache, keys):
+        """
+        Add the keys loaded by :func:`load_keys()` to a key cache.
+
+        :param key_cache: A :class:`.KeyCache` object.
+        :param keys: The result of :func:`load_keys()`.
+
+        Failures are logged but otherwise ignored, because the keys are
+        still usable for this run.
+        """
+        try:
+            key_cache.store(keys)
+        except Exception as e:
+            logger.warning("Failed to cache keys! (%s)", e)
+
+    def unlock_drives(self, keys=None):
+        """
+        Unlock the encrypted drives.
+
+        :param keys: The result of :func:`load_keys()` or :data:`None`. When
+                     this is given the drives are unlocked using these keys
+                     (see :func:`.unlock_with_key()`) instead of using
+                     ``cryptdisks_start``.
+        """
+        from linux_utils.luks import cryptdisks_start
+
+        def unlock(drive):
+            logger.info("Unlocking encrypted drive %s ..", drive.mapper_name)
+            if keys is not None:
+                unlock_with_key(drive.mapper_name, drive.source_device, keys[drive.mapper_name], self.state)
+            else:
+                secure_key_file(drive)
+                cryptdisks_start(drive.mapper_name, context=self.state.context)
+            self.state.add_mapper(drive.mapper_name)
+            return DriveStatus.UNLOCKED
+
+        self.execute_group(Action.OPEN, unlock, "Unlocking %s")
+
+    def mount_drives(self):
+        """
+        Mount the filesystems on the encrypted drives.
+
+        Drives that were still locked when the plan was created are probed
+        first (in one pass) and drives that turn out to contain an LVM
+        physical volume aren't mounted, instead their volume groups are
+        activated. The filesystems are mounted in dependency order, see
+        :func:`.mount_encrypted_drives()` for details.
+        """
+        from crypto_drive_manager.mounts import mount_encrypted_drives
+        from crypto_drive_manager.probe import probe_filesystems
+        unprobed = [d for d in self.pending(Action.MOUNT) if d.filesystem is None]
+        if unprobed:
+            with self.state.phase('probe'):
+                signatures = probe_filesystems([d.mapper_device for d in unprobed], context=self.state.context)
+            for drive in unprobed:
+                drive.filesystem = signatures.get(drive.mapper_device)
+                if drive.filesystem == 'LVM2_member':
+                    logger.verbose("Drive %s is part of an LVM volume group so we won't mount it directly.",
+                                   drive.mapper_device)
+                    drive.actions[drive.actions.index(Action.MOUNT)] = Action.ACTIVATE_LVM
+
+        drives = [d.mapper_name for d in self.pending(Action.MOUNT)]
+        lvm_drives = [d.mapper_name for d in self.pending(Action.ACTIVATE_LVM)]
+        if drives or lvm_drives:
+            self.results.merge(mount_encrypted_drives(drives, lvm_drives, self.concurrency, self.state))
+
+    def wait_for_drives(self, drives, deadline, events=None, key_cache=None):
+        """
+        Wait for drives that aren't available yet and activate each drive as soon as it appears.
+
+        :param drives: A list of :class:`DrivePlan` objects (of drives that
+                       weren't available when the plan was created).
+        :param deadline: The time after which we stop waiting (a number, as
+                         returned by :func:`time.time()`).
+        :param events: An event source (an object with the methods ``wait()``
+                       and ``close()`` like :class:`.InotifyEventSource`, the
+                       default watches the directories that contain the
+                       source devices of `drives`).
+        :param key_cache: See :func:`.initialize_keys_device()`.
+
+        The event source is created before the drives are checked, so that a
+        device that appears in between isn't missed. The event source only
+        wakes us up, whether a drive is available is always decided by
+        :attr:`~linux_utils.crypttab.EncryptedFileSystemEntry.is_available`.
+        Drives that appear together are activated together (see
+        :func:`activate_late_drives()`) while we keep waiting for the others.
+        Drives that don't appear before the deadline are skipped (just like
+        drives that aren't available without waiting).
+        """
+        from crypto_drive_manager.daemon import InotifyEventSource
+        from crypto_drive_manager.state import is_local_context
+        waiting = list(drives)
+        if events is None:
+            if not is_local_context(self.state.context):
+                logger.warning("Can't watch for devices on remote systems, skipping %s!",
+                               pluralize(len(waiting), "unavailable drive"))
+                return
+            events = InotifyEventSource(sorted(set(os.path.dirname(d.source_device) for d in waiting)))
+        try:
+            logger.info("Waiting up to %s for %s to appear: %s",
+                        format_timespan(max(0, deadline - time.time())),
+                        pluralize(len(waiting), "drive"),
+                        ', '.join(d.mapper_name for d in waiting))
+            while waiting:
+                ready = [d for d in waiting if d.entry.is_available]
+                if ready:
+                    waiting = [d for d in waiting if d not in ready]
+                    self.activate_late_drives(ready, key_cache)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0 or events.wait(remaining) is None:
+                    break
+        finally:
+            events.close()
+        for drive in waiting:
+            logger.warning("Gave up waiting for encrypted drive %s (%s) to appear!",
+                           drive.mapper_name, drive.source_device)
+
+    def activate_late_drives(self, drives, key_cache=None):
+        """
+        Activate drives that appeared after the plan was created.
+
+        :param drives: A list of :class:`DrivePlan` objects.
+        :param key_cache: See :func:`.initialize_keys_device()`.
+
+        The actions for the drives are planned now that they're available and
+        carried out by a separate :class:`PlanExecutor` (the virtual keys
+        device needs to be mounted) whose results are merged into ours.
+        """
+        logger.info("Detected %s: %s", pluralize(len(drives), "drive"), ', '.join(d.mapper_name for d in drives))
+        for drive in drives:
+            drive.available = True
+            drive.unlocked = self.state.is_mapped(drive.mapper_name)
+            drive.mounted = self.state.is_mounted(drive.mapper_device)
+            drive.actions = []
+            drive.plan_activation(self.plan.first_run)
+            if drive.unlocked and not drive.mounted:
+                drive.actions.append(Action.MOUNT)
+        plan = ActivationPlan(drives, self.plan.keys_directory, len(drives), self.plan.first_run)
+        plan.check_key_files(self.key_store)
+        executor = PlanExecutor(plan, self.fast_keyslots, self.concurrency, self.key_store, self.state)
+        keys = None
+        try:
+            executor.install_keys()
+            if key_cache is not None or not self.key_store.has_files:
+                keys = executor.load_keys()
+                if key_cache is not None:
+                    executor.cache_keys(key_cache, keys)
+            executor.unlock_drives(keys)
+            executor.mount_drives()
+        finally:
+            for key in (keys or {}).values():
+                key.wipe()
+        self.results.merge(executor.results)
+
+
+def secure_key_file(drive):
+    """
+    Make sure the key file of a drive isn't readable by other users.
+
+    :param drive: A :class:`DrivePlan` object.
+
+    Key files generated by older versions weren't created with restrictive
+    permissions, so we make sure they are now.
+    """
+    os.chmod(drive.key_file, 0o400)
+
+
+def format_flag(value):
+    """
+    Format a boolean flag for :func:`ActivationPlan.render_table()`.
+
+    :param value: :data:`True`, :data:`False` or :data:`None` (unknown).
+    :returns: The string ``yes``, ``no`` or ``unknown``.
+    """
+    return 'unknown' if value is None else ('yes' if value else 'no')
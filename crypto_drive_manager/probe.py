@@ -0,0 +1,165 @@
+# In-process filesystem signature probing.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+In-process detection of filesystem signatures.
+
+`crypto-drive-manager` needs to know whether an unlocked drive contains a
+filesystem that can be mounted or an LVM physical volume (which shouldn't be
+mounted directly). Running ``blkid`` once for every drive means process
+startup dominates when there are a lot of drives, so this module recognizes
+the most common signatures by reading the superblock / label regions of the
+device directly. Devices whose signature isn't recognized are passed to a
+single ``blkid`` invocation.
+
+The type names match the ``TYPE`` values reported by ``blkid``.
+"""
+
+# Standard library modules.
+import struct
+
+# External dependencies.
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.state import is_local_context
+
+PROBE_SIZE = 1024 * 68
+"""
+The number of bytes read from the start of each device (an integer).
+
+This covers the btrfs superblock (located at 64 KiB) and the swap signature
+for page sizes up to 64 KiB.
+"""
+
+SWAP_PAGE_SIZES = (4096, 8192, 16384, 32768, 65536)
+"""The page sizes checked for swap signatures (a tuple of integers)."""
+
+EXT4_INCOMPAT_FEATURES = 0x0040 | 0x0080 | 0x0100 | 0x0200 | 0x0400 | 0x1000 | 0x2000 | 0x8000
+"""Incompatible ext features that were introduced by ext4 (extents, 64bit, mmp, flex_bg, etc)."""
+
+EXT4_RO_COMPAT_FEATURES = 0x0008 | 0x0010 | 0x0020 | 0x0040 | 0x0400
+"""Read-only compatible ext features that were introduced by ext4 (huge_file, gdt_csum, etc)."""
+
+EXT3_JOURNAL_DEV = 0x0008
+"""The incompatible ext feature that marks an external ext3/4 journal device."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def probe_filesystem(device_file, fallback=True, context=None):
+    """
+    Detect the type of filesystem (or other signature) on a single device.
+
+    :param device_file: The pathname of a block device or regular file (a string).
+    :param fallback: :data:`True` to run ``blkid`` when the signature isn't
+                     recognized, :data:`False` to skip this.
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A ``blkid`` compatible type name (a string) or :data:`None`.
+    """
+    return probe_filesystems([device_file], fallback=fallback, context=context).get(device_file)
+
+
+def probe_filesystems(device_files, fallback=True, context=None):
+    """
+    Detect the types of filesystems (or other signatures) on multiple devices.
+
+    :param device_files: An iterable of pathnames of block devices or regular
+                         files (strings).
+    :param fallback: :data:`True` to run ``blkid`` (once, for all devices whose
+                     signature wasn't recognized), :data:`False` to skip this.
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+                    Signatures are only read in-process when this is a local
+                    context, otherwise ``blkid`` is used for all devices.
+    :returns: A dictionary with pathnames (strings) as keys and ``blkid``
+              compatible type names (strings or :data:`None`) as values.
+    """
+    context = coerce_context(context)
+    if not is_local_context(context):
+        return run_blkid(list(device_files), context=context) if fallback else {}
+    results = {}
+    unknown = []
+    for filename in device_files:
+        try:
+            with open(filename, 'rb') as handle:
+                data = handle.read(PROBE_SIZE)
+        except (IOError, OSError) as e:
+            logger.debug("Failed to read %s for signature detection! (%s)", filename, e)
+            data = None
+        results[filename] = match_signature(data) if data else None
+        if results[filename]:
+            logger.debug("Detected %s signature on %s.", results[filename], filename)
+        else:
+            unknown.append(filename)
+    if fallback and unknown:
+        results.update(run_blkid(unknown, context=context))
+    return results
+
+
+def match_signature(data):
+    """
+    Recognize a filesystem signature in the first bytes of a device.
+
+    :param data: The first bytes of a device (a byte string, ideally
+                 :data:`PROBE_SIZE` bytes long).
+    :returns: A ``blkid`` compatible type name (a string) or :data:`None`.
+    """
+    # LUKS header (version 1 or 2).
+    if data[0:6] == b'LUKS\xba\xbe':
+        return 'crypto_LUKS'
+    # LVM2 physical volume label (in one of the first four sectors).
+    for offset in range(0, 2048, 512):
+        if data[offset:offset + 8] == b'LABELONE' and data[offset + 24:offset + 32] == b'LVM2 001':
+            return 'LVM2_member'
+    # XFS superblock.
+    if data[0:4] == b'XFSB':
+        return 'xfs'
+    # ext2/3/4 superblock (at 1 KiB, magic number at offset 0x38).
+    if data[1024 + 0x38:1024 + 0x3A] == b'\x53\xef':
+        compat, incompat, ro_compat = struct.unpack('<III', data[1024 + 0x5C:1024 + 0x68])
+        if incompat & EXT3_JOURNAL_DEV:
+            return 'jbd'
+        elif (incompat & EXT4_INCOMPAT_FEATURES) or (ro_compat & EXT4_RO_COMPAT_FEATURES):
+            return 'ext4'
+        elif compat & 0x0004:
+            return 'ext3'
+        else:
+            return 'ext2'
+    # btrfs superblock (at 64 KiB, magic number at offset 0x40).
+    if data[65536 + 0x40:65536 + 0x48] == b'_BHRfS_M':
+        return 'btrfs'
+    # Swap space signature (in the last ten bytes of the first page).
+    for page_size in SWAP_PAGE_SIZES:
+        if data[page_size - 10:page_size] in (b'SWAPSPACE2', b'SWAP-SPACE'):
+            return 'swap'
+    return None
+
+
+def run_blkid(device_files, context=None):
+    """
+    Use ``blkid`` to detect the types of filesystems on multiple devices.
+
+    :param device_files: A list of pathnames of block devices (strings).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+    :returns: A dictionary with pathnames (strings) as keys and type names
+              (strings or :data:`None`) as values.
+
+    A single ``blkid`` process is used to probe all of the given devices.
+    """
+    logger.verbose("Running blkid to probe %i device(s) ..", len(device_files))
+    results = dict((filename, None) for filename in device_files)
+    context = coerce_context(context)
+    output = context.capture('blkid', '-o', 'export', *device_files, check=False)
+    for block in output.split('\n\n'):
+        variables = {}
+        for line in block.splitlines():
+            name, _, value = line.partition('=')
+            variables[name.strip().upper()] = value.strip()
+        if variables.get('DEVNAME') in results:
+            results[variables['DEVNAME']] = variables.get('TYPE') or None
+    return results
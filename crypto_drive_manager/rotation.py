@@ -0,0 +1,244 @@
+# Rotation of the keys of managed drives.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Resumable rotation of the keys of managed drives.
+
+Key files are only generated when a drive is initialized, so without this
+module the key of a drive never changes. :func:`rotate_key()` replaces the
+key of a drive so that the drive can be unlocked at every point in time,
+even when the rotation is interrupted (a crash, a power failure or Control-C
+halfway through rotating a hundred drives):
+
+1. The key slot unlocked by the current key is located and a new key is
+   generated under a temporary name (see :data:`PENDING_SUFFIX`).
+2. The new key is installed in a free key slot (authenticated using the
+   current key).
+3. The new key slot is tested.
+4. The new key replaces the current key on the virtual keys device, while
+   the current key is kept under a temporary name (see :data:`OLD_SUFFIX`).
+5. The old key slot is removed (authenticated using the new key).
+6. When the drive's key slot is pinned in ``/etc/crypttab`` (see
+   :func:`.find_key_slot_option()`) the new key is moved to that key slot.
+7. The copy of the old key is removed.
+
+After each step the progress is recorded in a :class:`RotationJournal` on
+the virtual keys device (next to the keys) and the next rotation picks up
+where an interrupted rotation left off. Steps whose outcome is uncertain
+(because the interruption could have happened while ``cryptsetup`` was
+running) are checked against the LUKS header before they're repeated.
+Because the keys are swapped before the old key slot is removed, the key
+stored under the name of the drive unlocks the drive after every step.
+"""
+
+# Standard library modules.
+import collections
+import json
+
+# External dependencies.
+from humanfriendly import Timer, format_timespan
+from humanfriendly.tables import format_pretty_table
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.keyslots import KeySlotError, add_key_file, find_key_slot, parse_key_slots, test_key_file
+
+PENDING_SUFFIX = '.new'
+"""The suffix of the names of new keys that are being installed (a string)."""
+
+OLD_SUFFIX = '.old'
+"""The suffix of the names of old keys whose key slot is being removed (a string)."""
+
+JOURNAL_SUFFIX = '.rotation'
+"""The suffix of the names of journal entries on the virtual keys device (a string)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def rotate_key(physical_device, name, key_store, journal, fast=False, key_slot=None, context=None):
+    """
+    Replace the key of a drive (resuming an interrupted rotation).
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param name: The device mapper name of the drive (a string).
+    :param key_store: A :class:`.KeyDirectory` or :class:`.KeyStore` object.
+    :param journal: A :class:`RotationJournal` object.
+    :param fast: See :func:`.add_key_file()`.
+    :param key_slot: See :func:`.migrate_key_slot()`.
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: A :class:`KeyRotation` object.
+    :raises: :exc:`.KeySlotError` when no free key slot is available or the
+             new key slot can't be verified, :exc:`~executor.ExternalCommandFailed`
+             when ``cryptsetup`` reports an error.
+    """
+    context = coerce_context(context)
+    timer = Timer()
+    pending = name + PENDING_SUFFIX
+    old_name = name + OLD_SUFFIX
+    entry = journal.get(name)
+    resumed = entry is not None
+    if resumed:
+        logger.info("Resuming rotation of key %s (step %r was completed) ..", name, entry['step'])
+    else:
+        with key_store.key_file(name) as key_file:
+            old_slot, _ = test_key_file(physical_device, key_file, context=context)
+        key_store.remove(old_name)
+        key_store.generate(pending)
+        entry = journal.update(name, step='generated', old_slot=old_slot)
+    if entry['step'] in ('generated', 'added'):
+        with key_store.key_file(pending) as new_key_file:
+            if entry['step'] == 'generated':
+                # An interrupted rotation may have installed the new key already.
+                new_slot = find_key_slot(physical_device, new_key_file, context=context)
+                if new_slot is None:
+                    version, key_slots = parse_key_slots(context.capture('cryptsetup', 'luksDump', physical_device))
+                    free_slots = [n for n in range(8 if version == 1 else 32) if n not in key_slots and n != key_slot]
+                    if not free_slots:
+                        raise KeySlotError("No free key slot available on %s!" % physical_device)
+                    new_slot = free_slots[0]
+                    logger.verbose("Installing new key for %s in key slot %i ..", name, new_slot)
+                    with key_store.key_file(name) as key_file:
+                        add_key_file(physical_device, new_key_file, fast=fast,
+                                     existing_key_file=key_file, key_slot=new_slot, context=context)
+                entry = journal.update(name, step='added', new_slot=new_slot)
+            if entry['step'] == 'added':
+                unlocked_slot, _ = test_key_file(physical_device, new_key_file,
+                                                 key_slot=entry['new_slot'], context=context)
+                if unlocked_slot == entry['old_slot']:
+                    raise KeySlotError("New key for %s unlocks the old key slot %i!" % (name, unlocked_slot))
+                entry = journal.update(name, step='verified')
+    if entry['step'] == 'verified':
+        # Keep the old key until its key slot has been removed. When .old
+        # exists the swap started before, which means the key stored under
+        # `name' may already be the new key.
+        if not key_store.exists(old_name):
+            with key_store.read(name) as old_key:
+                key_store.write(old_name, old_key.data)
+        if key_store.exists(pending):
+            key_store.rename(pending, name)
+        entry = journal.update(name, step='swapped')
+    if entry['step'] == 'swapped':
+        version, key_slots = parse_key_slots(context.capture('cryptsetup', 'luksDump', physical_device))
+        if entry['old_slot'] in key_slots:
+            logger.verbose("Removing old key slot %i of %s ..", entry['old_slot'], name)
+            with key_store.key_file(name) as new_key_file:
+                context.execute('cryptsetup', 'luksKillSlot', '--key-file=%s' % new_key_file,
+                                physical_device, str(entry['old_slot']))
+        entry = journal.update(name, step='killed')
+    if entry['step'] == 'killed' and key_slot is not None and entry['new_slot'] != key_slot:
+        # Move the new key to the key slot that's pinned in /etc/crypttab
+        # (which was freed by removing the old key slot).
+        with key_store.key_file(name) as new_key_file:
+            if find_key_slot(physical_device, new_key_file, key_slot, context) is None:
+                logger.verbose("Moving new key for %s to pinned key slot %i ..", name, key_slot)
+                add_key_file(physical_device, new_key_file, fast=fast,
+                             existing_key_file=new_key_file, key_slot=key_slot, context=context)
+                test_key_file(physical_device, new_key_file, key_slot=key_slot, context=context)
+            version, key_slots = parse_key_slots(context.capture('cryptsetup', 'luksDump', physical_device))
+            if entry['new_slot'] in key_slots:
+                context.execute('cryptsetup', 'luksKillSlot', '--key-file=%s' % new_key_file,
+                                physical_device, str(entry['new_slot']))
+        entry = journal.update(name, new_slot=key_slot)
+    key_store.remove(old_name)
+    journal.discard(name)
+    return KeyRotation(entry['old_slot'], entry['new_slot'], timer.elapsed_time, resumed)
+
+
+def render_rotation_report(rotations):
+    """
+    Render a table with the results of :func:`rotate_key()`.
+
+    :param rotations: A dictionary with mapper names (strings) as keys and
+                      :class:`KeyRotation` objects as values.
+    :returns: The rendered report (a string).
+    """
+    rows = []
+    for mapper_name, r in sorted(rotations.items()):
+        rows.append([mapper_name, r.old_slot, r.new_slot, "yes" if r.resumed else "no", format_timespan(r.duration)])
+    lines = [format_pretty_table(rows, ["Drive", "Old slot", "New slot", "Resumed", "Duration"])]
+    if rotations:
+        total = sum(r.duration for r in rotations.values())
+        lines.append("Spent %s rotating keys (%s per drive on average)." % (
+            format_timespan(total), format_timespan(total / len(rotations)),
+        ))
+    return '\n'.join(lines)
+
+
+class RotationJournal(object):
+
+    """
+    Journal of key rotations in progress.
+
+    The journal is stored next to the keys (using the same key store) with
+    one small JSON document per drive whose name is the device mapper name
+    followed by :data:`JOURNAL_SUFFIX`. Because every drive has its own entry,
+    the worker threads of :func:`.rotate_keys()` never write the same entry.
+    Entries are removed when the rotation of a drive has finished.
+    """
+
+    def __init__(self, key_store):
+        """
+        Initialize a :class:`RotationJournal` object.
+
+        :param key_store: A :class:`.KeyDirectory` or :class:`.KeyStore` object.
+        """
+        self.key_store = key_store
+
+    def names(self):
+        """
+        Find the drives whose rotation was interrupted.
+
+        :returns: A sorted list of device mapper names (strings).
+        """
+        return sorted(n[:-len(JOURNAL_SUFFIX)] for n in self.key_store.names() if n.endswith(JOURNAL_SUFFIX))
+
+    def get(self, name):
+        """
+        Get the journal entry of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: A dictionary or :data:`None` (when no rotation is in progress).
+        """
+        if not self.key_store.exists(name + JOURNAL_SUFFIX):
+            return None
+        with self.key_store.read(name + JOURNAL_SUFFIX) as buffer:
+            return json.loads(bytes(buffer.data).decode('UTF-8'))
+
+    def update(self, name, **fields):
+        """
+        Update the journal entry of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        :param fields: The fields to update.
+        :returns: The updated entry (a dictionary).
+
+        The entry is flushed to disk before this method returns.
+        """
+        entry = self.get(name) or {}
+        entry.update(fields)
+        self.key_store.write(name + JOURNAL_SUFFIX, json.dumps(entry, sort_keys=True).encode('UTF-8'))
+        return entry
+
+    def discard(self, name):
+        """
+        Remove the journal entry of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        """
+        self.key_store.remove(name + JOURNAL_SUFFIX)
+
+
+class KeyRotation(collections.namedtuple('KeyRotation', 'old_slot, new_slot, duration, resumed')):
+
+    """
+    The result of :func:`rotate_key()`.
+
+    The fields of the named tuple are the numbers of the old and new key slots
+    (integers), the time it took to rotate the key (a float, in seconds) and
+    whether an interrupted rotation was resumed (a boolean).
+    """
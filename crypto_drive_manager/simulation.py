@@ -0,0 +1,755 @@
+# Simulated backend for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Simulated system for testing and benchmarking `crypto-drive-manager`.
+
+All external commands run by `crypto-drive-manager` go through an execution
+context (see :mod:`executor.contexts`). This module provides an execution
+context that doesn't run any external commands but emulates the commands
+used by `crypto-drive-manager` (``cryptsetup``, ``cryptdisks_start``,
+``mount``, ``umount``, ``blkid``, ``systemctl``, ``dd`` and friends) on top
+of a fake ``/etc/crypttab``, ``/etc/fstab`` and ``/proc/mounts``. Each
+emulated program can be given a latency and a failure rate.
+
+This makes it possible to measure how an unlock run scales with the number
+of managed drives without having any LUKS hardware available, see
+:func:`run_simulation()` and ``scripts/benchmark.py``.
+"""
+
+# Standard library modules.
+import collections
+import hashlib
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    # Python 3.
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+# External dependencies.
+from executor import ExternalCommandFailed
+from executor.contexts import AbstractContext
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.keyring import DEFAULT_KEY_TIMEOUT, KeyCache
+from crypto_drive_manager.keys import KeyBuffer
+from crypto_drive_manager.state import SystemState
+
+SIMULATED_PROGRAMS = (
+    'blkid', 'cat', 'cryptdisks_start', 'cryptdisks_stop', 'cryptsetup', 'dd',
+    'find', 'lvs', 'mkfs.ext4', 'mount', 'pvs', 'pvscan', 'systemctl', 'test', 'timeout',
+    'umount', 'vgchange', 'which',
+)
+"""The names of the programs that are emulated by :class:`SimulatedSystem` (a tuple of strings)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class SimulatedSystem(object):
+
+    """
+    In-memory model of a system with encrypted drives.
+
+    The system consists of a number of managed drives whose key files are
+    located in :attr:`keys_directory`, the device mapper targets that exist
+    and the filesystems that are mounted. :func:`run()` emulates external
+    commands by inspecting and updating this model.
+    """
+
+    def __init__(self, num_drives, keys_directory, latencies=None, failure_rates=None,
+                 lvm_ratio=0.0, available_ratio=1.0, seed=None):
+        """
+        Initialize a :class:`SimulatedSystem` object.
+
+        :param num_drives: The number of managed drives (an integer).
+        :param keys_directory: The mount point of the virtual keys device (a string).
+        :param latencies: A dictionary with program names (strings) as keys
+                          and latencies (numbers of seconds) as values.
+        :param failure_rates: A dictionary with program names (strings) as
+                              keys and failure probabilities (floats between
+                              0 and 1) as values.
+        :param lvm_ratio: The fraction of drives that contain an LVM physical
+                          volume instead of a filesystem (a float).
+        :param available_ratio: The fraction of drives that are physically
+                                present (a float).
+        :param seed: The seed for the random number generator (any hashable
+                     value or :data:`None`).
+        """
+        self.random = random.Random(seed)
+        self.keys_directory = keys_directory
+        self.latencies = latencies or {}
+        self.failure_rates = failure_rates or {}
+        self.lock = threading.RLock()
+        self.counters = collections.Counter()
+        self.drives = collections.OrderedDict()
+        self.mappers = set()
+        self.mounts = collections.OrderedDict()
+        self.active_volume_groups = set()
+        self.busy = set()
+        for i in range(1, num_drives + 1):
+            name = 'drive%i' % i
+            self.drives[name] = SimulatedDrive(
+                name=name,
+                uuid=str(uuid.UUID(int=self.random.getrandbits(128))),
+                key_file=os.path.join(keys_directory, '%s.key' % name),
+                mount_point='/srv/%s' % name,
+                filesystem=('LVM2_member' if self.random.random() < lvm_ratio else 'ext4'),
+                available=(self.random.random() < available_ratio),
+            )
+
+    @property
+    def num_commands(self):
+        """The total number of (emulated) external commands that were run (an integer)."""
+        return sum(self.counters.values())
+
+    @property
+    def source_devices(self):
+        """A dictionary with source devices (strings) as keys and :class:`SimulatedDrive` objects as values."""
+        return dict((d.source_device, d) for d in self.drives.values() if d.available)
+
+    def render_crypttab(self):
+        """Generate the contents of ``/etc/crypttab`` (a string)."""
+        return ''.join('%s UUID=%s %s luks,noauto\n' % (d.name, d.uuid, d.key_file) for d in self.drives.values())
+
+    def render_fstab(self):
+        """
+        Generate the contents of ``/etc/fstab`` (a string).
+
+        Drives that contain an LVM physical volume aren't mounted directly,
+        instead the logical volume on the drive is mounted.
+        """
+        return ''.join(
+            '%s %s ext4 defaults,noauto 0 2\n' % (d.logical_volume_path or '/dev/mapper/%s' % d.name, d.mount_point)
+            for d in self.drives.values()
+        )
+
+    def render_mounts(self):
+        """Generate the contents of ``/proc/mounts`` (a string)."""
+        with self.lock:
+            return ''.join('%s %s ext4 rw,relatime 0 0\n' % (d, m) for d, m in self.mounts.items())
+
+    def exists(self, pathname):
+        """Check whether a pathname exists on the simulated system."""
+        with self.lock:
+            if pathname.startswith('/dev/mapper/'):
+                return os.path.basename(pathname) in self.mappers
+            return pathname in self.source_devices or pathname in ('/etc/crypttab', '/etc/fstab', '/proc/mounts')
+
+    def latency(self, command):
+        """
+        Get the latency of an external command.
+
+        :param command: A tuple with the program name and its arguments.
+        :returns: The latency in seconds (a number).
+        """
+        return self.latencies.get(os.path.basename(unwrap_timeout(command)[0]), 0)
+
+    def run(self, command, input=None, delay=True):
+        """
+        Emulate an external command.
+
+        :param command: A tuple with the program name and its arguments.
+        :param input: The data that would be fed to the command's standard
+                      input stream (ignored).
+        :param delay: :data:`True` to sleep for the :func:`latency()` of the
+                      command (the default), :data:`False` when the caller
+                      takes care of this (see :mod:`crypto_drive_manager.aio`).
+        :returns: A :class:`SimulatedCommand` object.
+        """
+        timeout = find_timeout(command)
+        command = unwrap_timeout(command)
+        program, arguments = os.path.basename(command[0]), list(command[1:])
+        with self.lock:
+            self.counters[program] += 1
+            fails = self.random.random() < self.failure_rates.get(program, 0)
+        latency = self.latency(command) if delay else 0
+        if timeout is not None and latency > timeout:
+            # Emulate the exit status of ``timeout`` when the command is terminated.
+            time.sleep(timeout)
+            return SimulatedCommand(command, 124, error="Simulated timeout of %s!" % program)
+        if latency:
+            time.sleep(latency)
+        if fails:
+            return SimulatedCommand(command, 1, error="Simulated failure of %s!" % program)
+        handler = getattr(self, 'emulate_%s' % program.replace('.', '_'), None)
+        if handler is None:
+            return SimulatedCommand(command, 127, error="Program not found: %s" % program)
+        with self.lock:
+            result = handler(*arguments)
+        error = None
+        if isinstance(result, tuple) and len(result) == 3:
+            returncode, stdout, error = result
+        elif isinstance(result, tuple):
+            returncode, stdout = result
+        elif isinstance(result, bool):
+            returncode, stdout = (0 if result else 1), ''
+        else:
+            returncode, stdout = 0, result or ''
+        return SimulatedCommand(command, returncode, stdout=stdout, error=error)
+
+    def emulate_blkid(self, *arguments):
+        """Emulate ``blkid -o export DEVICE..``."""
+        blocks = []
+        for device_file in arguments[2:]:
+            drive = self.drives.get(os.path.basename(device_file))
+            if drive and drive.name in self.mappers:
+                blocks.append('DEVNAME=%s\nTYPE=%s\n' % (device_file, drive.filesystem))
+        return (0 if blocks else 2), '\n'.join(blocks)
+
+    def emulate_cat(self, filename):
+        """Emulate ``cat`` for the simulated configuration files."""
+        renderers = {
+            '/etc/crypttab': self.render_crypttab,
+            '/etc/fstab': self.render_fstab,
+            '/proc/mounts': self.render_mounts,
+        }
+        return (0, renderers[filename]()) if filename in renderers else (1, '')
+
+    def emulate_cryptdisks_start(self, name):
+        """Emulate ``cryptdisks_start NAME``."""
+        drive = self.drives.get(name)
+        if not (drive and drive.available):
+            return False
+        self.mappers.add(name)
+        return True
+
+    def emulate_cryptdisks_stop(self, name):
+        """Emulate ``cryptdisks_stop NAME``."""
+        self.mappers.discard(name)
+        return True
+
+    def emulate_cryptsetup(self, action, *arguments):
+        """Emulate the ``cryptsetup`` actions used by `crypto-drive-manager`."""
+        options = dict(a.partition('=')[::2] for a in arguments if a.startswith('-'))
+        arguments = [a for a in arguments if not a.startswith('-')]
+        if action in ('luksOpen', 'open') and '--test-passphrase' in options:
+            drive = self.source_devices.get(arguments[0])
+            slot = drive and drive.find_key_slot(options.get('--key-file'), options.get('--key-slot'))
+            if slot is None:
+                return False
+            return 'Key slot %i unlocked.\nCommand successful.\n' % slot
+        elif action in ('luksOpen', 'open'):
+            source, target = arguments[:2]
+            drive = self.source_devices.get(source)
+            if target in self.mappers or (drive is None and target in self.drives):
+                return False
+            self.mappers.add(target)
+        elif action in ('luksClose', 'close'):
+            if arguments[0] not in self.mappers:
+                return False
+            drive = self.drives.get(arguments[0])
+            in_use = ('/dev/mapper/%s' % arguments[0] in self.mounts or
+                      (drive and drive.volume_group in self.active_volume_groups))
+            if in_use:
+                return 5, '', "Device %s is still in use." % arguments[0]
+            self.mappers.discard(arguments[0])
+        elif action == 'luksAddKey':
+            drive = self.source_devices.get(arguments[0])
+            if drive is None:
+                return False
+            slot = int(options.get('--key-slot', min(set(range(32)) - set(drive.key_slots))))
+            if slot in drive.key_slots:
+                return False
+            iterations = int(options.get('--pbkdf-force-iterations', 1000000))
+            drive.key_slots[slot] = (identify_key(arguments[1]), iterations)
+        elif action == 'luksDump':
+            drive = self.source_devices.get(arguments[0])
+            if drive is None:
+                return False
+            return drive.render_header()
+        elif action == 'luksKillSlot':
+            drive = self.source_devices.get(arguments[0])
+            slot = int(arguments[1])
+            if drive is None or slot not in drive.key_slots:
+                return False
+            del drive.key_slots[slot]
+        return True
+
+    def emulate_dd(self, *arguments):
+        """Emulate ``dd`` (only reading LUKS headers produces output)."""
+        options = dict(a.partition('=')[::2] for a in arguments)
+        drive = self.source_devices.get(options.get('if'))
+        return drive.render_raw_header() if drive else True
+
+    def emulate_find(self, directory, *arguments):
+        """Emulate ``find`` for listing ``/dev/mapper``."""
+        if directory == '/dev/mapper':
+            return '\0'.join(os.path.join(directory, name) for name in sorted(self.mappers))
+        return False
+
+    def emulate_lvs(self, *arguments):
+        """Emulate ``lvs --noheadings --separator=: --options=FIELD,.. VG..``."""
+        options = dict(a.partition('=')[::2] for a in arguments if a.startswith('-'))
+        names = [a for a in arguments if not a.startswith('-')]
+        lines = []
+        for drive in self.drives.values():
+            if drive.volume_group in names and drive.name in self.mappers:
+                fields = dict(
+                    vg_name=drive.volume_group,
+                    lv_path=drive.logical_volume_path,
+                    lv_dm_path=drive.logical_volume,
+                    lv_active='active' if drive.volume_group in self.active_volume_groups else '',
+                )
+                lines.append('  %s\n' % ':'.join(fields[f] for f in options['--options'].split(',')))
+        return ''.join(lines)
+
+    def emulate_mkfs_ext4(self, device_file):
+        """Emulate ``mkfs.ext4``."""
+        return True
+
+    def emulate_mount(self, device_file, mount_point=None):
+        """Emulate ``mount DEVICE [MOUNT_POINT]`` and ``mount MOUNT_POINT``."""
+        if mount_point is None and not device_file.startswith('/dev/'):
+            # Mount a logical volume by its mount point.
+            drive = next((d for d in self.drives.values() if d.mount_point == device_file), None)
+            if not (drive and drive.volume_group in self.active_volume_groups):
+                return 32, '', "mount: %s: can't find in /etc/fstab." % device_file
+            device_file, mount_point = drive.logical_volume, drive.mount_point
+        elif os.path.basename(device_file) not in self.mappers:
+            return False
+        if device_file in self.mounts:
+            return False
+        if mount_point is None:
+            drive = self.drives.get(os.path.basename(device_file))
+            if not drive or drive.filesystem == 'LVM2_member':
+                return False
+            mount_point = drive.mount_point
+        self.mounts[device_file] = mount_point
+        return True
+
+    def emulate_pvs(self, *arguments):
+        """Emulate ``pvs --noheadings --separator=: --options=pv_name,vg_name DEVICE..``."""
+        lines = []
+        for device_file in arguments:
+            drive = self.drives.get(os.path.basename(device_file))
+            if drive and drive.volume_group and drive.name in self.mappers:
+                lines.append('  %s:%s\n' % (device_file, drive.volume_group))
+        return ''.join(lines)
+
+    def emulate_pvscan(self, *arguments):
+        """Emulate ``pvscan --cache DEVICE..``."""
+        return True
+
+    def emulate_systemctl(self, action, *arguments):
+        """Emulate ``systemctl show --property=.. UNIT..``."""
+        units = [a for a in arguments if not a.startswith('-')]
+        return '\n'.join('Id=%s\nRequiresMountsFor=\n' % unit for unit in units)
+
+    def emulate_test(self, operator, pathname):
+        """Emulate ``test -e PATHNAME`` and friends."""
+        return self.exists(pathname)
+
+    def emulate_umount(self, target):
+        """Emulate ``umount MOUNT_POINT``."""
+        for device_file, mount_point in list(self.mounts.items()):
+            if target in (device_file, mount_point):
+                if target in self.busy:
+                    return 32, '', "umount: %s: target is busy." % target
+                del self.mounts[device_file]
+                return True
+        return False
+
+    def emulate_vgchange(self, *arguments):
+        """Emulate ``vgchange --activate y|n VG..``."""
+        names = [a for a in arguments if not a.startswith('-') and a not in ('y', 'n')]
+        activate = 'y' in arguments
+        for name in names:
+            if activate and not any(d.volume_group == name and d.name in self.mappers for d in self.drives.values()):
+                return 5, '', "Volume group \"%s\" not found" % name
+            if not activate and any(m.startswith('/dev/mapper/%s-' % name) for m in self.mounts):
+                return 5, '', "Logical volume %s contains a filesystem in use." % name
+            if activate:
+                self.active_volume_groups.add(name)
+            else:
+                self.active_volume_groups.discard(name)
+        return True
+
+    def emulate_which(self, *programs):
+        """Emulate ``which PROGRAM..``."""
+        found = ['/usr/sbin/%s' % p for p in programs if p in SIMULATED_PROGRAMS]
+        return (0 if found else 1), '\n'.join(found)
+
+
+class SimulatedDrive(object):
+
+    """A managed drive in a :class:`SimulatedSystem`."""
+
+    def __init__(self, name, uuid, key_file, mount_point, filesystem, available):
+        """Initialize a :class:`SimulatedDrive` object."""
+        self.name = name
+        self.uuid = uuid
+        self.key_file = key_file
+        self.mount_point = mount_point
+        self.filesystem = filesystem
+        self.available = available
+        # Key slot 0 contains the passphrase used to create the volume.
+        self.key_slots = {0: (None, 1000000)}
+
+    @property
+    def source_device(self):
+        """The pathname of the physical device (a string)."""
+        return '/dev/disk/by-uuid/%s' % self.uuid
+
+    @property
+    def volume_group(self):
+        """The name of the LVM volume group on the drive (a string or :data:`None`)."""
+        return 'vg_%s' % self.name if self.filesystem == 'LVM2_member' else None
+
+    @property
+    def logical_volume(self):
+        """The device mapper pathname of the logical volume in :attr:`volume_group` (a string or :data:`None`)."""
+        return '/dev/mapper/%s-data' % self.volume_group if self.volume_group else None
+
+    @property
+    def logical_volume_path(self):
+        """The pathname of the logical volume in :attr:`volume_group` (a string or :data:`None`)."""
+        return '/dev/%s/data' % self.volume_group if self.volume_group else None
+
+    def find_key_slot(self, key_file, key_slot=None):
+        """Find the key slot that is unlocked by a key file (an integer or :data:`None`)."""
+        key = identify_key(key_file)
+        for slot, (slot_key, iterations) in sorted(self.key_slots.items()):
+            if key is not None and slot_key == key and (key_slot is None or int(key_slot) == slot):
+                return slot
+
+    def render_header(self):
+        """Generate the output of ``cryptsetup luksDump`` (a string)."""
+        lines = [
+            'LUKS header information', 'Version:       \t2', '',
+            'Metadata area: \t16384 [bytes]', 'Keyslots area: \t16744448 [bytes]', '', 'Keyslots:',
+        ]
+        for slot, (key, iterations) in sorted(self.key_slots.items()):
+            lines.append('  %i: luks2' % slot)
+            lines.append('\tPBKDF:      pbkdf2')
+            lines.append('\tIterations: %i' % iterations)
+        lines.append('Tokens:')
+        return '\n'.join(lines) + '\n'
+
+    def render_raw_header(self):
+        """Generate a stand-in for the raw LUKS header (a string that changes when the key material changes)."""
+        return ''.join('%i:%s:%i\n' % (
+            slot, hashlib.sha256(repr(key).encode('UTF-8')).hexdigest(), iterations,
+        ) for slot, (key, iterations) in sorted(self.key_slots.items()))
+
+
+class SimulatedCommand(object):
+
+    """The result of an external command emulated by :class:`SimulatedSystem`."""
+
+    def __init__(self, command, returncode, stdout='', error=None):
+        """Initialize a :class:`SimulatedCommand` object."""
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout.encode('UTF-8')
+        self.error_message = error or "Simulated command failed with exit code %i! (%s)" % (
+            returncode, ' '.join(command),
+        )
+
+    @property
+    def output(self):
+        """The standard output of the command (a stripped string)."""
+        return self.stdout.decode('UTF-8').strip()
+
+    @property
+    def succeeded(self):
+        """:data:`True` if the command succeeded, :data:`False` otherwise."""
+        return self.returncode == 0
+
+    @property
+    def failed(self):
+        """:data:`True` if the command failed, :data:`False` otherwise."""
+        return not self.succeeded
+
+
+class SimulatedContext(AbstractContext):
+
+    """Execution context that emulates external commands using a :class:`SimulatedSystem`."""
+
+    def __init__(self, system, **options):
+        """
+        Initialize a :class:`SimulatedContext` object.
+
+        :param system: A :class:`SimulatedSystem` object.
+        :param options: Any keyword arguments are passed on to the
+                        :class:`~executor.contexts.AbstractContext` initializer.
+        """
+        super(SimulatedContext, self).__init__(**options)
+        self.system = system
+
+    @property
+    def command_type(self):
+        """The type of command objects created by this context (:class:`SimulatedCommand`)."""
+        return SimulatedCommand
+
+    @property
+    def cpu_count(self):
+        """The number of CPUs in the system (an integer)."""
+        return multiprocessing.cpu_count()
+
+    def capture(self, *command, **options):
+        """Emulate an external command and return its output."""
+        return self.execute(*command, **options).output
+
+    def execute(self, *command, **options):
+        """
+        Emulate an external command.
+
+        :param command: The program name and its arguments (strings).
+        :param options: The keyword arguments ``check`` and ``input`` are
+                        respected, other keyword arguments are ignored.
+        :returns: A :class:`SimulatedCommand` object.
+        :raises: :exc:`~executor.ExternalCommandFailed` when the emulated
+                 command fails and ``check`` is :data:`True` (the default).
+        """
+        result = self.system.run(command, input=options.get('input'))
+        if result.failed and options.get('check', True):
+            raise ExternalCommandFailed(result, error_message=result.error_message)
+        return result
+
+    def find_program(self, program_name, *args):
+        """Find the emulated programs with the given names."""
+        return self.capture('which', program_name, *args, check=False).splitlines()
+
+    def read_file(self, filename, **options):
+        """Read a simulated configuration file."""
+        return self.execute('cat', filename, **options).stdout
+
+    def test(self, *command, **options):
+        """Emulate an external command and get its status."""
+        options.update(check=False)
+        return self.execute(*command, **options).succeeded
+
+    def __str__(self):
+        """Render a human friendly string representation of the context."""
+        return "simulated system (%i drives)" % len(self.system.drives)
+
+
+class SimulatedEventSource(object):
+
+    """
+    Event source for :class:`.HotplugDaemon` that plugs in simulated drives on request.
+
+    Call :func:`plug()` to make a drive available (and generate the
+    corresponding event) and :func:`close()` to stop the daemon.
+    """
+
+    def __init__(self, system):
+        """
+        Initialize a :class:`SimulatedEventSource` object.
+
+        :param system: A :class:`SimulatedSystem` object.
+        """
+        self.system = system
+        self.queue = queue.Queue()
+
+    def plug(self, name):
+        """
+        Make a simulated drive available and generate an event for it.
+
+        :param name: The name of the drive (a string like ``drive1``).
+        """
+        drive = self.system.drives[name]
+        with self.system.lock:
+            drive.available = True
+        self.queue.put(drive.source_device)
+
+    def wait(self, timeout=None):
+        """
+        Wait for simulated events.
+
+        :param timeout: The number of seconds to wait (a number or
+                        :data:`None` to wait indefinitely).
+        :returns: A list of pathnames (empty when the timeout expired) or
+                  :data:`None` when the event source was closed.
+        """
+        try:
+            pathnames = [self.queue.get(timeout=timeout)]
+            while not self.queue.empty():
+                pathnames.append(self.queue.get_nowait())
+        except queue.Empty:
+            return []
+        if None in pathnames:
+            return None
+        return pathnames
+
+    def close(self):
+        """Make :func:`wait()` report that the event source was closed."""
+        self.queue.put(None)
+
+
+class SimulatedKeyring(KeyCache):
+
+    """
+    In-memory implementation of :class:`.KeyCache` (a fake kernel keyring).
+
+    Keys expire after :attr:`~.KeyCache.timeout` seconds just like keys in
+    the kernel keyring. The attribute :attr:`counters` records how often each
+    operation was performed (so tests can check for cache hits and misses).
+    """
+
+    def __init__(self, timeout=DEFAULT_KEY_TIMEOUT):
+        """
+        Initialize a :class:`SimulatedKeyring` object.
+
+        :param timeout: See :class:`.KeyCache`.
+        """
+        super(SimulatedKeyring, self).__init__(timeout)
+        self.keys = {}
+        self.counters = collections.Counter()
+
+    def find_key(self, description):
+        """Find a key that hasn't expired yet."""
+        self.counters['find'] += 1
+        value = self.keys.get(description)
+        if value and (value[1] is None or value[1] > time.time()):
+            return description
+        self.keys.pop(description, None)
+        return None
+
+    def read_key(self, handle):
+        """Copy a key into a new :class:`.KeyBuffer`."""
+        self.counters['read'] += 1
+        if handle not in self.keys:
+            return None
+        data = self.keys[handle][0]
+        key = KeyBuffer(len(data))
+        key.data[:] = data
+        return key
+
+    def add_key(self, description, key):
+        """Store a copy of a key."""
+        self.counters['add'] += 1
+        expires = time.time() + self.timeout if self.timeout else None
+        self.keys[description] = (bytes(key.data), expires)
+
+    def remove_key(self, handle):
+        """Remove a key."""
+        self.counters['remove'] += 1
+        self.keys.pop(handle, None)
+
+    def list_keys(self):
+        """List the descriptions of the keys."""
+        return list(self.keys)
+
+    def __str__(self):
+        """Render a human friendly string representation of the keyring."""
+        return "simulated keyring"
+
+
+def unwrap_timeout(command):
+    """
+    Strip ``timeout [OPTION..] DURATION`` from a command (see :func:`find_timeout()`).
+
+    :param command: A tuple with the program name and its arguments.
+    :returns: The command that is run by ``timeout`` (a tuple) or
+              `command` itself when it doesn't use ``timeout``.
+    """
+    while os.path.basename(command[0]) == 'timeout':
+        arguments = list(command[1:])
+        while arguments[0].startswith('-'):
+            arguments.pop(0)
+        command = tuple(arguments[1:])
+    return tuple(command)
+
+
+def find_timeout(command):
+    """
+    Find the duration given to ``timeout [OPTION..] DURATION COMMAND..``.
+
+    :param command: A tuple with the program name and its arguments.
+    :returns: The number of seconds (a number) or :data:`None` when
+              `command` doesn't use ``timeout``.
+    """
+    if os.path.basename(command[0]) == 'timeout':
+        arguments = [a for a in command[1:] if not a.startswith('-')]
+        return float(arguments[0].rstrip('s'))
+    return None
+
+
+def identify_key(key_file):
+    """
+    Identify the key in a key file (like ``cryptsetup`` does).
+
+    :param key_file: The pathname of a key file (a string or :data:`None`).
+    :returns: The contents of the key file (a byte string) when it can be
+              read, otherwise the pathname (so that key files that only exist
+              in the simulation are identified by name).
+    """
+    try:
+        with open(key_file, 'rb') as handle:
+            return handle.read()
+    except (IOError, OSError, TypeError):
+        return key_file
+
+
+def run_simulation(num_drives, concurrency=1, pipeline=False, **options):
+    """
+    Run :func:`.initialize_keys_device()` against a :class:`SimulatedSystem`.
+
+    :param num_drives: The number of managed drives (an integer).
+    :param concurrency: See :func:`.initialize_keys_device()`.
+    :param pipeline: See :func:`.initialize_keys_device()`.
+    :param options: Any keyword arguments are passed on to the
+                    :class:`SimulatedSystem` initializer.
+    :returns: A dictionary with the keys ``drives``, ``wall_time``
+              (a float), ``num_commands`` (an integer), ``commands``
+              (a dictionary with the number of commands per program),
+              ``failures`` (the number of drives that failed) and ``error``
+              (a string when the run was aborted, :data:`None` otherwise).
+
+    The virtual keys device and the key files are created in a temporary
+    directory which is removed afterwards. The first run is simulated, which
+    means a key file is generated and installed for every drive.
+
+    Simulated failures can also abort the run as a whole (for example when
+    creating the virtual keys device fails). In that case all drives are
+    counted as failed and the error is reported instead of being raised.
+    """
+    from crypto_drive_manager import ActivationFailed, initialize_keys_device
+    directory = tempfile.mkdtemp()
+    try:
+        mount_point = os.path.join(directory, 'keys')
+        system = SimulatedSystem(num_drives, mount_point, **options)
+        context = SimulatedContext(system)
+        timer = Timer()
+        try:
+            initialize_keys_device(
+                image_file=os.path.join(directory, 'keys.img'),
+                mapper_name='encryption-keys',
+                mount_point=mount_point,
+                concurrency=concurrency,
+                pipeline=pipeline,
+                state=SystemState(context=context),
+            )
+            failures, error = 0, None
+        except ActivationFailed as e:
+            failures, error = len(e.failures), None
+        except Exception as e:
+            logger.warning("Simulated run aborted! (%s)", e)
+            failures, error = num_drives, "%s: %s" % (type(e).__name__, e)
+        return dict(
+            drives=num_drives,
+            wall_time=timer.elapsed_time,
+            num_commands=system.num_commands,
+            commands=dict(system.counters),
+            failures=failures,
+            error=error,
+        )
+    finally:
+        shutil.rmtree(directory)
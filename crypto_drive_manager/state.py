@@ -0,0 +1,195 @@
+# Snapshot of the relevant system state.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Snapshot of the system state that `crypto-drive-manager` cares about.
+
+During a single run `crypto-drive-manager` needs to know (for every managed
+drive) whether the device mapper target exists and whether the drive is
+mounted. Parsing ``/proc/mounts`` and checking ``/dev/mapper`` for every drive
+scales badly when there are a lot of drives and/or mounted filesystems, so
+instead :class:`SystemState` takes a snapshot once and is kept up to date as
+`crypto-drive-manager` makes changes to the system.
+"""
+
+# Standard library modules.
+import os
+import threading
+
+# External dependencies.
+from executor.contexts import LocalContext
+from linux_utils import coerce_context
+from linux_utils.fstab import find_mounted_filesystems, parse_fstab
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.crypttab import load_crypttab
+from crypto_drive_manager.timings import InstrumentedContext, NullPhase
+
+DEVICE_MAPPER_DIRECTORY = '/dev/mapper'
+"""The directory that contains the device mapper devices (a string)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class SystemState(object):
+
+    """
+    Snapshot of crypttab entries, device mapper targets and mounted filesystems.
+
+    The snapshot is taken when the object is created (see :func:`refresh()`)
+    and afterwards it's updated in place using :func:`add_mapper()` and
+    :func:`add_mount()`. All methods are thread safe so that a single
+    snapshot can be shared between the worker threads that are used by
+    :class:`.PlanExecutor`.
+
+    The entries in ``/etc/crypttab`` are available as a (cached)
+    :class:`.CrypttabIndex` object in :attr:`crypttab`. The entries in
+    ``/etc/fstab`` are parsed on first use (see :attr:`fstab`).
+
+    The :attr:`cache` dictionary can be used to remember (expensive to
+    compute) information that is derived from the system state for the
+    duration of a run, it's cleared by :func:`refresh()`.
+    """
+
+    def __init__(self, crypttab='/etc/crypttab', mounts='/proc/mounts', fstab='/etc/fstab', context=None, timings=None):
+        """
+        Initialize a :class:`SystemState` object.
+
+        :param crypttab: The pathname of the crypttab file (a string,
+                         defaults to ``/etc/crypttab``).
+        :param mounts: The pathname of the file with mounted filesystems (a
+                       string, defaults to ``/proc/mounts``).
+        :param fstab: The pathname of the fstab file (a string, defaults to
+                      ``/etc/fstab``).
+        :param context: The execution context used to inspect the system
+                        and to run external commands during the run. See
+                        :func:`~linux_utils.coerce_context()` for details.
+        :param timings: A :class:`.Timings` object to record the durations
+                        of external commands and the phases of the run (or
+                        :data:`None` to disable timing).
+        """
+        self.timings = timings
+        self.context = coerce_context(context)
+        if timings is not None:
+            self.context = InstrumentedContext(self.context, timings)
+        self.crypttab_file = crypttab
+        self.mounts_file = mounts
+        self.fstab_file = fstab
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        """Take a new snapshot of the system state (discarding any previous snapshot)."""
+        with self.lock, self.phase('snapshot'):
+            logger.debug("Taking snapshot of system state ..")
+            self.cache = {}
+            self.crypttab = load_crypttab(filename=self.crypttab_file, context=self.context)
+            self.crypttab_entries = self.crypttab.entries
+            self.crypttab_by_target = self.crypttab.by_target
+            self.mounted_filesystems = {}
+            for entry in find_mounted_filesystems(filename=self.mounts_file, context=self.context):
+                self.mounted_filesystems.setdefault(entry.device_file, []).append(entry.mount_point)
+            try:
+                if is_local_context(self.context):
+                    self.mapper_names = set(os.listdir(DEVICE_MAPPER_DIRECTORY))
+                else:
+                    self.mapper_names = set(self.context.list_entries(DEVICE_MAPPER_DIRECTORY))
+            except Exception:
+                self.mapper_names = set()
+
+    @property
+    def fstab(self):
+        """The entries in ``/etc/fstab`` (a list of :class:`~linux_utils.fstab.FileSystemEntry` objects)."""
+        with self.lock:
+            if 'fstab' not in self.cache:
+                self.cache['fstab'] = list(parse_fstab(filename=self.fstab_file, context=self.context))
+            return self.cache['fstab']
+
+    def add_mapper(self, mapper_name):
+        """
+        Record that a device mapper target was created.
+
+        :param mapper_name: The device mapper name (a string).
+        """
+        with self.lock:
+            self.mapper_names.add(mapper_name)
+
+    def add_mount(self, device_file, mount_point=None):
+        """
+        Record that a filesystem was mounted.
+
+        :param device_file: The pathname of the mounted device (a string).
+        :param mount_point: The pathname of the mount point (a string or
+                            :data:`None` when the mount point is unknown).
+        """
+        with self.lock:
+            self.mounted_filesystems.setdefault(device_file, []).append(mount_point)
+
+    def phase(self, name, drive=None):
+        """
+        Time a phase of the run (if timings are being recorded).
+
+        :param name: The name of the phase (a string).
+        :param drive: The mapper name of a drive (a string or :data:`None`).
+        :returns: A context manager (see :func:`.Timings.phase()`).
+        """
+        return self.timings.phase(name, drive) if self.timings is not None else NullPhase()
+
+    def remove_mapper(self, mapper_name):
+        """
+        Record that a device mapper target was removed.
+
+        :param mapper_name: The device mapper name (a string).
+        """
+        with self.lock:
+            self.mapper_names.discard(mapper_name)
+
+    def remove_mount(self, device_file):
+        """
+        Record that a filesystem was unmounted.
+
+        :param device_file: The pathname of the unmounted device (a string).
+        """
+        with self.lock:
+            self.mounted_filesystems.pop(device_file, None)
+
+    def is_mapped(self, mapper_name):
+        """
+        Check if a device mapper target exists.
+
+        :param mapper_name: The device mapper name (a string).
+        :returns: :data:`True` if the target exists, :data:`False` otherwise.
+        """
+        with self.lock:
+            return mapper_name in self.mapper_names
+
+    def is_mounted(self, device_file):
+        """
+        Check if a device is mounted.
+
+        :param device_file: The pathname of a device file (a string).
+        :returns: :data:`True` if the device is mounted, :data:`False` otherwise.
+        """
+        with self.lock:
+            return device_file in self.mounted_filesystems
+
+
+def is_local_context(context):
+    """
+    Check if system state can be inspected without using the execution context.
+
+    :param context: An execution context created by :mod:`executor.contexts`.
+    :returns: :data:`True` if `context` is a :class:`~executor.contexts.LocalContext`
+              that doesn't change privileges, :data:`False` otherwise.
+
+    For local contexts `crypto-drive-manager` prefers to use in-process
+    alternatives for external commands like ``find`` and ``blkid``.
+    """
+    while isinstance(context, InstrumentedContext):
+        context = context.context
+    return type(context) is LocalContext and not any(map(context.options.get, ('sudo', 'uid', 'user')))
@@ -1,23 +1,29 @@
 # Workaround for systemd incompatibility.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: February 12, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-crypto-drive-manager
 
 """
 Workarounds for `systemd issue #3816`_.
 
+Because :func:`update_systemd_services()` runs as a systemd generator during
+early boot this module only depends on the standard library and
+:mod:`verboselogs` at import time, other dependencies are imported by the
+functions that need them.
+
 .. _systemd issue #3816: https://github.com/systemd/systemd/issues/3816
 """
 
 # Standard library modules.
 import glob
+import logging
 import os
+import stat
+import subprocess
 import sys
 
 # External dependencies.
-import coloredlogs
-from executor import execute, which
 from verboselogs import VerboseLogger
 
 CRYPTSETUP_GENERATOR = '/lib/systemd/system-generators/systemd-cryptsetup-generator'
@@ -33,18 +39,29 @@ string). This is the location where crypto-drive-manager moves the original
 program when installing the workaround.
 """
 
-CRYPTSETUP_SERVICES = '/var/run/systemd/generator/systemd-cryptsetup@*.service'
+GENERATOR_DIRECTORY = '/var/run/systemd/generator'
+"""The directory where systemd generators write their unit files (a string)."""
+
+CRYPTSETUP_SERVICES = os.path.join(GENERATOR_DIRECTORY, 'systemd-cryptsetup@*.service')
 """A glob pattern that matches the generated ``*.service`` files (a string)."""
 
+DEFAULT_CONCURRENCY = 8
+"""The number of unit files that :func:`rewrite_service_files()` processes at the same time (an integer)."""
+
+PARALLEL_THRESHOLD = 256
+"""The number of unit files at which :func:`rewrite_service_files()` starts processing files concurrently."""
+
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
 
-def have_systemd_dependencies(mount_point):
+def have_systemd_dependencies(mount_point, state=None):
     """
     Determine if any of the managed drives are affected by `systemd issue #3816`_.
 
     :param mount_point: The mount point for the virtual keys device (a string).
+    :param state: A :class:`.SystemState` object (optional, its execution
+                  context is used to run ``systemctl``).
     :returns: :data:`True` if any of the encrypted drives managed by
               `crypto-drive-manager` are affected by `systemd issue #3816`_,
               :data:`False` if none of the managed drives are affected.
@@ -64,20 +81,86 @@ def have_systemd_dependencies(mount_point):
     to do because I don't know of a better workaround :-(.
     """
     from crypto_drive_manager import find_managed_drives, match_prefix
+    if state is not None and mount_point in state.cache.setdefault('systemd_dependencies', {}):
+        return state.cache['systemd_dependencies'][mount_point]
     logger.verbose("Checking if we're affected by systemd issue #3816 ..")
-    if execute('which', 'systemctl', check=False, silent=True):
-        for device in find_managed_drives(mount_point):
-            output = execute(
-                'systemctl', 'show',
-                'systemd-cryptsetup@%s.service' % device.target,
-                capture=True, check=False, silent=True,
+    units = ['systemd-cryptsetup@%s.service' % d.target for d in find_managed_drives(mount_point, state=state)]
+    affected = any(
+        match_prefix(pathname, mount_point)
+        for pathnames in find_mount_requirements(units, context=(state.context if state else None)).values()
+        for pathname in pathnames
+    )
+    if state is not None:
+        state.cache['systemd_dependencies'][mount_point] = affected
+    return affected
+
+
+def find_mount_requirements(units, systemctl='systemctl', generator_directory=GENERATOR_DIRECTORY, context=None):
+    """
+    Find the ``RequiresMountsFor`` dependencies of systemd units.
+
+    :param units: A list of systemd unit names (strings).
+    :param systemctl: The name or pathname of the ``systemctl`` program (a
+                      string, defaults to ``systemctl``).
+    :param generator_directory: The directory with generated unit files (a
+                                string, defaults to :data:`GENERATOR_DIRECTORY`).
+    :param context: See :func:`~linux_utils.coerce_context()` for details.
+                    Unit files are only read in-process when this is a local
+                    context, otherwise ``systemctl`` is used for all units.
+    :returns: A dictionary with unit names (strings) as keys and lists of
+              pathnames (strings) as values.
+
+    The ``systemd-cryptsetup@*.service`` units are generated by
+    ``systemd-cryptsetup-generator`` so most of the time their dependencies
+    can be read from the unit files in `generator_directory` without running
+    any external commands. The dependencies of the remaining units are
+    queried using a single ``systemctl show`` command (if ``systemctl`` is
+    installed).
+    """
+    from executor import which
+    from humanfriendly.text import pluralize
+    from linux_utils import coerce_context
+    from crypto_drive_manager.state import is_local_context
+    context = coerce_context(context)
+    local = is_local_context(context)
+    requirements = {}
+    remaining = []
+    for unit in units:
+        unit_file = os.path.join(generator_directory, unit)
+        if local and os.path.isfile(unit_file):
+            with open(unit_file) as handle:
+                requirements[unit] = parse_mount_requirements(handle)
+        else:
+            remaining.append(unit)
+    if remaining and (which(systemctl) if local else context.find_program(systemctl)):
+        logger.verbose("Querying %s using systemctl ..", pluralize(len(remaining), "systemd unit"))
+        output = context.capture(
+            systemctl, 'show', '--property=Id', '--property=RequiresMountsFor', *remaining,
+            check=False, silent=True
+        )
+        for block in output.split('\n\n'):
+            properties = dict(
+                (key.strip(), value.strip()) for key, _, value in
+                (line.partition('=') for line in block.splitlines())
             )
-            for line in output.splitlines():
-                key, _, value = line.partition('=')
-                if (key.strip() == 'RequiresMountsFor' and
-                        match_prefix(value.strip(), mount_point)):
-                    return True
-    return False
+            if properties.get('Id') in remaining:
+                requirements[properties['Id']] = properties.get('RequiresMountsFor', '').split()
+    return requirements
+
+
+def parse_mount_requirements(lines):
+    """
+    Parse the ``RequiresMountsFor`` directives in a systemd unit file.
+
+    :param lines: An iterable of strings with the lines of a unit file.
+    :returns: A list of pathnames (strings).
+    """
+    pathnames = []
+    for line in lines:
+        key, _, value = line.partition('=')
+        if key.strip() == 'RequiresMountsFor':
+            pathnames.extend(value.split())
+    return pathnames
 
 
 def have_systemd_workaround():
@@ -111,35 +194,111 @@ def systemd_workaround_requested():
         return False
 
 
-def update_systemd_services():
-    """Apply the workaround for `systemd issue #3816`_."""
-    coloredlogs.install(syslog=True)
+def update_systemd_services(arguments=()):
+    """
+    Apply the workaround for `systemd issue #3816`_.
+
+    :param arguments: The command line arguments given to the generator by
+                      systemd (an iterable of strings, these are passed on to
+                      the original ``systemd-cryptsetup-generator`` program).
+                      The first argument is the directory where the unit
+                      files are generated (when no arguments are given
+                      :data:`CRYPTSETUP_SERVICES` is used).
+
+    This runs as a systemd generator, whose standard error stream is
+    captured by systemd, so :mod:`coloredlogs` and :mod:`executor` aren't
+    loaded here (to keep the boot fast).
+    """
+    logging.basicConfig(format='%(name)s: %(message)s', level=logging.INFO)
     logger.info("Running systemd-cryptsetup-generator program ..")
-    execute(CRYPTSETUP_GENERATOR_WRAPPED, sudo=True)
-    for service_file in glob.glob(CRYPTSETUP_SERVICES):
-        # Read the *.service file.
-        logger.info("Reading %s ..", service_file)
-        with open(service_file) as handle:
-            contents = list(handle)
-        # Remove the 'RequiresMountsFor' field.
-        modified = []
-        for line in contents:
-            key, _, value = line.partition('=')
-            if key.strip() == 'RequiresMountsFor':
-                logger.info("Stripping line: %s", line.strip())
-            else:
-                modified.append(line)
-        # Check if a modification was made.
-        if modified != contents:
-            logger.info("Saving %s ..", service_file)
-            # Save the modified *.service file.
-            with open(service_file, 'w') as handle:
-                for line in modified:
-                    handle.write(line)
+    arguments = list(arguments)
+    subprocess.check_call([CRYPTSETUP_GENERATOR_WRAPPED] + arguments)
+    if arguments:
+        pattern = os.path.join(arguments[0], os.path.basename(CRYPTSETUP_SERVICES))
+    else:
+        pattern = CRYPTSETUP_SERVICES
+    rewrite_service_files(glob.glob(pattern))
+
+
+def rewrite_service_files(filenames, concurrency=None):
+    """
+    Remove the ``RequiresMountsFor`` directives from generated unit files.
+
+    :param filenames: A list of pathnames of unit files (strings).
+    :param concurrency: The number of files to process at the same time (a
+                        positive integer). Defaults to one when there are
+                        fewer than :data:`PARALLEL_THRESHOLD` files and to
+                        :data:`DEFAULT_CONCURRENCY` otherwise.
+    :returns: A list with the pathnames of the files that were changed.
+
+    See :func:`rewrite_service_file()` for details.
+    """
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY if len(filenames) >= PARALLEL_THRESHOLD else 1
+    if concurrency > 1 and len(filenames) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        # Give each thread a slice of the files (instead of submitting a task
+        # per file) to minimize the overhead of the thread pool.
+        chunks = [filenames[i::concurrency] for i in range(concurrency)]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            changed = set(fn for chunk in pool.map(rewrite_service_files, chunks, [1] * concurrency) for fn in chunk)
+        return [fn for fn in filenames if fn in changed]
+    return [fn for fn in filenames if rewrite_service_file(fn)]
+
+
+def rewrite_service_file(filename):
+    """
+    Remove the ``RequiresMountsFor`` directives from a generated unit file.
+
+    :param filename: The pathname of the unit file (a string).
+    :returns: :data:`True` if the file was changed, :data:`False` otherwise.
+
+    The file is streamed line by line and it's only written when it contains
+    a ``RequiresMountsFor`` directive. In that case the remaining lines are
+    written to a temporary file in the same directory (with the same
+    permissions) which is flushed to disk and renamed over the original file,
+    so that a crash halfway through can't leave behind a truncated unit file.
+    """
+    logger.debug("Reading %s ..", filename)
+    with open(filename, 'rb') as handle:
+        if not any(is_mount_requirement(line) for line in handle):
+            return False
+        handle.seek(0)
+        directory, basename = os.path.split(os.path.abspath(filename))
+        temporary_file = os.path.join(directory, '.%s.%i.tmp' % (basename, os.getpid()))
+        mode = stat.S_IMODE(os.fstat(handle.fileno()).st_mode)
+        fd = os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                for line in handle:
+                    if is_mount_requirement(line):
+                        logger.info("Stripping line from %s: %s", basename, line.decode('UTF-8', 'replace').strip())
+                    else:
+                        output.write(line)
+                output.flush()
+                os.fsync(output.fileno())
+            os.rename(temporary_file, filename)
+        except Exception:
+            os.unlink(temporary_file)
+            raise
+    logger.info("Saved %s.", filename)
+    return True
+
+
+def is_mount_requirement(line):
+    """
+    Check if a line of a unit file is a ``RequiresMountsFor`` directive.
+
+    :param line: A line of a unit file (a byte string).
+    :returns: :data:`True` if the line is a ``RequiresMountsFor`` directive,
+              :data:`False` otherwise.
+    """
+    return line.partition(b'=')[0].strip() == b'RequiresMountsFor'
 
 
 def find_program_file():
     """Find the absolute pathname of the `crypto-drive-manager` executable."""
+    from executor import which
     value = sys.argv[0]
     msg = "Failed to determine absolute pathname of program!"
     if not os.path.isabs(value):
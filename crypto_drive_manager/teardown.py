@@ -0,0 +1,338 @@
+# Locking of managed drives.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Locking of the encrypted drives managed by `crypto-drive-manager`.
+
+:func:`lock_encrypted_drives()` is the counterpart of
+:func:`.initialize_keys_device()`. It tears down the managed drives in three
+stages and the work within each stage is done in parallel, so that the time
+it takes to lock a lot of drives is determined by the slowest drive instead
+of by the sum of all drives:
+
+1. The filesystems on the drives (and on the logical volumes on top of the
+   drives) are unmounted, deepest mount points first. All mount points at
+   the same depth are unmounted in parallel.
+2. The LVM volume groups on top of the drives are deactivated.
+3. The device mapper targets of the drives are closed, except when other
+   devices still depend on them (these drives are reported as busy).
+
+Every external command is subject to a timeout (using the ``timeout``
+program). A drive for which a stage fails is excluded from the remaining
+stages and reported in the table rendered by :func:`render_lock_report()`.
+"""
+
+# Standard library modules.
+import enum
+import os
+
+# External dependencies.
+from humanfriendly import Timer, format_timespan
+from humanfriendly.tables import format_pretty_table
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager import coerce_state, find_managed_drives, map_drives
+
+DEFAULT_TIMEOUT = 60
+"""The default timeout for the external commands run by :func:`lock_encrypted_drives()` (in seconds)."""
+
+KILL_GRACE_PERIOD = 5
+"""The number of seconds between terminating and killing commands that timed out (an integer)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def lock_encrypted_drives(keys_directory, volumes=(), concurrency=None, timeout=DEFAULT_TIMEOUT, state=None):
+    """
+    Unmount and lock the managed drives.
+
+    :param keys_directory: The mount point for the virtual keys device (a
+                           string, used to find the managed drives).
+    :param volumes: An iterable of mapper names (strings). If given then only
+                    these drives are locked.
+    :param concurrency: The maximum number of external commands that are run
+                        in parallel (an integer or :data:`None`, in which case
+                        all drives are handled in parallel).
+    :param timeout: The number of seconds after which an external command is
+                    terminated (a number, or :data:`None` to disable the timeout).
+    :param state: A :class:`.SystemState` object (if this isn't given a
+                  snapshot of the system state is taken automatically).
+    :returns: A list of :class:`DriveTeardown` objects (one for every
+              selected drive that was unlocked).
+    """
+    from crypto_drive_manager.lvm import find_logical_volumes, find_volume_groups
+    state = coerce_state(state)
+    timer = Timer()
+    drives = []
+    for entry in find_managed_drives(keys_directory, state=state):
+        if volumes and entry.target not in volumes:
+            logger.verbose("Ignoring %s because it doesn't match the filter.", entry.target)
+        elif not state.is_mapped(entry.target):
+            logger.verbose("Encrypted drive %s is already locked.", entry.target)
+        else:
+            drives.append(DriveTeardown(entry.target, timer))
+    if not drives:
+        logger.info("Nothing to do! (no unlocked encrypted drives)")
+        return drives
+    # Find the volume groups and logical volumes on top of the drives.
+    with state.phase('find-volume-groups'):
+        volume_groups = find_volume_groups([d.mapper_device for d in drives], context=state.context)
+        logical_volumes = find_logical_volumes(volume_groups.values(), context=state.context)
+    for drive in drives:
+        drive.volume_group = volume_groups.get(drive.mapper_device)
+        drive.devices.extend(logical_volumes.get(drive.volume_group, []))
+        with state.lock:
+            drive.mount_points = [mp for dev in drive.devices for mp in state.mounted_filesystems.get(dev, []) if mp]
+    teardown = Teardown(drives, concurrency, timeout, state)
+    with state.phase('unmount'):
+        teardown.unmount()
+    with state.phase('deactivate-volume-groups'):
+        teardown.deactivate_volume_groups()
+    with state.phase('close'):
+        teardown.close()
+    num_locked = sum(1 for d in drives if d.status == TeardownStatus.LOCKED)
+    logger.info("Locked %i of %i encrypted drives in %s.", num_locked, len(drives), timer)
+    return drives
+
+
+def render_lock_report(drives):
+    """
+    Render a table with the results of :func:`lock_encrypted_drives()`.
+
+    :param drives: A list of :class:`DriveTeardown` objects.
+    :returns: The rendered table (a string).
+    """
+    rows = []
+    for drive in drives:
+        rows.append([
+            drive.mapper_name,
+            drive.status.value if drive.status else '-',
+            ', '.join(drive.mount_points) or '-',
+            drive.volume_group or '-',
+            format_timespan(drive.elapsed_time) if drive.elapsed_time is not None else '-',
+            drive.error or '',
+        ])
+    return format_pretty_table(rows, ["Drive", "Result", "Mount points", "Volume group", "Time", "Error"])
+
+
+class TeardownStatus(enum.Enum):
+
+    """Enumeration of the results of locking a managed drive."""
+
+    LOCKED = 'locked'
+    """The drive was unmounted and locked."""
+
+    BUSY = 'busy'
+    """A filesystem, volume group or device mapper target on the drive is still in use."""
+
+    TIMEOUT = 'timeout'
+    """An external command didn't finish within the timeout."""
+
+    FAILED = 'failed'
+    """An external command failed for another reason."""
+
+
+class DriveTeardown(object):
+
+    """The teardown of a single managed drive (see :func:`lock_encrypted_drives()`)."""
+
+    def __init__(self, mapper_name, timer):
+        """
+        Initialize a :class:`DriveTeardown` object.
+
+        :param mapper_name: The device mapper name of the drive (a string).
+        :param timer: A :class:`~humanfriendly.Timer` that was started at the
+                      beginning of the teardown.
+        """
+        self.mapper_name = mapper_name
+        self.timer = timer
+        self.devices = [self.mapper_device]
+        """The device mapper device of the drive and the logical volumes on top of it (a list of strings)."""
+        self.mount_points = []
+        self.volume_group = None
+        self.status = None
+        self.error = None
+        self.elapsed_time = None
+
+    @property
+    def mapper_device(self):
+        """The pathname of the device mapper device of the drive (a string)."""
+        return '/dev/mapper/%s' % self.mapper_name
+
+    def finish(self, status, error=None):
+        """
+        Record the result of the teardown (only once).
+
+        :param status: A :class:`TeardownStatus` value.
+        :param error: An error message (a string or :data:`None`).
+        """
+        if self.status is None:
+            self.status = status
+            self.error = error
+            self.elapsed_time = self.timer.elapsed_time
+
+
+class Teardown(object):
+
+    """The stages of :func:`lock_encrypted_drives()`."""
+
+    def __init__(self, drives, concurrency, timeout, state):
+        """
+        Initialize a :class:`Teardown` object.
+
+        :param drives: A list of :class:`DriveTeardown` objects.
+        :param concurrency: See :func:`lock_encrypted_drives()`.
+        :param timeout: See :func:`lock_encrypted_drives()`.
+        :param state: A :class:`.SystemState` object.
+        """
+        self.drives = drives
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.state = state
+
+    @property
+    def pending(self):
+        """The drives for which no stage has failed yet (a list of :class:`DriveTeardown` objects)."""
+        return [d for d in self.drives if d.status is None]
+
+    def run_parallel(self, function, items, message):
+        """Call a function for every item using :func:`.map_drives()`."""
+        map_drives(function, items, self.concurrency or len(items), message)
+
+    def execute(self, drives, *command, **options):
+        """
+        Run an external command on behalf of one or more drives.
+
+        :param drives: A list of :class:`DriveTeardown` objects.
+        :param command: The command to run (a tuple of strings).
+        :param options: The keyword argument `busy` gives the exit statuses
+                        of `command` that mean the device is busy (a tuple
+                        of integers) and `busy_messages` gives the (lower
+                        case) error messages that mean the same thing (a
+                        tuple of strings, defaults to ``('busy',)``).
+        :returns: :data:`True` if the command succeeded, :data:`False` if it
+                  failed (in which case the drives are marked as failed).
+        """
+        if self.timeout:
+            command = ('timeout', '--kill-after=%i' % KILL_GRACE_PERIOD, '%g' % self.timeout) + command
+        try:
+            self.state.context.execute(*command, capture=True, capture_stderr=True, silent=True)
+            return True
+        except Exception as e:
+            returncode = getattr(e, 'returncode', None)
+            text = str(e)
+            if self.timeout and returncode in (124, 137):
+                status = TeardownStatus.TIMEOUT
+                error = "Timeout after %s" % format_timespan(self.timeout)
+            elif (returncode in options.get('busy', ()) or
+                  any(m in text.lower() for m in options.get('busy_messages', ('busy',)))):
+                status = TeardownStatus.BUSY
+                error = text.strip().splitlines()[-1]
+            else:
+                status = TeardownStatus.FAILED
+                error = text.strip().splitlines()[-1]
+            for drive in drives:
+                logger.warning("Failed to lock encrypted drive %s! (%s: %s)", drive.mapper_name, status.value, error)
+                drive.finish(status, error)
+            return False
+
+    def unmount(self):
+        """Unmount the filesystems on the drives (deepest mount points first)."""
+        def depth(pathname):
+            return len([c for c in os.path.normpath(pathname).split(os.sep) if c])
+
+        def unmount(item):
+            mount_point, drive = item
+            if drive.status is None:
+                logger.info("Unmounting %s ..", mount_point)
+                self.execute([drive], 'umount', mount_point)
+
+        items = [(mp, d) for d in self.pending for mp in d.mount_points]
+        for level in sorted(set(depth(mp) for mp, d in items), reverse=True):
+            self.run_parallel(unmount, [(mp, d) for mp, d in items if depth(mp) == level], "Unmounting %s")
+        for drive in self.pending:
+            for device in drive.devices:
+                self.state.remove_mount(device)
+
+    def deactivate_volume_groups(self):
+        """Deactivate the volume groups on top of the drives."""
+        groups = {}
+        for drive in self.pending:
+            if drive.volume_group:
+                groups.setdefault(drive.volume_group, []).append(drive)
+
+        def deactivate(name):
+            logger.info("Deactivating volume group %s ..", name)
+            # vgchange exits with status 5 for any failure, so the message decides.
+            self.execute(groups[name], 'vgchange', '--activate', 'n', name,
+                         busy_messages=('busy', 'in use', 'open logical volume'))
+
+        self.run_parallel(deactivate, sorted(groups), "Deactivating volume groups of %s")
+
+    def close(self):
+        """Close the device mapper targets of the drives (unless other devices depend on them)."""
+        def close(drive):
+            holders = find_holders(drive.mapper_device, self.state)
+            if holders:
+                error = "In use by %s" % ', '.join(holders)
+                logger.warning("Not locking encrypted drive %s! (%s)", drive.mapper_name, error)
+                drive.finish(TeardownStatus.BUSY, error)
+            else:
+                logger.info("Locking encrypted drive %s ..", drive.mapper_name)
+                if self.execute([drive], 'cryptsetup', 'close', drive.mapper_name, busy=(5,)):
+                    self.state.remove_mapper(drive.mapper_name)
+                    drive.finish(TeardownStatus.LOCKED)
+
+        self.run_parallel(close, self.pending, "Locking %s")
+
+
+def find_holders(device_file, state):
+    """
+    Find the devices that depend on a device mapper target.
+
+    :param device_file: The pathname of a device mapper device (a string).
+    :param state: A :class:`.SystemState` object.
+    :returns: A list of kernel device names (strings like ``dm-5``).
+
+    The holders are listed in ``/sys/block/*/holders``, which is only checked
+    for local contexts (see :func:`.is_local_context()`). For other contexts
+    an empty list is returned and ``cryptsetup`` reports the device as busy.
+    """
+    from crypto_drive_manager.state import is_local_context
+    if is_local_context(state.context):
+        directory = '/sys/block/%s/holders' % os.path.basename(os.path.realpath(device_file))
+        if os.path.isdir(directory):
+            return sorted(os.listdir(directory))
+    return []
+
+
+def lock_keys_device(mapper_name, mount_point, state=None):
+    """
+    Unmount and lock the virtual keys device (if it's unlocked).
+
+    :param mapper_name: The device mapper name for the virtual keys device (a string).
+    :param mount_point: The mount point for the virtual keys device (a string).
+    :param state: A :class:`.SystemState` object (optional).
+
+    The virtual keys device is normally locked at the end of every run, but
+    it's left unlocked on systems affected by `systemd issue #3816`_ (see
+    :func:`.have_systemd_dependencies()`). Once the managed drives have been
+    locked it's safe to lock the virtual keys device as well.
+
+    .. _systemd issue #3816: https://github.com/systemd/systemd/issues/3816
+    """
+    state = coerce_state(state)
+    mapper_device = '/dev/mapper/%s' % mapper_name
+    if state.is_mounted(mapper_device):
+        logger.info("Unmounting the virtual keys device ..")
+        state.context.execute('umount', mount_point)
+        state.remove_mount(mapper_device)
+    if state.is_mapped(mapper_name):
+        logger.info("Locking the virtual keys device ..")
+        state.context.execute('cryptsetup', 'close', mapper_name)
+        state.remove_mapper(mapper_name)
@@ -0,0 +1,1090 @@
+# Test suite for the `crypto-drive-manager' package.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Test suite for the `crypto-drive-manager` package.
+
+The tests don't need root privileges or LUKS hardware: the filesystem
+signatures are written to temporary files and everything else runs against
+the simulated system in :mod:`crypto_drive_manager.simulation`.
+"""
+
+# Standard library modules.
+import json
+import logging
+import logging.handlers
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# External dependencies.
+from executor.contexts import LocalContext
+from humanfriendly.testing import TemporaryDirectory, TestCase, retry, touch
+
+# Modules included in our package.
+from crypto_drive_manager import (
+    ActivationFailed,
+    ActivationResults,
+    DriveStatus,
+    KeysDevice,
+    initialize_keys_device,
+    keyslots,
+)
+from crypto_drive_manager.coordination import RunCoordinator
+from crypto_drive_manager.crypttab import load_crypttab
+from crypto_drive_manager.daemon import HotplugDaemon, InotifyEventSource
+from crypto_drive_manager.keyring import DESCRIPTION_PREFIX
+from crypto_drive_manager.keys import create_image_file, generate_key_file, write_key_file
+from crypto_drive_manager.keystore import (
+    BLOCK_SIZE,
+    KeyDirectory,
+    KeyStore,
+    KeyStoreError,
+    detect_store_format,
+    encode_name,
+    save_recovery_copy,
+)
+from crypto_drive_manager.lvm import LogicalVolume, activate_lvm_drives, find_fstab_entries
+from crypto_drive_manager.mounts import Mount, MountScheduler, MountStatus, logger as mounts_logger
+from crypto_drive_manager.plan import Action, create_plan
+from crypto_drive_manager.probe import PROBE_SIZE, match_signature, probe_filesystems
+from crypto_drive_manager.rotation import RotationJournal, rotate_key
+from crypto_drive_manager.simulation import SimulatedContext, SimulatedEventSource, SimulatedKeyring, SimulatedSystem
+from crypto_drive_manager.state import SystemState
+from crypto_drive_manager.systemd import find_mount_requirements
+from crypto_drive_manager.teardown import TeardownStatus, lock_encrypted_drives, render_lock_report
+from crypto_drive_manager.timings import InstrumentedContext, Timings
+from crypto_drive_manager.verification import (
+    DEFAULT_LUKS2_HEADER_SIZE,
+    ResourceBudget,
+    VerificationCache,
+    find_header_size,
+    verify_key,
+)
+
+
+class CryptoDriveManagerTestCase(TestCase):
+
+    """Container for the `crypto-drive-manager` tests."""
+
+    def test_match_signature(self):
+        """Test the recognition of filesystem signatures."""
+        for name, (expected_type, data) in create_fixtures().items():
+            assert match_signature(data) == expected_type, name
+
+    def test_probe_filesystems(self):
+        """Test probing the filesystem signatures of multiple (fake) devices in one pass."""
+        with TemporaryDirectory() as directory:
+            expected = {}
+            for name, (expected_type, data) in create_fixtures().items():
+                filename = os.path.join(directory, name)
+                with open(filename, 'wb') as handle:
+                    handle.write(data)
+                expected[filename] = expected_type
+            # Devices that can't be read don't have a signature.
+            expected[os.path.join(directory, 'missing')] = None
+            assert probe_filesystems(sorted(expected), fallback=False) == expected
+            # The unrecognized devices are passed to a single blkid invocation.
+            timings = Timings()
+            context = InstrumentedContext(LocalContext(), timings)
+            results = probe_filesystems(sorted(expected), context=context)
+            assert dict((k, v) for k, v in results.items() if v) == dict((k, v) for k, v in expected.items() if v)
+            commands = [r.name.split() for r in timings.records if r.kind == 'command']
+            assert len(commands) == 1
+            assert commands[0][0] == 'blkid'
+            assert sorted(commands[0][3:]) == sorted(k for k, v in expected.items() if not v)
+
+    def test_find_mount_requirements(self):
+        """Test that generated unit files are read in-process and the other units are queried in one batch."""
+        with TemporaryDirectory() as directory:
+            generator_directory = os.path.join(directory, 'generator')
+            os.mkdir(generator_directory)
+            with open(os.path.join(generator_directory, 'systemd-cryptsetup@drive1.service'), 'w') as handle:
+                handle.write('[Unit]\nRequiresMountsFor=/mnt/keys /srv\n')
+            # The fake systemctl program records its arguments and reports a
+            # dependency for every unit that it's asked about.
+            log_file = os.path.join(directory, 'systemctl.log')
+            systemctl = os.path.join(directory, 'systemctl')
+            with open(systemctl, 'w') as handle:
+                handle.write('\n'.join([
+                    '#!/bin/sh',
+                    'echo "$@" >> %s' % log_file,
+                    'for unit in "$@"; do',
+                    '  case "$unit" in -*) continue;; esac',
+                    '  printf "Id=%s\\nRequiresMountsFor=/mnt/keys\\n\\n" "$unit"',
+                    'done',
+                ]) + '\n')
+            os.chmod(systemctl, 0o755)
+            requirements = find_mount_requirements(
+                ['systemd-cryptsetup@drive1.service', 'drive2.service', 'drive3.service'],
+                systemctl=systemctl, generator_directory=generator_directory,
+            )
+            assert requirements == {
+                'systemd-cryptsetup@drive1.service': ['/mnt/keys', '/srv'],
+                'drive2.service': ['/mnt/keys'],
+                'drive3.service': ['/mnt/keys'],
+            }
+            with open(log_file) as handle:
+                invocations = handle.read().splitlines()
+            assert invocations == [
+                'show --property=Id --property=RequiresMountsFor drive2.service drive3.service',
+            ]
+
+    def test_hotplug_daemon(self):
+        """Test that the hotplug daemon unlocks drives as they appear (and survives failures)."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(3, os.path.join(directory, 'keys'), available_ratio=0, seed=1)
+            system.drives['drive3'].filesystem = 'LVM2_member'
+            events = SimulatedEventSource(system)
+            coordination_directory = os.path.join(directory, 'run')
+            daemon = HotplugDaemon(
+                image_file=os.path.join(directory, 'keys.img'),
+                mapper_name='encryption-keys',
+                mount_point=system.keys_directory,
+                events=events,
+                debounce=0.1,
+                coordination_directory=coordination_directory,
+                state=SystemState(context=SimulatedContext(system)),
+            )
+            # Unlocking the drive that's available at startup fails, but
+            # that doesn't stop the daemon.
+            system.drives['drive1'].available = True
+            system.failure_rates['cryptsetup'] = 1
+            thread = threading.Thread(target=daemon.run)
+            thread.start()
+            try:
+                retry(lambda: system.counters['cryptsetup'] > 0)
+                system.failure_rates.clear()
+                assert thread.is_alive()
+                # Drives that appear together are unlocked together (after concurrent runs have finished).
+                with RunCoordinator(coordination_directory):
+                    events.plug('drive2')
+                    events.plug('drive3')
+                    time.sleep(0.5)
+                    assert not system.mappers
+                retry(lambda: set(system.mappers) == {'drive2', 'drive3'})
+                # The volume group on drive3 is activated and its logical volume mounted.
+                retry(lambda: system.drives['drive3'].logical_volume in system.mounts)
+                assert '/dev/mapper/drive2' in system.mounts
+            finally:
+                events.close()
+                thread.join()
+            # The virtual keys device was locked again.
+            assert 'encryption-keys' not in system.mappers
+            # The results of the last batch were recorded for concurrent runs.
+            with open(os.path.join(coordination_directory, 'run.json')) as handle:
+                assert json.load(handle)['activated'] == ['drive2', 'drive3']
+
+    def test_key_cache(self):
+        """Test that cached keys unlock drives without unlocking the virtual keys device."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(3, os.path.join(directory, 'keys'), seed=1)
+            key_cache = SimulatedKeyring()
+            cached_keys = [DESCRIPTION_PREFIX + name for name in ('drive1', 'drive2', 'drive3')]
+
+            def unlock():
+                initialize_keys_device(
+                    image_file=os.path.join(directory, 'keys.img'),
+                    mapper_name='encryption-keys',
+                    mount_point=system.keys_directory,
+                    key_cache=key_cache,
+                    state=SystemState(context=SimulatedContext(system)),
+                )
+
+            # The first run creates the keys and caches them.
+            unlock()
+            assert sorted(key_cache.list_keys()) == cached_keys
+            # After a "reboot" the drives are unlocked using the cached keys.
+            system.mappers.clear()
+            system.mounts.clear()
+            system.counters.clear()
+            unlock()
+            assert sorted(system.mappers) == ['drive1', 'drive2', 'drive3']
+            assert key_cache.counters['read'] == 3
+            assert system.counters['cryptsetup'] == 3
+            # Evicted keys are read from the virtual keys device again.
+            key_cache.evict(['drive2'])
+            system.mappers.clear()
+            system.mounts.clear()
+            system.counters.clear()
+            unlock()
+            assert sorted(system.mappers) == ['drive1', 'drive2', 'drive3']
+            assert system.counters['cryptsetup'] > 3
+            assert 'encryption-keys' not in system.mappers
+            assert sorted(key_cache.list_keys()) == cached_keys
+
+    def test_wait_for_devices(self):
+        """Test that drives which appear before the deadline are unlocked."""
+        with TemporaryDirectory() as directory:
+            # The deadline starts once the virtual keys device is unlocked,
+            # so the time spent formatting it doesn't count.
+            system = SimulatedSystem(3, os.path.join(directory, 'keys'), latencies={'mkfs.ext4': 1}, seed=1)
+            system.drives['drive2'].available = False
+            system.drives['drive3'].available = False
+            events = SimulatedEventSource(system)
+            timer = threading.Timer(1.5, events.plug, ['drive2'])
+            timer.start()
+            try:
+                initialize_keys_device(
+                    image_file=os.path.join(directory, 'keys.img'),
+                    mapper_name='encryption-keys',
+                    mount_point=system.keys_directory,
+                    wait_for_devices=1,
+                    events=events,
+                    state=SystemState(context=SimulatedContext(system)),
+                )
+            finally:
+                timer.join()
+            # The drive that never appeared was skipped.
+            assert sorted(m for m in system.mappers if m.startswith('drive')) == ['drive1', 'drive2']
+
+    def test_create_plan(self):
+        """Test that plans contain the right actions (and that planning doesn't change anything)."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(4, os.path.join(directory, 'keys'), seed=1)
+            # drive1 is locked, drive2 is unlocked and mounted, drive3 is an
+            # unlocked LVM physical volume and drive4 isn't available.
+            system.mappers.update(['drive2', 'drive3'])
+            system.mounts['/dev/mapper/drive2'] = '/srv/drive2'
+            system.drives['drive3'].filesystem = 'LVM2_member'
+            system.drives['drive4'].available = False
+            state = SystemState(context=SimulatedContext(system))
+            plan = create_plan(system.keys_directory, keys_accessible=False, state=state)
+            assert dict((d.mapper_name, d.actions) for d in plan.drives) == {
+                'drive1': [Action.OPEN, Action.MOUNT],
+                'drive2': [],
+                'drive3': [Action.ACTIVATE_LVM],
+                'drive4': [Action.SKIP_UNAVAILABLE],
+            }
+            assert plan.needs_keys
+            # Missing key files are created and installed (only for drives that need to be unlocked).
+            plan.check_key_files()
+            assert plan.drives[0].actions == [Action.CREATE_KEY, Action.ADD_KEY, Action.OPEN, Action.MOUNT]
+            assert plan.render_actions().splitlines() == [
+                "Unlock virtual keys device.",
+                "create-key 1 drive: drive1",
+                "add-key 1 drive: drive1",
+                "open 1 drive: drive1",
+                "mount 1 drive: drive1",
+                "activate-lvm 1 drive: drive3",
+                "skip-unavailable 1 drive: drive4",
+            ]
+            table = plan.render_table()
+            assert all(name in table for name in ('drive1', 'drive2', 'drive3', 'drive4', 'skip-unavailable'))
+            document = json.loads(plan.render_json())
+            assert document['needs_keys'] is True
+            assert [d['actions'] for d in document['drives']][0] == ['create-key', 'add-key', 'open', 'mount']
+            # On the first run every available drive gets a new key.
+            plan = create_plan(system.keys_directory, first_run=True, keys_accessible=False, state=state)
+            assert all(d.actions[:2] == [Action.CREATE_KEY, Action.ADD_KEY] for d in plan.available_drives)
+            assert plan.render_actions().splitlines()[0] == "Create virtual keys device."
+            # Planning (e.g. for --dry-run and the status command) only inspects the system.
+            for program in ('cryptsetup', 'cryptdisks_start', 'mount', 'umount', 'vgchange', 'mkfs.ext4'):
+                assert system.counters[program] == 0
+            assert system.mappers == set(['drive2', 'drive3'])
+            assert list(system.mounts) == ['/dev/mapper/drive2']
+            assert not system.active_volume_groups
+            assert not os.path.exists(system.keys_directory)
+
+    def test_async_timeout(self):
+        """Test that a command that times out fails its drive and the virtual keys device is still locked."""
+        if sys.version_info[:2] < (3, 5):
+            return self.skipTest("the asyncio API requires Python 3.5+")
+        from crypto_drive_manager import aio
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(2, os.path.join(directory, 'keys'), seed=1)
+            system.latencies['cryptdisks_start'] = 5
+            start_time = time.time()
+            with self.assertRaises(ActivationFailed) as context:
+                aio.run_sync(aio.initialize_keys_device(
+                    image_file=os.path.join(directory, 'keys.img'),
+                    mapper_name='encryption-keys',
+                    mount_point=system.keys_directory,
+                    concurrency=2,
+                    timeout=0.1,
+                    state=SystemState(context=SimulatedContext(system)),
+                ))
+            assert time.time() - start_time < 2
+            assert sorted(context.exception.failures) == ['drive1', 'drive2']
+            assert all(isinstance(e, aio.CommandTimedOut) for e in context.exception.failures.values())
+            assert 'encryption-keys' not in system.mappers
+            assert '/dev/mapper/encryption-keys' not in system.mounts
+
+    def test_async_cancellation(self):
+        """Test that cancelling an unlock run still unmounts and locks the virtual keys device."""
+        if sys.version_info[:2] < (3, 5):
+            return self.skipTest("the asyncio API requires Python 3.5+")
+        import asyncio
+        from crypto_drive_manager import aio
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(2, os.path.join(directory, 'keys'), seed=1)
+            system.latencies['cryptdisks_start'] = 5
+            # The cleanup commands are slow, but they finish before the cancellation propagates.
+            system.latencies['umount'] = 0.2
+
+            async def cancel_unlock():
+                task = asyncio.ensure_future(aio.initialize_keys_device(
+                    image_file=os.path.join(directory, 'keys.img'),
+                    mapper_name='encryption-keys',
+                    mount_point=system.keys_directory,
+                    concurrency=2,
+                    state=SystemState(context=SimulatedContext(system)),
+                ))
+                # Wait until the keys have been installed and the drives are being unlocked.
+                while not system.counters['which']:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.1)
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    return True
+                return False
+
+            start_time = time.time()
+            assert aio.run_sync(cancel_unlock())
+            assert time.time() - start_time < 2
+            assert system.counters['cryptdisks_start'] == 0
+            assert system.counters['umount'] == 1
+            assert 'encryption-keys' not in system.mappers
+            assert '/dev/mapper/encryption-keys' not in system.mounts
+            # The key files were kept, so the next run doesn't start over.
+            assert os.path.isfile(os.path.join(directory, 'keys.img'))
+
+    def test_key_store(self):
+        """Test creating, reading, replacing, removing and renaming keys in a key store."""
+        with TemporaryDirectory() as directory:
+            device_file = os.path.join(directory, 'keys.img')
+            # Room for the header, one index block and eight small records.
+            create_image_file(device_file, 2 * BLOCK_SIZE + 8 * 64)
+            assert detect_store_format(device_file) == 'ext4'
+            self.assertRaises(KeyStoreError, KeyStore, device_file)
+            store = KeyStore.create(device_file, record_size=64)
+            assert detect_store_format(device_file) == 'raw'
+            assert store.num_records == 8
+            assert store.names() == []
+            # Write, read and replace a key.
+            store.write('drive1', b'1' * 64)
+            assert read_key(store, 'drive1') == b'1' * 64
+            store.write('drive1', b'2' * 32)
+            assert read_key(KeyStore(device_file), 'drive1') == b'2' * 32
+            self.assertRaises(KeyStoreError, store.write, 'drive1', b'3' * 65)
+            self.assertRaises(KeyStoreError, store.read, 'missing')
+            # Keys are available as (temporary) files for cryptsetup.
+            with store.key_file('drive1') as key_file:
+                with open(key_file, 'rb') as handle:
+                    assert handle.read() == b'2' * 32
+            assert not os.path.exists(key_file)
+            # Find two names with the same start of their probe sequence.
+            first, second = find_collision(store.num_records)
+            store.write(first, b'a' * 64)
+            store.write(second, b'b' * 64)
+            # Removing the first leaves a tombstone that lookups of the second probe past.
+            assert store.remove(first)
+            assert not store.remove(first)
+            assert not store.exists(first)
+            assert read_key(store, second) == b'b' * 64
+            # Renaming keeps the key and removes the old name.
+            store.rename(second, 'drive2')
+            assert not store.exists(second)
+            assert read_key(store, 'drive2') == b'b' * 64
+            assert store.names() == ['drive1', 'drive2']
+            # The store is full when every record is used.
+            for i in range(3, 9):
+                store.write('drive%i' % i, b'%i' % i)
+            assert len(store.names()) == 8
+            self.assertRaises(KeyStoreError, store.write, 'drive9', b'9')
+            # Corrupt keys are detected by their checksum.
+            entry = store.lookup('drive1')
+            with open(device_file, 'r+b') as handle:
+                handle.seek(store.record_offset(entry.record))
+                handle.write(b'x')
+            self.assertRaises(KeyStoreError, store.read, 'drive1')
+
+    def test_key_store_migration(self):
+        """Test migrating key files to a key store (including recovery from an interrupted migration)."""
+        with TemporaryDirectory() as directory:
+            key_directory = KeyDirectory(os.path.join(directory, 'keys'))
+            os.mkdir(key_directory.directory)
+            for name in ('drive1', 'drive2'):
+                key_directory.generate(name)
+            expected = dict((name, read_key(key_directory, name)) for name in key_directory.names())
+            touch(os.path.join(directory, 'keys.img'))
+            # The migration replaces the key files by a key store.
+            create_image_file(os.path.join(directory, 'device'), 1024 * 1024)
+            keys_device = FileKeysDevice(directory)
+            keys_device.key_store = key_directory
+            keys_device.migrate()
+            assert isinstance(keys_device.key_store, KeyStore)
+            assert detect_store_format(keys_device.mapper_device) == 'raw'
+            assert dict((n, read_key(keys_device.key_store, n)) for n in keys_device.key_store.names()) == expected
+            assert not os.path.exists(keys_device.recovery_directory)
+            # A migration interrupted after the copy was saved (and the
+            # device was reformatted) is resumed from the copy.
+            keys = dict((name, key_directory.read(name)) for name in key_directory.names())
+            save_recovery_copy(keys, keys_device.recovery_directory)
+            for key in keys.values():
+                key.wipe()
+            os.unlink(keys_device.mapper_device)
+            create_image_file(keys_device.mapper_device, 1024 * 1024)
+            keys_device = FileKeysDevice(directory)
+            assert keys_device.recover()
+            assert dict((n, read_key(keys_device.key_store, n)) for n in keys_device.key_store.names()) == expected
+            assert not os.path.exists(keys_device.recovery_directory)
+            # An incomplete copy is discarded (the ext4 filesystem wasn't touched yet).
+            keys_device = FileKeysDevice(directory)
+            os.makedirs(keys_device.recovery_directory)
+            touch(os.path.join(keys_device.recovery_directory, 'drive1.key'))
+            assert not keys_device.recover()
+            assert not os.path.exists(keys_device.recovery_directory)
+            assert keys_device.key_store is None
+
+    def test_parse_key_slots(self):
+        """Test parsing the LUKS1 and LUKS2 header formats and recognizing fast key slots."""
+        version, key_slots = keyslots.parse_key_slots(LUKS1_DUMP)
+        assert version == 1
+        assert key_slots == {
+            0: {'PBKDF': 'pbkdf2', 'Iterations': '1847042', 'Salt': '0f 0e'},
+            1: {'PBKDF': 'pbkdf2', 'Iterations': '1000'},
+        }
+        assert [keyslots.is_fast_key_slot(key_slots[n]) for n in (0, 1)] == [False, True]
+        version, key_slots = keyslots.parse_key_slots(LUKS2_DUMP)
+        assert version == 2
+        # The digests section also has PBKDF2 iterations, they don't belong to a key slot.
+        assert sorted(key_slots) == [0, 3]
+        assert key_slots[0]['PBKDF'] == 'argon2id'
+        assert [keyslots.is_fast_key_slot(key_slots[n]) for n in (0, 3)] == [False, True]
+        assert not keyslots.is_fast_key_slot({'PBKDF': 'pbkdf2', 'Iterations': '1001'})
+        assert not keyslots.is_fast_key_slot({'PBKDF': 'pbkdf2'})
+
+    def test_migrate_key_slot(self):
+        """Test the order of the key slot changes made by migrations (including pinned and interrupted ones)."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(1, os.path.join(directory, 'keys'), seed=1)
+            drive = system.drives['drive1']
+            key_file = os.path.join(directory, 'drive1.key')
+            with open(key_file, 'wb') as handle:
+                handle.write(os.urandom(64))
+            timings = Timings()
+            context = InstrumentedContext(SimulatedContext(system), timings)
+
+            def reset(*fast_slots):
+                # Slot 0 has the passphrase, slot 1 the key file (with the default PBKDF).
+                drive.key_slots = {0: (None, 1000000)}
+                context.execute('cryptsetup', 'luksAddKey', '--key-slot=1', drive.source_device, key_file)
+                for n in fast_slots:
+                    context.execute('cryptsetup', 'luksAddKey', '--key-slot=%i' % n,
+                                    '--pbkdf-force-iterations=1000', drive.source_device, key_file)
+                del timings.records[:]
+
+            def migrate(key_slot=None):
+                migration = keyslots.migrate_key_slot(drive.source_device, key_file, key_slot, context)
+                changes = []
+                for record in timings.records:
+                    arguments = record.name.split()
+                    if record.kind == 'command' and arguments[1] in ('luksAddKey', 'luksKillSlot'):
+                        slot = [a.split('=')[1] for a in arguments if a.startswith('--key-slot=')]
+                        changes.append('%s %s' % (arguments[1], (slot or arguments[-1:])[0]))
+                del timings.records[:]
+                return migration, changes
+
+            def fast_slots():
+                return sorted(n for n, (key, iterations) in drive.key_slots.items() if iterations == 1000)
+
+            # The new key slot is added and tested before the old key slot is removed.
+            reset()
+            migration, changes = migrate()
+            assert (migration.old_slot, migration.new_slot) == (1, 2)
+            assert changes == ['luksAddKey 2', 'luksKillSlot 1']
+            assert sorted(drive.key_slots) == [0, 2] and fast_slots() == [2]
+            # Fast key slots are left alone.
+            migration, changes = migrate()
+            assert (migration.old_slot, migration.new_slot) == (2, 2)
+            assert changes == []
+            # A fast key slot left behind by an interrupted migration is reused.
+            reset(2)
+            migration, changes = migrate()
+            assert (migration.old_slot, migration.new_slot) == (1, 2)
+            assert changes == ['luksKillSlot 1']
+            assert sorted(drive.key_slots) == [0, 2]
+            # Additional fast key slots left behind are removed.
+            reset(2, 3)
+            migration, changes = migrate()
+            assert changes == ['luksKillSlot 1', 'luksKillSlot 3']
+            assert sorted(drive.key_slots) == [0, 2]
+            # A pinned key slot is replaced while a temporary fast key slot unlocks the drive.
+            reset()
+            migration, changes = migrate(key_slot=1)
+            assert (migration.old_slot, migration.new_slot) == (1, 1)
+            assert changes == ['luksAddKey 2', 'luksKillSlot 1', 'luksAddKey 1', 'luksKillSlot 2']
+            assert sorted(drive.key_slots) == [0, 1] and fast_slots() == [1]
+            migration, changes = migrate(key_slot=1)
+            assert changes == []
+            # Interrupted after the pinned key slot was removed.
+            reset(2)
+            context.execute('cryptsetup', 'luksKillSlot', drive.source_device, '1')
+            del timings.records[:]
+            migration, changes = migrate(key_slot=1)
+            assert changes == ['luksAddKey 1', 'luksKillSlot 2']
+            assert sorted(drive.key_slots) == [0, 1] and fast_slots() == [1]
+            # Interrupted after the pinned key slot was replaced.
+            reset(2)
+            context.execute('cryptsetup', 'luksKillSlot', drive.source_device, '1')
+            context.execute('cryptsetup', 'luksAddKey', '--key-slot=1', '--pbkdf-force-iterations=1000',
+                            drive.source_device, key_file)
+            del timings.records[:]
+            migration, changes = migrate(key_slot=1)
+            assert changes == ['luksKillSlot 2']
+            assert sorted(drive.key_slots) == [0, 1]
+            # A pinned key slot that contains another key isn't touched.
+            reset()
+            self.assertRaises(keyslots.KeySlotError, migrate, key_slot=0)
+            assert sorted(drive.key_slots) == [0, 1]
+
+    def test_rotate_key(self):
+        """Test that a key rotation interrupted after any step can be resumed without locking out the drive."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(1, os.path.join(directory, 'keys'), seed=1)
+            state = SystemState(context=SimulatedContext(system))
+            initialize_keys_device(
+                image_file=os.path.join(directory, 'keys.img'),
+                mapper_name='encryption-keys',
+                mount_point=system.keys_directory,
+                cleanup=False,
+                state=state,
+            )
+            drive = system.drives['drive1']
+            key_store = KeyDirectory(system.keys_directory)
+
+            def current_slot():
+                with key_store.key_file('drive1') as key_file:
+                    return keyslots.test_key_file(drive.source_device, key_file, context=state.context)[0]
+
+            for step in ('generated', 'added', 'verified', 'swapped', 'killed'):
+                old_slot = current_slot()
+                journal = InterruptedJournal(key_store, step)
+                self.assertRaises(KeyboardInterrupt, rotate_key, drive.source_device, 'drive1',
+                                  key_store, journal, context=state.context)
+                # The key stored under the name of the drive still unlocks it.
+                current_slot()
+                rotation = rotate_key(drive.source_device, 'drive1', key_store,
+                                      RotationJournal(key_store), context=state.context)
+                assert rotation.resumed
+                assert rotation.old_slot == old_slot
+                assert current_slot() == rotation.new_slot != old_slot
+                assert old_slot not in drive.key_slots
+                # Only the passphrase and the new key are left.
+                assert len(drive.key_slots) == 2
+                assert key_store.names() == ['drive1']
+
+    def test_verify_key(self):
+        """Test that verification results are cached until the LUKS header or the key changes."""
+        assert find_header_size('Version:       \t1\nPayload offset:\t4096\n') == 4096 * 512
+        assert find_header_size('Metadata area: \t16384 [bytes]\nKeyslots area: \t16744448 [bytes]\n') == 16 * 1024 ** 2
+        assert find_header_size(LUKS2_DUMP) == DEFAULT_LUKS2_HEADER_SIZE
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(1, os.path.join(directory, 'keys'), seed=1)
+            state = SystemState(context=SimulatedContext(system))
+            initialize_keys_device(
+                image_file=os.path.join(directory, 'keys.img'),
+                mapper_name='encryption-keys',
+                mount_point=system.keys_directory,
+                cleanup=False,
+                state=state,
+            )
+            drive = system.drives['drive1']
+            key_store = KeyDirectory(system.keys_directory)
+            cache_file = os.path.join(directory, 'verification.json')
+
+            def verify(key_slot=None):
+                cache = VerificationCache(cache_file)
+                result = verify_key(drive.source_device, 'drive1', key_store, key_slot=key_slot,
+                                    cache=cache, context=state.context)
+                cache.save()
+                return result
+
+            # The first verification runs cryptsetup, the second one is cached.
+            result = verify()
+            assert result.status == 'passed' and not result.cached
+            key_slot = result.key_slot
+            result = verify()
+            assert result.status == 'passed' and result.cached and result.key_slot == key_slot
+            assert verify(key_slot=key_slot).cached
+            # Key material that changes without affecting the output of luksDump invalidates the cache.
+            dump = state.context.capture('cryptsetup', 'luksDump', drive.source_device)
+            drive.key_slots[0] = (os.urandom(32), drive.key_slots[0][1])
+            assert state.context.capture('cryptsetup', 'luksDump', drive.source_device) == dump
+            result = verify()
+            assert result.status == 'passed' and not result.cached
+            assert verify().cached
+            # Adding a key slot invalidates the cache.
+            state.context.execute('cryptsetup', 'luksAddKey', drive.source_device, cache_file)
+            result = verify()
+            assert result.status == 'passed' and not result.cached
+            # An expected key slot other than the cached one is tested.
+            result = verify(key_slot=0)
+            assert result.status == 'failed' and not result.cached
+            result = verify()
+            assert result.status == 'passed' and not result.cached
+            # Changing the key invalidates the cache (and the new key doesn't unlock the drive).
+            with open(key_store.location('drive1'), 'wb') as handle:
+                handle.write(os.urandom(64))
+            result = verify()
+            assert result.status == 'failed' and not result.cached
+
+    def test_resource_budget(self):
+        """Test that concurrent reservations don't exceed the resource budget."""
+        budget = ResourceBudget(4, 1000)
+        admitted = threading.Event()
+
+        def reserve(cpus, memory):
+            with budget.reserve(cpus, memory):
+                admitted.set()
+
+        # A reservation that doesn't fit waits for the running ones.
+        for cpus, memory in ((2, 600), (3, 100)):
+            admitted.clear()
+            with budget.reserve(2, 500):
+                thread = threading.Thread(target=reserve, args=(cpus, memory))
+                thread.start()
+                assert not admitted.wait(0.2)
+            thread.join()
+            assert admitted.is_set()
+        # A reservation that does fit is admitted right away.
+        admitted.clear()
+        with budget.reserve(2, 500):
+            thread = threading.Thread(target=reserve, args=(2, 500))
+            thread.start()
+            assert admitted.wait(5)
+            thread.join()
+        # A reservation that exceeds the budget on its own is admitted when nothing else is running.
+        with budget.reserve(8, 5000):
+            assert budget.used_cpus == 4
+        assert (budget.used_cpus, budget.used_memory) == (0, 0)
+
+    def test_run_coordinator(self):
+        """Test that concurrent runs wait for each other and reuse each other's results."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(2, os.path.join(directory, 'keys'), seed=1)
+            state = SystemState(context=SimulatedContext(system))
+            first = RunCoordinator(directory, volumes=['drive1', 'drive2'])
+            second = RunCoordinator(directory)
+            entered = threading.Event()
+
+            def concurrent_run():
+                with second:
+                    entered.set()
+
+            with first:
+                # Nobody is waiting yet, so the virtual keys device should be locked.
+                assert not first.keep_keys_device()
+                thread = threading.Thread(target=concurrent_run)
+                thread.start()
+                retry(first.has_waiters)
+                # Now the virtual keys device should be left unlocked for the waiting run.
+                assert first.keep_keys_device()
+                results = ActivationResults()
+                results['drive1'] = DriveStatus.UNLOCKED
+                results.failures['drive2'] = Exception("Simulated failure!")
+                first.record_results(results)
+                assert not entered.is_set()
+            thread.join()
+            assert entered.is_set()
+            assert second.inherited_keys_device
+            assert second.previous_run['activated'] == ['drive1']
+            # The drive that failed in the other run isn't tried again.
+            plan = create_plan(system.keys_directory, state=state)
+            results = ActivationResults()
+            second.reuse_results(plan, results)
+            actions = dict((d.mapper_name, d.actions) for d in plan.drives)
+            assert actions['drive1'] and not actions['drive2']
+            assert 'Simulated failure!' in str(results.failures['drive2'])
+            # A run that didn't have to wait doesn't reuse anything.
+            with RunCoordinator(directory) as third:
+                assert third.previous_run is None
+                assert not third.inherited_keys_device
+                assert not third.has_waiters()
+
+    def test_lock_encrypted_drives(self):
+        """Test that drives are unmounted deepest mount points first and that busy and hanging drives are reported."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(4, os.path.join(directory, 'keys'), seed=1)
+            system.drives['drive4'].filesystem = 'LVM2_member'
+            state = SystemState(context=SimulatedContext(system))
+            initialize_keys_device(
+                image_file=os.path.join(directory, 'keys.img'),
+                mapper_name='encryption-keys',
+                mount_point=system.keys_directory,
+                state=state,
+            )
+            # Mount drive2 inside of drive1.
+            system.mounts['/dev/mapper/drive2'] = '/srv/drive1/nested'
+            # The filesystem on drive3 is in use.
+            system.busy.add('/srv/drive3')
+            # A logical volume in the volume group on drive4 is in use.
+            system.mounts['/dev/mapper/vg_drive4-other'] = '/srv/other'
+            timings = Timings()
+            context = InstrumentedContext(SimulatedContext(system), timings)
+            drives = lock_encrypted_drives(system.keys_directory, timeout=10, state=SystemState(context=context))
+            statuses = dict((d.mapper_name, d.status) for d in drives)
+            assert statuses == {
+                'drive1': TeardownStatus.LOCKED,
+                'drive2': TeardownStatus.LOCKED,
+                'drive3': TeardownStatus.BUSY,
+                'drive4': TeardownStatus.BUSY,
+            }
+            unmounted = [r.name.split()[-1] for r in timings.records if r.kind == 'command' and ' umount ' in r.name]
+            assert unmounted.index('/srv/drive1/nested') < unmounted.index('/srv/drive1')
+            assert set(system.mappers) == {'drive3', 'drive4'}
+            report = render_lock_report(drives)
+            assert 'target is busy' in report and 'in use' in report
+            # Commands that hang are terminated.
+            system.busy.clear()
+            del system.mounts['/dev/mapper/vg_drive4-other']
+            system.latencies['cryptsetup'] = 5
+            drives = lock_encrypted_drives(system.keys_directory, timeout=0.1, state=SystemState(context=context))
+            assert [d.status for d in drives] == [TeardownStatus.TIMEOUT] * 2
+            assert 'Timeout after' in render_lock_report(drives)
+            assert set(system.mappers) == {'drive3', 'drive4'}
+
+    def test_activate_lvm_drives(self):
+        """Test that volume groups are activated in one batch and their logical volumes matched to ``/etc/fstab``."""
+        with TemporaryDirectory() as directory:
+            system = SimulatedSystem(4, os.path.join(directory, 'keys'), lvm_ratio=1, seed=1)
+            system.mappers.update(system.drives)
+            # The volume group on drive3 is already active and its logical volume is mounted.
+            system.active_volume_groups.add('vg_drive3')
+            system.mounts['/dev/mapper/vg_drive3-data'] = '/srv/drive3'
+            timings = Timings()
+            state = SystemState(context=InstrumentedContext(SimulatedContext(system), timings))
+            results, mounts = activate_lvm_drives(['drive1', 'drive2', 'drive3'], state=state)
+            commands = [r.name.split() for r in timings.records if r.kind == 'command']
+            # One pvscan and one vgchange for all drives together.
+            assert [c[1:] for c in commands if c[0] == 'pvscan'] == [
+                ['--cache', '/dev/mapper/drive1', '/dev/mapper/drive2', '/dev/mapper/drive3'],
+            ]
+            assert [c[1:] for c in commands if c[0] == 'vgchange'] == [
+                ['--activate', 'y', 'vg_drive1', 'vg_drive2'],
+            ]
+            assert system.active_volume_groups == {'vg_drive1', 'vg_drive2', 'vg_drive3'}
+            assert dict(results) == {'drive1': DriveStatus.ACTIVATED, 'drive2': DriveStatus.ACTIVATED}
+            # The logical volumes are mounted by their mount point in /etc/fstab.
+            assert sorted((m.drive, m.device_file, m.target) for m in mounts) == [
+                ('drive1', '/dev/mapper/vg_drive1-data', '/srv/drive1'),
+                ('drive2', '/dev/mapper/vg_drive2-data', '/srv/drive2'),
+            ]
+            # Entries in /etc/fstab can refer to the pathname or the device mapper pathname of a logical volume.
+            logical_volumes = [
+                LogicalVolume('vg_drive1', '/dev/vg_drive1/data', '/dev/mapper/vg_drive1-data'),
+                LogicalVolume('vg_drive2', '/dev/vg_drive2/renamed', '/dev/vg_drive2/data'),
+                LogicalVolume('vg_drive4', '/dev/vg_drive4/other', '/dev/mapper/vg_drive4-other'),
+            ]
+            entries = find_fstab_entries(logical_volumes, state)
+            assert sorted(entries) == ['vg_drive1', 'vg_drive2']
+            assert [(lv.path, entry.mount_point) for lv, entry in entries['vg_drive2']] == [
+                ('/dev/vg_drive2/renamed', '/srv/drive2'),
+            ]
+
+    def test_mount_scheduler(self):
+        """Test that nested filesystems wait for their parent and are skipped when it fails to mount."""
+        with TemporaryDirectory() as directory:
+            system = NestedMountSystem(4, os.path.join(directory, 'keys'), latencies={'mount': 0.1}, seed=1)
+            for name, mount_point in (('drive1', '/srv'), ('drive2', '/srv/data'),
+                                      ('drive3', '/other'), ('drive4', '/srv/data/deeper')):
+                system.drives[name].mount_point = mount_point
+            system.mappers.update(system.drives)
+            state = SystemState(context=SimulatedContext(system))
+
+            def run_scheduler():
+                mounts = [Mount('/dev/mapper/%s' % name, drive.mount_point, name)
+                          for name, drive in system.drives.items()]
+                handler = logging.handlers.BufferingHandler(100)
+                mounts_logger.addHandler(handler)
+                try:
+                    MountScheduler(mounts, concurrency=4, state=state).run()
+                finally:
+                    mounts_logger.removeHandler(handler)
+                errors = [r.getMessage() for r in handler.buffer if r.levelno >= logging.ERROR]
+                return dict((m.drive, m.status) for m in mounts), errors
+
+            # Every filesystem is mounted after the filesystem that it's mounted inside of.
+            statuses, errors = run_scheduler()
+            assert set(statuses.values()) == {MountStatus.MOUNTED}
+            assert system.parents_missing == []
+            assert errors == []
+            # When a parent fails to mount its children are skipped (independent mounts aren't affected).
+            system.mounts.clear()
+            system.mappers.discard('drive1')
+            statuses, errors = run_scheduler()
+            assert statuses == {
+                'drive1': MountStatus.FAILED,
+                'drive2': MountStatus.SKIPPED,
+                'drive3': MountStatus.MOUNTED,
+                'drive4': MountStatus.SKIPPED,
+            }
+            assert list(system.mounts.values()) == ['/other']
+            # The failures are summarized in a single message.
+            assert len(errors) == 1
+            assert "Failed to mount 3 filesystems" in errors[0]
+            assert "/srv/data (drive2): Not mounted because /srv wasn't mounted." in errors[0]
+            assert "/srv/data/deeper (drive4): Not mounted because /srv/data wasn't mounted." in errors[0]
+
+    def test_load_crypttab(self):
+        """Test the indexes of ``/etc/crypttab`` and the invalidation of cached indexes."""
+        with TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'crypttab')
+            with open(filename, 'w') as handle:
+                handle.write('\n'.join([
+                    'drive1 UUID=1234 /mnt/keys/drive1.key luks,noauto',
+                    'drive2 /dev/sdb /mnt/keys/sub/drive2.key luks',
+                    'swap /dev/sdc /dev/urandom swap,cipher=aes-xts-plain64',
+                ]) + '\n')
+            index = load_crypttab(filename, context=LocalContext())
+            assert [e.target for e in index.entries] == ['drive1', 'drive2', 'swap']
+            assert sorted(index.by_target) == ['drive1', 'drive2', 'swap']
+            assert index.by_source['/dev/disk/by-uuid/1234'].target == 'drive1'
+            assert index.by_source['/dev/sdb'].target == 'drive2'
+            # Entries are indexed under every directory that contains their key file.
+            assert [e.target for e in index.find_managed_drives('/mnt/keys/')] == ['drive1', 'drive2']
+            assert [e.target for e in index.find_managed_drives('/mnt')] == ['drive1', 'drive2']
+            assert [e.target for e in index.find_managed_drives('/mnt/keys/sub')] == ['drive2']
+            assert index.find_managed_drives('/dev') == []
+            assert index.find_managed_drives('/mnt/key') == []
+            # The index is cached until the file changes.
+            assert load_crypttab(filename, context=LocalContext()) is index
+            info = os.stat(filename)
+            os.utime(filename, (info.st_atime, info.st_mtime + 1))
+            changed = load_crypttab(filename, context=LocalContext())
+            assert changed is not index
+            assert load_crypttab(filename, context=LocalContext()) is changed
+            # A file that was replaced is parsed again (even with the same size and modification time).
+            info = os.stat(filename)
+            with open(filename + '.new', 'w') as handle:
+                with open(filename) as original:
+                    handle.write(original.read().replace('drive1', 'drive9'))
+            os.utime(filename + '.new', (info.st_atime, info.st_mtime))
+            os.rename(filename + '.new', filename)
+            replaced = load_crypttab(filename, context=LocalContext())
+            assert replaced is not changed
+            assert sorted(replaced.by_target) == ['drive2', 'drive9', 'swap']
+            # Other contexts aren't cached.
+            system = SimulatedSystem(2, os.path.join(directory, 'keys'))
+            context = SimulatedContext(system)
+            assert load_crypttab(context=context) is not load_crypttab(context=context)
+
+    def test_write_key_file(self):
+        """Test that key files are created with restrictive permissions and replaced atomically."""
+        with TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'drive1.key')
+            write_key_file(filename, b'old key')
+            assert stat.S_IMODE(os.stat(filename).st_mode) == 0o400
+            inode = os.stat(filename).st_ino
+            # The key file is replaced (by renaming a new file) instead of being overwritten.
+            write_key_file(filename, bytearray(b'new key'))
+            with open(filename, 'rb') as handle:
+                assert handle.read() == b'new key'
+            assert os.stat(filename).st_ino != inode
+            assert stat.S_IMODE(os.stat(filename).st_mode) == 0o400
+            assert os.listdir(directory) == ['drive1.key']
+            # A temporary file that already exists isn't reused (O_EXCL).
+            temporary_file = os.path.join(directory, '.drive1.key.%i.tmp' % os.getpid())
+            touch(temporary_file)
+            self.assertRaises(OSError, write_key_file, filename, b'other key')
+            with open(filename, 'rb') as handle:
+                assert handle.read() == b'new key'
+            os.unlink(temporary_file)
+            # When writing fails the old key file is left alone and the temporary file is removed.
+            self.assertRaises(TypeError, write_key_file, filename, object())
+            with open(filename, 'rb') as handle:
+                assert handle.read() == b'new key'
+            assert os.listdir(directory) == ['drive1.key']
+            # Generated key files contain random bytes.
+            generate_key_file(filename, 64)
+            generate_key_file(os.path.join(directory, 'drive2.key'), 64)
+            keys = []
+            for name in ('drive1.key', 'drive2.key'):
+                with open(os.path.join(directory, name), 'rb') as handle:
+                    keys.append(handle.read())
+            assert [len(k) for k in keys] == [64, 64]
+            assert keys[0] != keys[1]
+            assert stat.S_IMODE(os.stat(filename).st_mode) == 0o400
+
+    def test_inotify_event_source(self):
+        """Test that devices in a directory that doesn't exist yet are detected."""
+        with TemporaryDirectory() as directory:
+            device_directory = os.path.join(directory, 'dev', 'disk', 'by-uuid')
+            device_file = os.path.join(device_directory, '0123-4567')
+            events = InotifyEventSource([device_directory])
+            try:
+                assert events.wait(0) == []
+                os.makedirs(device_directory)
+                touch(device_file)
+                retry(lambda: device_file in events.wait(0.1))
+            finally:
+                events.close()
+            assert events.wait() is None
+
+
+class FileKeysDevice(KeysDevice):
+
+    """Virtual keys device whose unlocked device and recovery directory are regular files (for tests)."""
+
+    def __init__(self, directory):
+        """Initialize a :class:`FileKeysDevice` object for the files in `directory`."""
+        super(FileKeysDevice, self).__init__(
+            image_file=os.path.join(directory, 'keys.img'),
+            mapper_name='encryption-keys',
+            mount_point=os.path.join(directory, 'keys'),
+            state=SystemState(context=SimulatedContext(SimulatedSystem(0, os.path.join(directory, 'keys')))),
+        )
+        self.directory = directory
+
+    @property
+    def mapper_device(self):
+        """The regular file that takes the place of the unlocked device (a string)."""
+        return os.path.join(self.directory, 'device')
+
+    @property
+    def recovery_directory(self):
+        """The directory that takes the place of the recovery directory in ``/run`` (a string)."""
+        return os.path.join(self.directory, 'recovery')
+
+
+class InterruptedJournal(RotationJournal):
+
+    """Rotation journal that simulates an interruption right after a step was recorded (for tests)."""
+
+    def __init__(self, key_store, step):
+        """Initialize an :class:`InterruptedJournal` object that interrupts after `step`."""
+        super(InterruptedJournal, self).__init__(key_store)
+        self.step = step
+
+    def update(self, name, **fields):
+        """Update the journal entry and raise :exc:`~exceptions.KeyboardInterrupt` after :attr:`step`."""
+        entry = super(InterruptedJournal, self).update(name, **fields)
+        if entry['step'] == self.step:
+            raise KeyboardInterrupt()
+        return entry
+
+
+class NestedMountSystem(SimulatedSystem):
+
+    """Simulated system that records filesystems which were mounted before their parent."""
+
+    def __init__(self, *args, **kw):
+        """Initialize a :class:`NestedMountSystem` object."""
+        super(NestedMountSystem, self).__init__(*args, **kw)
+        self.parents_missing = []
+
+    def emulate_mount(self, device_file, mount_point=None):
+        """Check that the parent directory of the mount point is a mounted filesystem (if it's managed)."""
+        drive = self.drives.get(os.path.basename(device_file))
+        if drive:
+            managed = set(d.mount_point for d in self.drives.values())
+            parent = os.path.dirname(drive.mount_point)
+            if parent in managed and parent not in self.mounts.values():
+                self.parents_missing.append(drive.mount_point)
+        return super(NestedMountSystem, self).emulate_mount(device_file, mount_point)
+
+
+def read_key(store, name):
+    """Read a key from a :class:`.KeyStore` or :class:`.KeyDirectory` (a byte string)."""
+    with store.read(name) as key:
+        return bytes(key.data)
+
+
+def find_collision(num_records):
+    """Find two key names whose probe sequences start at the same position (a tuple of strings)."""
+    seen = {}
+    for i in range(1000):
+        name = 'collision%i' % i
+        position = zlib.crc32(encode_name(name)) % num_records
+        if position in seen:
+            return seen[position], name
+        seen[position] = name
+
+
+LUKS1_DUMP = """LUKS header information for /dev/sdb
+
+Version:       \t1
+Cipher name:   \taes
+Key Slot 0: ENABLED
+\tIterations:         \t1847042
+\tSalt:               \t0f 0e
+Key Slot 1: ENABLED
+\tIterations:         \t1000
+Key Slot 2: DISABLED
+"""
+"""Abbreviated output of ``cryptsetup luksDump`` for a LUKS1 volume (a string)."""
+
+LUKS2_DUMP = """LUKS header information
+Version:       \t2
+Epoch:         \t5
+
+Keyslots:
+  0: luks2
+\tKey:        512 bits
+\tPBKDF:      argon2id
+\tTime cost:  4
+\tMemory:     1048576
+  3: luks2
+\tPBKDF:      pbkdf2
+\tHash:       sha256
+\tIterations: 1000
+Tokens:
+Digests:
+  0: pbkdf2
+\tHash:       sha256
+\tIterations: 93802
+"""
+"""Abbreviated output of ``cryptsetup luksDump`` for a LUKS2 volume (a string)."""
+
+
+def create_fixtures():
+    """
+    Create the first bytes of devices with known signatures.
+
+    :returns: A dictionary with names of fixtures (strings) as keys and tuples
+              with the expected ``blkid`` type name (a string or :data:`None`
+              for a device without a signature) and a byte string of
+              :data:`.PROBE_SIZE` bytes as values.
+    """
+    fixtures = {}
+    # ext2/3/4 superblocks differ in their feature flags.
+    for fs_type, compat, incompat in (('ext2', 0, 0), ('ext3', 0x0004, 0), ('ext4', 0x0004, 0x0040)):
+        data = bytearray(PROBE_SIZE)
+        data[1024 + 0x38:1024 + 0x3A] = b'\x53\xef'
+        data[1024 + 0x5C:1024 + 0x68] = struct.pack('<III', compat, incompat, 0)
+        fixtures[fs_type] = (fs_type, bytes(data))
+    # XFS superblock at the start of the device.
+    data = bytearray(PROBE_SIZE)
+    data[0:4] = b'XFSB'
+    fixtures['xfs'] = ('xfs', bytes(data))
+    # btrfs superblock at 64 KiB (with the magic number at offset 0x40).
+    data = bytearray(PROBE_SIZE)
+    data[0x10040:0x10048] = b'_BHRfS_M'
+    fixtures['btrfs'] = ('btrfs', bytes(data))
+    # LUKS headers are followed by the (big endian) version number.
+    for version in (1, 2):
+        data = bytearray(PROBE_SIZE)
+        data[0:8] = b'LUKS\xba\xbe' + struct.pack('>H', version)
+        fixtures['luks%i' % version] = ('crypto_LUKS', bytes(data))
+    # Swap space signature at the end of the first (4 KiB) page.
+    data = bytearray(PROBE_SIZE)
+    data[4096 - 10:4096] = b'SWAPSPACE2'
+    fixtures['swap'] = ('swap', bytes(data))
+    # LVM2 physical volume label in the second sector.
+    data = bytearray(PROBE_SIZE)
+    data[512:520] = b'LABELONE'
+    data[512 + 24:512 + 32] = b'LVM2 001'
+    fixtures['lvm2'] = ('LVM2_member', bytes(data))
+    # No signature at all.
+    fixtures['empty'] = (None, bytes(bytearray(PROBE_SIZE)))
+    return fixtures
@@ -0,0 +1,255 @@
+# Timing instrumentation for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Timing instrumentation for external commands and the phases of an unlock run.
+
+When a :class:`Timings` object is passed to :class:`.SystemState` every
+external command run by `crypto-drive-manager` is timed (by wrapping the
+execution context in an :class:`InstrumentedContext`) and the phases of
+:func:`.initialize_keys_device()` and :func:`.activate_encrypted_drive()`
+are timed as well. Each measurement results in a :class:`TimingRecord`
+that is passed to the registered hooks and can be summarized using
+:func:`Timings.render_report()`.
+"""
+
+# Standard library modules.
+import collections
+import json
+import threading
+import time
+
+# External dependencies.
+from executor import ExternalCommandFailed, quote
+from executor.contexts import AbstractContext
+from humanfriendly import format_timespan
+from humanfriendly.tables import format_pretty_table
+
+TimingRecord = collections.namedtuple('TimingRecord', 'kind, name, drive, duration, status')
+"""
+A single measurement made by :class:`Timings`.
+
+The fields of the named tuple are:
+
+- ``kind``: Either ``'phase'`` or ``'command'`` (a string).
+- ``name``: The name of the phase or the command line (a string).
+- ``drive``: The mapper name of the drive or :data:`None` (a string).
+- ``duration``: The elapsed time in seconds (a float).
+- ``status``: For commands the exit status (an integer or :data:`None` when
+  the command couldn't be started), for phases ``'ok'`` or ``'failed'``.
+"""
+
+
+class Timings(object):
+
+    """Collector of :class:`TimingRecord` objects (thread safe)."""
+
+    def __init__(self, hooks=()):
+        """
+        Initialize a :class:`Timings` object.
+
+        :param hooks: An iterable of callables that will be called with
+                      every :class:`TimingRecord` as it is recorded.
+        """
+        self.hooks = list(hooks)
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def current_drive(self):
+        """The mapper name of the drive that the current thread is working on (a string or :data:`None`)."""
+        for name, drive in reversed(getattr(self.local, 'stack', [])):
+            if drive:
+                return drive
+
+    def add_hook(self, callback):
+        """
+        Register a callback to be called for every :class:`TimingRecord`.
+
+        :param callback: A callable that accepts a single :class:`TimingRecord`.
+        """
+        self.hooks.append(callback)
+
+    def record(self, kind, name, drive, duration, status):
+        """Create a :class:`TimingRecord`, store it and pass it to the hooks."""
+        record = TimingRecord(kind, name, drive, duration, status)
+        with self.lock:
+            self.records.append(record)
+        for callback in self.hooks:
+            callback(record)
+        return record
+
+    def phase(self, name, drive=None):
+        """
+        Time a phase of an unlock run.
+
+        :param name: The name of the phase (a string).
+        :param drive: The mapper name of the drive (a string or :data:`None`).
+                      Nested phases inherit the drive of the enclosing phase.
+        :returns: A context manager.
+        """
+        return TimedPhase(self, name, drive or self.current_drive)
+
+    def summarize(self, kind='phase', key=None):
+        """
+        Summarize records by name.
+
+        :param kind: The kind of records to summarize (a string).
+        :param key: A callable that maps a :class:`TimingRecord` to a key
+                    (defaults to the name of the record).
+        :returns: An ordered dictionary with keys as computed by `key` and
+                  lists with the number of records and the total duration
+                  as values.
+        """
+        summary = collections.OrderedDict()
+        with self.lock:
+            records = [r for r in self.records if r.kind == kind]
+        for record in records:
+            totals = summary.setdefault(key(record) if key else record.name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += record.duration
+        return summary
+
+    def render_report(self):
+        """
+        Render a human friendly report with a per-phase and per-drive breakdown.
+
+        :returns: The report (a string).
+        """
+        sections = []
+        # Summarize the phases and the external commands (grouped by program name).
+        for title, summary in (("Phase", self.summarize('phase')),
+                               ("Program", self.summarize('command', key=lambda r: r.name.split()[0]))):
+            if summary:
+                rows = [[key, count, format_timespan(total)] for key, (count, total) in summary.items()]
+                sections.append(format_pretty_table(rows, [title, "Count", "Total time"]))
+        # Break down the time spent per drive and per phase.
+        drives = collections.OrderedDict()
+        phases = []
+        with self.lock:
+            for record in self.records:
+                if record.kind == 'phase' and record.drive:
+                    drives.setdefault(record.drive, {})[record.name] = record.duration
+                    if record.name not in phases:
+                        phases.append(record.name)
+        if drives:
+            rows = [[drive] + [format_timespan(durations[p]) if p in durations else '-' for p in phases]
+                    for drive, durations in drives.items()]
+            sections.append(format_pretty_table(rows, ["Drive"] + phases))
+        return '\n\n'.join(sections)
+
+    def render_json(self):
+        """
+        Render the records as JSON.
+
+        :returns: A JSON document (a string).
+        """
+        with self.lock:
+            records = [r._asdict() for r in self.records]
+        return json.dumps(dict(records=records), indent=2)
+
+
+class TimedPhase(object):
+
+    """Context manager used by :func:`Timings.phase()`."""
+
+    def __init__(self, timings, name, drive):
+        """Initialize a :class:`TimedPhase` object."""
+        self.timings = timings
+        self.name = name
+        self.drive = drive
+
+    def __enter__(self):
+        """Start timing the phase."""
+        stack = self.timings.local.__dict__.setdefault('stack', [])
+        stack.append((self.name, self.drive))
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Stop timing the phase and record the result."""
+        duration = time.time() - self.start_time
+        self.timings.local.stack.pop()
+        self.timings.record('phase', self.name, self.drive, duration, 'failed' if exc_type else 'ok')
+
+
+class NullPhase(object):
+
+    """Context manager that does nothing (used when timings aren't being recorded)."""
+
+    def __enter__(self):
+        """Don't start timing anything."""
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Don't record anything."""
+
+
+class InstrumentedContext(AbstractContext):
+
+    """Execution context that times the external commands run by another execution context."""
+
+    def __init__(self, context, timings):
+        """
+        Initialize an :class:`InstrumentedContext` object.
+
+        :param context: The execution context to wrap.
+        :param timings: The :class:`Timings` object used to record timings.
+        """
+        super(InstrumentedContext, self).__init__()
+        self.context = context
+        self.timings = timings
+
+    @property
+    def command_type(self):
+        """The type of command objects created by the wrapped context."""
+        return self.context.command_type
+
+    @property
+    def cpu_count(self):
+        """The number of CPUs in the system according to the wrapped context."""
+        return self.context.cpu_count
+
+    def capture(self, *command, **options):
+        """Execute and time an external command and capture its output."""
+        options['capture'] = True
+        return self.execute(*command, **options).output
+
+    def execute(self, *command, **options):
+        """
+        Execute and time an external command using the wrapped context.
+
+        :param command: The positional arguments for the wrapped context.
+        :param options: The keyword arguments for the wrapped context.
+        :returns: The command object returned by the wrapped context.
+        """
+        command_line = ' '.join(quote(a) for a in command)
+        drive = self.timings.current_drive
+        status = None
+        start_time = time.time()
+        try:
+            cmd = self.context.execute(*command, **options)
+            status = cmd.returncode
+            return cmd
+        except ExternalCommandFailed as e:
+            status = e.returncode
+            raise
+        finally:
+            self.timings.record('command', command_line, drive, time.time() - start_time, status)
+
+    def glob(self, pattern):
+        """Find matches for a filename pattern using the wrapped context."""
+        return self.context.glob(pattern)
+
+    def test(self, *command, **options):
+        """Execute and time an external command and get its status."""
+        options.update(check=False, silent=True)
+        return self.execute(*command, **options).succeeded
+
+    def __str__(self):
+        """Render a human friendly string representation of the wrapped context."""
+        return str(self.context)
@@ -0,0 +1,419 @@
+# Verification of the keys of managed drives.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Verification of the keys of managed drives against their LUKS headers.
+
+A key file that no longer unlocks its drive (because a key slot was removed
+or the key file was damaged) normally goes unnoticed until the next reboot.
+:func:`verify_key()` checks a key using ``cryptsetup open --test-passphrase``,
+which runs the key derivation function of the key slot but doesn't activate
+the drive. Because key derivation is deliberately expensive (Argon2 key
+slots can use a gigabyte of memory and several CPUs) concurrent checks are
+admitted by a :class:`ResourceBudget` and the outcome is remembered by a
+:class:`VerificationCache`: As long as neither the LUKS header nor the key
+changes there's no need to check the key again.
+"""
+
+# Standard library modules.
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+# External dependencies.
+from executor import ExternalCommandFailed
+from humanfriendly import Timer, format_timespan
+from humanfriendly.tables import format_pretty_table
+from linux_utils import coerce_context
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from crypto_drive_manager.keyslots import KeySlotError, parse_key_slots, test_key_file
+
+DEFAULT_CACHE_FILE = '/var/cache/crypto-drive-manager/verification.json'
+"""The pathname of the file used by :class:`VerificationCache` (a string)."""
+
+DEFAULT_LUKS2_HEADER_SIZE = 16 * 1024 * 1024
+"""The size of a LUKS2 header in bytes when ``cryptsetup luksDump`` doesn't report it (an integer)."""
+
+DEFAULT_MEMORY_FRACTION = 0.5
+"""The fraction of the available memory used by :func:`default_memory_budget()` (a float)."""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def verify_key(physical_device, name, key_store, key_slot=None, cache=None, budget=None, context=None):
+    """
+    Check that the key of a drive unlocks the drive (without activating it).
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param name: The device mapper name of the drive (a string).
+    :param key_store: A :class:`.KeyDirectory` or :class:`.KeyStore` object.
+    :param key_slot: The key slot that the key is expected to unlock (an
+                     integer or :data:`None` when any key slot will do).
+    :param cache: A :class:`VerificationCache` object (optional).
+    :param budget: A :class:`ResourceBudget` object (optional).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: A :class:`VerificationResult` object.
+
+    A cached result is only used when it concerns the expected key slot.
+    When no key slot is expected but the key unlocked a known key slot last
+    time, that key slot is tested first (only when it doesn't unlock are
+    the other key slots tested).
+    """
+    context = coerce_context(context)
+    budget = budget or ResourceBudget(context.cpu_count)
+    timer = Timer()
+    dump = context.capture('cryptsetup', 'luksDump', physical_device)
+    version, key_slots = parse_key_slots(dump)
+    header = read_header(physical_device, dump, context)
+    with key_store.read(name) as key:
+        fingerprint = compute_fingerprint(header, key.data)
+    if cache is not None:
+        cached_slot = cache.get(name, fingerprint)
+        if cached_slot is not None and key_slot in (None, cached_slot):
+            logger.verbose("Skipping %s because its LUKS header and key didn't change.", name)
+            return VerificationResult('passed', cached_slot, timer.elapsed_time, True, None)
+    if key_slot is not None:
+        candidates = [key_slot]
+    else:
+        hint = cache.last_slot(name) if cache is not None else None
+        candidates = [hint, None] if hint in key_slots else [None]
+    threads, memory = estimate_cost(key_slots, None if None in candidates else key_slot)
+    error = None
+    with budget.reserve(threads, memory):
+        with key_store.key_file(name) as key_file:
+            for candidate in candidates:
+                try:
+                    unlocked_slot, _ = test_key_file(physical_device, key_file, key_slot=candidate, context=context)
+                    break
+                except (ExternalCommandFailed, KeySlotError):
+                    error = ("Key doesn't unlock key slot %i!" % candidate if candidate is not None
+                             else "Key doesn't unlock any key slot!")
+            else:
+                unlocked_slot = None
+    if unlocked_slot is None:
+        if cache is not None:
+            cache.discard(name)
+        return VerificationResult('failed', key_slot, timer.elapsed_time, False, error)
+    if cache is not None:
+        cache.set(name, fingerprint, unlocked_slot)
+    return VerificationResult('passed', unlocked_slot, timer.elapsed_time, False, None)
+
+
+def read_header(physical_device, dump, context):
+    """
+    Read the raw LUKS header of a drive.
+
+    :param physical_device: The pathname of the LUKS volume (a string).
+    :param dump: The output of ``cryptsetup luksDump`` (a string).
+    :param context: See :func:`~linux_utils.coerce_context()`.
+    :returns: The contents of the header (a byte string).
+
+    The header is read using dd_ so that remote contexts work as well. Refer
+    to :func:`find_header_size()` for which part of the volume is read.
+
+    .. _dd: https://manpages.debian.org/dd
+    """
+    return context.execute(
+        'dd', 'if=%s' % physical_device, 'bs=512',
+        'count=%i' % (find_header_size(dump) // 512),
+        'status=none', capture=True,
+    ).stdout
+
+
+def find_header_size(dump):
+    """
+    Find the size of a LUKS header.
+
+    :param dump: The output of ``cryptsetup luksDump`` (a string).
+    :returns: The size in bytes (an integer).
+
+    For LUKS1 volumes the header runs up to the payload offset (which includes
+    the key material of all key slots). For LUKS2 volumes the header consists
+    of two copies of the JSON metadata followed by the key slots area. Older
+    versions of ``cryptsetup`` don't report the size of these areas, in that
+    case :data:`DEFAULT_LUKS2_HEADER_SIZE` is used.
+    """
+    fields = {}
+    for line in dump.splitlines():
+        name, delimiter, value = line.partition(':')
+        tokens = value.split()
+        if delimiter and tokens and tokens[0].isdigit():
+            fields.setdefault(name.strip(), int(tokens[0]))
+    if 'Payload offset' in fields:
+        return fields['Payload offset'] * 512
+    if 'Metadata area' in fields and 'Keyslots area' in fields:
+        return fields['Metadata area'] * 2 + fields['Keyslots area']
+    return DEFAULT_LUKS2_HEADER_SIZE
+
+
+def compute_fingerprint(header, key):
+    """
+    Compute the fingerprint of a LUKS header and a key.
+
+    :param header: The raw LUKS header (a byte string, see :func:`read_header()`).
+    :param key: The key (a byte string or :class:`bytearray`).
+    :returns: A hexadecimal SHA-256 digest (a string).
+
+    The fingerprint changes when a key slot is added, removed or changed
+    (even when the output of ``cryptsetup luksDump`` stays the same, because
+    the key material is part of the header) and when the key changes. Only
+    the digest is stored, which doesn't reveal the key.
+    """
+    context = hashlib.sha256(hashlib.sha256(header).digest())
+    context.update(bytes(key))
+    return context.hexdigest()
+
+
+def estimate_cost(key_slots, key_slot=None):
+    """
+    Estimate the resources used by ``cryptsetup open --test-passphrase``.
+
+    :param key_slots: The key slots (as returned by :func:`.parse_key_slots()`).
+    :param key_slot: The number of the key slot that will be tested (an
+                     integer or :data:`None` when all key slots are tried).
+    :returns: A tuple with the number of CPUs (an integer) and the amount
+              of memory in bytes (an integer) used by the key derivation.
+
+    Key slots are tried one at a time, so the most expensive key slot decides.
+    PBKDF2 key slots use a single CPU and a negligible amount of memory.
+    """
+    if key_slot in key_slots:
+        candidates = [key_slots[key_slot]]
+    else:
+        candidates = list(key_slots.values())
+    threads, memory = 1, 0
+    for properties in candidates:
+        try:
+            threads = max(threads, int(properties.get('Threads', 1)))
+            memory = max(memory, int(properties.get('Memory', 0)) * 1024)
+        except ValueError:
+            pass
+    return threads, memory
+
+
+def default_memory_budget():
+    """
+    Get the default memory budget (a fraction of the available memory).
+
+    :returns: The number of bytes (an integer) or :data:`None` when the
+              amount of available memory is unknown.
+    """
+    try:
+        with open('/proc/meminfo') as handle:
+            for line in handle:
+                tokens = line.split()
+                if tokens[0] == 'MemAvailable:':
+                    return int(int(tokens[1]) * 1024 * DEFAULT_MEMORY_FRACTION)
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def render_verification_report(results):
+    """
+    Render a table with the results of :func:`verify_key()`.
+
+    :param results: An :class:`.ActivationResults` object whose values are
+                    :class:`VerificationResult` objects (unexpected errors
+                    are taken from :attr:`.ActivationResults.failures`).
+    :returns: The rendered report (a string).
+    """
+    rows = []
+    for name, r in sorted(iter_results(results)):
+        rows.append([
+            name, r.status.upper(), '-' if r.key_slot is None else r.key_slot,
+            format_timespan(r.duration), "yes" if r.cached else "no", r.error or '',
+        ])
+    lines = [format_pretty_table(rows, ["Drive", "Result", "Key slot", "Duration", "Cached", "Error"])]
+    counts = collections.Counter(r.status for name, r in iter_results(results))
+    lines.append("%i passed, %i failed, %i missing (%i skipped because they didn't change)." % (
+        counts['passed'], counts['failed'], counts['missing'],
+        sum(1 for name, r in iter_results(results) if r.cached),
+    ))
+    return '\n'.join(lines)
+
+
+def render_verification_json(results):
+    """
+    Render the results of :func:`verify_key()` as JSON.
+
+    :param results: See :func:`render_verification_report()`.
+    :returns: A JSON document (a string).
+    """
+    return json.dumps(dict(drives=[
+        dict(name=name, **r._asdict()) for name, r in sorted(iter_results(results))
+    ]), indent=2)
+
+
+def iter_results(results):
+    """
+    Iterate over the results and unexpected errors of a verification.
+
+    :param results: See :func:`render_verification_report()`.
+    :returns: A generator of tuples with device mapper names and :class:`VerificationResult` objects.
+    """
+    for name, result in results.items():
+        yield name, result
+    for name, e in results.failures.items():
+        yield name, VerificationResult('failed', None, 0, False, str(e))
+
+
+class ResourceBudget(object):
+
+    """
+    Limit the CPUs and memory used by concurrent key derivations.
+
+    A check that doesn't fit in the budget waits until enough checks have
+    finished. A check is always admitted when no other checks are running,
+    even when it exceeds the budget on its own.
+    """
+
+    def __init__(self, cpus, memory=None):
+        """
+        Initialize a :class:`ResourceBudget` object.
+
+        :param cpus: The number of CPUs (an integer).
+        :param memory: The amount of memory in bytes (an integer or
+                       :data:`None` for no limit).
+        """
+        self.cpus = cpus
+        self.memory = memory
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.condition = threading.Condition()
+
+    def fits(self, cpus, memory):
+        """
+        Check if a reservation fits in the remaining budget.
+
+        :param cpus: The number of CPUs (an integer).
+        :param memory: The amount of memory in bytes (an integer).
+        :returns: :data:`True` if it fits, :data:`False` otherwise.
+        """
+        return (self.used_cpus + cpus <= self.cpus and
+                (self.memory is None or self.used_memory + memory <= self.memory))
+
+    @contextlib.contextmanager
+    def reserve(self, cpus, memory):
+        """
+        Reserve part of the budget (waiting until it's available).
+
+        :param cpus: The number of CPUs (an integer).
+        :param memory: The amount of memory in bytes (an integer).
+        :returns: A context manager that releases the reservation.
+        """
+        cpus = min(cpus, self.cpus)
+        with self.condition:
+            while self.used_cpus and not self.fits(cpus, memory):
+                self.condition.wait()
+            self.used_cpus += cpus
+            self.used_memory += memory
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used_cpus -= cpus
+                self.used_memory -= memory
+                self.condition.notify_all()
+
+
+class VerificationCache(object):
+
+    """
+    Remember which keys were verified (by the fingerprint of the LUKS header and the key).
+
+    The cache file contains a JSON object with device mapper names as keys
+    and objects with the fields ``fingerprint`` (see :func:`compute_fingerprint()`),
+    ``key_slot`` and ``verified`` (a UNIX timestamp) as values. Only keys that
+    passed verification are cached.
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_FILE):
+        """
+        Initialize a :class:`VerificationCache` object (loading the cache file).
+
+        :param filename: The pathname of the cache file (a string).
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename) as handle:
+                self.entries = json.load(handle)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, name, fingerprint):
+        """
+        Check if the key of a drive was verified with the same fingerprint.
+
+        :param name: The device mapper name of the drive (a string).
+        :param fingerprint: The current fingerprint (a string).
+        :returns: The key slot unlocked by the key (an integer) or :data:`None`.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+        return entry['key_slot'] if entry and entry.get('fingerprint') == fingerprint else None
+
+    def last_slot(self, name):
+        """
+        Get the key slot that the key of a drive unlocked when it was last verified.
+
+        :param name: The device mapper name of the drive (a string).
+        :returns: The key slot (an integer) or :data:`None`.
+        """
+        with self.lock:
+            return self.entries.get(name, {}).get('key_slot')
+
+    def set(self, name, fingerprint, key_slot):
+        """
+        Remember that the key of a drive was verified.
+
+        :param name: The device mapper name of the drive (a string).
+        :param fingerprint: The fingerprint (a string).
+        :param key_slot: The key slot unlocked by the key (an integer).
+        """
+        with self.lock:
+            self.entries[name] = dict(fingerprint=fingerprint, key_slot=key_slot, verified=time.time())
+
+    def discard(self, name):
+        """
+        Forget about the key of a drive.
+
+        :param name: The device mapper name of the drive (a string).
+        """
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def save(self):
+        """Atomically replace the cache file."""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        temporary_file = '%s.%i.tmp' % (self.filename, os.getpid())
+        with self.lock:
+            with open(temporary_file, 'w') as handle:
+                json.dump(self.entries, handle, indent=2, sort_keys=True)
+        os.rename(temporary_file, self.filename)
+
+
+class VerificationResult(collections.namedtuple('VerificationResult', 'status, key_slot, duration, cached, error')):
+
+    """
+    The result of :func:`verify_key()`.
+
+    The fields of the named tuple are the status (``passed``, ``failed`` or
+    ``missing``), the key slot unlocked by the key (an integer or
+    :data:`None`), the time spent (a float, in seconds), whether the result
+    was taken from the :class:`VerificationCache` (a boolean) and an error
+    message (a string or :data:`None`).
+    """
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Benchmark suite for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Usage: benchmark.py [OPTIONS]
+
+Measure how an unlock run of crypto-drive-manager scales with the number of
+managed drives. The runs use a simulated system (see the module
+crypto_drive_manager.simulation), so no LUKS hardware or root privileges
+are required. Each run happens in a separate process so that the reported
+peak memory usage (RSS) is specific to that run.
+
+Supported options:
+
+  -d, --drives=LIST
+
+    Comma separated list with the numbers of managed drives to benchmark
+    (defaults to '1,10,100,1000').
+
+  -j, --jobs=N
+
+    Activate up to N drives in parallel (defaults to 1).
+
+  -p, --pipeline
+
+    Read all keys before unlocking the drives (see the --pipeline option
+    of crypto-drive-manager).
+
+  -l, --latency=SECONDS
+
+    Simulate the given latency for every external command (defaults to 0).
+
+  -f, --failure-rate=FLOAT
+
+    Simulate failing external commands (a probability between 0 and 1,
+    defaults to 0).
+
+  -h, --help
+
+    Show this message and exit.
+"""
+
+# Standard library modules.
+import getopt
+import multiprocessing
+import resource
+import sys
+
+try:
+    # Python 3.
+    from queue import Empty
+except ImportError:
+    # Python 2.
+    from Queue import Empty
+
+# External dependencies.
+import coloredlogs
+from humanfriendly import format_size, format_timespan
+from humanfriendly.tables import format_pretty_table
+from humanfriendly.terminal import usage, warning
+
+# Modules included in our package.
+from crypto_drive_manager.simulation import SIMULATED_PROGRAMS, run_simulation
+
+POLL_INTERVAL = 1
+"""The number of seconds between checks whether the child process is still alive (a number)."""
+
+
+def main():
+    """Command line interface for the benchmark suite."""
+    coloredlogs.install(level='error')
+    drive_counts = [1, 10, 100, 1000]
+    concurrency = 1
+    pipeline = False
+    latency = 0
+    failure_rate = 0
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'd:j:pl:f:h', [
+            'drives=', 'jobs=', 'pipeline', 'latency=', 'failure-rate=', 'help',
+        ])
+        for option, value in options:
+            if option in ('-d', '--drives'):
+                drive_counts = [int(n) for n in value.split(',')]
+            elif option in ('-j', '--jobs'):
+                concurrency = int(value)
+            elif option in ('-p', '--pipeline'):
+                pipeline = True
+            elif option in ('-l', '--latency'):
+                latency = float(value)
+            elif option in ('-f', '--failure-rate'):
+                failure_rate = float(value)
+            elif option in ('-h', '--help'):
+                usage(__doc__)
+                return
+    except Exception as e:
+        warning("Error: Failed to parse command line arguments! (%s)", e)
+        sys.exit(1)
+    rows = []
+    for num_drives in drive_counts:
+        stats = run_isolated(
+            num_drives=num_drives,
+            concurrency=concurrency,
+            pipeline=pipeline,
+            latencies=dict((p, latency) for p in SIMULATED_PROGRAMS),
+            failure_rates=dict((p, failure_rate) for p in SIMULATED_PROGRAMS),
+            seed=num_drives,
+        )
+        if 'peak_rss' not in stats:
+            warning("Benchmark with %i drives crashed! (%s)", num_drives, stats['error'])
+            rows.append([num_drives, '-', '-', '-', '-', stats['error']])
+            continue
+        rows.append([
+            stats['drives'],
+            format_timespan(stats['wall_time']),
+            stats['num_commands'],
+            stats['failures'],
+            format_size(stats['peak_rss'], binary=True),
+            stats['error'] or '-',
+        ])
+    print(format_pretty_table(rows, ['Drives', 'Wall time', 'Subprocesses', 'Failures', 'Peak RSS', 'Error']))
+
+
+def run_isolated(**options):
+    """
+    Run :func:`.run_simulation()` in a child process and report its peak RSS.
+
+    :param options: The keyword arguments for :func:`.run_simulation()`.
+    :returns: The result of :func:`.run_simulation()` (a dictionary) with the
+              additional key ``peak_rss``. When the child process doesn't
+              report a result (because it crashed) a dictionary with only
+              the keys ``drives`` and ``error`` is returned.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=child, args=(queue,), kwargs=options)
+    process.start()
+    try:
+        while True:
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if not process.is_alive():
+                    # The child may have put its result on the queue right before exiting.
+                    try:
+                        return queue.get(timeout=POLL_INTERVAL)
+                    except Empty:
+                        return dict(drives=options.get('num_drives'),
+                                    error="Child process exited with code %s" % process.exitcode)
+    finally:
+        process.join()
+
+
+def child(queue, **options):
+    """Run :func:`.run_simulation()` and send the results (or the error) to the parent process."""
+    try:
+        stats = run_simulation(**options)
+        # On Linux ru_maxrss is expressed in kilobytes.
+        stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except BaseException as e:
+        stats = dict(drives=options.get('num_drives'), error="%s: %s" % (type(e).__name__, e))
+    queue.put(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Benchmark for the systemd generator workaround of crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Usage: generator.py [OPTIONS]
+
+Measure how the rewriting of generated systemd-cryptsetup@*.service files
+(the workaround for systemd issue #3816) scales with the number of units.
+Each run uses a fixture directory with freshly generated unit files and
+compares the following strategies:
+
+  legacy      The original implementation (read each file into a list and
+              rewrite it in place).
+  serial      rewrite_service_files() processing one file at a time.
+  concurrent  rewrite_service_files() processing files concurrently.
+  unchanged   rewrite_service_files() on files that don't need changes.
+
+Supported options:
+
+  -u, --units=LIST
+
+    Comma separated list with the numbers of units to benchmark (defaults
+    to '100,1000,5000').
+
+  -r, --ratio=FLOAT
+
+    The fraction of units that contain a RequiresMountsFor directive
+    (defaults to 1, i.e. all units need to be rewritten).
+
+  -d, --directory=PATH
+
+    Create the fixture directories in PATH (defaults to /dev/shm because
+    systemd generators write to /run, which is also a tmpfs).
+
+  -j, --jobs=N
+
+    The concurrency of the 'concurrent' strategy (defaults to 8).
+
+  -h, --help
+
+    Show this message and exit.
+"""
+
+# Standard library modules.
+import getopt
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+# External dependencies.
+import coloredlogs
+from humanfriendly import Timer
+from humanfriendly.tables import format_pretty_table
+from humanfriendly.terminal import usage, warning
+
+# Modules included in our package.
+from crypto_drive_manager.systemd import DEFAULT_CONCURRENCY, rewrite_service_files
+
+UNIT_TEMPLATE = """\
+# Automatically generated by systemd-cryptsetup-generator
+
+[Unit]
+Description=Cryptography Setup for %%I
+Documentation=man:crypttab(5) man:systemd-cryptsetup-generator(8) man:systemd-cryptsetup@.service(8)
+SourcePath=/etc/crypttab
+DefaultDependencies=no
+Conflicts=umount.target
+IgnoreOnIsolate=true
+After=cryptsetup-pre.target
+Before=cryptsetup.target
+%(requirement)sBindsTo=dev-disk-by\\x2duuid-%(uuid)s.device
+After=dev-disk-by\\x2duuid-%(uuid)s.device
+Before=umount.target
+
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+TimeoutSec=0
+KeyringMode=shared
+ExecStart=/lib/systemd/systemd-cryptsetup attach '%(name)s' '/dev/disk/by-uuid/%(uuid)s' '%(key_file)s' 'luks'
+ExecStop=/lib/systemd/systemd-cryptsetup detach '%(name)s'
+"""
+
+
+def main():
+    """Command line interface for the generator benchmark."""
+    coloredlogs.install(level='warning')
+    unit_counts = [100, 1000, 5000]
+    ratio = 1.0
+    concurrency = DEFAULT_CONCURRENCY
+    parent_directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'u:r:d:j:h', [
+            'units=', 'ratio=', 'directory=', 'jobs=', 'help',
+        ])
+        for option, value in options:
+            if option in ('-u', '--units'):
+                unit_counts = [int(n) for n in value.split(',')]
+            elif option in ('-r', '--ratio'):
+                ratio = float(value)
+            elif option in ('-d', '--directory'):
+                parent_directory = value
+            elif option in ('-j', '--jobs'):
+                concurrency = int(value)
+            elif option in ('-h', '--help'):
+                usage(__doc__)
+                return
+    except Exception as e:
+        warning("Error: Failed to parse command line arguments! (%s)", e)
+        sys.exit(1)
+    rows = []
+    for count in unit_counts:
+        directory = tempfile.mkdtemp(prefix='crypto-drive-manager-generator-', dir=parent_directory)
+        try:
+            row = [count]
+            for strategy in ('legacy', 'serial', 'concurrent', 'unchanged'):
+                if strategy != 'unchanged':
+                    create_fixture(directory, count, ratio)
+                filenames = glob.glob(os.path.join(directory, 'systemd-cryptsetup@*.service'))
+                timer = Timer()
+                if strategy == 'legacy':
+                    legacy_rewrite(filenames)
+                else:
+                    rewrite_service_files(filenames, concurrency=(concurrency if strategy == 'concurrent' else 1))
+                row.append(str(timer))
+            rows.append(row)
+        finally:
+            shutil.rmtree(directory)
+    print(format_pretty_table(rows, ["Units", "Legacy", "Serial", "Concurrent", "Unchanged"]))
+
+
+def create_fixture(directory, count, ratio):
+    """
+    Generate unit files like the ones created by ``systemd-cryptsetup-generator``.
+
+    :param directory: The pathname of the fixture directory (a string).
+    :param count: The number of unit files to generate (an integer).
+    :param ratio: The fraction of units that get a ``RequiresMountsFor``
+                  directive (a float between 0 and 1).
+    """
+    for i in range(count):
+        name = 'drive-%i' % i
+        key_file = '/mnt/keys/%s' % name
+        filename = os.path.join(directory, 'systemd-cryptsetup@%s.service' % name)
+        with open(filename, 'w') as handle:
+            handle.write(UNIT_TEMPLATE % dict(
+                name=name,
+                key_file=key_file,
+                uuid='00000000-0000-0000-0000-%012i' % i,
+                requirement=('RequiresMountsFor=%s\n' % key_file if i < count * ratio else ''),
+            ))
+
+
+def legacy_rewrite(filenames):
+    """
+    Rewrite unit files using the original implementation.
+
+    :param filenames: A list of pathnames of unit files (strings).
+    """
+    for service_file in filenames:
+        with open(service_file) as handle:
+            contents = list(handle)
+        modified = [line for line in contents if line.partition('=')[0].strip() != 'RequiresMountsFor']
+        if modified != contents:
+            with open(service_file, 'w') as handle:
+                for line in modified:
+                    handle.write(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Startup benchmark for crypto-drive-manager.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-crypto-drive-manager
+
+"""
+Usage: importtime.py [OPTIONS]
+
+Measure the cold start of each entry path of crypto-drive-manager using
+'python -X importtime' (which requires Python 3.7 or newer). Each entry path
+is started in a new interpreter a number of times and the fastest run is
+reported. The entry paths are:
+
+  import     Just importing the command line interface.
+  help       Running 'crypto-drive-manager --help'.
+  generator  Running as the systemd-cryptsetup-generator wrapper (the wrapped
+             program is replaced by 'true' and no service files are touched).
+  unlock     An unlock run of a single drive on a simulated system (this
+             includes the import time of the simulated backend).
+
+Supported options:
+
+  -n, --runs=N
+
+    Start each entry path N times (defaults to 5).
+
+  -s, --save=FILE
+
+    Save the results to FILE (in JSON format) to use as a baseline.
+
+  -c, --compare=FILE
+
+    Compare the results to the baseline saved in FILE and exit with a nonzero
+    status when the import time of an entry path regressed by more than the
+    tolerance.
+
+  -t, --tolerance=PERCENT
+
+    The regression that is tolerated by --compare (defaults to 25%).
+
+  -h, --help
+
+    Show this message and exit.
+"""
+
+# Standard library modules.
+import getopt
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# External dependencies.
+from humanfriendly import format_timespan
+from humanfriendly.tables import format_pretty_table
+from humanfriendly.terminal import usage, warning
+
+ENTRY_PATHS = (
+    ('import', "import crypto_drive_manager.cli"),
+    ('help', "\n".join([
+        "import sys",
+        "sys.argv = ['crypto-drive-manager', '--help']",
+        "from crypto_drive_manager.cli import main",
+        "main()",
+    ])),
+    ('generator', "\n".join([
+        "import sys",
+        "import crypto_drive_manager.systemd as systemd",
+        "systemd.CRYPTSETUP_GENERATOR_WRAPPED = 'true'",
+        "systemd.CRYPTSETUP_SERVICES = '/nonexistent/*.service'",
+        "sys.argv = [systemd.CRYPTSETUP_GENERATOR]",
+        "from crypto_drive_manager.cli import main",
+        "main()",
+    ])),
+    ('unlock', "\n".join([
+        "from crypto_drive_manager.simulation import run_simulation",
+        "run_simulation(1)",
+    ])),
+)
+"""The names of the entry paths and the Python code that runs them (a tuple of tuples)."""
+
+
+def main():
+    """Command line interface for the startup benchmark."""
+    runs = 5
+    save_file = None
+    compare_file = None
+    tolerance = 25.0
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'n:s:c:t:h', [
+            'runs=', 'save=', 'compare=', 'tolerance=', 'help',
+        ])
+        for option, value in options:
+            if option in ('-n', '--runs'):
+                runs = int(value)
+            elif option in ('-s', '--save'):
+                save_file = value
+            elif option in ('-c', '--compare'):
+                compare_file = value
+            elif option in ('-t', '--tolerance'):
+                tolerance = float(value.rstrip('%'))
+            elif option in ('-h', '--help'):
+                usage(__doc__)
+                return
+    except Exception as e:
+        warning("Error: Failed to parse command line arguments! (%s)", e)
+        sys.exit(1)
+    results = dict((name, measure(code, runs)) for name, code in ENTRY_PATHS)
+    baseline = {}
+    if compare_file:
+        with open(compare_file) as handle:
+            baseline = json.load(handle)
+    rows = []
+    regressions = []
+    for name, code in ENTRY_PATHS:
+        stats = results[name]
+        row = [name, stats['modules'], format_timespan(stats['import_time']), format_timespan(stats['wall_time'])]
+        if name in baseline:
+            change = (stats['import_time'] / baseline[name]['import_time'] - 1) * 100
+            row.append('%+.0f%%' % change)
+            if change > tolerance:
+                regressions.append(name)
+        rows.append(row)
+    columns = ['Entry path', 'Modules', 'Import time', 'Wall time']
+    print(format_pretty_table(rows, columns + (['Change'] if baseline else [])))
+    if save_file:
+        with open(save_file, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+    if regressions:
+        warning("Error: Import time regressed by more than %s%% for: %s", tolerance, ', '.join(regressions))
+        sys.exit(1)
+
+
+def measure(code, runs):
+    """
+    Start an entry path in new interpreters and report the fastest run.
+
+    :param code: The Python code that runs the entry path (a string).
+    :param runs: The number of runs (an integer).
+    :returns: A dictionary with the keys ``modules`` (the number of imported
+              modules), ``import_time`` and ``wall_time`` (floats, in seconds).
+    """
+    fastest = None
+    with open(os.devnull, 'wb') as devnull:
+        for i in range(runs):
+            start_time = time.time()
+            process = subprocess.Popen(
+                [sys.executable, '-X', 'importtime', '-c', code],
+                stdout=devnull, stderr=subprocess.PIPE,
+            )
+            _, stderr = process.communicate()
+            wall_time = time.time() - start_time
+            if process.returncode != 0:
+                raise Exception("Entry path failed! (%s)" % stderr.decode('UTF-8'))
+            # Lines look like 'import time:  self [us] | cumulative | module'.
+            pattern = re.compile(r'^import time:\s+(\d+) \|', re.MULTILINE)
+            self_times = [int(m.group(1)) for m in pattern.finditer(stderr.decode('UTF-8'))]
+            stats = dict(modules=len(self_times), import_time=sum(self_times) / 1e6, wall_time=wall_time)
+            if fastest is None or stats['import_time'] < fastest['import_time']:
+                fastest = stats
+    return fastest
+
+
+if __name__ == '__main__':
+    main()
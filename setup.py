@@ -3,7 +3,7 @@
 # Setup script for the `crypto-drive-manager' package.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: January 5, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-crypto-drive-manager
 
 """
@@ -48,6 +48,8 @@ def get_install_requires():
     if 'bdist_wheel' not in sys.argv:
         if sys.version_info[:2] < (3, 4):
             install_requires.append('enum34 >= 1.1.6')
+        if sys.version_info[0] == 2:
+            install_requires.append('futures >= 3.0.5')
     return sorted(install_requires)
 
 
@@ -64,6 +66,7 @@ def get_extras_require():
             'python_version == "3.3"',
         ])
         extras_require[expression] = ['enum34 >= 1.1.6']
+        extras_require[':python_version == "2.6" or python_version == "2.7"'] = ['futures >= 3.0.5']
     return extras_require
 
 